@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+"""
+Read-through disk cache for the HTTP downloaders. Responses are stored, keyed
+by url and by the request headers they vary on, with their headers, and are
+served from the cache for as long as Cache-Control and Expires say they are
+fresh. Stale responses are revalidated with their ETag or Last-Modified
+validators.
+
+The cache directory can be shared by several processes. Entries are written to
+temporary files and renamed into place, so readers never see a partial entry,
+and the least recently used entries are evicted once the cache grows beyond its
+maximum size.
+
+Each entry is a pair of files: ``<key>.meta``, the JSON metadata, which names
+``<key>-<id>.body``, the response body. The body is kept in a file of its own
+so that it can be copied, or reflinked, to destinations by the kernel.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform
+    fcntl = None
+
+from requests.structures import CaseInsensitiveDict
+
+
+_LOG = logging.getLogger(__name__)
+
+# how a download was served, see DownloadReport.cache_status
+CACHE_HIT = 'hit'  # served from the cache, without a request
+CACHE_REVALIDATED = 'revalidated'  # served from the cache after a 304 response
+CACHE_MISS = 'miss'  # fetched from the server
+CACHE_STATUSES = (CACHE_HIT, CACHE_REVALIDATED, CACHE_MISS)
+
+# share of the time since the last modification a response without an explicit
+# lifetime is considered fresh for, as suggested by RFC 7234, and its maximum
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 86400  # seconds
+# cached response headers that are replaced by those of a 304 response
+_HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                                 'proxy-authorization', 'te', 'trailers', 'transfer-encoding',
+                                 'upgrade', 'content-length'])
+# bodies and temporary files that no entry refers to are removed after this long
+ORPHAN_GRACE_TIME = 3600  # seconds
+# eviction shrinks the cache to this share of its maximum size
+EVICTION_TARGET = 0.9
+
+META_SUFFIX = '.meta'
+BODY_SUFFIX = '.body'
+TEMP_PREFIX = '.tmp-'
+LOCK_NAME = '.lock'
+
+
+def parse_cache_control(value):
+    """
+    :param value: value of a Cache-Control header
+    :type  value: str or None
+    :return: directives, lower case, mapped to their value, or None if they have none
+    :rtype:  dict
+    """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, sep, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if sep else None
+    return directives
+
+
+def credentials_scope(config):
+    """
+    Scope of the cached responses to the requests made with a configuration:
+    responses to requests made with other credentials, basic auth or client
+    certificate, are kept apart, since they may differ.
+
+    :param config: downloader configuration
+    :type  config: nectar.config.DownloaderConfig
+    :return: hex digest, or an empty string for requests without credentials
+    :rtype:  str
+    """
+    credentials = [config.basic_auth_username, config.basic_auth_password]
+    for path in (config.ssl_client_cert_path, config.ssl_client_key_path):
+        if path is not None:
+            with open(path, 'rb') as handle:
+                credentials.append(handle.read())
+    if not any(credentials):
+        return ''
+    digest = hashlib.sha256()
+    for value in credentials:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest.update('\0' + (value or ''))
+    return digest.hexdigest()
+
+
+def _seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value):
+    parsed = parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _vary_names(response_headers):
+    return sorted(set(name.strip().lower()
+                      for name in response_headers.get('vary', '').split(',') if name.strip()))
+
+
+class CacheEntry(object):
+    """
+    Cached response.
+
+    :ivar url:       url of the response
+    :ivar headers:   response headers
+    :ivar size:      size of the body, in bytes
+    :ivar stored_at: time, as returned by time.time(), the response was stored or last
+                     revalidated
+    :ivar body_path: path of the body
+    """
+
+    def __init__(self, cache, key, meta):
+        self.cache = cache
+        self.key = key
+        self.url = meta['url']
+        self.headers = CaseInsensitiveDict(meta['headers'])
+        self.vary = meta['vary']
+        self.size = meta['size']
+        self.stored_at = meta['stored_at']
+        self.body_path = os.path.join(cache.directory, meta['body'])
+
+    @property
+    def freshness_lifetime(self):
+        """
+        :return: number of seconds the response is fresh for after it was sent
+        :rtype:  int
+        """
+        directives = parse_cache_control(self.headers.get('cache-control'))
+        if 'no-cache' in directives:
+            return 0
+        max_age = _seconds(directives.get('max-age'))
+        if max_age is not None:
+            return max_age
+        date = _http_date(self.headers.get('date')) or self.stored_at
+        expires = _http_date(self.headers.get('expires'))
+        if expires is not None:
+            return max(expires - date, 0)
+        if 'expires' in self.headers:  # invalid dates mean already expired
+            return 0
+        last_modified = _http_date(self.headers.get('last-modified'))
+        if last_modified is not None:
+            return min(int((date - last_modified) * HEURISTIC_FRACTION), MAX_HEURISTIC_LIFETIME)
+        return 0
+
+    @property
+    def age(self):
+        """
+        :return: number of seconds since the response was sent by the origin server
+        :rtype:  float
+        """
+        return max(time.time() - self.stored_at, 0) + (_seconds(self.headers.get('age')) or 0)
+
+    def is_fresh(self, request_headers=None):
+        """
+        :param request_headers: headers of the request, whose Cache-Control can
+                                ask for a fresher response
+        :type  request_headers: dict
+        :return: True if the response can be used without revalidating it
+        :rtype:  bool
+        """
+        request_headers = CaseInsensitiveDict(request_headers or {})
+        directives = parse_cache_control(request_headers.get('cache-control'))
+        if 'no-cache' in directives or request_headers.get('pragma') == 'no-cache':
+            return False
+        lifetime = self.freshness_lifetime
+        max_age = _seconds(directives.get('max-age'))
+        if max_age is not None:
+            lifetime = min(lifetime, max_age)
+        return self.age < lifetime
+
+    def validators(self):
+        """
+        :return: headers that make a request conditional on the response having
+                 changed, empty if the response has no validators
+        :rtype:  dict
+        """
+        headers = {}
+        if self.headers.get('etag'):
+            headers['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified'):
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+    def open(self):
+        """
+        Open the body for reading, and mark the entry as used.
+
+        :return: open file, or None if the entry has been evicted or replaced
+        :rtype:  file or None
+        """
+        try:
+            handle = open(self.body_path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        self.cache._touch(self.key)
+        return handle
+
+
+class CacheWriter(object):
+    """
+    Writes a response to a temporary file in the cache, which is added to the
+    cache when committed.
+    """
+
+    def __init__(self, cache, key, meta):
+        self.cache = cache
+        self.key = key
+        self.meta = meta
+        self.size = 0
+        self._handle = cache._temp_file()
+
+    def write(self, data):
+        if self._handle is None:
+            return
+        self.size += len(data)
+        if self.cache.max_size is not None and self.size > self.cache.max_size:
+            # too big to ever be cached
+            self.abort()
+            return
+        try:
+            self._handle.write(data)
+        except (IOError, OSError) as e:
+            # the download goes on without being cached
+            _LOG.warning('Unable to cache %s: %s' % (self.meta['url'], e))
+            self.abort()
+
+    def commit(self):
+        """
+        Add the response to the cache, replacing an earlier one for the same key.
+        """
+        if self._handle is None:
+            return
+        handle, self._handle = self._handle, None
+        try:
+            handle.close()
+            self.meta['size'] = self.size
+            self.meta['stored_at'] = time.time()
+            self.cache._commit(self.key, handle.name, self.meta)
+        except (IOError, OSError) as e:
+            _LOG.warning('Unable to cache %s: %s' % (self.meta['url'], e))
+            _unlink(handle.name)
+
+    def abort(self):
+        if self._handle is None:
+            return
+        handle, self._handle = self._handle, None
+        handle.close()
+        _unlink(handle.name)
+
+
+class HTTPCache(object):
+    """
+    Disk cache of HTTP responses.
+
+    :ivar directory: cache directory
+    :ivar max_size:  maximum size of the cached bodies, in bytes, or None for no limit
+    """
+
+    def __init__(self, directory, max_size=None):
+        """
+        :param directory: cache directory, created if it does not exist
+        :type  directory: str
+        :param max_size:  maximum size of the cached bodies, in bytes
+        :type  max_size:  int
+        """
+        self.directory = directory
+        self.max_size = max_size
+        # size of the cache as last measured, plus what has been added since
+        self._estimated_size = None
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def _key(url, scope):
+        return hashlib.sha256('\0'.join((scope, url))).hexdigest()
+
+    def lookup(self, url, request_headers, scope=''):
+        """
+        Find the cached response to a request.
+
+        :param url:             url of the request
+        :type  url:             str
+        :param request_headers: headers of the request, matched against those
+                                the response varies on
+        :type  request_headers: dict
+        :param scope:           separates the responses to requests that get
+                                different ones, such as with other credentials
+        :type  scope:           str
+        :return: cached response, or None
+        :rtype:  CacheEntry or None
+        """
+        request_headers = CaseInsensitiveDict(request_headers)
+        if 'no-store' in parse_cache_control(request_headers.get('cache-control')):
+            return None
+        key = self._key(url, scope)
+        meta = self._read_meta(key)
+        if meta is None or meta['url'] != url:
+            return None
+        for name, value in meta['vary'].items():
+            if request_headers.get(name) != value:
+                return None
+        return CacheEntry(self, key, meta)
+
+    def writer(self, url, request_headers, status_code, response_headers, scope=''):
+        """
+        Return a writer to store a response in the cache with, if it can be
+        cached.
+
+        :param url:              url of the request
+        :type  url:              str
+        :param request_headers:  headers of the request
+        :type  request_headers:  dict
+        :param status_code:      status code of the response
+        :type  status_code:      int
+        :param response_headers: headers of the response
+        :type  response_headers: dict
+        :param scope:            see lookup
+        :type  scope:            str
+        :return: writer for the response's body, or None if it can't be cached
+        :rtype:  CacheWriter or None
+        """
+        request_headers = CaseInsensitiveDict(request_headers)
+        response_headers = CaseInsensitiveDict(response_headers)
+        if status_code != 200 or 'range' in request_headers:
+            return None
+        if 'no-store' in parse_cache_control(request_headers.get('cache-control')) or \
+                'no-store' in parse_cache_control(response_headers.get('cache-control')):
+            return None
+        vary = _vary_names(response_headers)
+        if '*' in vary:
+            return None
+        length = _seconds(response_headers.get('content-length'))
+        if self.max_size is not None and length is not None and length > self.max_size:
+            return None
+
+        headers = dict((name, value) for name, value in response_headers.items()
+                       if name.lower() not in _HOP_BY_HOP_HEADERS)
+        meta = {
+            'url': url,
+            'headers': headers,
+            'vary': dict((name, request_headers.get(name)) for name in vary),
+        }
+        try:
+            return CacheWriter(self, self._key(url, scope), meta)
+        except (IOError, OSError) as e:
+            _LOG.warning('Unable to cache %s: %s' % (url, e))
+            return None
+
+    def revalidated(self, entry, response_headers):
+        """
+        Update a cached response with the headers of a 304 response to a
+        request conditional on it.
+
+        :param entry:            cached response
+        :type  entry:            CacheEntry
+        :param response_headers: headers of the 304 response
+        :type  response_headers: dict
+        :return: updated entry
+        :rtype:  CacheEntry
+        """
+        meta = self._read_meta(entry.key)
+        if meta is None or os.path.join(self.directory, meta['body']) != entry.body_path:
+            # replaced or evicted in the meantime
+            return entry
+        headers = CaseInsensitiveDict(meta['headers'])
+        for name, value in response_headers.items():
+            if name.lower() not in _HOP_BY_HOP_HEADERS:
+                headers[name] = value
+        meta['headers'] = dict(headers.items())
+        meta['stored_at'] = time.time()
+        try:
+            self._write_meta(entry.key, meta)
+        except (IOError, OSError) as e:
+            _LOG.warning('Unable to update the cached %s: %s' % (entry.url, e))
+        return CacheEntry(self, entry.key, meta)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is below its
+        maximum size, as well as files left behind by interrupted writes. It
+        does nothing if another process is already evicting.
+        """
+        lock = self._lock()
+        if lock is None:
+            return
+        try:
+            self._evict()
+        finally:
+            lock.close()
+
+    # -- files -----------------------------------------------------------------
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=TEMP_PREFIX, delete=False)
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key + META_SUFFIX), 'rb') as handle:
+                return json.load(handle)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                _LOG.warning('Unable to read the cache entry %s: %s' % (key, e))
+        except ValueError as e:
+            _LOG.warning('Corrupted cache entry %s: %s' % (key, e))
+        return None
+
+    def _write_meta(self, key, meta):
+        handle = self._temp_file()
+        try:
+            with handle:
+                json.dump(meta, handle)
+            os.rename(handle.name, self._path(key + META_SUFFIX))
+        except Exception:
+            _unlink(handle.name)
+            raise
+
+    def _commit(self, key, body_temp_path, meta):
+        body_name = '%s-%s%s' % (key, uuid.uuid4().hex, BODY_SUFFIX)
+        os.rename(body_temp_path, self._path(body_name))
+        old_meta = self._read_meta(key)
+        meta['body'] = body_name
+        try:
+            self._write_meta(key, meta)
+        except Exception:
+            _unlink(self._path(body_name))
+            raise
+        if old_meta is not None and old_meta['body'] != body_name:
+            # readers that already opened it keep reading it
+            _unlink(self._path(old_meta['body']))
+
+        if self.max_size is not None:
+            if self._estimated_size is None:
+                self._estimated_size = self._measure()
+            else:
+                self._estimated_size += meta['size']
+            if self._estimated_size > self.max_size:
+                self.evict()
+
+    def _touch(self, key):
+        # the modification time of the metadata is the time of last use
+        try:
+            os.utime(self._path(key + META_SUFFIX), None)
+        except OSError:
+            pass
+
+    def _lock(self):
+        if fcntl is None:
+            return open(os.devnull)
+        handle = open(self._path(LOCK_NAME), 'a')
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            handle.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return handle
+
+    def _scan(self):
+        """
+        :return: (last used, key, body name, size) of the entries, and the
+                 names and modification times of the other files
+        :rtype:  tuple of list
+        """
+        entries = []
+        others = []
+        for name in os.listdir(self.directory):
+            if name == LOCK_NAME:
+                continue
+            path = self._path(name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if name.endswith(META_SUFFIX) and not name.startswith(TEMP_PREFIX):
+                key = name[:-len(META_SUFFIX)]
+                meta = self._read_meta(key)
+                if meta is not None:
+                    entries.append((mtime, key, meta['body'], meta['size']))
+                    continue
+            others.append((name, mtime))
+        return entries, others
+
+    def _measure(self):
+        entries, others = self._scan()
+        return sum(size for mtime, key, body, size in entries)
+
+    def _evict(self):
+        entries, others = self._scan()
+
+        # bodies no entry refers to, and temporary files, once they are old
+        # enough not to be in the middle of being committed
+        referenced = set(body for mtime, key, body, size in entries)
+        cutoff = time.time() - ORPHAN_GRACE_TIME
+        for name, mtime in others:
+            if name not in referenced and mtime < cutoff:
+                _unlink(self._path(name))
+
+        size = sum(entry[3] for entry in entries)
+        if self.max_size is not None and size > self.max_size:
+            target = self.max_size * EVICTION_TARGET
+            for mtime, key, body, body_size in sorted(entries):
+                if size <= target:
+                    break
+                _unlink(self._path(key + META_SUFFIX))
+                _unlink(self._path(body))
+                size -= body_size
+        self._estimated_size = size
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            _LOG.warning('Unable to remove %s: %s' % (path, e))
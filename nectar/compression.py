@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming decompression of downloaded data, and of response bodies sent with
+a content coding.
+
+gzip and bzip2 are always available. xz requires the lzma module (or its
+backports.lzma backport), zstd requires the zstandard package and the br
+content coding requires a version of the brotli package whose decompressor
+can bound its output.
+"""
+
+import bz2
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+GZIP = 'gzip'
+BZIP2 = 'bz2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+# file name extensions, mapped to the compression they indicate
+EXTENSIONS = {'.gz': GZIP, '.bz2': BZIP2, '.xz': XZ, '.zst': ZSTD}
+
+# content codings of HTTP responses, besides gzip and zstd
+BROTLI = 'br'
+DEFLATE = 'deflate'
+IDENTITY = 'identity'
+# content codings transfers are negotiated with, the most preferred first
+CONTENT_CODINGS = (ZSTD, BROTLI, GZIP, DEFLATE)
+# bytes a content decoder produces at most at a time, by default
+DEFAULT_DECODE_LIMIT = 64 * 1024
+# magic number of a zstd frame
+ZSTD_MAGIC = 0xFD2FB528
+
+
+class UnsupportedCompression(ValueError):
+    """
+    Raised when a compression is unknown, or its module is not installed.
+    """
+
+
+class TruncatedCompression(ValueError):
+    """
+    Raised when compressed data ends before the end of its stream.
+    """
+
+
+def compression_from_name(name):
+    """
+    Guess the compression of a file from its name or url.
+
+    :param name: file name, path or url
+    :type  name: basestring
+    :return: compression, or None if the name does not indicate one
+    :rtype:  str or None
+    """
+    name = name.split('?', 1)[0].split('#', 1)[0]
+    for extension, compression in EXTENSIONS.items():
+        if name.endswith(extension):
+            return compression
+    return None
+
+
+def supported():
+    """
+    :return: the compressions whose modules are available
+    :rtype:  list of str
+    """
+    compressions = [GZIP, BZIP2]
+    if lzma is not None:
+        compressions.append(XZ)
+    if zstandard is not None:
+        compressions.append(ZSTD)
+    return compressions
+
+
+def decompressor(compression):
+    """
+    Build a streaming decompressor for the given compression.
+
+    :param compression: one of GZIP, BZIP2, XZ or ZSTD
+    :type  compression: str
+    :return: object with a decompress(data) method returning the decompressed
+             data available so far, and a finish() method raising
+             TruncatedCompression if the data ended before the end of the stream
+    :raises UnsupportedCompression: if the compression is unknown or unavailable
+    """
+    if compression == GZIP:
+        return _MultiStreamDecompressor(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    if compression == BZIP2:
+        return _MultiStreamDecompressor(bz2.BZ2Decompressor)
+    if compression == XZ and lzma is not None:
+        return _MultiStreamDecompressor(lzma.LZMADecompressor)
+    if compression == ZSTD and zstandard is not None:
+        return _ZstdDecompressor()
+    raise UnsupportedCompression(compression)
+
+
+def supported_content_codings():
+    """
+    :return: the content codings whose modules are available, the most
+             preferred first
+    :rtype:  list of str
+    """
+    codings = []
+    if zstandard is not None:
+        codings.append(ZSTD)
+    if _bounded_brotli():
+        codings.append(BROTLI)
+    return codings + [GZIP, DEFLATE]
+
+
+def _bounded_brotli():
+    # older versions of brotli decompress a chunk at once, however long its output
+    return brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data')
+
+
+def accept_encoding(codings):
+    """
+    :param codings: content codings a response may be sent with, the most
+                    preferred first; an empty list for none
+    :type  codings: list of str
+    :return: value of the Accept-Encoding header asking for those that are
+             available
+    :rtype:  str
+    """
+    available = supported_content_codings()
+    accepted = [c for c in codings if c in available]
+    return ', '.join(accepted) if accepted else IDENTITY
+
+
+class ContentDecoder(object):
+    """
+    Streaming decoder of a response body sent with the content codings of
+    its Content-Encoding header. It produces pieces of at most limit bytes,
+    so that a small, highly compressed chunk does not inflate into a large
+    string.
+    """
+
+    def __init__(self, content_encoding, limit=DEFAULT_DECODE_LIMIT):
+        """
+        :param content_encoding: value of the Content-Encoding header, or None
+        :type  content_encoding: str
+        :param limit:            bytes produced at most at a time
+        :type  limit:            int
+        :raises UnsupportedCompression: if a content coding is unknown or unavailable
+        """
+        codings = [c.strip().lower() for c in (content_encoding or '').split(',')]
+        # the codings were applied in order, they are undone in reverse
+        self._decoders = [_content_decoder(c, limit) for c in reversed(codings)
+                          if c not in ('', IDENTITY)]
+
+    def decoded(self, chunks):
+        """
+        Decode a body as its chunks are read, which is as the returned
+        iterator is.
+
+        :param chunks: chunks of the body
+        :type  chunks: iterable of str
+        :return: the decoded pieces; the iterator raises TruncatedCompression
+                 if the body ended before the end of a content coding's stream
+        :rtype:  iterator of str
+        """
+        for decoder in self._decoders:
+            chunks = decoder.decoded(chunks)
+        return (piece for piece in chunks if piece)
+
+
+def _content_decoder(coding, limit):
+    if coding in (GZIP, 'x-gzip'):
+        return _ZlibDecoder(16 + zlib.MAX_WBITS, limit)
+    if coding == DEFLATE:
+        return _ZlibDecoder(None, limit)
+    if coding == ZSTD and zstandard is not None:
+        return _ZstdDecoder(limit)
+    if coding == BROTLI and _bounded_brotli():
+        return _BrotliDecoder(limit)
+    raise UnsupportedCompression(coding)
+
+
+class _PushDecoder(object):
+    """
+    Base class of the content decoders that are handed the chunks of the
+    body one at a time, by decode, and then told it ended, by flush.
+    """
+
+    def decoded(self, chunks):
+        for chunk in chunks:
+            for piece in self.decode(chunk):
+                yield piece
+        for piece in self.flush():
+            yield piece
+
+
+class _ZlibDecoder(_PushDecoder):
+    """
+    Decoder of the gzip and deflate content codings, that produces at most
+    limit bytes at a time. A gzip body may have several members.
+    """
+
+    def __init__(self, wbits, limit):
+        """
+        :param wbits: zlib window bits, or None for deflate, whose zlib wrapper
+                      some servers leave out
+        :type  wbits: int
+        :param limit: bytes produced at most at a time
+        :type  limit: int
+        """
+        self._wbits = wbits
+        self._limit = limit
+        self._head = ''
+        self._decompressor = None if wbits is None else zlib.decompressobj(wbits)
+        self._started = False
+        self._ended = False
+
+    def decode(self, data):
+        if data:
+            self._started = True
+        if self._decompressor is None:
+            self._head += data
+            if len(self._head) < 2:
+                return
+            data, self._head = self._head, ''
+            first, second = ord(data[0]), ord(data[1])
+            wrapped = first & 0x0f == 8 and ((first << 8) + second) % 31 == 0
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS if wrapped
+                                                    else -zlib.MAX_WBITS)
+        while True:
+            output = self._decompressor.decompress(data, self._limit)
+            if output:
+                yield output
+            if self._decompressor.unused_data:
+                # the end of the stream, which python 2 also leaves as its
+                # unconsumed tail
+                if self._wbits is None:
+                    self._ended = True
+                    return
+                # the next gzip member
+                data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(self._wbits)
+                continue
+            data = self._decompressor.unconsumed_tail
+            if not data and len(output) < self._limit:
+                return
+
+    def flush(self):
+        # an empty body, as sent with some responses without content, is fine
+        if not self._started:
+            return
+        if self._decompressor is None or \
+                not (self._ended or _stream_ended(self._decompressor)):
+            raise TruncatedCompression('Body ended before the end of the stream')
+        output = self._decompressor.flush()
+        if output:
+            yield output
+
+
+class _BrotliDecoder(_PushDecoder):
+    """
+    Decoder of the br content coding, that produces no more than a few times
+    limit bytes at a time; brotli stops growing its output buffer, in steps,
+    once it reaches the limit.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: size brotli's output buffer stops growing at
+        :type  limit: int
+        """
+        self._limit = limit
+        self._decompressor = brotli.Decompressor()
+        self._started = False
+
+    def decode(self, data):
+        if data:
+            self._started = True
+        output = self._decompressor.process(data, output_buffer_limit=self._limit)
+        while output:
+            yield output
+            # the rest of the output is taken with no more input
+            output = self._decompressor.process('', output_buffer_limit=self._limit)
+
+    def flush(self):
+        if self._started and not self._decompressor.is_finished():
+            raise TruncatedCompression('Body ended before the end of the stream')
+        return iter(())
+
+
+class _ZstdDecoder(object):
+    """
+    Decoder of the zstd content coding, that produces at most limit bytes at
+    a time. zstandard's decompressors only bound their output when they read
+    the body from a source themselves, as a stream reader does.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: bytes produced at most at a time
+        :type  limit: int
+        """
+        self._limit = limit
+
+    def decoded(self, chunks):
+        source = _ZstdFrameSource(chunks)
+        reader = zstandard.ZstdDecompressor().stream_reader(source)
+        while True:
+            output = reader.read(self._limit)
+            if not output:
+                break
+            yield output
+        # an empty body, as sent with some responses without content, is fine
+        if source.started and not source.frame_ended:
+            raise TruncatedCompression('Body ended before the end of the frame')
+
+
+class _ZstdFrameSource(object):
+    """
+    File-like object a zstd stream reader reads the chunks of a body from. The
+    reader does not tell whether the frame ended, so the source follows the
+    headers of the frame and of its blocks as they are read.
+
+    :ivar started:     whether the body had any data
+    :ivar frame_ended: whether the data read so far has the end of the frame
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.started = False
+        self.frame_ended = False
+        # the header being read, the bytes to skip until the next one, and
+        # the size of the frame's checksum, once its header was read
+        self._header = ''
+        self._skip = 0
+        self._checksum_size = None
+        self._last_block = False
+
+    def read(self, size=-1):
+        for chunk in self._chunks:
+            if chunk:
+                self.started = True
+                self._follow(chunk)
+                return chunk
+        return ''
+
+    def _follow(self, data):
+        while not self.frame_ended:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+            if self._skip:
+                return
+            if self._last_block:
+                self.frame_ended = True
+                return
+            if not data:
+                return
+            # the start of the frame header, then the headers of the blocks
+            size = 5 if self._checksum_size is None else 3
+            missing = size - len(self._header)
+            self._header += data[:missing]
+            data = data[missing:]
+            if len(self._header) < size:
+                return
+            header, self._header = self._header, ''
+            if self._checksum_size is None:
+                self._skip = self._frame_header(header)
+            else:
+                self._skip = self._block_header(header)
+
+    def _frame_header(self, header):
+        if struct.unpack('<I', header[:4])[0] != ZSTD_MAGIC:
+            # not a zstd frame, which the decompressor reports
+            self.frame_ended = True
+            return 0
+        descriptor = ord(header[4])
+        single_segment = descriptor >> 5 & 1
+        content_size_size = (single_segment, 2, 4, 8)[descriptor >> 6]
+        dictionary_id_size = (0, 1, 2, 4)[descriptor & 3]
+        self._checksum_size = 4 if descriptor >> 2 & 1 else 0
+        # the rest of the frame header
+        return 1 - single_segment + dictionary_id_size + content_size_size
+
+    def _block_header(self, header):
+        value = ord(header[0]) | ord(header[1]) << 8 | ord(header[2]) << 16
+        # an RLE block is a single byte repeated
+        size = 1 if value >> 1 & 3 == 1 else value >> 3
+        if value & 1:
+            self._last_block = True
+            size += self._checksum_size
+        return size
+
+
+class _MultiStreamDecompressor(object):
+    """
+    Decompressor for formats that allow several compressed streams to be
+    concatenated, like the output of ``pigz`` or ``pbzip2``. A new decompressor
+    is started on whatever data follows the end of a stream.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, data):
+        pieces = []
+        while data:
+            pieces.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._factory()
+        return ''.join(pieces)
+
+    def finish(self):
+        """
+        :raises TruncatedCompression: if the data ended before the end of the
+                last stream
+        """
+        if not _stream_ended(self._decompressor):
+            raise TruncatedCompression('Compressed data ended before the end of the stream')
+
+
+def _stream_ended(decompressor):
+    # lzma says whether the end of the stream was reached
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # zlib leaves the data that follows the end of the stream unused, and bz2
+    # refuses it; the probe byte spoils a stream that did not end, which is
+    # truncated anyway
+    try:
+        if hasattr(decompressor, 'copy'):
+            probe = decompressor.copy()
+            probe.decompress('\0')
+            return bool(probe.unused_data)
+        decompressor.decompress('\0')
+    except EOFError:
+        return True
+    except (IOError, zlib.error):
+        pass
+    return False
+
+
+class _ZstdDecompressor(object):
+    """
+    Decompressor for zstd, whose end of frame is checked by finish.
+    """
+
+    def __init__(self):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def finish(self):
+        """
+        :raises TruncatedCompression: if the data ended before the end of the frame
+        """
+        ended = getattr(self._decompressor, 'eof', None)
+        if ended is None:
+            # older versions of zstandard refuse any data once the frame ended
+            try:
+                self._decompressor.decompress('')
+            except zstandard.ZstdError:
+                ended = True
+        if not ended:
+            raise TruncatedCompression('Compressed data ended before the end of the frame')
+
+
+class DecompressingWriter(object):
+    """
+    Write-only file-like object that decompresses the data written to it, as it
+    is written, into another file-like object. The compressed data can also be
+    written, unchanged, to a second file-like object.
+
+    :ivar bytes_written:      number of compressed bytes written
+    :ivar bytes_decompressed: number of decompressed bytes produced
+    """
+
+    def __init__(self, compression, file_handle, compressed_file_handle=None):
+        """
+        :param compression:            one of GZIP, BZIP2, XZ or ZSTD
+        :type  compression:            str
+        :param file_handle:            file-like object the decompressed data is written to
+        :param compressed_file_handle: optional file-like object the compressed data is
+                                       written to
+        """
+        self.compression = compression
+        self.file_handle = file_handle
+        self.compressed_file_handle = compressed_file_handle
+        self.bytes_written = 0
+        self.bytes_decompressed = 0
+        self._decompressor = decompressor(compression)
+
+    def write(self, data):
+        if self.compressed_file_handle is not None:
+            self.compressed_file_handle.write(data)
+        self.bytes_written += len(data)
+
+        decompressed = self._decompressor.decompress(data)
+        if decompressed:
+            self.file_handle.write(decompressed)
+            self.bytes_decompressed += len(decompressed)
+
+    def flush(self):
+        if self.compressed_file_handle is not None:
+            self.compressed_file_handle.flush()
+        self.file_handle.flush()
+
+    def finish(self):
+        """
+        Check that all the compressed data was written.
+
+        :raises TruncatedCompression: if the data ended before the end of the stream
+        """
+        self._decompressor.finish()
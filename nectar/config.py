@@ -5,6 +5,8 @@ import tempfile
 
 import requests.auth
 
+from nectar import fastcopy, staging
+
 
 class DownloaderConfig(object):
     """
@@ -19,13 +21,18 @@ class DownloaderConfig(object):
             ssl_validation=True, proxy_url=None, proxy_port=None, proxy_username=None,
             proxy_password=None, max_speed=None, headers=None, buffer_size=None,
             progress_interval=None, use_hard_links=False, use_sym_links=False,
-            connect_timeout=6.05, read_timeout=27, working_dir="/tmp", stream=False):
+            connect_timeout=6.05, read_timeout=27, working_dir="/tmp", stream=False,
+            staged_writes=False, durability=None, link_strategies=None, skip_identical=False,
+            shared_connections=False, cache_dir=None, cache_max_size=None, deadline=None,
+            min_speed=None, min_speed_window=None, hedge_percentile=None, hedge_budget=None,
+            journal_path=None, write_behind_threads=None, write_behind_budget=None):
         """
         Initialize the DownloaderConfig. All parameters are optional. Not all downloaders use each
         of the configuration items, so for each parameter documented below, the downloaders that
         use it are listed in parenthesis.
 
-        :param max_concurrent:       maximum number of downloads to run concurrently (Threaded)
+        :param max_concurrent:       maximum number of downloads to run concurrently (Threaded,
+                                     Local)
         :type  max_concurrent:       int
         :param basic_auth_username:  http basic auth username (basic_auth_password must also be
                                      provided) (Threaded)
@@ -106,6 +113,79 @@ class DownloaderConfig(object):
         :param stream:               If true, the raw response is returned. If false, a decoded
                                      response is returned.
         :type stream:                bool
+        :param staged_writes:        If True, downloads to a path are written to a temporary file in
+                                     the same directory, preallocated to the expected size, which
+                                     atomically replaces the destination once the download has
+                                     succeeded. Failed downloads leave the destination untouched.
+                                     Defaults to False. (Threaded, Local)
+        :type  staged_writes:        bool
+        :param durability:           How staged writes are flushed to disk. None (the default)
+                                     leaves it to the operating system; 'file' fsyncs each file and
+                                     its directory before the download is reported; 'batch'
+                                     fdatasyncs each file, but fsyncs each directory only once, at
+                                     the end of the call to download. (Threaded, Local)
+        :type  durability:           str
+        :param link_strategies:      Strategies to put local files in place with, tried in order
+                                     until one succeeds; out of 'reflink', 'hardlink', 'symlink',
+                                     'copy' (copied by the kernel) and 'buffered' (copied through
+                                     Python). Overrides use_hard_links and use_sym_links. (Local)
+        :type  link_strategies:      list of str
+        :param skip_identical:       If True, local files are not put in place when the
+                                     destination already is the same file, or has the same size
+                                     and modification time. Requires link_strategies. Defaults to
+                                     False. (Local)
+        :type  skip_identical:       bool
+        :param shared_connections:   If True, connections are borrowed from pools shared by all the
+                                     downloaders of the process whose configurations have the same
+                                     TLS material, proxy and credentials, rather than opened for
+                                     this downloader alone. Defaults to False. (Threaded)
+        :type  shared_connections:   bool
+        :param cache_dir:            Directory of a disk cache of the HTTP responses, which can be
+                                     shared by several processes. Responses are served from it for
+                                     as long as their Cache-Control or Expires headers allow, and
+                                     revalidated with the server after that. Defaults to None, for
+                                     no cache. (Threaded)
+        :type  cache_dir:            str
+        :param cache_max_size:       Size, in bytes, beyond which the least recently used responses
+                                     are evicted from the cache. Defaults to None, for no limit.
+                                     (Threaded)
+        :type  cache_max_size:       int
+        :param deadline:             Number of seconds a worker may spend fetching a request, all
+                                     its attempts included, after which it fails. Defaults to
+                                     None, for no deadline. (Threaded)
+        :type  deadline:             float
+        :param min_speed:            Throughput, in bytes per second, below which a transfer is
+                                     considered stalled; it is aborted and retried, on the next of
+                                     the request's mirrors if it has any. Defaults to None, for no
+                                     minimum. (Threaded)
+        :type  min_speed:            int
+        :param min_speed_window:     Number of seconds the throughput compared to min_speed is
+                                     measured over. Defaults to 30. (Threaded)
+        :type  min_speed_window:     float
+        :param hedge_percentile:     If set, a request that is slower than this percentile of the
+                                     requests that succeeded is hedged: a duplicate of it is
+                                     started, from the next of its mirrors if it has any, and
+                                     whichever finishes first is kept. Defaults to None, for no
+                                     hedging. (Threaded)
+        :type  hedge_percentile:     float
+        :param hedge_budget:         Share of the requests, between 0 and 1, that may be hedged.
+                                     Defaults to 0.05. (Threaded)
+        :type  hedge_budget:         float
+        :param journal_path:         Path of a journal the completed downloads are recorded in.
+                                     Requests it records as done, whose destinations are still in
+                                     place, are skipped, so that a batch that was interrupted
+                                     resumes where it stopped. Defaults to None, for no journal.
+                                     (Threaded, Local, Process)
+        :type  journal_path:         str
+        :param write_behind_threads: If set, the number of I/O threads the downloaded chunks are
+                                     written to their destinations by, so that the workers reading
+                                     them off the network do not wait on a slow disk. Defaults to
+                                     None, for the workers to write them. (Threaded)
+        :type  write_behind_threads: int
+        :param write_behind_budget:  Bytes of chunks that wait for the I/O threads, at most;
+                                     workers wait for room beyond that. Defaults to 16 MiB.
+                                     (Threaded)
+        :type  write_behind_budget:  int
         """
         self.max_concurrent = max_concurrent
         self.basic_auth_username = basic_auth_username
@@ -132,10 +212,34 @@ class DownloaderConfig(object):
         self.read_timeout = read_timeout
         self.working_dir = working_dir
         self.stream = stream
+        self.staged_writes = staged_writes
+        self.durability = durability
+        self.link_strategies = link_strategies
+        self.skip_identical = skip_identical
+        self.shared_connections = shared_connections
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.deadline = deadline
+        self.min_speed = min_speed
+        self.min_speed_window = min_speed_window
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.journal_path = journal_path
+        self.write_behind_threads = write_behind_threads
+        self.write_behind_budget = write_behind_budget
 
         # concurrency options
         self._process_concurrency()
 
+        # transfer limits
+        self._process_transfer_limits()
+
+        # staged write options
+        self._process_durability()
+
+        # local file options
+        self._process_link_strategies()
+
         # ssl file options
         self._process_ssl_settings()
 
@@ -143,11 +247,45 @@ class DownloaderConfig(object):
         """
         Assert that either the concurrency is unspecified or that it is a positive integer.
         """
-        if self.max_concurrent is None:
+        for name in ('max_concurrent', 'write_behind_threads', 'write_behind_budget'):
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise ValueError('%s must be greater than 0' % name)
+
+    def _process_transfer_limits(self):
+        """
+        Assert that the transfer limits are either unspecified or positive, and
+        that the hedging settings are within their ranges.
+        """
+        for name in ('deadline', 'min_speed', 'min_speed_window'):
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise ValueError('%s must be greater than 0' % name)
+
+        if self.hedge_percentile is not None and not 0 < self.hedge_percentile < 100:
+            raise ValueError('hedge_percentile must be between 0 and 100')
+        if self.hedge_budget is not None and not 0 < self.hedge_budget <= 1:
+            raise ValueError('hedge_budget must be greater than 0, and at most 1')
+
+    def _process_durability(self):
+        """
+        Assert that the durability is one of the supported values.
+        """
+        if self.durability not in staging.DURABILITIES:
+            raise ValueError('durability must be one of: %s' %
+                             ', '.join(str(d) for d in staging.DURABILITIES))
+
+    def _process_link_strategies(self):
+        """
+        Assert that the link strategies are all supported.
+        """
+        if self.link_strategies is None:
             return
 
-        if self.max_concurrent <= 0:
-            raise ValueError('max_concurrent must be greater than 0')
+        for strategy in self.link_strategies:
+            if strategy not in fastcopy.STRATEGIES:
+                raise ValueError('link_strategies must be some of: %s' %
+                                 ', '.join(fastcopy.STRATEGIES))
 
     def _process_ssl_settings(self):
         """
@@ -189,6 +327,13 @@ class DownloaderConfig(object):
     def __del__(self):
         self.finalize()
 
+    def __getstate__(self):
+        # copies, including the ones sent to other processes, must not delete
+        # the original's temporary files when they are finalized
+        state = self.__dict__.copy()
+        state['_temp_files'] = []
+        return state
+
     def finalize(self):
         """
         Delete any persistent state.
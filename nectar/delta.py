@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Delta updates of large files that change only partly between downloads, such
+as VM images and sqlite databases, in the manner of zsync.
+
+A block index of the new file, published next to it as a sidecar file, lists
+the digest of each of its fixed-size blocks. The blocks of the previous
+download that match are reused; only the others are fetched, with multi-range
+requests, and the new file is assembled, in order, from both. It is then
+checked against the digest of the whole file in the index.
+
+Blocks are matched at block boundaries only, rather than with a rolling
+checksum at every offset, which suits files that are rewritten in place.
+"""
+
+import hashlib
+import os
+import re
+
+from nectar import sink
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+BLOCK_DIGEST = 'sha1'
+FILE_DIGEST = 'sha256'
+# ranges asked for in a single request
+MAX_RANGES = 32
+# strategy of the reports of the requests updated with a delta
+STRATEGY_DELTA = 'delta'
+
+HEADER = 'nectar-block-index 1'
+# longest header line of a multipart/byteranges body
+MAX_LINE = 8192
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+
+class DeltaError(Exception):
+    """
+    Raised when a file cannot be updated with a delta, and has to be
+    downloaded in full instead.
+    """
+
+
+class BlockIndex(object):
+    """
+    Digests of the fixed-size blocks of a file, and of the whole file.
+
+    :ivar size:       size of the file in bytes
+    :ivar block_size: size of the blocks in bytes; the last one may be shorter
+    :ivar digest:     hex FILE_DIGEST digest of the file
+    :ivar blocks:     hex BLOCK_DIGEST digests of the blocks, in order
+    """
+
+    def __init__(self, size, block_size, digest, blocks):
+        self.size = size
+        self.block_size = block_size
+        self.digest = digest
+        self.blocks = blocks
+
+    @classmethod
+    def from_file(cls, source, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        :param source:     path of the file, or file-like object to read it from
+        :type  source:     str or file-like object
+        :param block_size: size of the blocks in bytes
+        :type  block_size: int
+        :return: block index of the file
+        :rtype:  BlockIndex
+        """
+        if isinstance(source, basestring):
+            with open(source, 'rb') as file_handle:
+                return cls.from_file(file_handle, block_size)
+        file_hash = hashlib.new(FILE_DIGEST)
+        blocks = []
+        size = 0
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            file_hash.update(block)
+            blocks.append(hashlib.new(BLOCK_DIGEST, block).hexdigest())
+        return cls(size, block_size, file_hash.hexdigest(), blocks)
+
+    @classmethod
+    def load(cls, source):
+        """
+        :param source: path of a sidecar file, or file-like object to read it from
+        :type  source: str or file-like object
+        :return: the block index in it
+        :rtype:  BlockIndex
+        :raises DeltaError: if it is not a valid block index
+        """
+        if isinstance(source, basestring):
+            with open(source, 'rb') as file_handle:
+                return cls.load(file_handle)
+        lines = source.read().splitlines()
+        if not lines or lines[0] != HEADER:
+            raise DeltaError('Not a block index')
+        try:
+            fields = dict(line.split(' ', 1) for line in lines[1:4])
+            index = cls(int(fields['size']), int(fields['block-size']),
+                        fields[FILE_DIGEST], lines[4:])
+        except (KeyError, ValueError):
+            raise DeltaError('Malformed block index')
+        if index.block_size <= 0 or index.size < 0 or \
+                len(index.blocks) != (index.size + index.block_size - 1) // index.block_size:
+            raise DeltaError('Malformed block index')
+        return index
+
+    def save(self, destination):
+        """
+        :param destination: path of the sidecar file, or file-like object to write it to
+        :type  destination: str or file-like object
+        """
+        if isinstance(destination, basestring):
+            with open(destination, 'wb') as file_handle:
+                return self.save(file_handle)
+        destination.write('%s\nsize %d\nblock-size %d\n%s %s\n' % (
+            HEADER, self.size, self.block_size, FILE_DIGEST, self.digest))
+        for block in self.blocks:
+            destination.write(block + '\n')
+
+    def block_length(self, block):
+        """
+        :return: length in bytes of the block at the given index
+        :rtype:  int
+        """
+        return min(self.block_size, self.size - block * self.block_size)
+
+    def plan(self, seed_path):
+        """
+        Match the blocks of the file against those of a local seed, such as
+        the previous download of the file.
+
+        :param seed_path: path of the seed
+        :type  seed_path: str
+        :return: which blocks are reused from the seed, and which are fetched
+        :rtype:  DeltaPlan
+        """
+        # offsets of the seed's blocks, by digest
+        offsets = {}
+        offset = 0
+        with open(seed_path, 'rb') as seed:
+            while True:
+                block = seed.read(self.block_size)
+                if not block:
+                    break
+                digest = hashlib.new(BLOCK_DIGEST, block).hexdigest()
+                offsets.setdefault((digest, len(block)), offset)
+                offset += len(block)
+
+        local = {}
+        for block, digest in enumerate(self.blocks):
+            seed_offset = offsets.get((digest, self.block_length(block)))
+            if seed_offset is not None:
+                local[block] = seed_offset
+        return DeltaPlan(self, seed_path, local)
+
+
+class DeltaPlan(object):
+    """
+    Blocks of a file that are reused from a local seed, and byte ranges of
+    the file that are fetched.
+
+    :ivar index:     block index of the file
+    :ivar seed_path: path of the seed
+    :ivar local:     offsets in the seed of the reused blocks, by block
+    :ivar spans:     (start, end) byte ranges that are fetched, end excluded, in order
+    """
+
+    def __init__(self, index, seed_path, local):
+        self.index = index
+        self.seed_path = seed_path
+        self.local = local
+        self.spans = []
+        for block in range(len(index.blocks)):
+            if block in local:
+                continue
+            start = block * index.block_size
+            end = start + index.block_length(block)
+            if self.spans and self.spans[-1][1] == start:
+                self.spans[-1] = (self.spans[-1][0], end)
+            else:
+                self.spans.append((start, end))
+
+    @property
+    def fetched_bytes(self):
+        return sum(end - start for start, end in self.spans)
+
+    @property
+    def reused_bytes(self):
+        return self.index.size - self.fetched_bytes
+
+    def batches(self, max_ranges=None):
+        """
+        :param max_ranges: ranges per batch, defaults to MAX_RANGES
+        :type  max_ranges: int
+        :return: the spans, in batches of at most max_ranges, each fetched
+                 with one request
+        :rtype:  list of lists of tuples
+        """
+        max_ranges = max_ranges or MAX_RANGES
+        return [self.spans[i:i + max_ranges] for i in range(0, len(self.spans), max_ranges)]
+
+
+def range_header(spans):
+    """
+    :param spans: (start, end) byte ranges, end excluded
+    :type  spans: list of tuples
+    :return: value of the Range header asking for them
+    :rtype:  str
+    """
+    return 'bytes=' + ','.join('%d-%d' % (start, end - 1) for start, end in spans)
+
+
+def parse_content_range(value):
+    """
+    :return: first and last byte of a Content-Range header value
+    :rtype:  tuple
+    :raises DeltaError: if it is not a byte range
+    """
+    match = _CONTENT_RANGE.match((value or '').strip())
+    if match is None:
+        raise DeltaError('Invalid Content-Range: %r' % value)
+    return int(match.group(1)), int(match.group(2))
+
+
+def iter_ranges(content_type, content_range, chunks):
+    """
+    Read the byte ranges of a 206 response.
+
+    :param content_type:  Content-Type header of the response
+    :type  content_type:  str
+    :param content_range: Content-Range header of the response, for a single range
+    :type  content_range: str
+    :param chunks:        chunks of the body of the response
+    :type  chunks:        iterator of str
+    :return: the offset in the file of each piece of the body, and the piece
+    :rtype:  iterator of tuples
+    :raises DeltaError: if the body is not what was asked for
+    """
+    content_type = content_type or ''
+    if not content_type.lower().startswith('multipart/byteranges'):
+        start, end = parse_content_range(content_range)
+        return _iter_range(start, end - start + 1, _Reader(chunks))
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise DeltaError('Multipart response without a boundary')
+    return _iter_parts(match.group(1), _Reader(chunks))
+
+
+def _iter_range(offset, length, reader):
+    for data in reader.read(length):
+        yield offset, data
+        offset += len(data)
+
+
+def _iter_parts(boundary, reader):
+    delimiter = '--' + boundary
+    while True:
+        line = reader.readline().strip()
+        # the preamble and the line breaks before each delimiter
+        while line not in (delimiter, delimiter + '--'):
+            line = reader.readline().strip()
+        if line == delimiter + '--':
+            return
+        content_range = None
+        while True:
+            line = reader.readline()
+            if not line.strip():
+                break
+            name, _sep, value = line.partition(':')
+            if name.strip().lower() == 'content-range':
+                content_range = value
+        start, end = parse_content_range(content_range)
+        for piece in _iter_range(start, end - start + 1, reader):
+            yield piece
+
+
+class _Reader(object):
+    """
+    Lines and lengths read off an iterator of chunks.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += chunk
+                return
+        raise DeltaError('Truncated response')
+
+    def readline(self):
+        while '\n' not in self._buffer:
+            if len(self._buffer) > MAX_LINE:
+                raise DeltaError('Line too long')
+            self._fill()
+        line, _sep, self._buffer = self._buffer.partition('\n')
+        return line + '\n'
+
+    def read(self, length):
+        while length:
+            if not self._buffer:
+                self._fill()
+            data = self._buffer[:length]
+            self._buffer = self._buffer[len(data):]
+            length -= len(data)
+            yield data
+
+
+class Assembler(object):
+    """
+    Writes the new file, in order, from the blocks of the seed and the
+    fetched ranges, and checks it against the digest of the whole file.
+    """
+
+    def __init__(self, plan, file_handle):
+        """
+        :param plan:        plan of the delta
+        :type  plan:        DeltaPlan
+        :param file_handle: file-like object the new file is written to
+        """
+        self.plan = plan
+        self.file_handle = file_handle
+        self.offset = 0
+        self._hash = hashlib.new(FILE_DIGEST)
+        self._seed = open(plan.seed_path, 'rb')
+
+    def _write(self, data):
+        self.file_handle.write(data)
+        self._hash.update(data)
+        self.offset += len(data)
+
+    def fill(self, end):
+        """
+        Write the blocks of the seed up to the given offset.
+        """
+        index = self.plan.index
+        while self.offset < end:
+            block = self.offset // index.block_size
+            seed_offset = self.plan.local.get(block)
+            if seed_offset is None or self.offset % index.block_size:
+                raise DeltaError('Missing the range at %d' % self.offset)
+            self._seed.seek(seed_offset)
+            data = self._seed.read(index.block_length(block))
+            if len(data) != index.block_length(block):
+                raise DeltaError('The seed changed')
+            self._write(data)
+
+    def remote(self, offset, data):
+        """
+        Write a piece of a fetched range.
+
+        :param offset: offset of the piece in the file
+        :type  offset: int
+        :param data:   the piece
+        :type  data:   str
+        """
+        if offset > self.offset:
+            self.fill(offset)
+        if offset != self.offset or offset + len(data) > self.plan.index.size:
+            raise DeltaError('Unexpected range at %d' % offset)
+        self._write(data)
+
+    def finish(self):
+        """
+        Write the remaining blocks of the seed, and check the file.
+
+        :raises nectar.sink.VerificationFailed: if the file does not match its digest
+        """
+        self.fill(self.plan.index.size)
+        if self._hash.hexdigest() != self.plan.index.digest:
+            raise sink.VerificationFailed('The assembled file does not match its %s digest'
+                                          % FILE_DIGEST)
+
+    def close(self):
+        self._seed.close()
+
+
+def write_index(path, index_path=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Write the block index of a file to a sidecar file, for publishing next to it.
+
+    :param path:       path of the file
+    :type  path:       str
+    :param index_path: path of the sidecar file, defaults to the path of the file
+                       with a .blocks extension
+    :type  index_path: str
+    :param block_size: size of the blocks in bytes
+    :type  block_size: int
+    :return: path of the sidecar file
+    :rtype:  str
+    """
+    index_path = index_path or path + '.blocks'
+    BlockIndex.from_file(path, block_size).save(index_path)
+    return index_path
+
+
+def seed_for(request):
+    """
+    :param request: download request
+    :type  request: nectar.request.DownloadRequest
+    :return: path of the previous download of the request, to update with a
+             delta, or None if it cannot be
+    :rtype:  str or None
+    """
+    if request.delta is None or request.decompress:
+        return None
+    if not isinstance(request.destination, basestring):
+        return None
+    if not os.path.isfile(request.destination):
+        return None
+    return request.destination
@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import Queue
+import sys
+import threading
 
-from nectar.listener import DownloadEventListener
+from nectar import journal, sink, staging
+from nectar.listener import DownloadEventListener, ReportQueueListener
+from nectar.report import DownloadReport
 
 
 _LOG = logging.getLogger(__name__)
 
+# reports iter_download holds before the downloader's workers wait for them to be consumed
+DEFAULT_REPORT_BUFFER_SIZE = 100
+# how often, in seconds, iter_download checks whether the download is over
+ITER_POLL_INTERVAL = 0.1
+# strategy recorded on the reports of requests the journal has as done, as
+# the local file downloader does for identical files
+SKIPPED = 'skipped'
+
 
 class Downloader(object):
     """
@@ -19,8 +33,13 @@ class Downloader(object):
     :ivar config: downloader configuration
     :ivar event_listener: event listener providing life-cycle callbacks.
     :ivar is_cancelled: boolean showing if the cancel method has been called.
+    :ivar journal_digests: whether the files recorded in the journal are
+                           digested as they are downloaded; only downloaders
+                           that write the bytes of each download themselves do
     """
 
+    journal_digests = False
+
     def __init__(self, config, event_listener=None):
         """
         :param config: configuration for this backend
@@ -34,6 +53,14 @@ class Downloader(object):
         # If False, no events will be fired to a listener. This is useful for
         # doing a synchronous download.
         self.fire_events = True
+        # directories with staged files moved into them that still need to be
+        # flushed to disk
+        self._unsynced_directories = set()
+        self._unsynced_directories_lock = threading.Lock()
+        # journal of the completed downloads, opened by the first batch, and
+        # the hash sinks digesting the downloads, by key
+        self._journal = None
+        self._journal_sinks = {}
 
     # download api -------------------------------------------------------------
 
@@ -49,6 +76,57 @@ class Downloader(object):
         """
         raise NotImplementedError()
 
+    def iter_download(self, request_list, buffer_size=DEFAULT_REPORT_BUFFER_SIZE):
+        """
+        Download the files represented by the download requests, and yield the
+        report of each download as it finishes, successfully or not, in the
+        order they finish. The event listener is still fired every event.
+
+        The download runs in a thread of its own. At most buffer_size reports
+        are held for the caller; once that many are waiting, the downloader's
+        workers wait for the caller to catch up, so that memory use does not
+        grow with the number of requests. If the caller stops iterating before
+        the end, the download is canceled.
+
+        :param request_list:  list of download requests
+        :type  request_list:  iterator of nectar.request.DownloadRequest
+        :param buffer_size:   number of reports held for the caller
+        :type  buffer_size:   int
+        :return: iterator of the download reports, in the order the downloads finished
+        :rtype:  iterator of nectar.report.DownloadReport
+        """
+        listener = ReportQueueListener(self.event_listener, buffer_size)
+        errors = []
+
+        def download():
+            try:
+                self.download(request_list)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        self.event_listener = listener
+        thread = threading.Thread(target=download)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            # poll rather than block, so that signals are handled
+            while thread.is_alive() or not listener.queue.empty():
+                try:
+                    yield listener.queue.get(timeout=ITER_POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+        finally:
+            if thread.is_alive():
+                self.cancel()
+                listener.close()
+                while thread.is_alive():
+                    thread.join(ITER_POLL_INTERVAL)
+            self.event_listener = listener.listener
+
+        if errors:
+            exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
     def download_one(self, request, events=False):
         """
         Downloads one url, blocks, and returns a DownloadReport.
@@ -65,7 +143,9 @@ class Downloader(object):
         # by default don't fire events to a listener for this synchronous call
         self.fire_events = events
         try:
-            return self._download_one(request)
+            report = self._download_one(request)
+            self.sync_directories()
+            return report
         finally:
             self.fire_events = True
 
@@ -90,6 +170,150 @@ class Downloader(object):
         """
         self.is_canceled = True
 
+    # journal api --------------------------------------------------------------
+
+    def _journaled(self, request_list):
+        """
+        Filter out of the requests those that the configured journal records
+        as done. They are reported as succeeded, with the 'skipped' strategy,
+        without being downloaded. Downloaders call this on the requests of each
+        batch; it opens the journal with the first.
+
+        :param request_list: download requests
+        :type  request_list: iterator of nectar.request.DownloadRequest
+        :return: the requests left to download
+        :rtype:  iterator of nectar.request.DownloadRequest
+        """
+        if self.config.journal_path is None:
+            return request_list
+        if self._journal is None:
+            self._journal = journal.DownloadJournal(self.config.journal_path)
+        return self._iter_journaled(request_list)
+
+    def _iter_journaled(self, request_list):
+        for request in request_list:
+            if self._journal.is_done(request):
+                report = DownloadReport.from_download_request(request)
+                report.strategy = SKIPPED
+                if report.total_bytes is None:
+                    report.total_bytes = self._journal.lookup(request.url, request.destination)[0]
+                report.download_started()
+                self.fire_download_started(report)
+                report.download_succeeded()
+                # bypassing the journal, which already has it
+                self._fire_event_to_listener(self.event_listener.download_succeeded, report)
+                self._download_finished(report)
+                continue
+            if self.journal_digests and isinstance(request.destination, basestring) and \
+                    not request.decompress:
+                hash_sink = sink.HashSink(self._journal.digest)
+                request.sinks = request.sinks + [hash_sink]
+                self._journal_sinks[self._journal_key(request.url, request.destination)] = \
+                    (request, hash_sink)
+            yield request
+
+    @staticmethod
+    def _journal_key(url, destination):
+        return url, os.path.abspath(destination)
+
+    def _record_in_journal(self, report):
+        """
+        Record a download that succeeded in the journal, if there is one.
+        """
+        if self._journal is None or not isinstance(report.destination, basestring):
+            return
+        digest = None
+        digesting = self._journal_sinks.pop(
+            self._journal_key(report.url, report.destination), None)
+        if digesting is not None:
+            request, hash_sink = digesting
+            request.sinks.remove(hash_sink)
+            digest = hash_sink.hexdigest()
+        try:
+            size = os.path.getsize(report.destination)
+        except OSError:
+            return
+        self._journal.record(report.url, report.destination, size, digest)
+
+    # file handle api ----------------------------------------------------------
+
+    def initialize_file_handle(self, request, size=None, staged=False):
+        """
+        Open the request's file handle, staging the write if configured to.
+
+        :param request: download request
+        :type  request: nectar.request.DownloadRequest
+        :param size:    expected size of the download in bytes, if known
+        :type  size:    int
+        :param staged:  if True, the write is staged even if it is not configured to be
+        :type  staged:  bool
+        :return: file-like object for writing the download to
+        """
+        return request.initialize_file_handle(staged=staged or self.config.staged_writes,
+                                              size=size, durability=self.config.durability)
+
+    def finalize_file_handle(self, request, commit):
+        """
+        Close the request's file handle, moving a staged file into place if
+        the download succeeded.
+
+        With batch durability, the directories of the moved files are
+        remembered, to be flushed by sync_directories.
+
+        :param request: download request
+        :type  request: nectar.request.DownloadRequest
+        :param commit:  True if the download succeeded
+        :type  commit:  bool
+        """
+        committed = request.finalize_file_handle(commit)
+        if committed and self.config.durability == staging.DURABILITY_BATCH:
+            with self._unsynced_directories_lock:
+                self._unsynced_directories.update(os.path.dirname(os.path.abspath(p))
+                                                  for p in committed)
+
+    def sync_directories(self, requests=None):
+        """
+        Flush the directories staged files were moved into to disk, and then
+        the journal, if any. Downloaders call this at the end of each batch.
+
+        :param requests: requests of the batch, whose journal hash sinks are
+                         taken off if their downloads did not succeed; those of
+                         all the requests if None
+        :type  requests: iterable of nectar.request.DownloadRequest
+        """
+        with self._unsynced_directories_lock:
+            directories = self._unsynced_directories
+            self._unsynced_directories = set()
+        for directory in directories:
+            try:
+                staging.fsync_directory(directory)
+            except OSError as e:
+                _LOG.warning('Could not sync directory %s: %s' % (directory, e))
+
+        if self._journal is not None:
+            self._journal.flush()
+            # the requests that did not succeed
+            if requests is None:
+                for request, hash_sink in self._journal_sinks.values():
+                    request.sinks.remove(hash_sink)
+                self._journal_sinks.clear()
+            else:
+                for request in requests:
+                    self._drop_journal_sink(request)
+
+    def _drop_journal_sink(self, request):
+        """
+        Take the journal's hash sink off a request that is done, if it has one.
+        """
+        if not isinstance(request.destination, basestring):
+            return
+        key = self._journal_key(request.url, request.destination)
+        digesting = self._journal_sinks.get(key)
+        # another request may have the same url and destination
+        if digesting is not None and digesting[0] is request:
+            del self._journal_sinks[key]
+            request.sinks.remove(digesting[1])
+
     # events api ---------------------------------------------------------------
 
     def fire_download_headers(self, report):
@@ -126,7 +350,9 @@ class Downloader(object):
         :param report: download reports
         :type report: nectar.report.DownloadReport
         """
+        self._record_in_journal(report)
         self._fire_event_to_listener(self.event_listener.download_succeeded, report)
+        self._download_finished(report)
 
     def fire_download_failed(self, report):
         """
@@ -136,6 +362,16 @@ class Downloader(object):
         :type report: nectar.report.DownloadReport
         """
         self._fire_event_to_listener(self.event_listener.download_failed, report)
+        self._download_finished(report)
+
+    def _download_finished(self, report):
+        """
+        Called with the final report of each request, once its listener was
+        fired, whether or not events are fired. Does nothing by default.
+
+        :param report: download report
+        :type report: nectar.report.DownloadReport
+        """
 
     # events utility methods ---------------------------------------------------
 
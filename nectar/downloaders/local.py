@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import binascii
 import datetime
+import errno
 import itertools
 import logging
 import os
+import threading
+import time
 import urllib
 
+from nectar import fastcopy
 from nectar.downloaders.base import Downloader
+from nectar.downloaders.threaded import WorkerQueue
 from nectar.report import DownloadReport, DOWNLOAD_SUCCEEDED
 
 
@@ -15,6 +21,11 @@ DEFAULT_BUFFER_SIZE = 1048576  # 1 MB in bytes
 DEFAULT_PROGRESS_INTERVAL = 5  # seconds
 
 
+# strategy recorded on reports of requests skipped because the destination
+# already was the source file
+SKIPPED = 'skipped'
+
+
 class UnlinkableDestination(Exception):
     """
     Exception thrown when the downloader is configured to use hard or soft
@@ -22,12 +33,23 @@ class UnlinkableDestination(Exception):
     """
 
 
+# errors on which the link strategy chain moves on to the next strategy
+_STRATEGY_ERRORS = (OSError, IOError, fastcopy.UnsupportedCopy, UnlinkableDestination)
+
+
 class LocalFileDownloader(Downloader):
     """
     Downloader class that handles local file URLs. It has the ability to hard
     link files, symbolic link files, or copy files.
+
+    If ``max_concurrent`` is configured, that many files are handled at once
+    by worker threads; otherwise they are handled one at a time.
     """
 
+    def __init__(self, config, event_listener=None):
+        super(LocalFileDownloader, self).__init__(config, event_listener)
+        self._event_lock = threading.RLock()
+
     @property
     def buffer_size(self):
         buffer_size_str = self.config.buffer_size
@@ -54,17 +76,92 @@ class LocalFileDownloader(Downloader):
             method = self._hard_link
         if self.config.use_sym_links:
             method = self._symbolic_link
+        if self.config.link_strategies:
+            method = self._link_chain
         return method
 
     def download(self, request_list):
+        request_list = self._journaled(request_list)
+
+        if (self.config.max_concurrent or 1) > 1:
+            self._download_concurrently(request_list)
+            return
 
         for report in itertools.imap(self.download_method, request_list):
+            self._fire_download_finished(report)
 
-            if report.state == DOWNLOAD_SUCCEEDED:
-                self.fire_download_succeeded(report)
+        self.sync_directories()
 
-            else:  # DOWNLOAD_FAILED
-                self.fire_download_failed(report)
+    def _download_concurrently(self, request_list):
+        """
+        Handle the requests with max_concurrent worker threads. The events of
+        each request are fired in order, by the thread that handles it. Once
+        the downloader is canceled, the requests that haven't been started are
+        reported as canceled, before this returns.
+
+        :param request_list: iterable of DownloadRequest instances
+        :type  request_list: iterable
+        """
+        queue = WorkerQueue(request_list)
+        worker_threads = []
+
+        for i in range(self.config.max_concurrent):
+            worker_thread = threading.Thread(target=self.worker, args=[queue])
+            worker_thread.setDaemon(True)
+            worker_thread.start()
+            worker_threads.append(worker_thread)
+
+        # As in the threaded downloader, sleep instead of joining the threads so
+        # that signals are able to be intercepted by projects using this library.
+        while True:
+            if self.is_canceled:
+                queue.close()
+            if not any(thread.is_alive() for thread in worker_threads):
+                break
+            time.sleep(0.1)
+
+        if self.is_canceled:
+            for request in queue.drain():
+                self._cancel_queued(request)
+
+        self.sync_directories()
+
+    def worker(self, queue):
+        """
+        :param queue: queue of DownloadRequest instances
+        :type  queue: nectar.downloaders.threaded.WorkerQueue
+        """
+        try:
+            while True:
+                request = queue.get()
+                if request is None:
+                    break
+                if self.is_canceled:
+                    self._cancel_queued(request)
+                    break
+                self._fire_download_finished(self.download_method(request))
+
+        except Exception:
+            logger.exception('Unhandled Exception in Worker Thread [%s]' %
+                             threading.currentThread().ident)
+            # cancel the download, otherwise the other workers carry on without this one
+            self.cancel()
+
+    def _cancel_queued(self, request):
+        """
+        Report a request that was still queued as canceled.
+        """
+        report = DownloadReport.from_download_request(request)
+        report.download_started()
+        report.download_canceled()
+        self.fire_download_failed(report)
+
+    def _fire_download_finished(self, report):
+        if report.state == DOWNLOAD_SUCCEEDED:
+            self.fire_download_succeeded(report)
+
+        else:  # DOWNLOAD_FAILED
+            self.fire_download_failed(report)
 
     def _download_one(self, request):
         """
@@ -105,7 +202,7 @@ class LocalFileDownloader(Downloader):
         """
         return self._common_link(os.symlink, request, report)
 
-    def _copy(self, request, report=None):
+    def _copy(self, request, report=None, methods=fastcopy.METHODS):
         """
         Copy the source file to the destination.
 
@@ -116,38 +213,84 @@ class LocalFileDownloader(Downloader):
         :type request: nectar.request.DownloadRequest
         :param report: report instance for the request
         :type report: nectar.report.DownloadReport
+        :param methods: copy methods to try, out of nectar.fastcopy.METHODS
+        :type methods: sequence of str
         :return: report instance
         :rtype: nectar.report.DownloadReport
         """
 
         report = report or DownloadReport.from_download_request(request)
         report.download_started()
+
+        try:
+            if self._copy_file(request, report, methods, fire_started=True) is None:
+                report.download_canceled()
+                return report
+
+        except IOError, e:
+            logger.info(e)
+            report.error_msg = str(e)
+            report.download_failed()
+        except Exception, e:
+            logger.exception(e)
+            report.error_msg = str(e)
+            report.download_failed()
+
+        else:
+            logger.info("Download succeeded: {url}.".format(url=request.url))
+            report.download_succeeded()
+
+        return report
+
+    def _copy_file(self, request, report, methods, fire_started=False, staged=False):
+        """
+        Copy the source file to the destination, updating the report's byte
+        counts and firing progress events as it goes.
+
+        :param request: request instance
+        :type request: nectar.request.DownloadRequest
+        :param report: report instance for the request
+        :type report: nectar.report.DownloadReport
+        :param methods: copy methods to try, out of nectar.fastcopy.METHODS
+        :type methods: sequence of str
+        :param fire_started: if True, the started event is fired once the files are open
+        :type fire_started: bool
+        :param staged: if True, the copy is written to a temporary file that only
+                       replaces the destination once it is complete
+        :type staged: bool
+        :return: the copy method the file was copied with, or None if the
+                 download was canceled
+        :rtype: str or None
+        :raises nectar.fastcopy.UnsupportedCopy: if none of the copy methods
+                are supported for the files
+        """
         src_handle = None
 
         try:
             src_path = self._file_path_from_url(request.url)
             src_handle = open(src_path, 'rb')
-            dst_handle = request.initialize_file_handle()
-            buffer_size = self.buffer_size
-
-            self.fire_download_started(report)
+            size = os.fstat(src_handle.fileno()).st_size
+            if report.total_bytes is None:
+                report.total_bytes = size
+            dst_handle = self.initialize_file_handle(request, size, staged=staged)
+            chunks = self._copy_chunks(request, src_handle, dst_handle, methods)
+
+            if fire_started:
+                self.fire_download_started(report)
             last_progress_update = datetime.datetime.now()
 
             while True:
 
                 if self.is_canceled or request.canceled:
-                    report.download_canceled()
-                    # NOTE the control flow here will pass through the finally
-                    # block on the way out, but not the else block :D
-                    return report
+                    return None
 
-                chunk = src_handle.read(buffer_size)
+                copied = next(chunks, 0)
 
-                if not chunk:
+                if not copied:
                     break
 
-                dst_handle.write(chunk)
-                report.bytes_downloaded += len(chunk)
+                report.bytes_downloaded += copied
+                report.bytes_decompressed = request.bytes_decompressed
 
                 now = datetime.datetime.now()
 
@@ -157,7 +300,120 @@ class LocalFileDownloader(Downloader):
                 self.fire_download_progress(report)
                 last_progress_update = now
 
-        except IOError, e:
+            if not isinstance(chunks, fastcopy.FileCopier):
+                method = fastcopy.METHOD_BUFFERED
+            elif chunks.bytes_copied < size:
+                raise fastcopy.UnsupportedCopy('None of the copy methods are supported: %s' %
+                                               ', '.join(methods))
+            else:
+                method = chunks.method
+
+            self.finalize_file_handle(request, commit=True)
+
+        finally:
+            if src_handle is not None:
+                src_handle.close()
+            self.finalize_file_handle(request, commit=False)
+
+        return method
+
+    def _copy_chunks(self, request, src_handle, dst_handle, methods=fastcopy.METHODS):
+        """
+        Return an iterator that copies the source to the destination one chunk
+        at a time, yielding the number of bytes copied in each chunk.
+
+        Files are copied by the kernel when the destination is a file and the
+        download isn't being decompressed; otherwise the data is read and
+        written through Python.
+
+        :param request: request instance
+        :type request: nectar.request.DownloadRequest
+        :param src_handle: source file object
+        :type src_handle: file
+        :param dst_handle: file-like object returned by initialize_file_handle
+        :param methods: copy methods to try, out of nectar.fastcopy.METHODS
+        :type methods: sequence of str
+        :return: iterator of chunk sizes, in bytes
+        :rtype: iterator
+        """
+        dst_fd = None
+        if not request.decompress:
+            try:
+                dst_handle.flush()
+                dst_fd = dst_handle.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass  # not a file, such as a StringIO
+
+        if isinstance(dst_fd, (int, long)):
+            return fastcopy.FileCopier(src_handle.fileno(), dst_fd, self.buffer_size, methods)
+        return self._buffered_chunks(src_handle, dst_handle)
+
+    def _buffered_chunks(self, src_handle, dst_handle):
+        buffer_size = self.buffer_size
+        while True:
+            chunk = src_handle.read(buffer_size)
+            if not chunk:
+                return
+            dst_handle.write(chunk)
+            yield len(chunk)
+
+    # -- link strategy chain ---------------------------------------------------
+
+    def _link_chain(self, request, report=None):
+        """
+        Put the source file in place with the configured link strategies, trying
+        each in turn until one succeeds. The strategy that did is recorded on the
+        report, as is SKIPPED if skip_identical is configured and the destination
+        already is the source file.
+
+        :param request: request instance
+        :type request: nectar.request.DownloadRequest
+        :param report: report instance for the request
+        :type report: nectar.report.DownloadReport
+        :return: report instance
+        :rtype: nectar.report.DownloadReport
+        """
+
+        if request.decompress or request.sinks:
+            # the decompressed contents, or the bytes for the sinks, can only be
+            # had by copying
+            return self._copy(request, report)
+
+        report = report or DownloadReport.from_download_request(request)
+
+        report.download_started()
+        self.fire_download_started(report)
+
+        error = None
+        try:
+            src_path = self._file_path_from_url(request.url)
+            src_stat = os.stat(src_path)
+            if report.total_bytes is None:
+                report.total_bytes = src_stat.st_size
+
+            if self.config.skip_identical and self._is_identical(src_stat, request.destination):
+                report.strategy = SKIPPED
+
+            for strategy in self.config.link_strategies:
+                if report.strategy is not None:
+                    break
+                if self.is_canceled or request.canceled:
+                    report.download_canceled()
+                    return report
+                report.bytes_downloaded = 0
+                try:
+                    report.strategy = self._place(strategy, src_path, src_stat, request, report)
+                except _STRATEGY_ERRORS, e:
+                    logger.debug('%s of %s failed: %s' % (strategy, request.url, e))
+                    error = e
+
+            if report.strategy is None:
+                if self.is_canceled or request.canceled:
+                    report.download_canceled()
+                    return report
+                raise error
+
+        except _STRATEGY_ERRORS, e:
             logger.info(e)
             report.error_msg = str(e)
             report.download_failed()
@@ -167,16 +423,60 @@ class LocalFileDownloader(Downloader):
             report.download_failed()
 
         else:
-            logger.info("Download succeeded: {url}.".format(url=request.url))
+            logger.info("Download succeeded with {strategy}: {url}.".format(
+                strategy=report.strategy, url=request.url))
             report.download_succeeded()
 
-        finally:
-            if src_handle is not None:
-                src_handle.close()
-            request.finalize_file_handle()
-
         return report
 
+    def _place(self, strategy, src_path, src_stat, request, report):
+        """
+        Put the source file in place with one link strategy.
+
+        :return: the strategy, or None if the download was canceled
+        :rtype: str or None
+        :raises OSError, IOError, nectar.fastcopy.UnsupportedCopy, UnlinkableDestination:
+                if the strategy failed
+        """
+        if strategy in (fastcopy.STRATEGY_HARDLINK, fastcopy.STRATEGY_SYMLINK):
+            if not isinstance(request.destination, basestring):
+                raise UnlinkableDestination(request.destination)
+            link_method = os.link if strategy == fastcopy.STRATEGY_HARDLINK else os.symlink
+            _replace_with_link(link_method, src_path, request.destination)
+            report.bytes_downloaded = src_stat.st_size
+            return strategy
+
+        is_path = isinstance(request.destination, basestring)
+        if strategy == fastcopy.STRATEGY_REFLINK and not is_path:
+            raise UnlinkableDestination(request.destination)
+        # the copy is staged, so that a failed strategy leaves the destination
+        # as it was: it may be a link to the source, which the next strategy uses
+        if self._copy_file(request, report, fastcopy.STRATEGY_METHODS[strategy],
+                           staged=is_path) is None:
+            return None
+        if is_path:
+            # so that the copy is recognized as identical next time
+            os.utime(request.destination, (src_stat.st_atime, src_stat.st_mtime))
+        return strategy
+
+    @staticmethod
+    def _is_identical(src_stat, destination):
+        """
+        :return: True if the destination is the source file, or a file with
+                 the same size and modification time
+        :rtype: bool
+        """
+        if not isinstance(destination, basestring):
+            return False
+        try:
+            dst_stat = os.stat(destination)
+        except OSError:
+            return False
+        if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+            return True
+        return dst_stat.st_size == src_stat.st_size and \
+            int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
     # -- common link function --------------------------------------------------
 
     def _common_link(self, link_method, request, report=None):
@@ -193,6 +493,11 @@ class LocalFileDownloader(Downloader):
         :rtype: nectar.report.DownloadReport
         """
 
+        if request.decompress or request.sinks:
+            # the decompressed contents, or the bytes for the sinks, can only be
+            # had by copying
+            return self._copy(request, report)
+
         report = report or DownloadReport.from_download_request(request)
 
         report.download_started()
@@ -209,7 +514,11 @@ class LocalFileDownloader(Downloader):
             src_path = self._file_path_from_url(request.url)
             link_method(src_path, request.destination)
 
-            report.bytes_downloaded = os.path.getsize(request.destination)
+            if request.size is not None:
+                report.bytes_downloaded = request.size
+            else:
+                report.bytes_downloaded = os.path.getsize(request.destination)
+            report.total_bytes = report.bytes_downloaded
 
         except OSError, e:
             logger.info(e)
@@ -226,6 +535,12 @@ class LocalFileDownloader(Downloader):
 
         return report
 
+    def _fire_event_to_listener(self, event_listener_callback, *args, **kwargs):
+        # thread-safe event firing
+        with self._event_lock:
+            super(LocalFileDownloader, self)._fire_event_to_listener(event_listener_callback,
+                                                                     *args, **kwargs)
+
     def _file_path_from_url(self, url):
         """
         Strip off the url scheme and return the absolute path to the local file.
@@ -242,3 +557,29 @@ class LocalFileDownloader(Downloader):
             raise ValueError('Unsupported scheme: %s' % scheme)
 
         return file_path
+
+
+def _replace_with_link(link_method, src_path, dst_path):
+    """
+    Link the destination to the source, atomically replacing the destination
+    if it exists.
+
+    :param link_method: os.link or os.symlink
+    :type link_method: callable
+    """
+    try:
+        link_method(src_path, dst_path)
+        return
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    directory, name = os.path.split(dst_path)
+    temp_path = os.path.join(directory, '.%s.%s.link' % (name, binascii.hexlify(os.urandom(4))))
+    link_method(src_path, temp_path)
+    try:
+        os.rename(temp_path, dst_path)
+    finally:
+        # renaming a hard link over another link to the same file does nothing
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import math
+import multiprocessing
+import Queue
+import signal
+import threading
+from gettext import gettext as _
+
+from nectar.downloaders.base import Downloader
+from nectar.downloaders.threaded import DEFAULT_BUFFER_SIZE, HTTPThreadedDownloader
+from nectar.listener import DownloadEventListener
+from nectar.report import DownloadReport
+
+
+_LOG = logging.getLogger(__name__)
+
+# number of requests per process that are handed to the processes ahead of time
+DEFAULT_PREFETCH = 10
+POLL_INTERVAL = 0.1  # seconds
+
+# report fields sent from the worker processes with each event
+_REPORT_FIELDS = ('state', 'total_bytes', 'bytes_downloaded', 'bytes_decompressed',
+                  'start_time', 'finish_time', 'error_msg', 'error_report', 'strategy',
+                  'cache_status', 'wire_bytes', 'write_stall_time')
+_EVENTS = ('download_started', 'download_headers', 'download_progress', 'download_succeeded',
+           'download_failed')
+
+
+class ProcessPoolDownloader(Downloader):
+    """
+    Downloader class that shards the requests across a number of worker
+    processes, each of which runs its own downloader, by default a threaded
+    HTTP downloader. It is meant for downloads that need more CPU than a single
+    Python process can get, for instance when hashing or decompressing them.
+
+    The events fired by the worker processes are sent back to this process and
+    fired to the event listener here, with reports that carry the requests' data.
+    Requests are handed out as the worker processes are ready for them, so the
+    request iterator is consumed lazily.
+
+    The requests and configuration are pickled to be sent to the worker
+    processes; requests whose destination is a file-like object fail.
+    ``max_speed`` is shared evenly between the worker processes, whose buffer
+    size is lowered when needed for their shares to add up to no more than it.
+    """
+
+    def __init__(self, config, event_listener=None, processes=None,
+                 backend=HTTPThreadedDownloader):
+        """
+        :param config: downloader configuration
+        :type config: nectar.config.DownloaderConfig
+        :param event_listener: event listener providing life-cycle callbacks
+        :type event_listener: nectar.listener.DownloadEventListener
+        :param processes: number of worker processes; defaults to the number of CPUs
+        :type processes: int
+        :param backend: downloader class run in each worker process
+        :type backend: type
+        """
+        super(ProcessPoolDownloader, self).__init__(config, event_listener)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backend = backend
+
+        self._cancel_event = None
+        self._event_lock = threading.RLock()
+
+    def cancel(self):
+        super(ProcessPoolDownloader, self).cancel()
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+
+    def _worker_config(self):
+        config = copy.copy(self.config)
+        # the journal is kept by this process, which gets the events
+        config.journal_path = None
+        if config.max_speed is not None:
+            config.max_speed = int(math.ceil(float(config.max_speed) / self.processes))
+            # The threaded downloader never goes slower than twice its buffer
+            # size, which would let the shares add up to more than max_speed;
+            # shrink the buffers so that each share stays above that floor.
+            buffer_size = int(config.buffer_size or DEFAULT_BUFFER_SIZE)
+            if 4 * buffer_size > config.max_speed:
+                config.buffer_size = max(config.max_speed // 4, 1)
+        return config
+
+    def download(self, request_list):
+        request_list = self._journaled(request_list)
+        tasks = multiprocessing.Queue(self.processes * DEFAULT_PREFETCH)
+        events = multiprocessing.Queue()
+        self._cancel_event = multiprocessing.Event()
+        if self.is_canceled:
+            self._cancel_event.set()
+
+        config = self._worker_config()
+        processes = []
+        for i in range(self.processes):
+            process = multiprocessing.Process(
+                target=_worker_process,
+                args=(self.backend, config, tasks, events, self._cancel_event))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        # requests handed to the worker processes and their reports, by index
+        pending = {}
+        reports = {}
+
+        feeder = threading.Thread(target=self._feed,
+                                  args=(request_list, tasks, pending, processes))
+        feeder.setDaemon(True)
+        feeder.start()
+
+        # Dispatch the events until the worker processes are done. As in the
+        # threaded downloader, poll instead of blocking so that signals are
+        # able to be intercepted by projects using this library.
+        while True:
+            try:
+                event, index, fields = events.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                if feeder.is_alive() or any(p.is_alive() for p in processes):
+                    continue
+                break
+            self._dispatch(event, index, fields, pending, reports)
+
+        feeder.join()
+        for process in processes:
+            process.join()
+        # don't wait for requests that were never taken to be flushed
+        tasks.cancel_join_thread()
+
+        # events sent by the worker processes between the last poll and their exit
+        while True:
+            try:
+                event, index, fields = events.get_nowait()
+            except Queue.Empty:
+                break
+            self._dispatch(event, index, fields, pending, reports)
+
+        # requests that were canceled before a worker process took them, or
+        # lost to a worker process that died
+        for index, request in sorted(pending.items()):
+            report = reports.get(index) or DownloadReport.from_download_request(request)
+            report.download_started()
+            if self.is_canceled:
+                report.download_canceled()
+            else:
+                report.error_msg = _('Worker process exited')
+                report.download_failed()
+            self.fire_download_failed(report)
+
+        self.sync_directories()
+
+    def _feed(self, request_list, tasks, pending, processes):
+        try:
+            for index, request in enumerate(request_list):
+                if self.is_canceled:
+                    break
+                if hasattr(request.destination, 'write') or \
+                        hasattr(request.decompressed_destination, 'write'):
+                    self._fail(request, _('File-like destinations cannot be sent to a worker '
+                                          'process'))
+                    continue
+                if request.sinks:
+                    self._fail(request, _('Sinks cannot be sent to a worker process'))
+                    continue
+                with self._event_lock:
+                    pending[index] = request
+                worker_request = copy.copy(request)
+                worker_request.data = index
+                if not _put(tasks, worker_request, processes):
+                    break
+        except Exception:
+            _LOG.exception(_('Unhandled exception while handing out requests'))
+            self.cancel()
+        finally:
+            for process in processes:
+                _put(tasks, None, processes)
+
+    def _fail(self, request, msg):
+        report = DownloadReport.from_download_request(request)
+        report.download_started()
+        report.error_msg = msg
+        report.download_failed()
+        self.fire_download_failed(report)
+
+    def _dispatch(self, event, index, fields, pending, reports):
+        with self._event_lock:
+            request = pending.get(index)
+        if request is None:
+            return
+
+        report = reports.get(index)
+        if report is None:
+            report = reports[index] = DownloadReport.from_download_request(request)
+        for name, value in fields.items():
+            setattr(report, name, value)
+
+        if event in ('download_succeeded', 'download_failed'):
+            with self._event_lock:
+                del pending[index]
+            del reports[index]
+        if event == 'download_succeeded':
+            self._record_in_journal(report)
+
+        self._fire_event_to_listener(getattr(self.event_listener, event), report)
+
+    def _download_one(self, request):
+        """
+        Downloads one url in this process, blocks, and returns a DownloadReport.
+
+        :param request: download request object with details about what to
+                        download and where to put it
+        :type  request: nectar.request.DownloadRequest
+
+        :return:    download report
+        :rtype:     nectar.report.DownloadReport
+        """
+        downloader = self.backend(self.config, self.event_listener)
+        return downloader.download_one(request, events=self.fire_events)
+
+    def _fire_event_to_listener(self, event_listener_callback, *args, **kwargs):
+        # thread-safe event firing
+        with self._event_lock:
+            super(ProcessPoolDownloader, self)._fire_event_to_listener(event_listener_callback,
+                                                                       *args, **kwargs)
+
+
+def _put(tasks, item, processes):
+    # put an item on the task queue, unless all the worker processes are gone
+    while True:
+        try:
+            tasks.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            if not any(p.is_alive() for p in processes):
+                return False
+
+
+# -- worker process ------------------------------------------------------------
+
+
+class _EventForwarder(DownloadEventListener):
+    """
+    Event listener that sends the events of a worker process to the parent.
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def _forward(self, event, report):
+        fields = dict((name, getattr(report, name)) for name in _REPORT_FIELDS)
+        if event == 'download_headers' and report.headers is not None:
+            fields['headers'] = dict(report.headers)
+        self.events.put((event, report.data, fields))
+
+
+def _make_forwarding_method(event):
+    return lambda self, report: self._forward(event, report)
+
+
+for _event in _EVENTS:
+    setattr(_EventForwarder, _event, _make_forwarding_method(_event))
+
+
+def _worker_process(backend, config, tasks, events, cancel_event):
+    # the parent handles interrupts and cancels the worker processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    downloader = backend(config, _EventForwarder(events))
+
+    def watch_cancel():
+        cancel_event.wait()
+        downloader.cancel()
+
+    watcher = threading.Thread(target=watch_cancel)
+    watcher.setDaemon(True)
+    watcher.start()
+
+    try:
+        downloader.download(iter(tasks.get, None))
+    except Exception:
+        _LOG.exception(_('Unhandled exception in worker process'))
+    finally:
+        events.close()
+        events.join_thread()
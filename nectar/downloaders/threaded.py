@@ -1,19 +1,32 @@
+from cStringIO import StringIO
+import collections
+import copy
 import datetime
 import errno
+import heapq
 import httplib
+import os
+import ssl
+import tempfile
 import threading
 import time
 import urllib
 import urlparse
+from email.utils import mktime_tz, parsedate_tz
 from gettext import gettext as _
 from logging import getLogger
 
 import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
 from requests.packages.urllib3.util import retry, url as urllib3_url
 
+from nectar import (cache, compression, delta, fastcopy, hedge, inflight, pool, sink, tls,
+                    writebehind)
 from nectar.config import HTTPBasicWithProxyAuth
 from nectar.downloaders.base import Downloader
-from nectar.report import DownloadReport, DOWNLOAD_SUCCEEDED
+from nectar.future import DownloadFuture
+from nectar.report import DownloadReport, DOWNLOAD_FAILED, DOWNLOAD_SUCCEEDED
+from nectar.request import DownloadRequest, SinkWriter
 
 # -- constants -----------------------------------------------------------------
 
@@ -24,6 +37,16 @@ DEFAULT_BUFFER_SIZE = 8192  # bytes
 DEFAULT_PROGRESS_INTERVAL = 5  # seconds
 DEFAULT_TRIES = 5
 DEFAULT_GENERIC_TRIES = 3
+CANCEL_POLL_INTERVAL = 0.05  # seconds
+# longest pause of a host that a Retry-After header can ask for
+MAX_RETRY_AFTER = 300  # seconds
+# responses whose Retry-After header pauses all requests to the host
+RETRY_AFTER_STATUS_CODES = frozenset([429, httplib.SERVICE_UNAVAILABLE])
+# prefix of the temporary files hedges are fetched to
+HEDGE_PREFIX = '.nectar-hedge-'
+# requests a download with the engine running submits ahead of the finished
+# ones, per worker
+SUBMIT_AHEAD = 2
 
 ONE_SECOND = datetime.timedelta(seconds=1)
 
@@ -50,6 +73,37 @@ class SkipLocation(Exception):
     pass
 
 
+class TransferExpired(Exception):
+    """
+    Raised when a transfer was aborted for missing the deadline, or for
+    falling below the minimum throughput, of the configuration.
+    """
+    def __init__(self, url, reason):
+        super(TransferExpired, self).__init__(url, reason)
+
+
+class RetryLater(Exception):
+    """
+    Raised when the request's host has asked, with a Retry-After header, to be
+    left alone for a while.
+    """
+    def __init__(self, url, until):
+        super(RetryLater, self).__init__(url, until)
+
+
+class HostPausingRetry(retry.Retry):
+    """
+    Retry configuration that leaves responses carrying a Retry-After header to
+    the downloader, which pauses all of its workers' requests to the host,
+    instead of having urllib3 back off the one connection.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if has_retry_after and status_code in RETRY_AFTER_STATUS_CODES:
+            return False
+        return super(HostPausingRetry, self).is_retry(method, status_code, has_retry_after)
+
+
 # -- downloader class ----------------------------------------------------------
 
 
@@ -59,6 +113,8 @@ class HTTPThreadedDownloader(Downloader):
     HTTP, HTTPS and proxied download requests by the server.
     """
 
+    journal_digests = True
+
     def __init__(self, config, event_listener=None, tries=DEFAULT_TRIES, session=None):
         """
         :param config: downloader configuration
@@ -89,18 +145,81 @@ class HTTPThreadedDownloader(Downloader):
 
         # set of locations that produced a connection error
         self.failed_netlocs = set([])
+        # locations that asked to be retried later, mapped to the time until
+        # which no requests are sent to them
+        self.paused_netlocs = {}
+        self._pause_lock = threading.Lock()
+        # requests put back on the queue because of a pause, mapped to their
+        # report and the number of times their host asked for them to be retried
+        self._deferred = {}
+        # urls being fetched within a call to download, by coalescing key,
+        # mapped to the request fetching them and the (request, report) of the
+        # duplicates waiting for it
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
         self.session = session
         self.extra_headers = {}
 
+        # connections in use by the workers, aborted by cancel
+        self._connections = inflight.ConnectionTracker()
+        self._canceled_event = threading.Event()
+
+        # read-through disk cache of the responses
+        self._cache = None
+        if config.cache_dir is not None:
+            self._cache = cache.HTTPCache(config.cache_dir, config.cache_max_size)
+            self._credentials_scope = cache.credentials_scope(config)
+
+        # hedging of the slowest requests
+        self._hedging = None
+        if config.hedge_percentile is not None:
+            self._hedging = hedge.HedgingPolicy(config.hedge_percentile,
+                                                config.hedge_budget or hedge.DEFAULT_BUDGET)
+
+        # long-lived workers, started by start or submit: their queue, and
+        # the sessions download_one reuses while they run
+        self._engine_queue = None
+        self._engine_threads = []
+        self._engine_lock = threading.Lock()
+        self._idle_sessions = []
+        # futures of the submitted requests, by the id of the request
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+
+        # I/O threads the fetched chunks are written by, and the writers of
+        # the requests being fetched
+        self.write_behind = None
+        if config.write_behind_threads is not None:
+            self.write_behind = writebehind.WriteBehind(config.write_behind_threads,
+                                                        config.write_behind_budget)
+        self._behind_writers = {}
+        self._behind_lock = threading.Lock()
+
     def _make_session(self):
         session = requests.Session()
-        retry_conf = retry.Retry(total=self.tries, connect=self.tries,
-                                 read=self.tries, backoff_factor=1,
-                                 status_forcelist=[429])
+        retry_conf = HostPausingRetry(total=self.tries, connect=self.tries,
+                                      read=self.tries, backoff_factor=1,
+                                      status_forcelist=[429])
         retry_conf.BACKOFF_MAX = 8
-        adapter = requests.adapters.HTTPAdapter(max_retries=retry_conf)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
+        # the connections in use are tracked, for cancel to abort them
+        http_adapter = inflight.TrackingAdapter(max_retries=retry_conf)
+        https_adapter = inflight.TrackingAdapter(max_retries=retry_conf)
+        try:
+            if self.config.shared_connections:
+                # borrow connections from the pools shared by the downloaders
+                # of the process that connect the same way
+                http_adapter = https_adapter = pool.registry.adapter(self.config,
+                                                                     max_retries=retry_conf)
+            else:
+                # HTTPS connections share an SSL context with the CA bundle and
+                # client certificate already loaded
+                https_adapter = inflight.TrackingSSLContextAdapter(
+                    tls.get_ssl_context(self.config), max_retries=retry_conf)
+        except (ssl.SSLError, IOError), e:
+            # leave it to requests to report the error with each request
+            _logger.debug('Unable to build an SSL context: %s' % e)
+        session.mount('http://', http_adapter)
+        session.mount('https://', https_adapter)
         return session
 
     @property
@@ -174,17 +293,21 @@ class HTTPThreadedDownloader(Downloader):
         :type  queue:       WorkerQueue
 
         """
+        # kept for all the requests the worker fetches
+        session = self.session
         try:
             while True:
                 request = queue.get()
-                if request is None or self.is_canceled:
+                if request is None:
                     break
-                    
-                if not self.session:
+                if self.is_canceled:
+                    self._cancel_queued(request, queue)
+                    break
+
+                if not session:
                     session = self._make_session()
-                else:
-                    session = self.session
-                self._fetch(request, session)
+                with self._connections.track():
+                    self._fetch_coalesced(request, session, queue)
 
         except:
             msg = _('Unhandled Exception in Worker Thread [%s]') % threading.currentThread().ident
@@ -194,8 +317,11 @@ class HTTPThreadedDownloader(Downloader):
             self.cancel()
 
     def download(self, request_list):
+        if self._engine_queue is not None:
+            return self._download_submitted(request_list)
+        request_list = self._journaled(request_list)
         worker_threads = []
-        queue = WorkerQueue(request_list)
+        queue = WorkerQueue(request_list, not_before=self._request_paused_until)
 
         _logger.debug('starting workers')
         for i in range(self.max_concurrent):
@@ -209,15 +335,385 @@ class HTTPThreadedDownloader(Downloader):
         # able to be intercepted by projects using this library.
         while True:
             still_processing = False
-            if not queue.finished and not self.is_canceled:
+            if self.is_canceled:
+                queue.close()
+            elif not queue.finished:
                 still_processing = True
             for thread in worker_threads:
                 if thread.is_alive():
                     still_processing = True
-            if still_processing:
-                time.sleep(1)
-            else:
+            if not still_processing:
                 break
+            if self.is_canceled:
+                # the workers' connections were aborted, they are on their way out
+                time.sleep(CANCEL_POLL_INTERVAL)
+            else:
+                self._canceled_event.wait(1)
+
+        if self.is_canceled:
+            for request in queue.drain():
+                self._cancel_queued(request, queue)
+
+        self.sync_directories()
+
+    def cancel(self):
+        """
+        Cancel the download: the connections in use are aborted, so that the
+        requests in flight are canceled right away, and the requests still
+        queued are canceled in bulk, before download returns.
+        """
+        super(HTTPThreadedDownloader, self).cancel()
+        self._canceled_event.set()
+        self._connections.abort()
+        queue = self._engine_queue
+        if queue is not None:
+            for request in queue.drain():
+                self._cancel_queued(request, queue)
+
+    # -- engine ----------------------------------------------------------------
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def start(self):
+        """
+        Start the engine: max_concurrent workers that stay alive, each with a
+        session of its own, and download the submitted requests until the
+        engine is shut down. While it runs, download hands its requests to
+        them, and download_one reuses sessions. Does nothing if the engine is
+        already running.
+        """
+        with self._engine_lock:
+            if self._engine_queue is not None:
+                return
+            queue = SubmissionQueue(not_before=self._request_paused_until)
+            _logger.debug('starting engine workers')
+            for i in range(self.max_concurrent):
+                worker_thread = threading.Thread(target=self.worker, args=[queue])
+                worker_thread.setDaemon(True)
+                worker_thread.start()
+                self._engine_threads.append(worker_thread)
+            self._engine_queue = queue
+
+    def submit(self, request):
+        """
+        Submit a request to the engine, starting it if it is not running.
+
+        :param request: download request
+        :type  request: nectar.request.DownloadRequest
+        :return: future of the request's report
+        :rtype:  nectar.future.DownloadFuture
+        """
+        future = DownloadFuture(request)
+        with self._futures_lock:
+            self._futures.setdefault(id(request), []).append(future)
+        self.start()
+        queue = self._engine_queue
+        for request in self._journaled([request]):
+            if self.is_canceled or queue is None or not queue.put(request):
+                self._cancel_queued(request, queue)
+        return future
+
+    def shutdown(self):
+        """
+        Stop the engine once the submitted requests are downloaded, and wait
+        for its workers to exit. To stop without downloading them, cancel
+        first. Does nothing if the engine is not running.
+        """
+        with self._engine_lock:
+            queue, self._engine_queue = self._engine_queue, None
+            threads, self._engine_threads = self._engine_threads, []
+            del self._idle_sessions[:]
+        if queue is None:
+            return
+        queue.finish()
+        for thread in threads:
+            # join with a timeout, so that signals are handled
+            while thread.is_alive():
+                thread.join(1)
+        self.sync_directories()
+        # those of requests a worker failed on
+        with self._futures_lock:
+            futures = [f for pending in self._futures.values() for f in pending]
+            self._futures.clear()
+        for future in futures:
+            future.set_canceled()
+
+    def _download_finished(self, report):
+        # the futures keep their requests, and so their ids, alive
+        key = id(report._request)
+        with self._futures_lock:
+            pending = self._futures.get(key)
+            if not pending:
+                return
+            future = pending.pop(0)
+            if not pending:
+                del self._futures[key]
+        future.set_result(report)
+
+    def _download_submitted(self, request_list):
+        """
+        Download the requests with the engine's workers, submitting a few of
+        them ahead of those that finished.
+        """
+        pending = collections.deque()
+        for request in request_list:
+            pending.append(self.submit(request))
+            while len(pending) > SUBMIT_AHEAD * self.max_concurrent:
+                self._submitted_done(pending.popleft())
+        while pending:
+            self._submitted_done(pending.popleft())
+        # the engine's other requests may still be in flight; the journal
+        # sinks of this batch's were taken off as they finished
+        self.sync_directories(requests=())
+
+    def _submitted_done(self, future):
+        future.result()
+        if self._journal is not None:
+            self._drop_journal_sink(future.request)
+
+    def _cancel_queued(self, request, queue):
+        """
+        Cancel a request that was still queued, and the requests waiting for it.
+        """
+        with self._pause_lock:
+            report = self._deferred.pop(request, (None, 0))[0]
+        if report is None:
+            report = DownloadReport.from_download_request(request)
+            report.download_started()
+        report.download_canceled()
+        self.fire_download_failed(report)
+        self._land_duplicates(request, report, queue)
+
+    # -- request coalescing ----------------------------------------------------
+
+    def _fetch_coalesced(self, request, session, queue):
+        """
+        Fetch a request taken from the queue, unless another request for the
+        same url is already being fetched; the request then waits for that
+        one, and its destination gets a copy of the fetched file.
+
+        :param request: download request
+        :type  request: nectar.request.DownloadRequest
+        :param session: requests session
+        :type  session: requests.Session
+        :param queue:   queue the request was taken from
+        :type  queue:   WorkerQueue
+        """
+        if self._join_in_flight(request):
+            return
+
+        hedged = self._hedged(request)
+        try:
+            report = self._fetch(request, session, queue, hedged)
+        except Exception:
+            self._land_duplicates(request, None, queue)
+            raise
+        finally:
+            if hedged is not None:
+                hedged.close()
+        if report is not None:  # otherwise deferred, and still in flight
+            self._land_duplicates(request, report, queue)
+
+    @staticmethod
+    def _coalescing_key(request):
+        return request.url, tuple(sorted((request.headers or {}).items()))
+
+    @staticmethod
+    def _can_lead(request):
+        # only a request whose destination ends up with the bytes as fetched
+        # can be copied to the destinations of its duplicates
+        return isinstance(request.destination, basestring) and \
+            (not request.decompress or request.decompressed_destination is not None)
+
+    def _join_in_flight(self, request):
+        """
+        Make the request wait for the request already fetching its url, if
+        there is one; otherwise, if it can, the request becomes the one
+        fetching the url.
+
+        :return: True if the request waits for another
+        :rtype:  bool
+        """
+        key = self._coalescing_key(request)
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                if self._can_lead(request):
+                    self._in_flight[key] = (request, [])
+                return False
+            leader, duplicates = in_flight
+            if leader is request:  # handed out again after being deferred
+                return False
+            with self._pause_lock:
+                report = self._deferred.pop(request, (None, 0))[0]
+            if report is None:
+                report = DownloadReport.from_download_request(request)
+                report.download_started()
+                # before the request can be finished
+                self.fire_download_started(report)
+            duplicates.append((request, report))
+        return True
+
+    def _land_duplicates(self, leader, leader_report, queue):
+        """
+        Finish the requests that waited for the given one. They get a copy of
+        its file if it succeeded, and its failure if the server refused it.
+        Otherwise they are put back on the queue, to be fetched again.
+
+        :param leader:        request that fetched the url
+        :type  leader:        nectar.request.DownloadRequest
+        :param leader_report: its report, or None if fetching it raised an exception
+        :type  leader_report: nectar.report.DownloadReport
+        :param queue:         queue the requests were taken from
+        :type  queue:         WorkerQueue
+        """
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(self._coalescing_key(leader))
+            if in_flight is None or in_flight[0] is not leader:
+                return
+            del self._in_flight[self._coalescing_key(leader)]
+        duplicates = in_flight[1]
+
+        for request, report in duplicates:
+            if self.is_canceled or request.canceled or leader_report is None:
+                report.download_canceled()
+            elif leader_report.state is DOWNLOAD_SUCCEEDED:
+                self._copy_download(leader, leader_report, request, report)
+            elif leader_report.error_report.get('response_code') is not None:
+                report.error_msg = leader_report.error_msg
+                report.error_report = dict(leader_report.error_report)
+                report.download_failed()
+            else:
+                with self._pause_lock:
+                    self._deferred[request] = (report, 0)
+                queue.defer(request, time.time())
+                continue
+
+            if report.state is DOWNLOAD_SUCCEEDED:
+                self.fire_download_succeeded(report)
+            else:
+                self.fire_download_failed(report)
+
+    def _copy_download(self, leader, leader_report, request, report):
+        """
+        Write a copy of the file fetched for a request to the destination of a
+        duplicate request, in the kernel where possible.
+        """
+        report.headers = leader_report.headers
+        self.fire_download_headers(report)
+        try:
+            if isinstance(request.destination, basestring) and \
+                    os.path.abspath(request.destination) == os.path.abspath(leader.destination):
+                report.bytes_downloaded = leader_report.bytes_downloaded
+            else:
+                with open(leader.destination, 'rb') as src_handle:
+                    self._write_copy(request, report, src_handle)
+        except Exception as e:
+            _logger.exception(e)
+            report.error_msg = str(e)
+            report.download_failed()
+        else:
+            report.download_succeeded()
+        self.finalize_file_handle(request, commit=False)
+        self.fire_download_progress(report)
+
+    def _write_copy(self, request, report, src_handle):
+        """
+        Write a copy of an open file to the request's destination, counting
+        the bytes copied on its report, and commit it.
+        """
+        dst_handle = self.initialize_file_handle(request,
+                                                 size=os.fstat(src_handle.fileno()).st_size)
+        for copied in self._copy_chunks(request, src_handle, dst_handle):
+            report.bytes_downloaded += copied
+            report.bytes_decompressed = request.bytes_decompressed
+        self.finalize_file_handle(request, commit=True)
+
+    # -- http cache ------------------------------------------------------------
+
+    def _cache_scope(self, raw):
+        # bodies read raw and decoded are cached apart
+        return self._credentials_scope + (':raw' if raw else '')
+
+    @staticmethod
+    def _cache_request_headers(session, headers):
+        # the headers the request is sent with, once requests merged them with
+        # the session's, for matching against those a response varies on
+        request_headers = requests.structures.CaseInsensitiveDict(session.headers or {})
+        request_headers.update(headers)
+        return request_headers
+
+    def _cache_lookup(self, request, request_headers, raw):
+        """
+        :return: the cached response to the request and its open body, or
+                 (None, None) if none is cached
+        :rtype:  tuple
+        """
+        entry = self._cache.lookup(request.url, request_headers, self._cache_scope(raw))
+        body = entry.open() if entry is not None else None
+        if body is None:
+            return None, None
+        return entry, body
+
+    def _finish_from_cache(self, request, report, entry, body, status):
+        """
+        Write a cached response to the request's destination, and fire the
+        events of a download.
+
+        :param entry:  cached response
+        :type  entry:  nectar.cache.CacheEntry
+        :param body:   its body, open for reading, which is closed
+        :type  body:   file
+        :param status: how the response was served from the cache
+        :type  status: str
+        :return: download report
+        :rtype:  nectar.report.DownloadReport
+        """
+        _logger.debug('Serving {url} from the cache.'.format(url=request.url))
+        report.cache_status = status
+        report.headers = entry.headers
+        report.total_bytes = entry.size
+        self.fire_download_headers(report)
+        try:
+            with body:
+                self._write_copy(request, report, body)
+        except Exception as e:
+            _logger.exception(e)
+            report.error_msg = str(e)
+            report.download_failed()
+        else:
+            report.download_succeeded()
+        self.finalize_file_handle(request, commit=False)
+        self.fire_download_progress(report)
+
+        if report.state is DOWNLOAD_SUCCEEDED:
+            self.fire_download_succeeded(report)
+        else:
+            self.fire_download_failed(report)
+        return report
+
+    def _copy_chunks(self, request, src_handle, dst_handle):
+        # in the kernel when the destination is a file that gets the bytes as
+        # they are, otherwise through Python
+        if not request.decompress:
+            try:
+                dst_handle.flush()
+                dst_fd = dst_handle.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass  # not a file, such as a StringIO
+            else:
+                return fastcopy.FileCopier(src_handle.fileno(), dst_fd, self.buffer_size)
+        return self._buffered_chunks(src_handle, dst_handle)
+
+    def _buffered_chunks(self, src_handle, dst_handle):
+        for chunk in self.chunk_generator(src_handle, self.buffer_size):
+            dst_handle.write(chunk)
+            yield len(chunk)
 
     @staticmethod
     def chunk_generator(raw, chunk_size):
@@ -250,10 +746,22 @@ class HTTPThreadedDownloader(Downloader):
         :return:    download report
         :rtype:     nectar.report.DownloadReport
         """
-        session = self._make_session()
-        return self._fetch(request, session)
-
-    def _fetch(self, request, session):
+        with self._engine_lock:
+            session = self._idle_sessions.pop() if self._idle_sessions else None
+        if session is None:
+            session = self._make_session()
+        hedged = self._hedged(request)
+        try:
+            with self._connections.track():
+                return self._fetch(request, session, hedged=hedged)
+        finally:
+            if hedged is not None:
+                hedged.close()
+            with self._engine_lock:
+                if self._engine_queue is not None:
+                    self._idle_sessions.append(session)
+
+    def _fetch(self, request, session, queue=None, hedged=None):
         """
         :param request: download request object with details about what to
                         download and where to put it
@@ -262,7 +770,16 @@ class HTTPThreadedDownloader(Downloader):
         :param request: requests.Session instance
         :type  request: requests.Session
 
-        :return:    download report
+        :param queue:   queue the request was taken from. If the request's host
+                        asks for it to be retried later, it is put back on this
+                        queue and None is returned. Without a queue, the
+                        current thread waits for the host instead.
+        :type  queue:   WorkerQueue
+
+        :param hedged:  hedge of the request, started if the request is slow
+        :type  hedged:  HedgedRequest
+
+        :return:    download report, or None if the request was put back on the queue
         :rtype:     nectar.report.DownloadReport
         """
         headers = (self.config.headers or {}).copy()
@@ -270,12 +787,54 @@ class HTTPThreadedDownloader(Downloader):
         headers.update(self.extra_headers.copy())
         ignore_encoding, additional_headers = self._rfc2616_workaround(request)
         headers.update(additional_headers or {})
+        raw = ignore_encoding or self.config.stream
+        if request.accept_encoding is not None:
+            # the body is decoded here rather than by requests, a piece at a time
+            for name in [n for n in headers if n.lower() == 'accept-encoding']:
+                del headers[name]
+            headers['Accept-Encoding'] = compression.accept_encoding(request.accept_encoding)
+            raw = False
         max_speed = self._calculate_max_speed()  # None or integer in bytes/second
-        report = DownloadReport.from_download_request(request)
-        report.download_started()
-        self.fire_download_started(report)
-        netloc = urlparse.urlparse(request.url).netloc
+        with self._pause_lock:
+            report, retries_after = self._deferred.pop(request, (None, 0))
+        if report is None:
+            report = DownloadReport.from_download_request(request)
+            report.download_started()
+            self.fire_download_started(report)
+
+        if delta.seed_for(request) is not None and not (self.is_canceled or request.canceled):
+            delta_report = self._fetch_delta(request, session, report, headers)
+            if delta_report is not None:
+                return delta_report
+
+        cached = cached_body = None
+        if self._cache is not None:
+            request_headers = self._cache_request_headers(session, headers)
+        if self._cache is not None and not (self.is_canceled or request.canceled):
+            cached, cached_body = self._cache_lookup(request, request_headers, raw)
+            if cached is not None and cached.is_fresh(request_headers):
+                return self._finish_from_cache(request, report, cached, cached_body,
+                                               cache.CACHE_HIT)
+            if cached is not None:
+                # only fetch it if it changed
+                cached_body.close()
+                headers.update(cached.validators())
+
+        deadline = None
+        if self.config.deadline is not None:
+            deadline = time.time() + self.config.deadline
+        # a failed, stalled or corrupt transfer is retried from the next mirror
+        urls = [request.url] + list(request.mirrors)
+        mirror = 0
+        cache_writer = None
         for nretry in range(DEFAULT_GENERIC_TRIES):
+            url = urls[mirror]
+            netloc = urlparse.urlparse(url).netloc
+            response = None
+            monitor = None
+            if cache_writer is not None:
+                cache_writer.abort()
+                cache_writer = None
             try:
                 if self.is_canceled or request.canceled:
                     raise DownloadCancelled(request.url)
@@ -283,37 +842,92 @@ class HTTPThreadedDownloader(Downloader):
                 if netloc in self.failed_netlocs:
                     raise SkipLocation()
 
-                _logger.debug("Attempting to connect to {url}.".format(url=request.url))
+                paused_until = self.netloc_paused_until(netloc)
+                if paused_until is not None:
+                    raise RetryLater(request.url, paused_until)
+
+                if hedged is not None and hedged.won:
+                    raise TransferExpired(url, inflight.EXPIRED_HEDGED)
+                monitor = self._watch_transfer(deadline, hedged, urls[(mirror + 1) % len(urls)])
+                if monitor is not None and monitor.check() is not None:
+                    raise TransferExpired(url, monitor.expired)
+
+                _logger.debug("Attempting to connect to {url}.".format(url=url))
                 requests_kwargs = self.requests_kwargs_from_nectar_config(self.config)
-                response = session.get(request.url, headers=headers,
-                                       timeout=(self.config.connect_timeout,
-                                                self.config.read_timeout),
-                                       **requests_kwargs)
+                if self._cache is not None:
+                    report.cache_status = cache.CACHE_MISS
+                response = self._get(session, url, monitor, headers=headers,
+                                     timeout=(self.config.connect_timeout,
+                                              self.config.read_timeout),
+                                     **requests_kwargs)
+
+                if response.status_code == httplib.NOT_MODIFIED and cached is not None:
+                    response.close()
+                    cached = self._cache.revalidated(cached, response.headers)
+                    cached_body = cached.open()
+                    if cached_body is not None:
+                        return self._finish_from_cache(request, report, cached, cached_body,
+                                                       cache.CACHE_REVALIDATED)
+                    # evicted since it was looked up
+                    for name in cached.validators():
+                        del headers[name]
+                    cached = None
+                    response = self._get(session, url, monitor, headers=headers,
+                                         timeout=(self.config.connect_timeout,
+                                                  self.config.read_timeout),
+                                         **requests_kwargs)
+
                 report.headers = response.headers
                 self.fire_download_headers(report)
 
+                if response.status_code in RETRY_AFTER_STATUS_CODES and \
+                        retries_after < self.tries:
+                    delay = parse_retry_after(response.headers.get('retry-after'))
+                    if delay is not None:
+                        response.close()
+                        retries_after += 1
+                        raise RetryLater(request.url, self.pause_netloc(netloc, delay))
+
                 if response.status_code != httplib.OK:
                     raise DownloadFailed(request.url, response.status_code, response.reason)
+                if monitor is not None:
+                    monitor.responded(self._expected_body_length(response, raw))
 
                 progress_interval = self.progress_interval
-                file_handle = request.initialize_file_handle()
+                file_handle = self._written_behind(request, self.initialize_file_handle(
+                    request, size=self._expected_body_length(response, raw)))
+                if self._cache is not None:
+                    cache_writer = self._cache.writer(request.url, request_headers,
+                                                      response.status_code, response.headers,
+                                                      self._cache_scope(raw))
 
                 last_update_time = datetime.datetime.now()
                 self.fire_download_progress(report)
 
-                if ignore_encoding or self.config.stream:
+                if raw or request.accept_encoding is not None:
                     chunks = self.chunk_generator(response.raw, self.buffer_size)
                 else:
                     chunks = response.iter_content(self.buffer_size)
+                if monitor is not None:
+                    chunks = self._watched_chunks(chunks, monitor, url)
+                if raw:
+                    chunks = self._decoded_chunks(chunks, None, report)
+                elif request.accept_encoding is not None:
+                    decoder = compression.ContentDecoder(
+                        response.headers.get('content-encoding'), self.buffer_size)
+                    chunks = self._decoded_chunks(chunks, decoder, report)
 
                 for chunk in chunks:
                     if self.is_canceled or request.canceled:
                         raise DownloadCancelled(request.url)
 
                     file_handle.write(chunk)
+                    if cache_writer is not None:
+                        cache_writer.write(chunk)
 
                     bytes_read = len(chunk)
                     report.bytes_downloaded += bytes_read
+                    report.bytes_decompressed = request.bytes_decompressed
 
                     now = datetime.datetime.now()
 
@@ -334,9 +948,38 @@ class HTTPThreadedDownloader(Downloader):
                         # before this second is up
                         time.sleep(0.5)
 
+                if self.is_canceled or request.canceled:
+                    # an aborted connection can look like the end of the body
+                    raise DownloadCancelled(request.url)
+                self._check_body_length(request, response, report, raw)
+                if hedged is not None and not hedged.race.claim(hedge.PRIMARY):
+                    raise TransferExpired(url, inflight.EXPIRED_HEDGED)
+                with self._behind_lock:
+                    behind_writer = self._behind_writers.get(request)
+                self.finalize_file_handle(request, commit=True)
+                if behind_writer is not None:
+                    report.write_stall_time = behind_writer.stall_time
+                if cache_writer is not None:
+                    cache_writer.commit()
+
                 # guarantee 1 report at the end
                 self.fire_download_progress(report)
 
+            except RetryLater as e:
+                if queue is not None:
+                    _logger.debug("Deferring {url} until {netloc} can be retried.".format(
+                        url=request.url, netloc=netloc)
+                    )
+                    with self._pause_lock:
+                        self._deferred[request] = (report, retries_after)
+                    queue.defer(request, e.args[1])
+                    return None
+                if nretry < DEFAULT_GENERIC_TRIES - 1:
+                    self._wait_until(e.args[1], request)
+                    continue
+                report.error_msg = _('{netloc} asked to be retried later').format(netloc=netloc)
+                report.download_failed()
+
             except SkipLocation:
                 _logger.debug("Skipping {url} because {netloc} could not be reached.".format(
                     url=request.url, netloc=netloc)
@@ -344,32 +987,103 @@ class HTTPThreadedDownloader(Downloader):
                 report.download_skipped()
 
             except requests.ConnectionError as e:
+                if self.is_canceled or request.canceled:
+                    # its connection was aborted
+                    report.download_canceled()
+                elif e.args and isinstance(e.args[0], urllib3_exceptions.ReadTimeoutError):
+                    # a read timeout part way through the body is reported by
+                    # requests as a connection error; treat it as a timeout
+                    self._timed_out(request, report)
                 # retry only if there's indication of connection reset
-                if nretry < DEFAULT_GENERIC_TRIES - 1 and e.args and e.args[0] == errno.ECONNRESET:
+                elif nretry < DEFAULT_GENERIC_TRIES - 1 and is_connection_reset(e):
                     _logger.debug(_("Connection reset. Retrying to connect to {url}.".format(
                         url=request.url))
                     )
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
                     continue
-                _logger.error(_('Skipping requests to {netloc} due to repeated connection'
-                                ' failures: {e}').format(netloc=netloc, e=str(e)))
-                self.failed_netlocs.add(netloc)
-                report.download_connection_error()
+                elif len(urls) > 1 and nretry < DEFAULT_GENERIC_TRIES - 1:
+                    mirror = (mirror + 1) % len(urls)
+                    _logger.info(_('Could not connect to {url}: {e}. Retrying from '
+                                   '{mirror}.').format(url=url, e=str(e), mirror=urls[mirror]))
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
+                    continue
+                else:
+                    _logger.error(_('Skipping requests to {netloc} due to repeated connection'
+                                    ' failures: {e}').format(netloc=netloc, e=str(e)))
+                    self.failed_netlocs.add(netloc)
+                    report.download_connection_error()
 
             except requests.Timeout:
-                """
-                Handle a timeout differently than a connection error. Do not add
-                to failed_netlocs so that a new connection can be attempted.
-                """
-                _logger.warning("Request Timeout - Connection with {url} timed out.".format(
-                    url=request.url)
-                )
-                report.download_connection_error()
+                if self.is_canceled or request.canceled:
+                    report.download_canceled()
+                else:
+                    self._timed_out(request, report)
 
             except DownloadCancelled as e:
                 _logger.info(str(e))
                 report.download_canceled()
 
+            except TransferExpired as e:
+                if self.is_canceled or request.canceled:
+                    report.download_canceled()
+                elif e.args[1] == inflight.EXPIRED_HEDGED:
+                    # landed below
+                    _logger.info('The hedge of {url} finished first.'.format(url=request.url))
+                    report.error_msg = _('The hedge of the request finished first')
+                    report.download_failed()
+                elif e.args[1] == inflight.EXPIRED_STALLED and nretry < DEFAULT_GENERIC_TRIES - 1:
+                    mirror = (mirror + 1) % len(urls)
+                    _logger.info(_('Transfer from {url} stalled. Retrying from {mirror}.').format(
+                        url=url, mirror=urls[mirror]))
+                    if response is not None:
+                        response.close()
+                    self._connections.watch(None)
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
+                    continue
+                else:
+                    _logger.info('Transfer from {url} expired: {reason}'.format(
+                        url=url, reason=e.args[1]))
+                    report.error_msg = self._expired_msg(e.args[1])
+                    report.error_report['expired'] = e.args[1]
+                    report.download_failed()
+
+            except sink.VerificationFailed as e:
+                if len(urls) > 1 and nretry < DEFAULT_GENERIC_TRIES - 1:
+                    mirror = (mirror + 1) % len(urls)
+                    _logger.info(_('Transfer from {url} is corrupt: {e}. Retrying from '
+                                   '{mirror}.').format(url=url, e=str(e), mirror=urls[mirror]))
+                    if response is not None:
+                        response.close()
+                    if monitor is not None:
+                        self._connections.watch(None)
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
+                    continue
+                _logger.info('Transfer from {url} is corrupt: {e}'.format(url=url, e=str(e)))
+                report.error_msg = str(e)
+                report.error_report['verification'] = str(e)
+                report.download_failed()
+
             except DownloadFailed as e:
+                if len(urls) > 1 and nretry < DEFAULT_GENERIC_TRIES - 1:
+                    mirror = (mirror + 1) % len(urls)
+                    _logger.info(_('Download from {url} failed: {e}. Retrying from '
+                                   '{mirror}.').format(url=url, e=str(e), mirror=urls[mirror]))
+                    if response is not None:
+                        response.close()
+                    if monitor is not None:
+                        self._connections.watch(None)
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
+                    continue
                 _logger.info('Download failed: %s' % str(e))
                 report.error_msg = e.args[2]
                 report.error_report['response_code'] = e.args[1]
@@ -377,23 +1091,44 @@ class HTTPThreadedDownloader(Downloader):
                 report.download_failed()
 
             except Exception as e:
+                if self.is_canceled or request.canceled:
+                    # its connection was aborted
+                    _logger.info('Download canceled: %s' % request.url)
+                    report.download_canceled()
                 # retry only if there's indication of connection reset
-                if nretry < DEFAULT_GENERIC_TRIES - 1 and e.args and e.args[0] == errno.ECONNRESET:
+                elif nretry < DEFAULT_GENERIC_TRIES - 1 and is_connection_reset(e):
                     _logger.debug(_("Connection reset. Retrying to connect to {url}.".format(
                         url=request.url))
                     )
+                    self.finalize_file_handle(request, commit=False)
+                    report.bytes_downloaded = 0
+                    report.wire_bytes = None
                     continue
-                _logger.exception(e)
-                report.error_msg = str(e)
-                report.download_failed()
+                else:
+                    _logger.exception(e)
+                    report.error_msg = str(e)
+                    report.download_failed()
 
             else:
                 _logger.info("Download succeeded: {url}.".format(
                     url=request.url)
                 )
                 report.download_succeeded()
-
-            request.finalize_file_handle()
+                if self._hedging is not None and monitor is not None:
+                    self._hedging.record(monitor.responded_at - monitor.started,
+                                         report.bytes_downloaded, time.time() - monitor.started)
+
+            if monitor is not None:
+                self._connections.watch(None)
+            if response is not None and report.state is not DOWNLOAD_SUCCEEDED:
+                # a body that wasn't read to the end holds on to its
+                # connection until it is closed
+                response.close()
+            if cache_writer is not None:
+                cache_writer.abort()
+            self.finalize_file_handle(request, commit=False)
+            if report.state is DOWNLOAD_FAILED and hedged is not None and hedged.wait():
+                self._land_hedge(request, report, hedged)
 
             if report.state is DOWNLOAD_SUCCEEDED:
                 self.fire_download_succeeded(report)
@@ -402,6 +1137,369 @@ class HTTPThreadedDownloader(Downloader):
 
             return report
 
+    # -- write-behind ----------------------------------------------------------
+
+    def _written_behind(self, request, file_handle):
+        """
+        :return: writer that hands the chunks written to it over to the I/O
+                 threads, if there are any, or the file handle
+        """
+        if self.write_behind is None:
+            return file_handle
+        sinks = None
+        if isinstance(file_handle, SinkWriter):
+            # the sinks are still written to by the worker, so that they hold
+            # up the reads, and reject a corrupt chunk, as it is read
+            sinks, file_handle = file_handle.sinks, file_handle.file_handle
+        writer = self.write_behind.writer(file_handle)
+        with self._behind_lock:
+            self._behind_writers[request] = writer
+        if sinks is not None:
+            return SinkWriter(writer, sinks)
+        return writer
+
+    def finalize_file_handle(self, request, commit):
+        """
+        Wait for the request's chunks to be written by the I/O threads, or drop
+        them if the download did not succeed, and close its file handle.
+
+        :raises Exception: what writing the chunks raised
+        """
+        with self._behind_lock:
+            writer = self._behind_writers.pop(request, None)
+        if writer is not None:
+            if commit:
+                writer.drain()
+            else:
+                writer.discard()
+        super(HTTPThreadedDownloader, self).finalize_file_handle(request, commit)
+
+    # -- delta updates ---------------------------------------------------------
+
+    def _fetch_delta(self, request, session, report, headers):
+        """
+        Update the previous download at the request's destination with only
+        the blocks of the file that changed, fetched with multi-range
+        requests. The new file is staged, and replaces the previous download
+        once it was checked against the digest in the block index.
+
+        :param request: download request, whose delta is set
+        :type  request: nectar.request.DownloadRequest
+        :param session: requests.Session instance
+        :type  session: requests.Session
+        :param report:  report of the request
+        :type  report:  nectar.report.DownloadReport
+        :param headers: headers of the request
+        :type  headers: dict
+        :return: download report, or None if the file is to be downloaded in
+                 full instead
+        :rtype:  nectar.report.DownloadReport
+        """
+        requests_kwargs = self.requests_kwargs_from_nectar_config(self.config)
+        timeout = (self.config.connect_timeout, self.config.read_timeout)
+        # the ranges are of the file, not of an encoding of it
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})
+        assembler = None
+        try:
+            index = request.delta
+            if isinstance(index, basestring):
+                response = session.get(index, headers=headers, timeout=timeout,
+                                       **requests_kwargs)
+                if response.status_code != httplib.OK:
+                    response.close()
+                    raise delta.DeltaError('No block index at %s' % index)
+                index = delta.BlockIndex.load(StringIO(response.content))
+            plan = index.plan(request.destination)
+            if not plan.local:
+                raise delta.DeltaError('No block of the previous download matches')
+            _logger.debug('Updating {url} with {n} of its {total} bytes.'.format(
+                url=request.url, n=plan.fetched_bytes, total=index.size))
+
+            report.total_bytes = index.size
+            assembler = delta.Assembler(
+                plan, self.initialize_file_handle(request, size=index.size, staged=True))
+            for spans in plan.batches():
+                if self.is_canceled or request.canceled:
+                    raise DownloadCancelled(request.url)
+                response = session.get(request.url, timeout=timeout,
+                                       headers=dict(headers, Range=delta.range_header(spans)),
+                                       **requests_kwargs)
+                try:
+                    if response.status_code != httplib.PARTIAL_CONTENT:
+                        raise delta.DeltaError('Ranges of {url} refused: {code}'.format(
+                            url=request.url, code=response.status_code))
+                    report.headers = response.headers
+                    pieces = delta.iter_ranges(response.headers.get('content-type'),
+                                               response.headers.get('content-range'),
+                                               response.iter_content(self.buffer_size))
+                    for offset, data in pieces:
+                        assembler.remote(offset, data)
+                        report.bytes_downloaded += len(data)
+                finally:
+                    response.close()
+                self.fire_download_progress(report)
+            assembler.finish()
+            self.finalize_file_handle(request, commit=True)
+
+        except DownloadCancelled as e:
+            _logger.info(str(e))
+            report.download_canceled()
+        except Exception as e:
+            if self.is_canceled or request.canceled:
+                report.download_canceled()
+            else:
+                _logger.info(_('Could not update {url} with a delta, downloading it in full: '
+                               '{e}').format(url=request.url, e=str(e)))
+                self.finalize_file_handle(request, commit=False)
+                report.headers = None
+                report.bytes_downloaded = 0
+                report.total_bytes = request.size
+                return None
+        else:
+            _logger.info('Download succeeded: {url}.'.format(url=request.url))
+            report.strategy = delta.STRATEGY_DELTA
+            report.download_succeeded()
+        finally:
+            if assembler is not None:
+                assembler.close()
+
+        self.finalize_file_handle(request, commit=False)
+        self.fire_download_progress(report)
+        if report.state is DOWNLOAD_SUCCEEDED:
+            self.fire_download_succeeded(report)
+        else:
+            self.fire_download_failed(report)
+        return report
+
+    # -- transfer limits -------------------------------------------------------
+
+    def _watch_transfer(self, deadline, hedged=None, hedge_url=None):
+        """
+        Hold the transfer the current thread is about to make to the deadline,
+        and to the minimum throughput of the configuration, if any, and hedge
+        it once it is slow.
+
+        :param deadline:  time, as returned by time.time(), by which the request
+                          must be done, or None
+        :type  deadline:  float
+        :param hedged:    hedge of the request, or None
+        :type  hedged:    HedgedRequest
+        :param hedge_url: url the hedge is fetched from
+        :type  hedge_url: str
+        :return: monitor of the transfer, or None if there are no limits and
+                 the latencies of the requests are not learned
+        :rtype:  nectar.inflight.TransferMonitor
+        """
+        if deadline is None and self.config.min_speed is None and self._hedging is None:
+            return None
+        monitor = inflight.TransferMonitor(
+            deadline, self.config.min_speed,
+            self.config.min_speed_window or inflight.DEFAULT_SPEED_WINDOW)
+        if hedged is not None:
+            monitor.slow = self._hedging.delays()
+            monitor.on_slow = lambda: hedged.start(hedge_url)
+        self._connections.watch(monitor)
+        return monitor
+
+    @staticmethod
+    def _get(session, url, monitor, **kwargs):
+        # the connection of an expired transfer is aborted, which surfaces as
+        # whatever error the aborted socket operation raises
+        try:
+            return session.get(url, **kwargs)
+        except Exception:
+            if monitor is not None and monitor.expired is not None:
+                raise TransferExpired(url, monitor.expired)
+            raise
+
+    @staticmethod
+    def _watched_chunks(chunks, monitor, url):
+        """
+        Count the chunks of a transfer on its monitor.
+
+        :raises TransferExpired: if the transfer was aborted by the monitor,
+                which can also look like the end of the body
+        """
+        chunks = iter(chunks)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception:
+                if monitor.expired is not None:
+                    raise TransferExpired(url, monitor.expired)
+                raise
+            monitor.update(len(chunk))
+            yield chunk
+        if monitor.expired is not None:
+            raise TransferExpired(url, monitor.expired)
+
+    @staticmethod
+    def _decoded_chunks(chunks, decoder, report):
+        """
+        Count the chunks of a body as they were received, as the report's wire
+        bytes, and decode them.
+
+        :param decoder: decoder of the body's content coding, None to pass the
+                        chunks on as they are
+        :type  decoder: nectar.compression.ContentDecoder
+        """
+        report.wire_bytes = 0
+
+        def received():
+            for chunk in chunks:
+                report.wire_bytes += len(chunk)
+                yield chunk
+
+        if decoder is None:
+            return received()
+        return decoder.decoded(received())
+
+    # -- hedging ---------------------------------------------------------------
+
+    def _hedged(self, request):
+        """
+        :return: the hedge of a request about to be fetched, or None if it
+                 cannot be hedged
+        :rtype:  HedgedRequest
+        """
+        if self._hedging is None:
+            return None
+        self._hedging.request_started()
+        # like a duplicate, the request gets a copy of the hedge's file
+        if not self._can_lead(request):
+            return None
+        return HedgedRequest(self, request)
+
+    def _land_hedge(self, request, report, hedged):
+        """
+        Write the file fetched by the hedge of a request, which won, to the
+        request's destination.
+        """
+        report.state = report.DOWNLOAD_DOWNLOADING
+        report.error_msg = None
+        report.error_report = {}
+        report.bytes_downloaded = 0
+        report.headers = hedged.report.headers
+        try:
+            with open(hedged.path, 'rb') as src_handle:
+                self._write_copy(request, report, src_handle)
+        except Exception as e:
+            _logger.exception(e)
+            report.error_msg = str(e)
+            report.download_failed()
+        else:
+            report.download_succeeded()
+        self.finalize_file_handle(request, commit=False)
+        self.fire_download_progress(report)
+
+    def _expired_msg(self, reason):
+        if reason == inflight.EXPIRED_DEADLINE:
+            return _('The deadline of {seconds} seconds passed').format(
+                seconds=self.config.deadline)
+        return _('The transfer stalled below {speed} bytes per second').format(
+            speed=self.config.min_speed)
+
+    def pause_netloc(self, netloc, seconds):
+        """
+        Hold back all requests to the given location for a number of seconds.
+        An existing, longer, pause of the location is left as it is.
+
+        :param netloc:  network location, as parsed from a request url
+        :type  netloc:  str
+        :param seconds: number of seconds to pause the location for
+        :type  seconds: float
+        :return: time, as returned by time.time(), until which the location is paused
+        :rtype:  float
+        """
+        until = time.time() + min(seconds, MAX_RETRY_AFTER)
+        with self._pause_lock:
+            until = max(until, self.paused_netlocs.get(netloc, 0))
+            self.paused_netlocs[netloc] = until
+        _logger.info(_('Pausing requests to {netloc} for {seconds} seconds').format(
+            netloc=netloc, seconds=seconds))
+        return until
+
+    def netloc_paused_until(self, netloc):
+        """
+        :param netloc: network location, as parsed from a request url
+        :type  netloc: str
+        :return: time until which the location is paused, or None if it is not
+        :rtype:  float or None
+        """
+        if not self.paused_netlocs:
+            return None
+        with self._pause_lock:
+            until = self.paused_netlocs.get(netloc)
+            if until is not None and until <= time.time():
+                del self.paused_netlocs[netloc]
+                until = None
+        return until
+
+    def _request_paused_until(self, request):
+        if not self.paused_netlocs:
+            return None
+        return self.netloc_paused_until(urlparse.urlparse(request.url).netloc)
+
+    def _wait_until(self, until, request):
+        # sleep in short steps so that cancellation is noticed
+        while not (self.is_canceled or request.canceled):
+            remaining = until - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, WorkerQueue.POLL_INTERVAL))
+
+    @staticmethod
+    def _timed_out(request, report):
+        """
+        Handle a timeout differently than a connection error. Do not add
+        to failed_netlocs so that a new connection can be attempted.
+        """
+        _logger.warning("Request Timeout - Connection with {url} timed out.".format(
+            url=request.url)
+        )
+        report.download_connection_error()
+
+    @staticmethod
+    def _expected_body_length(response, raw):
+        """
+        The length of the body, as announced by the Content-Length header. It is
+        only known when the bytes counted are the bytes sent, that is when the
+        body is read raw or is not content-encoded.
+
+        :return: length of the body in bytes, or None if it is not known
+        :rtype:  int or None
+        """
+        if not raw and response.headers.get('content-encoding'):
+            return None
+        try:
+            return int(response.headers.get('content-length'))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _check_body_length(cls, request, response, report, raw):
+        """
+        Make sure the whole body announced by the Content-Length header arrived.
+
+        The underlying libraries silently return a short body when the server
+        closes or resets the connection part way through it.
+
+        :raises DownloadFailed: if fewer bytes than announced were received
+        """
+        if report.wire_bytes is not None:
+            # the body as it was sent, before it was decoded
+            content_length = cls._expected_body_length(response, True)
+            received = report.wire_bytes
+        else:
+            content_length = cls._expected_body_length(response, raw)
+            received = report.bytes_downloaded
+        if content_length is not None and received < content_length:
+            msg = _('Incomplete body: received %(r)d of %(t)d bytes') % {
+                'r': received, 't': content_length}
+            raise DownloadFailed(request.url, response.status_code, msg)
+
     @staticmethod
     def _rfc2616_workaround(request):
         # this is to deal with broken web servers that violate RFC 2616 by sending
@@ -442,9 +1540,157 @@ class HTTPThreadedDownloader(Downloader):
             super(HTTPThreadedDownloader, self)._fire_event_to_listener(event_listener_callback,
                                                                         *args, **kwargs)
 
+# -- hedged requests -----------------------------------------------------------
+
+
+class HedgedRequest(object):
+    """
+    Duplicate of a request, fetched by a downloader of its own to a temporary
+    file next to the request's destination, once the request is slow. The
+    first of the two to finish wins; when the duplicate does, the connection of
+    the request is aborted, and its destination gets a copy of the file.
+    """
+
+    def __init__(self, downloader, request):
+        """
+        :param downloader: downloader fetching the request
+        :type  downloader: HTTPThreadedDownloader
+        :param request:    request, fetched by the current thread
+        :type  request:    nectar.request.DownloadRequest
+        """
+        self.downloader = downloader
+        self.request = request
+        self.race = hedge.Race()
+        self.path = None
+        self.report = None
+        self._ident = threading.current_thread().ident
+        self._child = None
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def won(self):
+        return self.race.winner == hedge.HEDGE
+
+    def start(self, url):
+        """
+        Start fetching the duplicate in a thread of its own, if it was not
+        already, and the budget allows it.
+
+        :param url: url to fetch the duplicate from
+        :type  url: str
+        """
+        with self._lock:
+            if self._closed or self._thread is not None or \
+                    not self.downloader._hedging.spend():
+                return
+            _logger.debug('Hedging {url} with {hedge}.'.format(url=self.request.url, hedge=url))
+            directory = os.path.dirname(os.path.abspath(self.request.destination))
+            fd, self.path = tempfile.mkstemp(dir=directory, prefix=HEDGE_PREFIX)
+            os.close(fd)
+            self._child = self._make_child()
+            self._thread = threading.Thread(target=self._fetch, args=[url])
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _make_child(self):
+        # the child shares the cache and the write-behind I/O threads of the
+        # downloader, instead of making its own, records nothing in the
+        # journal, and does not hedge
+        downloader = self.downloader
+        config = copy.copy(downloader.config)
+        config.cache_dir = None
+        config.journal_path = None
+        config.write_behind_threads = None
+        config.hedge_percentile = None
+        child = HTTPThreadedDownloader(config, tries=downloader.tries, session=downloader.session)
+        if downloader._cache is not None:
+            child._cache = downloader._cache
+            child._credentials_scope = downloader._credentials_scope
+        child.write_behind = downloader.write_behind
+        return child
+
+    def _fetch(self, url):
+        request = DownloadRequest(url, self.path, headers=self.request.headers,
+                                  accept_encoding=self.request.accept_encoding)
+        self.report = self._child.download_one(request)
+        if self.report.state is DOWNLOAD_SUCCEEDED and self.race.claim(hedge.HEDGE):
+            self.downloader._connections.expire(self._ident, inflight.EXPIRED_HEDGED)
+
+    def wait(self):
+        """
+        Wait for the duplicate, if it was started, to finish.
+
+        :return: True if the duplicate won
+        :rtype:  bool
+        """
+        if self._thread is None:
+            return False
+        self._thread.join()
+        return self.won
+
+    def close(self):
+        """
+        Cancel the duplicate, unless it won, and remove its file.
+        """
+        with self._lock:
+            self._closed = True
+        if self._thread is None:
+            return
+        if not self.won:
+            self._child.cancel()
+        self._thread.join()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
 # -- requests utilities --------------------------------------------------------
 
 
+def parse_retry_after(value):
+    """
+    Parse the value of a Retry-After header, which is either a number of seconds
+    or an HTTP date.
+
+    :param value: header value
+    :type  value: str or None
+    :return: number of seconds to wait, or None if the value cannot be parsed
+    :rtype:  float or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - time.time(), 0.0)
+
+
+def is_connection_reset(e):
+    """
+    Tell whether an exception is, or wraps, a connection reset by the peer;
+    requests and urllib3 wrap the socket error of a reset part way through
+    the body in their own exceptions.
+
+    :param e: exception raised by a request
+    :type  e: Exception
+    :return: True if the connection was reset
+    :rtype:  bool
+    """
+    if isinstance(e, EnvironmentError) and e.errno == errno.ECONNRESET:
+        return True
+    for arg in getattr(e, 'args', ()):
+        if arg == errno.ECONNRESET:
+            return True
+        if isinstance(arg, BaseException) and arg is not e and is_connection_reset(arg):
+            return True
+    return False
+
+
 def build_session(config, session=None):
     """This method is deprecated: it is not thread-safe."""
     if session is None:
@@ -518,28 +1764,202 @@ def _add_proxy(session, config):
 class WorkerQueue(object):
     """
     Simple, thread-safe, wrapper around an iterable.
+
+    Items can be put back on the queue with a time before which they should not
+    be handed out again. While deferred items wait, the rest of the iterable is
+    served.
     """
 
-    def __init__(self, iterable):
+    POLL_INTERVAL = 0.5  # seconds
+
+    def __init__(self, iterable, not_before=None):
+        """
+        :param iterable:   items to hand out
+        :type  iterable:   iterable
+        :param not_before: optional callable that takes an item and returns the
+                           time, as returned by time.time(), before which it
+                           should not be handed out, or None
+        :type  not_before: callable
+        """
         self._iterable = iterable
         self._generator = _generator_wrapper(self._iterable)
+        self._not_before = not_before
+        self._deferred = []  # heap of (time, sequence number, item)
+        self._sequence = 0
+        self._exhausted = False
+        self._closed = False
 
         self._lock = threading.Lock()
-        self.finished = False
+
+    @property
+    def finished(self):
+        return self._closed or (self._exhausted and not self._deferred)
 
     def get(self):
         """
-        Get the next item from the queue in a thread-safe manner.
-        Returns None if the queue is empty.
+        Get the next item from the queue in a thread-safe manner. If only
+        deferred items are left, this blocks until the first of them is due.
+        Returns None if the queue is empty or closed.
         :return: next item in the queue or None
         """
+        while True:
+            with self._lock:
+                item, wait = self._next()
+            if wait is None:
+                return item
+            time.sleep(min(wait, self.POLL_INTERVAL))
+
+    def _next(self):
+        # returns the next item, or the number of seconds to wait for one
+        while not self._closed:
+            now = time.time()
+            if self._deferred and self._deferred[0][0] <= now:
+                item = heapq.heappop(self._deferred)[2]
+            elif self._exhausted:
+                if not self._deferred:
+                    return None, None
+                return None, self._deferred[0][0] - now
+            else:
+                try:
+                    item = next(self._generator)
+                except StopIteration:
+                    self._exhausted = True
+                    continue
+            until = self._not_before(item) if self._not_before else None
+            if until is None or until <= now:
+                return item, None
+            self._push(item, until)
+        return None, None
+
+    def _push(self, item, until):
+        heapq.heappush(self._deferred, (until, self._sequence, item))
+        self._sequence += 1
+
+    def defer(self, item, until):
+        """
+        Put an item back on the queue, to be handed out again no earlier than
+        the given time.
+
+        :param item:  item taken from this queue
+        :param until: time, as returned by time.time()
+        :type  until: float
+        """
         with self._lock:
-            try:
-                return next(self._generator)
-            except StopIteration:
-                self.finished = True
-            self.finished = True
-            return None
+            self._push(item, until)
+
+    def close(self):
+        """
+        Stop handing out items. Subsequent and waiting calls to get return None.
+        """
+        self._closed = True
+
+    def drain(self):
+        """
+        Close the queue, and iterate over the items it had left to hand out,
+        the deferred ones first.
+        """
+        with self._lock:
+            self._closed = True
+            deferred, self._deferred = self._deferred, []
+            exhausted, self._exhausted = self._exhausted, True
+        for until, sequence, item in sorted(deferred):
+            yield item
+        if not exhausted:
+            for item in self._generator:
+                yield item
+
+
+class SubmissionQueue(WorkerQueue):
+    """
+    WorkerQueue of the engine, that requests are submitted to one at a time.
+    Getting an item waits for one to be submitted, until the queue is
+    finished or closed.
+    """
+
+    def __init__(self, not_before=None):
+        """
+        :param not_before: optional callable that takes an item and returns the
+                           time, as returned by time.time(), before which it
+                           should not be handed out, or None
+        :type  not_before: callable
+        """
+        super(SubmissionQueue, self).__init__((), not_before)
+        self._submitted = collections.deque()
+        self._finishing = False
+        self._available = threading.Condition(self._lock)
+
+    @property
+    def finished(self):
+        return self._closed or (self._finishing and not self._submitted and not self._deferred)
+
+    def put(self, item):
+        """
+        Submit an item.
+
+        :return: False if the queue is finished or closed, and the item was not queued
+        :rtype:  bool
+        """
+        with self._lock:
+            if self._closed or self._finishing:
+                return False
+            self._submitted.append(item)
+            self._available.notify()
+        return True
+
+    def get(self):
+        with self._lock:
+            while True:
+                item, wait = self._next()
+                if wait is None:
+                    return item
+                self._available.wait(min(wait, self.POLL_INTERVAL))
+
+    def _next(self):
+        while not self._closed:
+            now = time.time()
+            if self._deferred and self._deferred[0][0] <= now:
+                item = heapq.heappop(self._deferred)[2]
+            elif self._submitted:
+                item = self._submitted.popleft()
+            elif self._deferred:
+                return None, self._deferred[0][0] - now
+            elif self._finishing:
+                return None, None
+            else:
+                return None, self.POLL_INTERVAL
+            until = self._not_before(item) if self._not_before else None
+            if until is None or until <= now:
+                return item, None
+            self._push(item, until)
+        return None, None
+
+    def defer(self, item, until):
+        with self._lock:
+            self._push(item, until)
+            self._available.notify()
+
+    def finish(self):
+        """
+        Stop taking items. Once those left are handed out, getting returns None.
+        """
+        with self._lock:
+            self._finishing = True
+            self._available.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._available.notify_all()
+
+    def drain(self):
+        with self._lock:
+            self._closed = True
+            self._available.notify_all()
+            submitted, self._submitted = self._submitted, collections.deque()
+        for item in super(SubmissionQueue, self).drain():
+            yield item
+        for item in submitted:
+            yield item
 
 
 def _generator_wrapper(iterable):
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Kernel file copies: files are copied between file descriptors by the kernel,
+with FICLONE reflinks, copy_file_range or sendfile, instead of being read into
+and written back out of Python. Where none of these are supported, the copy
+falls back to reading and writing buffers.
+
+It also names the strategies the local file downloader can put files in place
+with, of which the copy strategies use the methods here.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+try:
+    import fcntl
+except ImportError:  # not a POSIX platform
+    fcntl = None
+
+
+# copy methods, in the order they are tried
+METHOD_REFLINK = 'reflink'
+METHOD_COPY_FILE_RANGE = 'copy_file_range'
+METHOD_SENDFILE = 'sendfile'
+METHOD_BUFFERED = 'buffered'
+METHODS = (METHOD_REFLINK, METHOD_COPY_FILE_RANGE, METHOD_SENDFILE, METHOD_BUFFERED)
+
+# strategies for putting local files in place, see DownloaderConfig.link_strategies
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_HARDLINK = 'hardlink'
+STRATEGY_SYMLINK = 'symlink'
+STRATEGY_COPY = 'copy'  # copy_file_range or sendfile
+STRATEGY_BUFFERED = 'buffered'
+STRATEGIES = (STRATEGY_REFLINK, STRATEGY_HARDLINK, STRATEGY_SYMLINK, STRATEGY_COPY,
+              STRATEGY_BUFFERED)
+
+# copy methods used by each of the copy strategies
+STRATEGY_METHODS = {
+    STRATEGY_REFLINK: [METHOD_REFLINK],
+    STRATEGY_COPY: [METHOD_COPY_FILE_RANGE, METHOD_SENDFILE],
+    STRATEGY_BUFFERED: [METHOD_BUFFERED],
+}
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), from linux/fs.h
+
+# errors that mean a copy method isn't supported for the given files, rather
+# than that the copy failed
+UNSUPPORTED_ERRNOS = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                                errno.ENOTTY, errno.EBADF])
+
+
+class UnsupportedCopy(Exception):
+    """
+    Raised when a copy method isn't supported for the given files.
+    """
+
+
+def _find_libc_function(names, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_ssize_t
+            return func
+    return None
+
+
+_copy_file_range = _find_libc_function(
+    ['copy_file_range'],
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _find_libc_function(
+    ['sendfile64', 'sendfile'],
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+
+def _call(func, *args):
+    # call a libc function that sets errno, retrying when interrupted
+    while True:
+        result = func(*args)
+        if result >= 0:
+            return result
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err in UNSUPPORTED_ERRNOS:
+            raise UnsupportedCopy(os.strerror(err))
+        raise OSError(err, os.strerror(err))
+
+
+def reflink(src_fd, dst_fd):
+    """
+    Make the destination share the source's data blocks, on file systems that
+    support it, such as btrfs and XFS. The destination's offset is moved to the
+    end of the file, as if it had been written.
+
+    :param src_fd: file descriptor of the source, open for reading
+    :type  src_fd: int
+    :param dst_fd: file descriptor of the destination, open for writing
+    :type  dst_fd: int
+    :return: number of bytes copied
+    :rtype:  int
+    :raises UnsupportedCopy: if the files can't be reflinked
+    """
+    if fcntl is None:
+        raise UnsupportedCopy('reflinks are not supported on this platform')
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            raise UnsupportedCopy(e.strerror)
+        raise
+    size = os.fstat(src_fd).st_size
+    os.lseek(src_fd, size, os.SEEK_SET)
+    os.lseek(dst_fd, size, os.SEEK_SET)
+    return size
+
+
+def copy_file_range(src_fd, dst_fd, count):
+    """
+    Copy up to count bytes from the source's offset to the destination's, in
+    the kernel. Both offsets are advanced.
+
+    :return: number of bytes copied; 0 at the end of the source
+    :rtype:  int
+    :raises UnsupportedCopy: if the kernel can't copy between the files
+    """
+    if _copy_file_range is None:
+        raise UnsupportedCopy('copy_file_range is not available')
+    return _call(_copy_file_range, src_fd, None, dst_fd, None, count, 0)
+
+
+def sendfile(src_fd, dst_fd, count):
+    """
+    Copy up to count bytes from the source's offset to the destination's, in
+    the kernel. Both offsets are advanced.
+
+    :return: number of bytes copied; 0 at the end of the source
+    :rtype:  int
+    :raises UnsupportedCopy: if the kernel can't copy between the files
+    """
+    if _sendfile is None:
+        raise UnsupportedCopy('sendfile is not available')
+    return _call(_sendfile, dst_fd, src_fd, None, count)
+
+
+def buffered(src_fd, dst_fd, count):
+    """
+    Copy up to count bytes from the source's offset to the destination's,
+    through a buffer.
+
+    :return: number of bytes copied; 0 at the end of the source
+    :rtype:  int
+    """
+    data = os.read(src_fd, count)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(dst_fd, view):]
+    return len(data)
+
+
+_COPY_FUNCTIONS = {
+    METHOD_COPY_FILE_RANGE: copy_file_range,
+    METHOD_SENDFILE: sendfile,
+    METHOD_BUFFERED: buffered,
+}
+
+
+class FileCopier(object):
+    """
+    Iterator that copies a file from one file descriptor to another, from their
+    current offsets, yielding the number of bytes copied in each chunk, so that
+    the caller can report progress and stop between chunks.
+
+    The methods are tried in order. When one isn't supported, the next one
+    carries on from where it stopped. A reflink, which is only tried when
+    nothing has been copied yet, copies the whole file in one chunk.
+
+    :ivar method: the method the last chunk was copied with
+    """
+
+    def __init__(self, src_fd, dst_fd, chunk_size, methods=METHODS):
+        """
+        :param src_fd:     file descriptor of the source, open for reading
+        :type  src_fd:     int
+        :param dst_fd:     file descriptor of the destination, open for writing
+        :type  dst_fd:     int
+        :param chunk_size: maximum number of bytes copied per chunk
+        :type  chunk_size: int
+        :param methods:    copy methods to try, out of METHODS
+        :type  methods:    sequence of str
+        """
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.chunk_size = chunk_size
+        self.method = None
+        self.bytes_copied = 0
+
+        self._methods = list(methods)
+        self._copied_by_method = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._methods:
+            method = self._methods[0]
+            try:
+                if method == METHOD_REFLINK:
+                    copied = self._reflink()
+                else:
+                    copied = _COPY_FUNCTIONS[method](self.src_fd, self.dst_fd, self.chunk_size)
+            except UnsupportedCopy:
+                self._next_method()
+                continue
+
+            if copied == 0:
+                # Some file systems, such as /proc, report files as empty to
+                # the kernel copy functions; only trust the end of file from
+                # a method that has already copied something.
+                if method == METHOD_BUFFERED or self._copied_by_method:
+                    self._methods = []
+                    break
+                self._next_method()
+                continue
+
+            self.method = method
+            self.bytes_copied += copied
+            self._copied_by_method = True
+            if method == METHOD_REFLINK:
+                self._methods = []
+            return copied
+        raise StopIteration()
+
+    def _reflink(self):
+        if self.bytes_copied or os.lseek(self.src_fd, 0, os.SEEK_CUR) or \
+                os.lseek(self.dst_fd, 0, os.SEEK_CUR):
+            raise UnsupportedCopy('only whole files can be reflinked')
+        return reflink(self.src_fd, self.dst_fd)
+
+    def _next_method(self):
+        self._methods.pop(0)
+        self._copied_by_method = False
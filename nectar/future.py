@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Futures of the reports of the requests submitted to a downloader's engine.
+"""
+
+import logging
+import threading
+
+from nectar.report import DownloadReport
+
+
+_LOG = logging.getLogger(__name__)
+
+# seconds a wait for a report blocks at a time, so that signals are handled
+WAIT_POLL_INTERVAL = 1.0
+
+
+class TimeoutError(Exception):
+    """
+    Raised when the report of a request is not ready in time.
+    """
+
+
+class DownloadFuture(object):
+    """
+    Report of a submitted request, once it is downloaded. A failed download
+    does not raise: its report says why it failed.
+
+    :ivar request: the submitted request
+    """
+
+    def __init__(self, request):
+        """
+        :param request: the submitted request
+        :type  request: nectar.request.DownloadRequest
+        """
+        self.request = request
+        self._report = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        :return: True if the request was downloaded, failed or was canceled
+        :rtype:  bool
+        """
+        return self._done.is_set()
+
+    def cancel(self):
+        """
+        Cancel the request, if it is not done yet. Its report is then canceled.
+
+        :return: True if the request was not done yet
+        :rtype:  bool
+        """
+        if self.done():
+            return False
+        self.request.canceled = True
+        return True
+
+    def result(self, timeout=None):
+        """
+        Wait for the report of the request.
+
+        :param timeout: seconds to wait at most, None to wait for as long as it takes
+        :type  timeout: float
+        :return: report of the request
+        :rtype:  nectar.report.DownloadReport
+        :raises TimeoutError: if the report is not ready in time
+        """
+        remaining = timeout
+        # a wait without a timeout cannot be interrupted
+        while not self._done.wait(WAIT_POLL_INTERVAL if remaining is None
+                                  else min(remaining, WAIT_POLL_INTERVAL)):
+            if remaining is not None:
+                remaining -= WAIT_POLL_INTERVAL
+                if remaining <= 0:
+                    raise TimeoutError(self.request.url)
+        return self._report
+
+    def add_done_callback(self, callback):
+        """
+        Call the callback with the future once it is done, right away if it
+        already is. Callbacks are called in the thread that finished the
+        request, and their exceptions are logged.
+
+        :param callback: callable that takes the future
+        :type  callback: callable
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        _call(callback, self)
+
+    def set_result(self, report):
+        """
+        Set the report of the request, and call the callbacks. Called by the
+        downloader.
+
+        :param report: final report of the request
+        :type  report: nectar.report.DownloadReport
+        """
+        with self._lock:
+            if self.done():
+                return
+            self._report = report
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _call(callback, self)
+
+    def set_canceled(self):
+        """
+        Set a canceled report as the report of the request, if it has none.
+        """
+        if self.done():
+            return
+        report = DownloadReport.from_download_request(self.request)
+        report.download_started()
+        report.download_canceled()
+        self.set_result(report)
+
+
+def _call(callback, future):
+    try:
+        callback(future)
+    except Exception, e:
+        _LOG.exception(e)
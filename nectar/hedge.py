@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Hedging of slow requests: when a request takes longer than most requests do,
+a duplicate of it is started, and whichever of the two finishes first is kept.
+That cuts the tail of a large batch of downloads, which is otherwise held up by
+its few requests stuck on sluggish connections.
+
+How long most requests take is learned from the requests that succeeded: the
+time they took to get the response, and the time they took per byte of the
+body after that. A budget caps the share of the requests that are hedged, and
+with it the extra traffic.
+"""
+
+import collections
+import threading
+
+
+DEFAULT_PERCENTILE = 95
+# share of the requests that may be hedged
+DEFAULT_BUDGET = 0.05
+# requests that must have succeeded before any is hedged
+MIN_SAMPLES = 20
+# latest requests the percentiles are computed over
+MAX_SAMPLES = 1000
+
+# which of the requests won the race
+PRIMARY = 'primary'
+HEDGE = 'hedge'
+
+
+class LatencyStats(object):
+    """
+    Latencies of the latest requests that succeeded.
+    """
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        """
+        :param max_samples: number of requests the latencies are kept for
+        :type  max_samples: int
+        """
+        self._first_byte = collections.deque(maxlen=max_samples)
+        self._per_byte = collections.deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._first_byte)
+
+    def record(self, first_byte, per_byte=None):
+        """
+        :param first_byte: seconds the request took to get the response
+        :type  first_byte: float
+        :param per_byte:   seconds the body took per byte, or None if it was empty
+        :type  per_byte:   float
+        """
+        with self._lock:
+            self._first_byte.append(first_byte)
+            if per_byte is not None:
+                self._per_byte.append(per_byte)
+
+    def percentile(self, percentile):
+        """
+        :param percentile: between 0 and 100
+        :type  percentile: float
+        :return: the percentiles of the seconds to the response, and of the
+                 seconds per byte of the body (None if no body was seen)
+        :rtype:  tuple
+        """
+        with self._lock:
+            return _percentile(self._first_byte, percentile), \
+                _percentile(self._per_byte, percentile)
+
+
+def _percentile(samples, percentile):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = int(round(percentile / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class HedgingPolicy(object):
+    """
+    When to hedge a request: once it is slower than the given percentile of
+    the requests that succeeded, while the budget allows it.
+    """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, budget=DEFAULT_BUDGET,
+                 min_samples=MIN_SAMPLES):
+        """
+        :param percentile:  percentile of the latencies past which a request is hedged
+        :type  percentile:  float
+        :param budget:      share of the requests, between 0 and 1, that may be hedged
+        :type  budget:      float
+        :param min_samples: number of requests that must have succeeded before
+                            any is hedged
+        :type  min_samples: int
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.stats = LatencyStats()
+        self.requests = 0
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def delays(self):
+        """
+        :return: seconds after which a request that has not got its response is
+                 hedged, and seconds per byte of its body after which it is,
+                 or None if not enough requests succeeded yet
+        :rtype:  tuple or None
+        """
+        if len(self.stats) < self.min_samples:
+            return None
+        return self.stats.percentile(self.percentile)
+
+    def record(self, first_byte, size, duration):
+        """
+        Learn from a request that succeeded.
+
+        :param first_byte: seconds it took to get the response
+        :type  first_byte: float
+        :param size:       number of bytes of its body
+        :type  size:       int
+        :param duration:   seconds it took in all
+        :type  duration:   float
+        """
+        per_byte = (duration - first_byte) / size if size else None
+        self.stats.record(first_byte, per_byte)
+
+    def request_started(self):
+        with self._lock:
+            self.requests += 1
+
+    def spend(self):
+        """
+        Take a hedge out of the budget.
+
+        :return: True if the budget allowed it
+        :rtype:  bool
+        """
+        with self._lock:
+            if self.hedged + 1 > self.budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+
+class Race(object):
+    """
+    Race between a request and its hedge, which the first to claim wins.
+
+    :ivar winner: PRIMARY or HEDGE, or None while neither claimed
+    """
+
+    def __init__(self):
+        self.winner = None
+        self._lock = threading.Lock()
+
+    def claim(self, contender):
+        """
+        :param contender: PRIMARY or HEDGE
+        :type  contender: str
+        :return: True if the contender won, now or earlier
+        :rtype:  bool
+        """
+        with self._lock:
+            if self.winner is None:
+                self.winner = contender
+            return self.winner == contender
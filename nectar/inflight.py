@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking of the connections a downloader's threads have in use, so that
+canceling the downloader aborts them right away, instead of leaving its
+workers blocked on a slow server until their read timeout. The transfers of
+the threads can also be held to a deadline and to a minimum throughput, and
+their connections are aborted when they fall short, or when a hedge of the
+transfer won.
+
+The socket of a connection is tracked from the moment a pool hands the
+connection out, or the connection connects, until it is put back, which spans
+waiting for the response and reading its body. Aborting shuts the sockets down,
+which wakes the threads blocked on them up with an error. Only the connections
+of the pools and connection classes defined here, or that use the mixins
+defined here, are tracked.
+"""
+
+import collections
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connection, connectionpool, poolmanager
+
+from nectar import tls
+
+
+_local = threading.local()
+
+# how often, in seconds, the transfers being watched are checked
+WATCH_INTERVAL = 0.5
+# seconds over which the throughput of a transfer is measured
+DEFAULT_SPEED_WINDOW = 30
+
+# why a transfer was aborted
+EXPIRED_DEADLINE = 'deadline'
+EXPIRED_STALLED = 'stalled'
+EXPIRED_HEDGED = 'hedged'
+
+
+class ConnectionAborted(IOError):
+    """
+    Raised when a connection is asked for after the tracker was aborted.
+    """
+
+
+def _raw_socket(sock):
+    # the socket object of a connection is closed when a response that closes
+    # the connection is read, but the socket underneath lives on with the
+    # response, and shutting that one down still aborts it
+    return getattr(sock, '_sock', sock)
+
+
+class ConnectionTracker(object):
+    """
+    Sockets in use by the threads that track them with this tracker.
+
+    :ivar aborted: True once abort was called
+    """
+
+    def __init__(self):
+        self.aborted = False
+        self._sockets = {}  # thread ident -> set of sockets
+        self._monitors = {}  # thread ident -> TransferMonitor
+        # threads whose transfer expired, refused connections until they move on
+        self._expired = set()
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    def track(self):
+        """
+        :return: context manager, within which the connections the current
+                 thread uses are tracked
+        """
+        return _Tracking(self)
+
+    def refuses(self):
+        """
+        :return: True if the current thread may not make new connections,
+                 because the tracker was aborted or its transfer expired
+        :rtype:  bool
+        """
+        return self.aborted or threading.current_thread().ident in self._expired
+
+    def add(self, sock):
+        """
+        :raises ConnectionAborted: if the tracker was aborted, or the transfer
+                of the current thread expired
+        """
+        with self._lock:
+            if self.refuses():
+                raise ConnectionAborted('The connection was aborted')
+            self._sockets.setdefault(threading.current_thread().ident, set()).add(
+                _raw_socket(sock))
+
+    def discard(self, sock):
+        with self._lock:
+            self._sockets.get(threading.current_thread().ident, set()).discard(_raw_socket(sock))
+
+    def abort(self):
+        """
+        Shut the tracked sockets down, and refuse to track any more.
+
+        :return: number of sockets shut down
+        :rtype:  int
+        """
+        with self._lock:
+            self.aborted = True
+            sockets = [sock for thread_sockets in self._sockets.values()
+                       for sock in thread_sockets]
+        return _shutdown(sockets)
+
+    def watch(self, monitor):
+        """
+        Hold the transfer of the current thread to the limits of a monitor,
+        until the thread watches another one or stops tracking. Once the
+        monitor expires, the sockets of the thread are shut down.
+
+        :param monitor: monitor of the transfer, or None to stop watching
+        :type  monitor: TransferMonitor
+        """
+        ident = threading.current_thread().ident
+        with self._lock:
+            self._expired.discard(ident)
+            if monitor is None:
+                self._monitors.pop(ident, None)
+                return
+            self._monitors[ident] = monitor
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch_transfers)
+                self._watchdog.setDaemon(True)
+                self._watchdog.start()
+
+    def abort_expired(self, now=None):
+        """
+        Shut down the sockets of the threads whose monitor expired.
+
+        :param now: time, as returned by time.time(), to check the monitors at
+        :type  now: float
+        :return: number of sockets shut down
+        :rtype:  int
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            sockets = []
+            for ident, monitor in self._monitors.items():
+                if monitor.check(now) is not None:
+                    del self._monitors[ident]
+                    self._expired.add(ident)
+                    sockets.extend(self._sockets.get(ident, ()))
+            # while the lock is held, so that the threads cannot have moved on
+            # to another transfer
+            return _shutdown(sockets)
+
+    def expire(self, ident, reason):
+        """
+        Expire the transfer a thread is watching, if any, and shut the sockets
+        of the thread down.
+
+        :param ident:  ident of the thread
+        :type  ident:  int
+        :param reason: why the transfer expired
+        :type  reason: str
+        :return: number of sockets shut down
+        :rtype:  int
+        """
+        with self._lock:
+            monitor = self._monitors.pop(ident, None)
+            if monitor is None:
+                return 0
+            if monitor.expired is None:
+                monitor.expired = reason
+            self._expired.add(ident)
+            return _shutdown(self._sockets.get(ident, ()))
+
+    def _watch_transfers(self):
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            self.abort_expired()
+            with self._lock:
+                if not self._monitors:
+                    self._watchdog = None
+                    return
+
+    def _forget_thread(self):
+        with self._lock:
+            ident = threading.current_thread().ident
+            self._sockets.pop(ident, None)
+            self._monitors.pop(ident, None)
+            self._expired.discard(ident)
+
+
+def _shutdown(sockets):
+    aborted = 0
+    for sock in sockets:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            aborted += 1
+        except (socket.error, ValueError):
+            pass  # already closed
+    return aborted
+
+
+class TransferMonitor(object):
+    """
+    Progress of a transfer, held to a deadline and to a minimum throughput
+    measured over a sliding window. The throughput is only judged once the
+    transfer has been going for a whole window, and counts the bytes of the
+    chunks received in full.
+
+    A transfer can also be expected to take no longer than a number of
+    seconds to get the response, and a number of seconds per byte of the body
+    after that; it is then slow past that time, which a callback is told about.
+
+    :ivar expired:      why the transfer fell short of the limits, one of the
+                        EXPIRED_ reasons, or None while it has not
+    :ivar responded_at: time the response arrived, or None
+    :ivar size:         size of the body, or None if it is not known
+    """
+
+    def __init__(self, deadline=None, min_speed=None, window=DEFAULT_SPEED_WINDOW,
+                 slow=None, on_slow=None):
+        """
+        :param deadline:  time, as returned by time.time(), by which the
+                          transfer must be done, or None
+        :type  deadline:  float
+        :param min_speed: bytes per second below which the transfer stalled,
+                          or None
+        :type  min_speed: int
+        :param window:    number of seconds the throughput is measured over
+        :type  window:    float
+        :param slow:      seconds to the response, and seconds per byte of the
+                          body (or None), past which the transfer is slow
+        :type  slow:      tuple
+        :param on_slow:   called once, without arguments, when the transfer is
+                          found to be slow
+        :type  on_slow:   callable
+        """
+        self.deadline = deadline
+        self.min_speed = min_speed
+        self.window = window
+        self.slow = slow
+        self.on_slow = on_slow
+        self.expired = None
+        self.started = time.time()
+        self.responded_at = None
+        self.size = None
+        # (time, bytes received by then), back to the start of the window
+        self._samples = collections.deque([(self.started, 0)])
+        self._received = 0
+
+    def responded(self, size=None):
+        """
+        :param size: size of the body in bytes, if it is known
+        :type  size: int
+        """
+        self.responded_at = time.time()
+        self.size = size
+
+    def update(self, received):
+        """
+        :param received: number of bytes received
+        :type  received: int
+        """
+        self._received += received
+        if self.min_speed is not None:
+            self._samples.append((time.time(), self._received))
+
+    def speed(self, now=None):
+        """
+        :return: bytes per second received over the last window, or None if
+                 the transfer has not been going for a whole window yet
+        :rtype:  float or None
+        """
+        now = time.time() if now is None else now
+        start = now - self.window
+        if self.started > start:
+            return None
+        # the last sample from before the window is the baseline
+        while len(self._samples) > 1 and self._samples[1][0] <= start:
+            self._samples.popleft()
+        return (self._received - self._samples[0][1]) / float(self.window)
+
+    def check(self, now=None):
+        """
+        :return: why the transfer fell short of the limits, if it did
+        :rtype:  str or None
+        """
+        now = time.time() if now is None else now
+        if self.expired is None:
+            if self.deadline is not None and now >= self.deadline:
+                self.expired = EXPIRED_DEADLINE
+            elif self.min_speed is not None:
+                speed = self.speed(now)
+                if speed is not None and speed < self.min_speed:
+                    self.expired = EXPIRED_STALLED
+        if self.expired is None and self.on_slow is not None and self.is_slow(now):
+            on_slow, self.on_slow = self.on_slow, None
+            on_slow()
+        return self.expired
+
+    def is_slow(self, now=None):
+        """
+        :return: True if the transfer is past the time it was expected to take
+        :rtype:  bool
+        """
+        if self.slow is None:
+            return False
+        now = time.time() if now is None else now
+        first_byte, per_byte = self.slow
+        if self.responded_at is None:
+            return now - self.started >= first_byte
+        if per_byte is None or self.size is None:
+            return False
+        return now - self.started >= first_byte + per_byte * self.size
+
+
+class _Tracking(object):
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'tracker', None)
+        _local.tracker = self.tracker
+        return self.tracker
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # sockets closed rather than put back are forgotten here
+        self.tracker._forget_thread()
+        _local.tracker = self.previous
+
+
+class TrackingConnectionMixin(object):
+    """
+    Connection mixin that tracks the sockets it connects with the current
+    thread's tracker, if any.
+    """
+
+    def connect(self):
+        super(TrackingConnectionMixin, self).connect()
+        tracker = getattr(_local, 'tracker', None)
+        if tracker is not None:
+            try:
+                tracker.add(self.sock)
+            except ConnectionAborted:
+                self.close()
+                raise
+
+
+class TrackingPoolMixin(object):
+    """
+    Connection pool mixin that tracks the sockets of the connections it hands
+    out with the current thread's tracker, if any, until they are put back.
+    The pool's connection class must use TrackingConnectionMixin, for the
+    sockets of new connections to be tracked as well.
+    """
+
+    def _get_conn(self, timeout=None):
+        tracker = getattr(_local, 'tracker', None)
+        if tracker is not None and tracker.refuses():
+            raise ConnectionAborted('The connection was aborted')
+        conn = super(TrackingPoolMixin, self)._get_conn(timeout=timeout)
+        if tracker is not None and conn.sock is not None:
+            try:
+                tracker.add(conn.sock)
+            except ConnectionAborted:
+                self._put_conn(conn)
+                raise
+        return conn
+
+    def _put_conn(self, conn):
+        tracker = getattr(_local, 'tracker', None)
+        if tracker is not None and conn is not None and conn.sock is not None:
+            tracker.discard(conn.sock)
+        super(TrackingPoolMixin, self)._put_conn(conn)
+
+
+class HTTPConnection(TrackingConnectionMixin, connection.HTTPConnection):
+    pass
+
+
+class HTTPSConnection(TrackingConnectionMixin, connection.HTTPSConnection):
+    pass
+
+
+class HTTPConnectionPool(TrackingPoolMixin, connectionpool.HTTPConnectionPool):
+    ConnectionCls = HTTPConnection
+
+
+class HTTPSConnectionPool(TrackingPoolMixin, connectionpool.HTTPSConnectionPool):
+    ConnectionCls = HTTPSConnection
+
+
+POOL_CLASSES = {'http': HTTPConnectionPool, 'https': HTTPSConnectionPool}
+
+
+class TrackingAdapterMixin(object):
+    """
+    HTTP adapter mixin whose pools track their connections. The pools of SOCKS
+    proxies are left as they are.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TrackingAdapterMixin, self).init_poolmanager(*args, **kwargs)
+        self._track_pools(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super(TrackingAdapterMixin, self).proxy_manager_for(proxy, **proxy_kwargs)
+        self._track_pools(manager)
+        return manager
+
+    @staticmethod
+    def _track_pools(manager):
+        if manager.pool_classes_by_scheme is poolmanager.pool_classes_by_scheme:
+            manager.pool_classes_by_scheme = POOL_CLASSES
+
+
+class TrackingAdapter(TrackingAdapterMixin, HTTPAdapter):
+    pass
+
+
+class TrackingSSLContextAdapter(TrackingAdapterMixin, tls.SSLContextAdapter):
+    pass
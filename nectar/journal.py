@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Journal of the completed downloads, so that a large batch interrupted by a
+restart of the process resumes where it stopped, rather than from scratch.
+
+The journal is an append-only file with a line per completed request: its url
+and destination, and the size and digest of the file. Lines are appended in
+batches, each flushed to disk with a single write and fdatasync, and carry a
+checksum, so that a line torn by a crash is told apart and ignored. The journal
+is read into an index when it is opened, and compacted, atomically, once it
+holds more superseded or torn lines than live ones.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from nectar import staging
+
+
+DEFAULT_BATCH_SIZE = 256
+# seconds after which a batch is flushed, even if it is not full
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_DIGEST = 'sha256'
+
+HEADER = '# nectar download journal 1\n'
+# placeholder for an unknown digest
+NO_DIGEST = '-'
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    # tabs and newlines included
+    return value.encode('string_escape')
+
+
+def _key(url, destination):
+    return hashlib.md5(_escape(url) + '\t' + _escape(os.path.abspath(destination))).digest()
+
+
+def _format(url, destination, size, digest):
+    record = '%d\t%s\t%s\t%s' % (size, digest or NO_DIGEST, _escape(url),
+                                 _escape(os.path.abspath(destination)))
+    return '%08x\t%s\n' % (zlib.crc32(record) & 0xffffffff, record)
+
+
+def _parse(line):
+    """
+    :return: key, size and digest of a journal line, or None if it is torn,
+             corrupt or a comment
+    :rtype:  tuple or None
+    """
+    if not line.endswith('\n') or line.startswith('#'):
+        return None
+    checksum, _sep, record = line[:-1].partition('\t')
+    try:
+        if int(checksum, 16) != zlib.crc32(record) & 0xffffffff:
+            return None
+        size, digest, url, destination = record.split('\t')
+        size = int(size)
+    except ValueError:
+        return None
+    key = hashlib.md5(url + '\t' + destination).digest()
+    return key, size, None if digest == NO_DIGEST else digest
+
+
+class DownloadJournal(object):
+    """
+    Append-only journal of the completed downloads.
+
+    A download is only recorded once its file is in place, and a request is
+    considered done only if its destination still has the recorded size, so a
+    file that was lost, or whose data did not make it to disk before a crash,
+    is downloaded again. For the files themselves to survive a power loss,
+    the downloads need staged writes with a durability that syncs them.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, digest=DEFAULT_DIGEST):
+        """
+        :param path:           path of the journal file, created if it does not exist
+        :type  path:           str
+        :param batch_size:     number of records written to disk at a time
+        :type  batch_size:     int
+        :param flush_interval: seconds after which the records are written, even
+                               if there are fewer than batch_size of them
+        :type  flush_interval: float
+        :param digest:         hashlib algorithm the files are digested with
+        :type  digest:         str
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.digest = digest
+        self._index = {}  # key -> (size, digest)
+        self._pending = []
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._load()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _load(self):
+        lines = 0
+        torn = False
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                for line in journal:
+                    lines += 1
+                    torn = not line.endswith('\n')
+                    parsed = _parse(line)
+                    if parsed is not None:
+                        self._index[parsed[0]] = parsed[1:]
+        # a torn last line must not have records appended to it
+        if lines == 0 or torn or lines - 1 > 2 * len(self._index):
+            self._rewrite()
+        self._file = io.open(self.path, 'ab', buffering=0)
+
+    def lookup(self, url, destination):
+        """
+        :return: size and digest recorded for the request, or None
+        :rtype:  tuple or None
+        """
+        return self._index.get(_key(url, destination))
+
+    def is_done(self, request):
+        """
+        :param request: download request
+        :type  request: nectar.request.DownloadRequest
+        :return: True if the request was recorded as done, and its destination
+                 is in place with the recorded size
+        :rtype:  bool
+        """
+        if not isinstance(request.destination, basestring):
+            return False
+        recorded = self.lookup(request.url, request.destination)
+        if recorded is None:
+            return False
+        try:
+            return os.path.getsize(request.destination) == recorded[0]
+        except OSError:
+            return False
+
+    def record(self, url, destination, size, digest=None):
+        """
+        Record a completed download. The record is written to disk with the
+        rest of its batch.
+
+        :param url:         url of the request
+        :type  url:         str
+        :param destination: path of the destination
+        :type  destination: str
+        :param size:        size of the file in bytes
+        :type  size:        int
+        :param digest:      hex digest of the file, or None
+        :type  digest:      str
+        """
+        line = _format(url, destination, size, digest)
+        with self._lock:
+            self._index[_key(url, destination)] = (size, digest)
+            self._pending.append(line)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            if len(self._pending) >= self.batch_size or \
+                    time.time() - self._pending_since >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the pending records to disk.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending or self._file is None:
+            return
+        self._file.write(''.join(self._pending))
+        _fdatasync(self._file.fileno())
+        self._pending = []
+        self._pending_since = None
+
+    def compact(self):
+        """
+        Rewrite the journal with a line per recorded download, atomically.
+        """
+        with self._lock:
+            self._flush()
+            self._rewrite()
+
+    def _rewrite(self):
+        # the index only has the keys of the records, so the latest valid
+        # line of each is copied from the journal
+        latest = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                for number, line in enumerate(journal):
+                    parsed = _parse(line)
+                    if parsed is not None:
+                        latest[parsed[0]] = number
+        keep = set(latest.itervalues())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.nectar-journal-')
+        try:
+            with os.fdopen(fd, 'wb') as compacted:
+                compacted.write(HEADER)
+                if keep:
+                    with open(self.path, 'rb') as journal:
+                        for number, line in enumerate(journal):
+                            if number in keep:
+                                compacted.write(line)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        staging.fsync_directory(directory)
+        if self._file is not None:
+            self._file.close()
+            self._file = io.open(self.path, 'ab', buffering=0)
+
+    def close(self):
+        """
+        Write the pending records to disk, and close the journal.
+        """
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import itertools
+import Queue
+
+
+# how often, in seconds, a listener blocked on a full queue checks whether it was closed
+QUEUE_POLL_INTERVAL = 0.1
 
 
 class DownloadEventListener(object):
@@ -63,3 +68,56 @@ class AggregatingEventListener(DownloadEventListener):
 
     def download_failed(self, report):
         self.failed_reports.append(report)
+
+
+class ReportQueueListener(DownloadEventListener):
+    """
+    Event listener that puts the reports of finished downloads on a bounded
+    queue, for Downloader.iter_download, after passing every event on to
+    another listener. When the queue is full, the thread that fired the event
+    waits for a report to be taken off it, which holds up the downloader's
+    worker.
+
+    :ivar queue:    queue of the reports of finished downloads
+    :ivar listener: listener the events are passed on to
+    :ivar closed:   once True, reports are dropped rather than wait for room
+    """
+
+    def __init__(self, listener, maxsize):
+        """
+        :param listener: listener the events are passed on to
+        :type  listener: nectar.listener.DownloadEventListener
+        :param maxsize:  number of reports the queue holds
+        :type  maxsize:  int
+        """
+        self.listener = listener
+        self.queue = Queue.Queue(maxsize)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def download_started(self, report):
+        self.listener.download_started(report)
+
+    def download_progress(self, report):
+        self.listener.download_progress(report)
+
+    def download_headers(self, report):
+        self.listener.download_headers(report)
+
+    def download_succeeded(self, report):
+        self.listener.download_succeeded(report)
+        self._put(report)
+
+    def download_failed(self, report):
+        self.listener.download_failed(report)
+        self._put(report)
+
+    def _put(self, report):
+        while not self.closed:
+            try:
+                self.queue.put(report, timeout=QUEUE_POLL_INTERVAL)
+                return
+            except Queue.Full:
+                continue
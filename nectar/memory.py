@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory destinations, for small files such as repository metadata that are
+read right after they are downloaded. The content is written to buffers taken
+from a reusable pool, rather than to a file that is then read back, and is
+exposed as a memoryview, without being copied. Content that grows beyond a
+threshold spills to a temporary file, which the memoryview then maps.
+"""
+
+import ctypes
+import errno
+import mmap
+import tempfile
+import threading
+from gettext import gettext as _
+
+
+# smallest buffer handed out by a pool; larger ones are powers of two
+MIN_BUFFER_SIZE = 4096
+# bytes of free buffers a pool keeps for reuse
+DEFAULT_POOL_SIZE = 16 * 1024 * 1024
+# content larger than this spills to a temporary file
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024
+
+
+class BufferPool(object):
+    """
+    Pool of reusable bytearrays, in power of two sizes, shared by the
+    in-memory destinations.
+
+    :ivar max_pooled: bytes of free buffers the pool keeps; buffers released
+                      beyond that are left to the garbage collector
+    """
+
+    def __init__(self, max_pooled=DEFAULT_POOL_SIZE):
+        """
+        :param max_pooled: bytes of free buffers the pool keeps
+        :type  max_pooled: int
+        """
+        self.max_pooled = max_pooled
+        self._free = {}
+        self._pooled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pooled(self):
+        """
+        :return: bytes of free buffers in the pool
+        :rtype:  int
+        """
+        with self._lock:
+            return self._pooled
+
+    @staticmethod
+    def buffer_size(size):
+        """
+        :return: size of the buffer handed out for a number of bytes
+        :rtype:  int
+        """
+        buffer_size = MIN_BUFFER_SIZE
+        while buffer_size < size:
+            buffer_size *= 2
+        return buffer_size
+
+    def acquire(self, size):
+        """
+        Take a buffer of at least the given size out of the pool, allocating a
+        new one if the pool has none.
+
+        :param size: number of bytes the buffer must hold
+        :type  size: int
+        :return: buffer, whose content is undefined
+        :rtype:  bytearray
+        """
+        buffer_size = self.buffer_size(size)
+        with self._lock:
+            free = self._free.get(buffer_size)
+            if free:
+                self._pooled -= buffer_size
+                return free.pop()
+        return bytearray(buffer_size)
+
+    def release(self, buffer):
+        """
+        Put a buffer back in the pool. It must no longer be used, nor any
+        memoryview of it.
+
+        :param buffer: buffer returned by acquire
+        :type  buffer: bytearray
+        """
+        with self._lock:
+            if self._pooled + len(buffer) > self.max_pooled:
+                return
+            self._free.setdefault(len(buffer), []).append(buffer)
+            self._pooled += len(buffer)
+
+    def clear(self):
+        """
+        Drop the free buffers.
+        """
+        with self._lock:
+            self._free.clear()
+            self._pooled = 0
+
+
+# pool used by the destinations that aren't given one
+buffer_pool = BufferPool()
+
+
+class MemoryDestination(object):
+    """
+    File-like destination that keeps the downloaded content in memory, in a
+    buffer from a pool, and spills it to a temporary file once it grows beyond
+    a threshold. Downloaders start each attempt at a download from an empty
+    destination.
+
+    Once done with the content, release the destination, so that its buffer is
+    reused; it can be used as a context manager to that end.
+    """
+
+    def __init__(self, max_size=None, spill_threshold=DEFAULT_SPILL_THRESHOLD, spill_dir=None,
+                 pool=None):
+        """
+        :param max_size:        maximum size of the content, in bytes, beyond which writes fail
+                                with an IOError, so that the download fails; None for no limit
+        :type  max_size:        int
+        :param spill_threshold: size of the content, in bytes, beyond which it is written to
+                                a temporary file rather than kept in memory
+        :type  spill_threshold: int
+        :param spill_dir:       directory of the temporary file; None for the default one
+        :type  spill_dir:       str
+        :param pool:            pool the buffers are taken from; None for buffer_pool
+        :type  pool:            BufferPool
+        """
+        self.max_size = max_size
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.pool = pool or buffer_pool
+        self.size = 0
+
+        self._buffer = None
+        self._spill_file = None
+        self._view = None
+
+    @property
+    def spilled(self):
+        """
+        :return: True if the content was written to a temporary file
+        :rtype:  bool
+        """
+        return self._spill_file is not None
+
+    @property
+    def content(self):
+        """
+        The content, without copying it. It is only valid until the
+        destination is written to, reset or released.
+
+        :return: view of the content
+        :rtype:  memoryview
+        """
+        if self._view is None:
+            if self._spill_file is not None:
+                self._view = self._map_spill_file()
+            else:
+                self._view = memoryview(self._buffer or bytearray())[:self.size]
+        return self._view
+
+    def getvalue(self):
+        """
+        :return: a copy of the content
+        :rtype:  str
+        """
+        return self.content.tobytes()
+
+    def write(self, data):
+        size = self.size + len(data)
+        if self.max_size is not None and size > self.max_size:
+            raise IOError(errno.EFBIG, _('Content exceeds the maximum size of %(s)d bytes') %
+                          {'s': self.max_size})
+        self._view = None
+        if self._spill_file is None and size > self.spill_threshold:
+            self._spill()
+        if self._spill_file is not None:
+            self._spill_file.write(data)
+        else:
+            if self._buffer is None or size > len(self._buffer):
+                self._grow(size)
+            self._buffer[self.size:size] = data
+        self.size = size
+
+    def flush(self):
+        if self._spill_file is not None:
+            self._spill_file.flush()
+
+    def reset(self, size=None):
+        """
+        Empty the destination, before a new attempt at a download.
+
+        :param size: expected size of the content, if known, for which a
+                     buffer is taken right away, or which spills right away
+        :type  size: int
+        """
+        self.release()
+        if size is None:
+            return
+        if size > self.spill_threshold:
+            self._spill()
+        elif size > 0:
+            self._buffer = self.pool.acquire(size)
+
+    def release(self):
+        """
+        Give the buffer back to the pool and remove the temporary file, if any,
+        which empties the destination.
+        """
+        self._view = None
+        self.size = 0
+        buffer, self._buffer = self._buffer, None
+        if buffer is not None:
+            self.pool.release(buffer)
+        spill_file, self._spill_file = self._spill_file, None
+        if spill_file is not None:
+            spill_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _grow(self, size):
+        buffer = self.pool.acquire(size)
+        if self._buffer is not None:
+            buffer[:self.size] = memoryview(self._buffer)[:self.size]
+            self.pool.release(self._buffer)
+        self._buffer = buffer
+
+    def _spill(self):
+        self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        if self._buffer is not None:
+            self._spill_file.write(memoryview(self._buffer)[:self.size])
+            self.pool.release(self._buffer)
+            self._buffer = None
+
+    def _map_spill_file(self):
+        self._spill_file.flush()
+        if not self.size:
+            return memoryview(bytearray())
+        mapping = mmap.mmap(self._spill_file.fileno(), self.size, access=mmap.ACCESS_COPY)
+        # Python 2 can't make a memoryview of a mmap itself, but can of a
+        # ctypes array over it; the private mapping makes the array writable
+        # without ever writing to the file
+        return memoryview((ctypes.c_char * self.size).from_buffer(mapping))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Download requests built from metalink documents: Metalink 4 (RFC 5854), and
+the Metalink 3 documents many mirror networks still publish.
+
+A metalink lists, for each file, the urls it can be downloaded from, with
+their priority and location, and its size and digests, sometimes down to the
+digests of its pieces. Each file becomes a DownloadRequest for its preferred
+url, with the others as its mirrors, that is verified as it is downloaded: a
+corrupt piece fails the transfer as soon as it arrives, and it is retried from
+the next mirror.
+"""
+
+import hashlib
+import os
+from xml.etree import ElementTree
+
+from nectar import sink
+from nectar.request import DownloadRequest
+
+
+NS_METALINK_4 = 'urn:ietf:params:xml:ns:metalink'
+NS_METALINK_3 = 'http://www.metalinker.org/'
+
+# url schemes the threaded downloader fetches; a request's url and mirrors
+# must all be fetched by the same downloader
+DEFAULT_SCHEMES = ('http', 'https')
+# digests a file is verified with, strongest first
+DIGEST_PREFERENCE = ('sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5')
+# priority of the urls that have none, after all those that have one
+NO_PRIORITY = 1000000
+
+
+class MetalinkError(ValueError):
+    """
+    Raised when a metalink document cannot be parsed, or lists a file that
+    cannot be downloaded safely.
+    """
+
+
+class MetalinkUrl(object):
+    """
+    Url a file can be downloaded from.
+
+    :ivar url:      the url
+    :ivar priority: priority of the url, the lower the more preferred
+    :ivar location: ISO 3166-1 code of the country the url is in, or None
+    """
+
+    def __init__(self, url, priority=NO_PRIORITY, location=None):
+        self.url = url
+        self.priority = priority
+        self.location = location
+
+    def __repr__(self):
+        return 'MetalinkUrl(%r, %r, %r)' % (self.url, self.priority, self.location)
+
+
+class MetalinkFile(object):
+    """
+    File listed in a metalink document.
+
+    :ivar name:            path of the file, relative to the directory it is downloaded to
+    :ivar size:            size of the file in bytes, or None
+    :ivar hashes:          hex digests of the file, by hashlib algorithm
+    :ivar urls:            urls the file can be downloaded from
+    :ivar piece_algorithm: hashlib algorithm of the piece digests, or None
+    :ivar piece_length:    size of the pieces in bytes, or None
+    :ivar piece_digests:   hex digests of the pieces, in order
+    """
+
+    def __init__(self, name, size=None, hashes=None, urls=None, piece_algorithm=None,
+                 piece_length=None, piece_digests=None):
+        self.name = name
+        self.size = size
+        self.hashes = hashes or {}
+        self.urls = urls or []
+        self.piece_algorithm = piece_algorithm
+        self.piece_length = piece_length
+        self.piece_digests = piece_digests or []
+
+    def digest(self):
+        """
+        :return: the strongest of the file's digests, as an algorithm and hex
+                 digest, or None if it has none
+        :rtype:  tuple or None
+        """
+        for algorithm in DIGEST_PREFERENCE:
+            if algorithm in self.hashes:
+                return algorithm, self.hashes[algorithm]
+        return None
+
+    def ordered_urls(self, location=None):
+        """
+        :param location: ISO 3166-1 code of a country whose urls are preferred
+        :type  location: str
+        :return: the file's urls, the most preferred first
+        :rtype:  list of str
+        """
+        location = location.lower() if location else None
+
+        def preference(metalink_url):
+            elsewhere = location is not None and \
+                (metalink_url.location or '').lower() != location
+            return elsewhere, metalink_url.priority
+
+        # sorted is stable, urls of the same preference keep their order
+        return [u.url for u in sorted(self.urls, key=preference)]
+
+    def verifying_sink(self):
+        """
+        :return: sink that verifies the file as it is downloaded, or None if
+                 the metalink has nothing to verify it with
+        :rtype:  nectar.sink.VerifyingSink
+        """
+        digest = self.digest()
+        if digest is None and self.size is None and not self.piece_digests:
+            return None
+        algorithm, hex_digest = digest or (None, None)
+        return sink.VerifyingSink(algorithm, hex_digest, self.size, self.piece_algorithm,
+                                  self.piece_length, self.piece_digests)
+
+    def request(self, destination_dir, location=None, data=None):
+        """
+        :param destination_dir: directory the file is downloaded to
+        :type  destination_dir: str
+        :param location:        ISO 3166-1 code of a country whose urls are preferred
+        :type  location:        str
+        :param data:            arbitrary data passed back in the reports of the request
+        :return: request for the file, from its most preferred url, with the
+                 others as its mirrors, verified as it is downloaded
+        :rtype:  nectar.request.DownloadRequest
+        :raises MetalinkError: if the file has no url
+        """
+        urls = self.ordered_urls(location)
+        if not urls:
+            raise MetalinkError('No url to download %s from' % self.name)
+        verifying_sink = self.verifying_sink()
+        return DownloadRequest(urls[0], os.path.join(destination_dir, self.name), data=data,
+                               size=self.size, mirrors=urls[1:],
+                               sinks=[verifying_sink] if verifying_sink else None)
+
+
+def parse(source, schemes=DEFAULT_SCHEMES):
+    """
+    Parse a Metalink 4 or Metalink 3 document.
+
+    :param source:  path of the document, or file-like object to read it from
+    :type  source:  str or file-like object
+    :param schemes: url schemes to keep the urls of, the others are left out
+    :type  schemes: tuple of str
+    :return: files listed in the document
+    :rtype:  list of MetalinkFile
+    :raises MetalinkError: if the document is not a metalink, or lists a file
+            whose name would put it outside the directory it is downloaded to
+    """
+    try:
+        root = ElementTree.parse(source).getroot()
+    except ElementTree.ParseError as e:
+        raise MetalinkError('Malformed metalink: %s' % e)
+    if root.tag == _tag(NS_METALINK_4, 'metalink'):
+        parse_file = _parse_file_4
+        namespace = NS_METALINK_4
+    elif root.tag == _tag(NS_METALINK_3, 'metalink'):
+        parse_file = _parse_file_3
+        namespace = NS_METALINK_3
+    else:
+        raise MetalinkError('Not a metalink: %s' % root.tag)
+
+    files = []
+    for element in root.iter(_tag(namespace, 'file')):
+        metalink_file = parse_file(element, namespace)
+        metalink_file.urls = [u for u in metalink_file.urls
+                              if u.url.partition(':')[0].lower() in schemes]
+        files.append(metalink_file)
+    return files
+
+
+def requests_from_metalink(source, destination_dir, location=None, schemes=DEFAULT_SCHEMES):
+    """
+    Build the download requests of the files listed in a metalink document.
+    The files that have no url with one of the schemes are left out.
+
+    :param source:          path of the document, or file-like object to read it from
+    :type  source:          str or file-like object
+    :param destination_dir: directory the files are downloaded to
+    :type  destination_dir: str
+    :param location:        ISO 3166-1 code of a country whose urls are preferred
+    :type  location:        str
+    :param schemes:         url schemes the files may be downloaded from
+    :type  schemes:         tuple of str
+    :return: a request per file, with the MetalinkFile as its data
+    :rtype:  list of nectar.request.DownloadRequest
+    :raises MetalinkError: if the document cannot be parsed
+    """
+    return [f.request(destination_dir, location, data=f)
+            for f in parse(source, schemes) if f.urls]
+
+
+def _tag(namespace, name):
+    return '{%s}%s' % (namespace, name)
+
+
+def _algorithm(hash_type):
+    # RFC 5854 uses the IANA names, sha-256, Metalink 3 the hashlib ones
+    algorithm = (hash_type or '').lower().replace('-', '')
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        return None
+    return algorithm
+
+
+def _name(element):
+    name = element.get('name')
+    if not name:
+        raise MetalinkError('File without a name')
+    # RFC 5854 section 4.1.2.1: no absolute paths, no parent directories
+    if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise MetalinkError('Unsafe file name: %s' % name)
+    return name
+
+
+def _int(text, what):
+    try:
+        return int(text.strip())
+    except (AttributeError, ValueError):
+        raise MetalinkError('Invalid %s: %r' % (what, text))
+
+
+def _parse_hashes(parent, namespace, metalink_file):
+    for element in parent.findall(_tag(namespace, 'hash')):
+        algorithm = _algorithm(element.get('type'))
+        if algorithm is not None and element.text:
+            metalink_file.hashes[algorithm] = element.text.strip().lower()
+
+    pieces = parent.find(_tag(namespace, 'pieces'))
+    if pieces is None:
+        return
+    algorithm = _algorithm(pieces.get('type'))
+    if algorithm is None:
+        return
+    digests = pieces.findall(_tag(namespace, 'hash'))
+    if digests and digests[0].get('piece') is not None:
+        # Metalink 3 numbers them
+        digests.sort(key=lambda d: _int(d.get('piece'), 'piece'))
+    metalink_file.piece_algorithm = algorithm
+    metalink_file.piece_length = _int(pieces.get('length'), 'piece length')
+    metalink_file.piece_digests = [(d.text or '').strip().lower() for d in digests]
+
+
+def _parse_file_4(element, namespace):
+    metalink_file = MetalinkFile(_name(element))
+    size = element.find(_tag(namespace, 'size'))
+    if size is not None:
+        metalink_file.size = _int(size.text, 'size')
+    _parse_hashes(element, namespace, metalink_file)
+    for url in element.findall(_tag(namespace, 'url')):
+        if not url.text:
+            continue
+        priority = url.get('priority')
+        metalink_file.urls.append(MetalinkUrl(
+            url.text.strip(), NO_PRIORITY if priority is None else _int(priority, 'priority'),
+            url.get('location')))
+    return metalink_file
+
+
+def _parse_file_3(element, namespace):
+    metalink_file = MetalinkFile(_name(element))
+    size = element.find(_tag(namespace, 'size'))
+    if size is not None:
+        metalink_file.size = _int(size.text, 'size')
+    verification = element.find(_tag(namespace, 'verification'))
+    if verification is not None:
+        _parse_hashes(verification, namespace, metalink_file)
+    resources = element.find(_tag(namespace, 'resources'))
+    urls = [] if resources is None else resources.findall(_tag(namespace, 'url'))
+    for url in urls:
+        # urls of torrents, rather than of the file
+        if not url.text or (url.get('type') or '').lower() == 'bittorrent':
+            continue
+        # a preference of 1 to 100, the higher the more preferred
+        preference = url.get('preference')
+        priority = NO_PRIORITY if preference is None else 101 - _int(preference, 'preference')
+        metalink_file.urls.append(MetalinkUrl(url.text.strip(), priority, url.get('location')))
+    return metalink_file
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of connection pools, shared by the HTTP downloaders whose
+configurations connect the same way: with the same TLS material, proxy and
+credentials. Downloaders created one after the other, or side by side, for
+instance one per repository of the same CDN, borrow each other's warm
+connections instead of each opening their own.
+
+The registry caps the number of sockets its pools hold open, closing the
+connections that have been idle the longest to make room, and closes the
+connections that have been idle for too long, from a background thread that
+runs while it has pools.
+"""
+
+import atexit
+import hashlib
+import logging
+import threading
+import time
+import weakref
+
+from requests.packages.urllib3 import connection, connectionpool, poolmanager
+
+from nectar import inflight, tls
+
+
+_LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SOCKETS = 100
+DEFAULT_IDLE_TIMEOUT = 60  # seconds
+DEFAULT_NUM_POOLS = 10  # host pools kept per configuration
+DEFAULT_POOL_MAXSIZE = 10  # idle connections kept per host
+POLL_INTERVAL = 0.5  # seconds
+# seconds the reaper thread is given to exit when the interpreter exits
+EXIT_TIMEOUT = 1.0
+
+
+def connection_fingerprint(config):
+    """
+    Stable fingerprint of the settings of a configuration that determine how
+    connections are made and whom they are made for: its TLS material, proxy
+    and credentials. Credentials are only hashed into it.
+
+    :param config: downloader configuration
+    :type  config: nectar.config.DownloaderConfig
+    :return: hex digest
+    :rtype:  str
+    """
+    digest = hashlib.sha256(tls.ssl_fingerprint(config))
+    for value in (config.proxy_url, config.proxy_port, config.proxy_username,
+                  config.proxy_password, config.basic_auth_username,
+                  config.basic_auth_password):
+        digest.update('\0')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if value is not None:
+            digest.update(str(value))
+    return digest.hexdigest()
+
+
+class PoolRegistry(object):
+    """
+    Connection pools, one pool manager per connection fingerprint, shared by
+    the downloaders of the process.
+
+    :ivar max_sockets:  maximum number of sockets open at once across all the pools;
+                        connections wait for one to be closed beyond it
+    :ivar idle_timeout: number of seconds after which idle connections are closed
+    """
+
+    def __init__(self, max_sockets=DEFAULT_MAX_SOCKETS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 num_pools=DEFAULT_NUM_POOLS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        """
+        :param max_sockets:  maximum number of sockets open at once across all the pools
+        :type  max_sockets:  int
+        :param idle_timeout: number of seconds after which idle connections are closed
+        :type  idle_timeout: float
+        :param num_pools:    number of host pools kept per configuration
+        :type  num_pools:    int
+        :param pool_maxsize: number of idle connections kept per host
+        :type  pool_maxsize: int
+        """
+        self.max_sockets = max_sockets
+        self.idle_timeout = idle_timeout
+        self.num_pools = num_pools
+        self.pool_maxsize = pool_maxsize
+
+        self.slots = SocketSlots(max_sockets, self._close_oldest_idle)
+        # pool managers and proxy managers by connection fingerprint
+        self._managers = {}
+        self._proxy_managers = {}
+        self._pools = weakref.WeakSet()
+        self._lock = threading.RLock()
+        self._reaper = None
+        self._stopping = threading.Event()
+
+    @property
+    def open_sockets(self):
+        """
+        :return: number of sockets open in the pools
+        :rtype:  int
+        """
+        return len(self.slots)
+
+    def adapter(self, config, **kwargs):
+        """
+        Return an adapter for a requests session that borrows connections from
+        the pools shared by the configurations that connect the same way.
+
+        :param config: downloader configuration
+        :type  config: nectar.config.DownloaderConfig
+        :param kwargs: keyword arguments for the adapter, such as max_retries
+        :return: adapter to mount for http:// and https://
+        :rtype:  SharedPoolAdapter
+        :raises ssl.SSLError: if the configuration's certificates can't be loaded
+        :raises IOError:      if the configuration's certificates can't be read
+        """
+        fingerprint = connection_fingerprint(config)
+        ssl_context = tls.get_ssl_context(config)
+        with self._lock:
+            manager = self._managers.get(fingerprint)
+            if manager is None:
+                manager = self._managers[fingerprint] = SharedPoolManager(
+                    self, num_pools=self.num_pools, maxsize=self.pool_maxsize,
+                    ssl_context=ssl_context)
+                self._proxy_managers[fingerprint] = {}
+        return SharedPoolAdapter(self, manager, self._proxy_managers[fingerprint], ssl_context,
+                                 **kwargs)
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Close the connections that have been idle for longer than the given time.
+
+        :param idle_timeout: number of seconds; defaults to the registry's idle_timeout
+        :type  idle_timeout: float
+        :return: number of connections closed
+        :rtype:  int
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        cutoff = time.time() - idle_timeout
+        closed = 0
+        for idle_since, pool, conn in self._idle_connections():
+            if idle_since <= cutoff and self._take(pool, conn):
+                conn.close()
+                closed += 1
+        return closed
+
+    def clear(self):
+        """
+        Close all the pools and forget them.
+        """
+        with self._lock:
+            managers = self._managers.values()
+            for proxy_managers in self._proxy_managers.values():
+                managers.extend(proxy_managers.values())
+            self._managers.clear()
+            self._proxy_managers.clear()
+        for manager in managers:
+            manager.clear()
+
+    def _track(self, pool):
+        with self._lock:
+            self._pools.add(pool)
+            if self._reaper is None and not self._stopping.is_set():
+                self._reaper = threading.Thread(target=_reap,
+                                                args=(weakref.ref(self), self._stopping))
+                self._reaper.setDaemon(True)
+                _REAPERS[self._reaper] = self._stopping
+                self._reaper.start()
+
+    def _untrack(self, pool):
+        with self._lock:
+            self._pools.discard(pool)
+
+    def _reap(self):
+        # called by the reaper thread; returns False once it should exit
+        with self._lock:
+            if self._stopping.is_set() or not self._pools:
+                self._reaper = None
+                return False
+        self.evict_idle()
+        return True
+
+    def _close_oldest_idle(self):
+        # make room for a new socket; returns whether a connection was closed
+        for idle_since, pool, conn in sorted(self._idle_connections(), key=lambda idle: idle[0]):
+            if self._take(pool, conn):
+                _LOG.debug('Closing an idle connection to %s to stay within %d sockets' %
+                           (pool.host, self.max_sockets))
+                conn.close()
+                return True
+        return False
+
+    def _idle_connections(self):
+        """
+        :return: (idle since, pool, connection) of the idle connections with an open socket
+        :rtype:  list of tuple
+        """
+        with self._lock:
+            pools = list(self._pools)
+        idle = []
+        for pool in pools:
+            queue = pool.pool
+            if queue is None:  # closed
+                self._untrack(pool)
+                continue
+            with queue.mutex:
+                for conn in queue.queue:
+                    if conn is not None and conn.sock is not None:
+                        idle.append((getattr(conn, 'idle_since', 0), pool, conn))
+        return idle
+
+    @staticmethod
+    def _take(pool, conn):
+        # take an idle connection out of its pool, so that it isn't handed out
+        # while it is being closed; returns False if it was handed out already
+        queue = pool.pool
+        if queue is None:
+            return False
+        with queue.mutex:
+            for i, queued in enumerate(queue.queue):
+                if queued is conn:
+                    queue.queue[i] = None
+                    return True
+        return False
+
+
+def _reap(registry_ref, stopping):
+    # closes the idle connections of a registry every half idle timeout, while
+    # it has pools; the registry is not kept alive while the thread waits
+    while True:
+        registry = registry_ref()
+        if registry is None:
+            return
+        interval = max(registry.idle_timeout / 2.0, POLL_INTERVAL)
+        del registry
+        if stopping.wait(interval):
+            return
+        registry = registry_ref()
+        if registry is None or not registry._reap():
+            return
+        del registry
+
+
+class SocketSlots(object):
+    """
+    Counts the sockets open across the pools of a registry, and makes
+    connections wait for a slot once the limit is reached.
+
+    A slot is held by a connection from the time it connects until it is
+    closed, or garbage collected without being closed.
+    """
+
+    def __init__(self, limit, make_room):
+        """
+        :param limit:     maximum number of slots held at once
+        :type  limit:     int
+        :param make_room: called, without arguments, when no slot is free; returns
+                          whether it freed one
+        :type  make_room: callable
+        """
+        self.limit = limit
+        self._make_room = make_room
+        self._held = {}  # weak references to the connections, by id
+        self._condition = threading.Condition(threading.RLock())
+
+    def __len__(self):
+        return len(self._held)
+
+    def acquire(self, conn):
+        key = id(conn)
+        while True:
+            with self._condition:
+                if key in self._held:
+                    return
+                if len(self._held) < self.limit:
+                    self._held[key] = weakref.ref(conn, lambda ref: self._release(key))
+                    return
+            if not self._make_room():
+                with self._condition:
+                    if len(self._held) >= self.limit:
+                        self._condition.wait(POLL_INTERVAL)
+
+    def release(self, conn):
+        self._release(id(conn))
+
+    def _release(self, key):
+        with self._condition:
+            if self._held.pop(key, None) is not None:
+                self._condition.notify()
+
+
+# -- urllib3 classes -----------------------------------------------------------
+
+
+class _SlotConnectionMixin(object):
+    """
+    Holds a socket slot of the registry while the connection is open.
+    """
+
+    slots = None
+
+    def connect(self):
+        if self.slots is not None:
+            self.slots.acquire(self)
+        try:
+            super(_SlotConnectionMixin, self).connect()
+        except Exception:
+            if self.slots is not None:
+                self.slots.release(self)
+            raise
+
+    def close(self):
+        try:
+            super(_SlotConnectionMixin, self).close()
+        finally:
+            if self.slots is not None:
+                self.slots.release(self)
+
+
+class HTTPConnection(inflight.TrackingConnectionMixin, _SlotConnectionMixin,
+                     connection.HTTPConnection):
+    pass
+
+
+class HTTPSConnection(inflight.TrackingConnectionMixin, _SlotConnectionMixin,
+                      connection.HTTPSConnection):
+    pass
+
+
+class _SharedPoolMixin(object):
+    """
+    Records when connections are returned to the pool, and closes the ones that
+    have been idle for too long instead of handing them out.
+    """
+
+    registry = None
+
+    def _new_conn(self):
+        conn = super(_SharedPoolMixin, self)._new_conn()
+        conn.slots = self.registry.slots
+        return conn
+
+    def _get_conn(self, timeout=None):
+        conn = super(_SharedPoolMixin, self)._get_conn(timeout=timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if conn.sock is not None and idle_since is not None and \
+                time.time() - idle_since > self.registry.idle_timeout:
+            conn.close()
+            if getattr(conn, 'auto_open', 1) == 0:
+                # a tunneled connection can't be reopened, see _get_conn
+                conn = self._new_conn()
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.time()
+        super(_SharedPoolMixin, self)._put_conn(conn)
+
+
+class HTTPConnectionPool(inflight.TrackingPoolMixin, _SharedPoolMixin,
+                         connectionpool.HTTPConnectionPool):
+    ConnectionCls = HTTPConnection
+
+
+class HTTPSConnectionPool(inflight.TrackingPoolMixin, _SharedPoolMixin,
+                          connectionpool.HTTPSConnectionPool):
+    ConnectionCls = HTTPSConnection
+
+
+_POOL_CLASSES = {'http': HTTPConnectionPool, 'https': HTTPSConnectionPool}
+
+
+class _SharedManagerMixin(object):
+
+    def __init__(self, registry, *args, **kwargs):
+        super(_SharedManagerMixin, self).__init__(*args, **kwargs)
+        self.registry = registry
+        self.pool_classes_by_scheme = _POOL_CLASSES
+        # pools evicted from the manager, or cleared, are closed and forgotten
+        self.pools.dispose_func = self._dispose_pool
+
+    def _dispose_pool(self, pool):
+        self.registry._untrack(pool)
+        pool.close()
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super(_SharedManagerMixin, self)._new_pool(scheme, host, port, request_context)
+        pool.registry = self.registry
+        self.registry._track(pool)
+        return pool
+
+
+class SharedPoolManager(_SharedManagerMixin, poolmanager.PoolManager):
+    pass
+
+
+class SharedProxyManager(_SharedManagerMixin, poolmanager.ProxyManager):
+    pass
+
+
+class SharedPoolAdapter(tls.SSLContextAdapter):
+    """
+    HTTP adapter that borrows connections from the shared pools of a registry.
+    Closing it leaves the pools open for the other adapters.
+    """
+
+    def __init__(self, registry, manager, proxy_managers, ssl_context, *args, **kwargs):
+        """
+        :param registry:       registry the pools belong to
+        :type  registry:       PoolRegistry
+        :param manager:        shared pool manager
+        :type  manager:        SharedPoolManager
+        :param proxy_managers: shared proxy managers, by proxy url
+        :type  proxy_managers: dict
+        :param ssl_context:    shared SSL context of the pools
+        :type  ssl_context:    ssl.SSLContext
+        """
+        self.registry = registry
+        self._shared_manager = manager
+        self._shared_proxy_managers = proxy_managers
+        super(SharedPoolAdapter, self).__init__(ssl_context, *args, **kwargs)
+        self.proxy_manager = proxy_managers
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = self._shared_manager
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if proxy.lower().startswith('socks'):
+            with self.registry._lock:
+                return super(SharedPoolAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+
+        with self.registry._lock:
+            manager = self.proxy_manager.get(proxy)
+            if manager is None:
+                manager = self.proxy_manager[proxy] = SharedProxyManager(
+                    self.registry, proxy_url=proxy, proxy_headers=self.proxy_headers(proxy),
+                    num_pools=self.registry.num_pools, maxsize=self.registry.pool_maxsize,
+                    ssl_context=self.ssl_context, **proxy_kwargs)
+        return manager
+
+    def close(self):
+        # the pools are the registry's to close
+        pass
+
+
+# reaper threads, stopped when the interpreter exits, before the modules they
+# use are torn down, and the events they are stopped with
+_REAPERS = weakref.WeakKeyDictionary()
+
+
+@atexit.register
+def _stop_reapers():
+    reapers = _REAPERS.items()
+    for reaper, stopping in reapers:
+        stopping.set()
+    for reaper, stopping in reapers:
+        reaper.join(EXIT_TIMEOUT)
+
+
+# the registry of the process, used by downloaders configured with shared_connections
+registry = PoolRegistry()
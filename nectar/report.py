@@ -5,6 +5,8 @@ from gettext import gettext as _
 
 from isodate import UTC
 
+from nectar import memory
+
 
 class DownloadReport(object):
     """
@@ -19,6 +21,10 @@ class DownloadReport(object):
     :ivar total_bytes:      total bytes of the file to be downloaded, None if this could not be
                             determined
     :ivar bytes_downloaded: bytes of the file downloaded so far
+    :ivar bytes_decompressed: bytes of decompressed data written so far, None if the download is
+                            not being decompressed
+    :ivar wire_bytes:       bytes of the response body received so far, before its content
+                            coding is decoded, None if they are not counted apart
     :ivar start_time:       start time of the file download
     :ivar finish_time:      finish time of the file download
     :ivar error_msg:        string field where an error message should be stored. This will likely
@@ -27,6 +33,15 @@ class DownloadReport(object):
                             failure
     :ivar headers:          dictionary containing response headers if they are
                             available, such as from an http-related downloader.
+    :ivar strategy:         link strategy a local file was put in place with, 'skipped', or
+                            'delta' for a file updated with only its changed blocks, None
+                            for other downloads
+    :ivar write_stall_time: seconds the download waited for the I/O threads to write its
+                            chunks, if the threaded downloader writes behind; None otherwise
+    :ivar cache_status:     how an HTTP download was served by the cache: 'hit', 'revalidated'
+                            or 'miss', see nectar.cache; None if no cache is configured
+    :ivar content:          memoryview of the downloaded content, if the destination is a
+                            nectar.memory.MemoryDestination, None otherwise
     """
     DOWNLOAD_WAITING = 'waiting'
     DOWNLOAD_DOWNLOADING = 'downloading'
@@ -43,7 +58,10 @@ class DownloadReport(object):
         :return: report for request
         :rtype: nectar.report.DownloadReport
         """
-        return cls(request.url, request.destination, request.data)
+        report = cls(request.url, request.destination, request.data)
+        report.total_bytes = request.size
+        report._request = request
+        return report
 
     def __init__(self, url, destination, data=None):
         """
@@ -63,6 +81,8 @@ class DownloadReport(object):
 
         self.total_bytes = None
         self.bytes_downloaded = 0
+        self.bytes_decompressed = None
+        self.wire_bytes = None
 
         self.start_time = None
         self.finish_time = None
@@ -71,6 +91,18 @@ class DownloadReport(object):
         self.error_report = {}
 
         self.headers = None
+        self.strategy = None
+        self.cache_status = None
+        self.write_stall_time = None
+
+        # request the report was built from, if any
+        self._request = None
+
+    @property
+    def content(self):
+        if isinstance(self.destination, memory.MemoryDestination):
+            return self.destination.content
+        return None
 
     # state management methods -------------------------------------------------
 
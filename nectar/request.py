@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
+from nectar import compression, memory, staging
+
 
 class DownloadRequest(object):
     """
     Representation of a request for a file download.
     """
 
-    def __init__(self, url, destination, data=None, headers=None):
+    def __init__(self, url, destination, data=None, headers=None, decompress=None,
+                 decompressed_destination=None, size=None, sinks=None, mirrors=None,
+                 delta=None, accept_encoding=None):
         """
         :param url:         url of the file to be downloaded
         :type  url:         str
@@ -14,7 +20,8 @@ class DownloadRequest(object):
                             once they are retrieved. You can provide either a file-system path for
                             this parameter, or an open file-like object. If you provide a file-like
                             object, it is your responsibility to close the file after the download
-                            is finished.
+                            is finished. A nectar.memory.MemoryDestination keeps the contents in
+                            memory.
         :type  destination: str or file-like object
         :param data:        arbitrary data to be passed back as part of the
                             reports to the listener callbacks
@@ -23,37 +30,231 @@ class DownloadRequest(object):
                             will override any headers of the same key that
                             are specified in the config.
         :type  headers:     dict
+        :param decompress:  If set, the file is decompressed as it is downloaded. Either one of
+                            the compressions in nectar.compression, or True to guess the
+                            compression from the url's file name extension.
+        :type  decompress:  str or bool
+        :param decompressed_destination: where the decompressed contents are stored, a path or
+                            file-like object just like the destination. If it is given, the
+                            compressed contents are still stored at the destination; if it is
+                            not, the destination gets the decompressed contents instead.
+        :type  decompressed_destination: str or file-like object
+        :param size:        size of the file in bytes, if it is already known, reported as the
+                            total bytes before the download starts
+        :type  size:        int
+        :param sinks:       sinks the downloaded bytes are also written to, as they are
+                            downloaded and before they are decompressed
+        :type  sinks:       list of nectar.sink.Sink
+        :param mirrors:     urls the same file can be downloaded from instead of the url, tried
+                            in turn when a transfer fails to connect, gets an error response,
+                            stalls or is corrupt
+        :type  mirrors:     list of str
+        :param delta:       block index of the file, or the url of its sidecar file, to update
+                            the previous download at the destination with only the blocks
+                            that changed
+        :type  delta:       nectar.delta.BlockIndex or str
+        :param accept_encoding: content codings the response may be sent with, the most
+                            preferred first, an empty list for none; the body is then decoded
+                            as it is downloaded. If None, the downloader's defaults apply.
+        :type  accept_encoding: list of str
         """
 
         self.url = url
         self.destination = destination
         self.data = data
         self.headers = headers
+        self.decompress = decompress
+        self.decompressed_destination = decompressed_destination
+        self.size = size
+        self.sinks = sinks or []
+        self.mirrors = mirrors or []
+        self.delta = delta
+        self.accept_encoding = accept_encoding
         self.canceled = False
 
         self._file_handle = None
+        self._decompressed_file_handle = None
+        self._writer = None
+        self._sinks_started = False
+
+    @property
+    def compression(self):
+        """
+        :return: compression the download is decompressed from, or None
+        :rtype:  str or None
+        """
+        if self.decompress is True:
+            return compression.compression_from_name(self.url)
+        return self.decompress or None
+
+    @property
+    def bytes_decompressed(self):
+        """
+        :return: number of decompressed bytes written so far, or None if the
+                 download is not being decompressed
+        :rtype:  int or None
+        """
+        if self._writer is None:
+            return None
+        return self._writer.bytes_decompressed
 
-    def initialize_file_handle(self):
+    def initialize_file_handle(self, staged=False, size=None, durability=None):
         """
         Returns a file handle for the request's destination.
 
+        :param staged:     if True, destinations that are paths are written to a temporary file
+                           that replaces them when the file handle is finalized
+        :type  staged:     bool
+        :param size:       expected size of the destination, in bytes, used to preallocate a
+                           staged file
+        :type  size:       int
+        :param durability: how staged files are flushed to disk; one of
+                           nectar.staging.DURABILITIES
+        :type  durability: str or None
         :return: file-like object for writing the download to
+        :raises nectar.compression.UnsupportedCompression: if the download is to be
+                decompressed, but its compression is unknown or unavailable
         """
-        # if the destination is already a file-like object, return it
+        # the size is that of the download, not of what it decompresses to
+        if self.decompress and self.decompressed_destination is None:
+            size = None
+
+        # if the destination is already a file-like object, use it
         if hasattr(self.destination, 'write'):
-            return self.destination
+            file_handle = self.destination
+            if isinstance(file_handle, memory.MemoryDestination):
+                file_handle.reset(size)
+        else:
+            file_handle = self._open(self.destination, staged, size, durability)
+            self._file_handle = file_handle  # cache the handle
+
+        if not self.decompress:
+            return self._with_sinks(file_handle)
+
+        if self.decompressed_destination is None:
+            self._writer = compression.DecompressingWriter(self.compression, file_handle)
+        else:
+            if hasattr(self.decompressed_destination, 'write'):
+                decompressed_file_handle = self.decompressed_destination
+                if isinstance(decompressed_file_handle, memory.MemoryDestination):
+                    decompressed_file_handle.reset()
+            else:
+                decompressed_file_handle = self._open(self.decompressed_destination, staged,
+                                                      None, durability)
+                self._decompressed_file_handle = decompressed_file_handle
+            self._writer = compression.DecompressingWriter(self.compression,
+                                                           decompressed_file_handle,
+                                                           file_handle)
+        return self._with_sinks(self._writer)
+
+    def _with_sinks(self, file_handle):
+        if not self.sinks:
+            return file_handle
+        self._end_sinks(False)
+        for sink in self.sinks:
+            sink.start()
+        self._sinks_started = True
+        return SinkWriter(file_handle, self.sinks)
+
+    def _end_sinks(self, commit):
+        if not self._sinks_started:
+            return
+        self._sinks_started = False
+        for sink in self.sinks:
+            if commit:
+                sink.finish()
+            else:
+                sink.abort()
 
-        self._file_handle = open(self.destination, 'wb')  # cache the handle
-        return self._file_handle
+    @staticmethod
+    def _open(path, staged, size, durability):
+        if staged:
+            return staging.StagedFile(path, size, durability)
+        return open(path, 'wb')
 
-    def finalize_file_handle(self):
+    def finalize_file_handle(self, commit=True):
         """
         Cleanup the request destination's file handle. This is a no-op if the
         file handle wasn't create with the initialize_file_handle method.
+
+        :param commit: if True, staged files replace their destinations; if
+                       False, they are thrown away. It should be False when
+                       the download did not succeed.
+        :type  commit: bool
+        :return: paths of the staged files that replaced their destinations
+        :rtype:  list of str
+        :raises nectar.compression.TruncatedCompression: if the download is
+                decompressed, and its compressed data ended before the end of the
+                stream, in which case staged files are thrown away, as if commit
+                was False
+        :raises Exception: what a sink's verify raised, in which case staged
+                files are thrown away, as if commit was False
         """
+        file_handles = []
+        if self._decompressed_file_handle is not None:
+            file_handles.append(self._decompressed_file_handle)
         # don't close the file handle if it wasn't opened by get_file_handle
-        if self._file_handle in (None, self.destination):
-            return
-
-        self._file_handle.close()
+        if self._file_handle not in (None, self.destination):
+            file_handles.append(self._file_handle)
+        self._decompressed_file_handle = None
         self._file_handle = None
+
+        committed = []
+        if commit and (self._writer is not None or self._sinks_started):
+            try:
+                if self._writer is not None:
+                    self._writer.finish()
+                if self._sinks_started:
+                    for sink in self.sinks:
+                        sink.verify()
+            except Exception:
+                exc_info = sys.exc_info()
+                for file_handle in file_handles:
+                    self._close(file_handle, False, committed)
+                self._end_sinks(False)
+                raise exc_info[0], exc_info[1], exc_info[2]
+        for i, file_handle in enumerate(file_handles):
+            try:
+                self._close(file_handle, commit, committed)
+            except Exception:
+                exc_info = sys.exc_info()
+                for remaining in file_handles[i + 1:]:
+                    self._close(remaining, False, committed)
+                self._end_sinks(False)
+                raise exc_info[0], exc_info[1], exc_info[2]
+        self._end_sinks(commit)
+        return committed
+
+    @staticmethod
+    def _close(file_handle, commit, committed):
+        if not isinstance(file_handle, staging.StagedFile):
+            file_handle.close()
+        elif commit:
+            file_handle.commit()
+            committed.append(file_handle.destination)
+        else:
+            file_handle.discard()
+
+
+class SinkWriter(object):
+    """
+    Write-only file-like object that writes the data written to it to a file
+    handle, and then to each of the request's sinks.
+    """
+
+    def __init__(self, file_handle, sinks):
+        """
+        :param file_handle: file-like object the data is written to
+        :param sinks:       sinks the data is then written to
+        :type  sinks:       list of nectar.sink.Sink
+        """
+        self.file_handle = file_handle
+        self.sinks = sinks
+
+    def write(self, data):
+        self.file_handle.write(data)
+        for sink in self.sinks:
+            sink.write(data)
+
+    def flush(self):
+        self.file_handle.flush()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Sinks the downloaded bytes are streamed to, alongside the destination, so
+that they can be hashed, decompressed, parsed or sent elsewhere while the
+download is in flight, rather than in a second pass over the file.
+
+Sinks are given to a DownloadRequest. Each one is fed the bytes in order, as
+they are downloaded, before decompression. Writes are synchronous: a sink that
+is slow to take a chunk holds up the download, which is the backpressure.
+Stages transform the bytes and pass them on to one or more downstream sinks,
+so sinks compose into pipelines and trees. A sink can also reject a download,
+by raising from write or verify, before the destination is in place.
+"""
+
+import hashlib
+import Queue
+
+from nectar import compression
+
+
+# chunks a QueueSink holds before writes to it block
+DEFAULT_QUEUE_SIZE = 16
+# how often, in seconds, a blocked write checks whether the consumer closed the queue
+QUEUE_POLL_INTERVAL = 0.1
+
+
+class Sink(object):
+    """
+    Base class of the sinks. A sink is started at the start of each attempt
+    at a download, written the bytes of the attempt in order, and then either
+    finished, if the download succeeded, or aborted, if the attempt failed or
+    was canceled; an aborted attempt may be followed by another one.
+    """
+
+    def start(self):
+        """
+        Called at the start of each attempt at the download. Anything written
+        by an earlier, aborted attempt is to be discarded.
+        """
+
+    def write(self, data):
+        """
+        Called with each chunk of the download, in order. An exception raised
+        here fails the download.
+
+        :param data: chunk of the download
+        :type  data: str
+        """
+
+    def verify(self):
+        """
+        Called once all the bytes of the download were written, before the
+        destination is put in place. An exception raised here fails the
+        download.
+        """
+
+    def finish(self):
+        """
+        Called once the download succeeded, after the destination was written.
+        """
+
+    def abort(self):
+        """
+        Called when an attempt at the download failed or was canceled.
+        """
+
+
+class Stage(Sink):
+    """
+    Sink that transforms the bytes written to it and writes the result to its
+    downstream sinks, in order. With several downstream sinks, it tees the
+    bytes to each of them.
+
+    Subclasses override transform, and end if they hold back bytes.
+    """
+
+    def __init__(self, *downstream):
+        """
+        :param downstream: sinks the transformed bytes are written to
+        :type  downstream: nectar.sink.Sink
+        """
+        self.downstream = list(downstream)
+        self._ended = False
+
+    def transform(self, data):
+        """
+        :param data: chunk written to the stage
+        :type  data: str
+        :return: bytes to write downstream, which may be empty
+        :rtype:  str
+        """
+        return data
+
+    def end(self):
+        """
+        :return: bytes held back by the stage, written downstream when the
+                 download is finished
+        :rtype:  str
+        """
+        return ''
+
+    def start(self):
+        self._ended = False
+        for sink in self.downstream:
+            sink.start()
+
+    def write(self, data):
+        data = self.transform(data)
+        if data:
+            self.emit(data)
+
+    def emit(self, data):
+        for sink in self.downstream:
+            sink.write(data)
+
+    def _end(self):
+        if self._ended:
+            return
+        self._ended = True
+        data = self.end()
+        if data:
+            self.emit(data)
+
+    def verify(self):
+        # the bytes held back are verified too
+        self._end()
+        for sink in self.downstream:
+            sink.verify()
+
+    def finish(self):
+        self._end()
+        for sink in self.downstream:
+            sink.finish()
+
+    def abort(self):
+        for sink in self.downstream:
+            sink.abort()
+
+
+class Tee(Stage):
+    """
+    Stage that writes the bytes, unchanged, to each of its downstream sinks.
+    """
+
+
+class DecompressStage(Stage):
+    """
+    Stage that decompresses the bytes written to it.
+    """
+
+    def __init__(self, compression_type, *downstream):
+        """
+        :param compression_type: one of the compressions in nectar.compression
+        :type  compression_type: str
+        :param downstream:       sinks the decompressed bytes are written to
+        :type  downstream:       nectar.sink.Sink
+        :raises nectar.compression.UnsupportedCompression: if the compression is
+                unknown or unavailable
+        """
+        super(DecompressStage, self).__init__(*downstream)
+        self.compression = compression_type
+        self._decompressor = compression.decompressor(compression_type)
+
+    def start(self):
+        self._decompressor = compression.decompressor(self.compression)
+        super(DecompressStage, self).start()
+
+    def transform(self, data):
+        return self._decompressor.decompress(data)
+
+    def verify(self):
+        # truncated compressed data is not verified
+        self._decompressor.finish()
+        super(DecompressStage, self).verify()
+
+
+class HashSink(Sink):
+    """
+    Sink that hashes the bytes written to it.
+    """
+
+    def __init__(self, algorithm='sha256'):
+        """
+        :param algorithm: name of a hashlib algorithm
+        :type  algorithm: str
+        """
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+
+    def start(self):
+        self._hash = hashlib.new(self.algorithm)
+
+    def write(self, data):
+        self._hash.update(data)
+
+    def hexdigest(self):
+        """
+        :return: hex digest of the bytes written so far
+        :rtype:  str
+        """
+        return self._hash.hexdigest()
+
+
+class VerificationFailed(IOError):
+    """
+    Raised by a VerifyingSink when the download does not match its size or
+    digests.
+    """
+
+
+class VerifyingSink(Sink):
+    """
+    Sink that checks the bytes written to it against the expected size and
+    digest of the download. With the digests of its pieces, each piece is
+    checked as soon as it is complete, so that a corrupt download is rejected
+    at its first bad piece rather than once all of it was downloaded.
+    """
+
+    def __init__(self, algorithm=None, digest=None, size=None, piece_algorithm=None,
+                 piece_length=None, piece_digests=None):
+        """
+        :param algorithm:       name of the hashlib algorithm of the digest
+        :type  algorithm:       str
+        :param digest:          hex digest of the whole download, or None
+        :type  digest:          str
+        :param size:            size of the download in bytes, or None
+        :type  size:            int
+        :param piece_algorithm: name of the hashlib algorithm of the piece digests
+        :type  piece_algorithm: str
+        :param piece_length:    size of the pieces in bytes; the last one may be shorter
+        :type  piece_length:    int
+        :param piece_digests:   hex digests of the pieces, in order, or None
+        :type  piece_digests:   list of str
+        """
+        self.algorithm = algorithm
+        self.digest = digest.lower() if digest else None
+        self.size = size
+        self.piece_algorithm = piece_algorithm
+        self.piece_length = piece_length
+        self.piece_digests = [d.lower() for d in piece_digests or []]
+        self.start()
+
+    def start(self):
+        self._bytes = 0
+        self._hash = hashlib.new(self.algorithm) if self.digest else None
+        self._piece = 0
+        self._piece_bytes = 0
+        self._piece_hash = hashlib.new(self.piece_algorithm) if self.piece_digests else None
+
+    def write(self, data):
+        self._bytes += len(data)
+        if self.size is not None and self._bytes > self.size:
+            raise VerificationFailed('More than the expected %d bytes' % self.size)
+        if self._hash is not None:
+            self._hash.update(data)
+        if self._piece_hash is None:
+            return
+        offset = 0
+        while offset < len(data):
+            take = min(len(data) - offset, self.piece_length - self._piece_bytes)
+            self._piece_hash.update(buffer(data, offset, take))
+            offset += take
+            self._piece_bytes += take
+            if self._piece_bytes == self.piece_length:
+                self._check_piece()
+
+    def _check_piece(self):
+        if self._piece >= len(self.piece_digests):
+            raise VerificationFailed('More than the expected %d pieces' %
+                                     len(self.piece_digests))
+        if self._piece_hash.hexdigest() != self.piece_digests[self._piece]:
+            raise VerificationFailed('Piece %d does not match its digest' % self._piece)
+        self._piece += 1
+        self._piece_bytes = 0
+        self._piece_hash = hashlib.new(self.piece_algorithm)
+
+    def verify(self):
+        if self.size is not None and self._bytes != self.size:
+            raise VerificationFailed('Expected %d bytes, got %d' % (self.size, self._bytes))
+        if self._piece_hash is not None:
+            if self._piece_bytes:
+                self._check_piece()
+            if self._piece != len(self.piece_digests):
+                raise VerificationFailed('Expected %d pieces, got %d' %
+                                         (len(self.piece_digests), self._piece))
+        if self._hash is not None and self._hash.hexdigest() != self.digest:
+            raise VerificationFailed('The download does not match its %s digest' %
+                                     self.algorithm)
+
+
+class StreamAborted(IOError):
+    """
+    Raised to the consumer of a QueueSink when the attempt at the download it
+    was reading was aborted.
+    """
+
+
+_FINISHED = object()
+_ABORTED = object()
+
+
+class QueueSink(Sink):
+    """
+    Sink that hands the bytes over to a consumer in another thread, through a
+    bounded queue, so that the consumer processes the download while it is in
+    flight. Once the queue is full, the download waits for the consumer to
+    catch up.
+
+    The consumer iterates over the sink to read the chunks of an attempt. The
+    iteration stops once the download succeeded, or raises StreamAborted if
+    the attempt was aborted, after which the consumer can iterate again to
+    read the next attempt, if any. A consumer that gives up closes the sink,
+    after which the chunks are dropped rather than block the download.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        """
+        :param maxsize: number of chunks the queue holds
+        :type  maxsize: int
+        """
+        self.closed = False
+        self._queue = Queue.Queue(maxsize)
+
+    def write(self, data):
+        self._put(data)
+
+    def finish(self):
+        self._put(_FINISHED)
+
+    def abort(self):
+        self._put(_ABORTED)
+
+    def close(self):
+        """
+        Stop consuming the chunks.
+        """
+        self.closed = True
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _FINISHED:
+                return
+            if item is _ABORTED:
+                raise StreamAborted('The download was aborted')
+            yield item
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self._queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return
+            except Queue.Full:
+                continue
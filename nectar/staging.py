@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Staged writes: downloads are written to a temporary file next to their
+destination, which atomically replaces the destination once the download has
+succeeded. A failed or interrupted download never leaves a torn file behind.
+"""
+
+import binascii
+import ctypes
+import ctypes.util
+import errno
+import os
+
+
+# durability of staged writes, see DownloaderConfig
+DURABILITY_FILE = 'file'  # fsync each file and its directory
+DURABILITY_BATCH = 'batch'  # fdatasync each file, fsync the directories once per batch
+DURABILITIES = (None, DURABILITY_FILE, DURABILITY_BATCH)
+
+# errors that mean preallocation isn't supported, rather than that it failed
+_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+
+
+def _find_posix_fallocate():
+    if hasattr(os, 'posix_fallocate'):
+        def _posix_fallocate(fd, offset, length):
+            try:
+                os.posix_fallocate(fd, offset, length)
+            except OSError as e:
+                return e.errno
+            return 0
+        return _posix_fallocate
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.posix_fallocate64
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    func.restype = ctypes.c_int
+    return func
+
+
+_posix_fallocate = _find_posix_fallocate()
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def posix_fallocate(fd, offset, length):
+    """
+    Allocate disk space for a region of a file, so that it can be written
+    without fragmentation and without running out of space. This is a no-op
+    where the platform or file system does not support preallocation.
+
+    :param fd:     file descriptor
+    :type  fd:     int
+    :param offset: start of the region, in bytes
+    :type  offset: int
+    :param length: length of the region, in bytes
+    :type  length: int
+    :raises OSError: if there is not enough space
+    """
+    if _posix_fallocate is None or length <= 0:
+        return
+    err = _posix_fallocate(fd, offset, length)
+    if err and err not in _UNSUPPORTED_ERRNOS:
+        raise OSError(err, os.strerror(err))
+
+
+def fsync_directory(path):
+    """
+    Flush a directory's entries to disk, making the renames in it durable.
+
+    :param path: path to the directory
+    :type  path: str
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StagedFile(object):
+    """
+    Write-only file-like object that writes to a temporary file in the
+    directory of its destination. ``commit`` moves the temporary file into
+    place; ``discard`` throws it away.
+
+    :ivar destination: path the file is moved to on commit
+    :ivar path:        path of the temporary file
+    """
+
+    def __init__(self, destination, size=None, durability=None):
+        """
+        :param destination: path of the file to write
+        :type  destination: str
+        :param size:        expected size of the file, in bytes, used to preallocate it
+        :type  size:        int
+        :param durability:  one of DURABILITIES
+        :type  durability:  str or None
+        """
+        self.destination = destination
+        self.durability = durability
+        self.path, fd = self._create_temporary_file(destination)
+        self._file = os.fdopen(fd, 'wb')
+
+        if size:
+            try:
+                posix_fallocate(fd, 0, size)
+            except OSError:
+                self.discard()
+                raise
+
+    @staticmethod
+    def _create_temporary_file(destination):
+        # unlike tempfile.mkstemp, this creates the file with the permissions
+        # open() would have given the destination
+        directory, name = os.path.split(os.path.abspath(destination))
+        while True:
+            path = os.path.join(directory, '.%s.%s.part' % (name, binascii.hexlify(os.urandom(4))))
+            try:
+                return path, os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def commit(self):
+        """
+        Move the written file into place, replacing the destination.
+        """
+        try:
+            self._file.flush()
+            fd = self._file.fileno()
+            # preallocation may have made the file longer than what was written
+            os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+            if self.durability == DURABILITY_FILE:
+                os.fsync(fd)
+            elif self.durability == DURABILITY_BATCH:
+                _fdatasync(fd)
+            self._file.close()
+            os.rename(self.path, self.destination)
+        except Exception:
+            self.discard()
+            raise
+
+        if self.durability == DURABILITY_FILE:
+            fsync_directory(os.path.dirname(os.path.abspath(self.destination)))
+
+    def discard(self):
+        """
+        Throw the written file away, leaving the destination untouched.
+        """
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Shared TLS contexts: an SSLContext, with the CA bundle and client certificate
+loaded, is built once per distinct TLS configuration and shared by every
+connection made with that configuration, instead of the CA bundle and client
+certificate being loaded again for each new connection.
+
+Where the ssl module supports it (Python 3.6 and later), the contexts also keep
+the TLS session of the last connection to each host, so that new connections
+to the host resume it instead of making a full handshake.
+"""
+
+import hashlib
+import os
+import ssl
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+from requests.packages.urllib3.util import ssl_ as urllib3_ssl
+
+
+# whether ssl sockets can be given a session to resume
+SESSIONS_SUPPORTED = hasattr(ssl.SSLSocket, 'session')
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+class SSLContextMismatch(ValueError):
+    """
+    Raised when a request is made with TLS settings other than those of the
+    shared SSL context it would use.
+    """
+
+
+def ca_bundle_path(config):
+    """
+    :return: path of the CA bundle the server's certificate is verified with, as
+             chosen by requests, or None if it isn't verified
+    :rtype:  str or None
+    """
+    if config.ssl_validation is False:
+        return None
+    if config.ssl_ca_cert_path:
+        return config.ssl_ca_cert_path
+    return os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or \
+        DEFAULT_CA_BUNDLE_PATH
+
+
+def ssl_fingerprint(config):
+    """
+    Stable fingerprint of the TLS settings of a configuration. Files are
+    fingerprinted by their contents, so configurations whose certificates were
+    written to different temporary files have the same fingerprint.
+
+    :param config: downloader configuration
+    :type  config: nectar.config.DownloaderConfig
+    :return: hex digest
+    :rtype:  str
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(config.ssl_validation is not False))
+    for path in (ca_bundle_path(config), config.ssl_client_cert_path,
+                 config.ssl_client_key_path):
+        digest.update('\0')
+        if path is not None:
+            digest.update(_file_digest(path))
+    return digest.hexdigest()
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        # left for requests to report when the connection is made
+        return 'missing:' + path
+
+
+def get_ssl_context(config):
+    """
+    Return the shared SSL context for a configuration's TLS settings, building
+    it the first time.
+
+    :param config: downloader configuration
+    :type  config: nectar.config.DownloaderConfig
+    :return: SSL context
+    :rtype:  ssl.SSLContext
+    """
+    fingerprint = ssl_fingerprint(config)
+    with _contexts_lock:
+        context = _contexts.get(fingerprint)
+        if context is None:
+            context = _contexts[fingerprint] = _build_ssl_context(config)
+    return context
+
+
+def clear_ssl_contexts():
+    """
+    Forget the shared SSL contexts, for instance after the CA bundle changed.
+    """
+    with _contexts_lock:
+        _contexts.clear()
+
+
+def _build_ssl_context(config):
+    ca_path = ca_bundle_path(config)
+    context = SharedSSLContext(ssl.PROTOCOL_SSLv23)
+    # the same settings as urllib3's own contexts, but with session tickets
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | getattr(ssl, 'OP_NO_COMPRESSION', 0)
+    context.set_ciphers(urllib3_ssl.DEFAULT_CIPHERS)
+    context.check_hostname = False  # urllib3 matches the host name itself
+    context.verify_mode = ssl.CERT_REQUIRED if ca_path else ssl.CERT_NONE
+
+    if ca_path and os.path.isdir(ca_path):
+        context.load_verify_locations(capath=ca_path)
+    elif ca_path:
+        context.load_verify_locations(cafile=ca_path)
+    if config.ssl_client_cert_path and config.ssl_client_key_path:
+        context.load_cert_chain(config.ssl_client_cert_path, config.ssl_client_key_path)
+
+    context.ca_path = ca_path
+    context.cert = (config.ssl_client_cert_path, config.ssl_client_key_path)
+    return context
+
+
+class SharedSSLContext(ssl.SSLContext):
+    """
+    SSL context shared by the connections made with the same TLS settings.
+    Where the ssl module supports it, it resumes the last TLS session with each
+    host.
+
+    :ivar ca_path: path of the CA bundle loaded in the context, or None if the
+                   server's certificate isn't verified
+    :ivar cert:    paths of the client certificate and key loaded in the context
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SharedSSLContext, self).__init__(*args, **kwargs)
+        self.ca_path = None
+        self.cert = (None, None)
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if not SESSIONS_SUPPORTED or kwargs.get('server_side'):
+            return super(SharedSSLContext, self).wrap_socket(sock, *args, **kwargs)
+
+        key = (kwargs.get('server_hostname'),) + tuple(sock.getpeername()[:2])
+        with self._sessions_lock:
+            kwargs.setdefault('session', self._sessions.get(key))
+        wrapped = super(SharedSSLContext, self).wrap_socket(sock, *args, **kwargs)
+        if wrapped.session is not None:
+            with self._sessions_lock:
+                self._sessions[key] = wrapped.session
+        return wrapped
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """
+    HTTP adapter whose HTTPS connections use a shared SSL context, in which the
+    CA bundle and client certificate are already loaded.
+    """
+
+    def __init__(self, ssl_context, *args, **kwargs):
+        """
+        :param ssl_context: context returned by get_ssl_context
+        :type  ssl_context: ssl.SSLContext
+        """
+        self.ssl_context = ssl_context
+        super(SSLContextAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['ssl_context'] = self.ssl_context
+        return super(SSLContextAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        if not url.lower().startswith('https'):
+            return super(SSLContextAdapter, self).cert_verify(conn, url, verify, cert)
+
+        ca_path = self.ssl_context.ca_path
+        if verify is True and ca_path is not None:
+            verify = ca_path
+        if (verify or None) != ca_path:
+            raise SSLContextMismatch('CA bundle %s does not match the SSL context' % verify)
+        if isinstance(cert, basestring):
+            cert = (cert, None)
+        if cert and tuple(cert) != self.ssl_context.cert:
+            raise SSLContextMismatch('Client certificate %s does not match the SSL context' %
+                                     (cert,))
+
+        # the context already has the CA bundle and client certificate loaded;
+        # these would make each connection load them again
+        conn.cert_reqs = 'CERT_REQUIRED' if ca_path else 'CERT_NONE'
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+        conn.cert_file = None
+        conn.key_file = None
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy generation of download requests for the files in a local directory tree,
+for the local file downloader. The tree is walked as the requests are consumed,
+so listing it overlaps with copying it and the requests are never all in
+memory at once.
+"""
+
+import errno
+import fnmatch
+import logging
+import os
+import stat
+import urllib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from nectar.request import DownloadRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_file_requests(root, destination_root, patterns=None, min_size=None, max_size=None,
+                       newer_than=None, older_than=None, make_dirs=True):
+    """
+    Walk a local directory tree and yield a request for each of its files that
+    matches the filters, with its destination at the same relative path under
+    the destination root. Each request's size is that of the file, as found by
+    the walk.
+
+    Directories are walked depth first, with the entries of each directory in
+    name order. Symbolic links to files are followed; symbolic links to
+    directories are not.
+
+    :param root:             file:// URL or path of the directory to walk
+    :type  root:             str
+    :param destination_root: path of the directory the destinations are under
+    :type  destination_root: str
+    :param patterns:         glob patterns, one of which the path of a file relative to the root
+                             must match, such as '*.rpm' or 'repodata/*'
+    :type  patterns:         list of str
+    :param min_size:         minimum size of a file, in bytes
+    :type  min_size:         int
+    :param max_size:         maximum size of a file, in bytes
+    :type  max_size:         int
+    :param newer_than:       time, as returned by time.time(), a file must have been
+                             modified after
+    :type  newer_than:       float
+    :param older_than:       time, as returned by time.time(), a file must have been
+                             modified before
+    :type  older_than:       float
+    :param make_dirs:        if True, the directories of the destinations are created
+                             before their first request is yielded
+    :type  make_dirs:        bool
+    :return: iterator of download requests
+    :rtype:  iterator of nectar.request.DownloadRequest
+    """
+    scheme, path = urllib.splittype(root)
+    if scheme is not None:
+        if not scheme.startswith('file'):
+            raise ValueError('Unsupported scheme: %s' % scheme)
+        root = path
+    root = os.path.abspath(root)
+
+    def matches(relative_path, st):
+        if patterns and not any(fnmatch.fnmatch(relative_path, p) for p in patterns):
+            return False
+        if min_size is not None and st.st_size < min_size:
+            return False
+        if max_size is not None and st.st_size > max_size:
+            return False
+        if newer_than is not None and st.st_mtime <= newer_than:
+            return False
+        if older_than is not None and st.st_mtime >= older_than:
+            return False
+        return True
+
+    # stack of relative directory paths still to be walked
+    directories = ['']
+    while directories:
+        relative_dir = directories.pop()
+        made_dir = False
+        subdirectories = []
+
+        for name, is_dir, st in _list_directory(os.path.join(root, relative_dir)):
+            relative_path = os.path.join(relative_dir, name)
+            if is_dir:
+                subdirectories.append(relative_path)
+                continue
+            if st is None or not matches(relative_path, st):
+                continue
+
+            destination = os.path.join(destination_root, relative_path)
+            if make_dirs and not made_dir:
+                _make_dirs(os.path.dirname(destination))
+                made_dir = True
+            yield DownloadRequest('file://' + os.path.join(root, relative_path), destination,
+                                  size=st.st_size)
+
+        directories.extend(reversed(subdirectories))
+
+
+def _list_directory(path):
+    """
+    List the entries of a directory in name order, as (name, is_dir, stat)
+    tuples; the stat of directories is None. Symbolic links to directories,
+    and entries that are neither files nor directories, are left out.
+    """
+    try:
+        if scandir is not None:
+            entries = sorted(scandir(path), key=lambda entry: entry.name)
+        else:
+            entries = sorted(os.listdir(path))
+    except OSError as e:
+        logger.warning('Unable to list %s: %s' % (path, e))
+        return
+
+    for entry in entries:
+        name = entry.name if scandir is not None else entry
+        try:
+            if scandir is not None:
+                # the type is usually known without a stat call
+                if entry.is_dir(follow_symlinks=False):
+                    yield name, True, None
+                elif entry.is_file():
+                    yield name, False, entry.stat()
+                continue
+
+            st = os.lstat(os.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                yield name, True, None
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(os.path.join(path, name))
+            if stat.S_ISREG(st.st_mode):
+                yield name, False, st
+        except OSError as e:
+            # removed while being walked, or a broken link
+            if e.errno != errno.ENOENT:
+                logger.warning('Unable to stat %s: %s' % (os.path.join(path, name), e))
+
+
+def _make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind of downloaded chunks, so that the threads reading them off the
+network do not wait on a slow destination, such as NFS, Ceph or busy spinning
+disks, and let the TCP windows of their connections shrink.
+
+The chunks are handed over to a few dedicated I/O threads, each file to the
+same thread, so that its chunks are written in order. They are queued as the
+strings they were read as, not copied into pooled buffers: the destinations
+write strings, and a copy would not save the allocation of the chunk. The
+bytes handed over and not written yet are bounded by a memory budget; a reader
+only waits once the budget is used up, or for the last chunks of a file to be
+written before it is put in place, and the time it waits is counted as write
+stall time.
+"""
+
+import Queue
+import atexit
+import sys
+import threading
+import time
+import weakref
+
+
+DEFAULT_BUDGET = 16 * 1024 * 1024  # bytes
+# seconds after which an idle I/O thread exits; it is started again on demand
+IDLE_TIMEOUT = 5
+# seconds a wait blocks at a time, so that signals are handled
+WAIT_POLL_INTERVAL = 1.0
+# seconds the I/O threads are given to exit when the interpreter exits
+EXIT_TIMEOUT = 1.0
+
+
+class WriteBehind(object):
+    """
+    I/O threads the chunks of the downloads are written by, and the memory
+    budget of the chunks waiting for them.
+
+    :ivar threads: number of I/O threads
+    :ivar budget:  bytes of chunks that wait to be written, at most
+    """
+
+    def __init__(self, threads, budget=None):
+        """
+        :param threads: number of I/O threads
+        :type  threads: int
+        :param budget:  bytes of chunks that wait to be written, at most, defaults
+                        to DEFAULT_BUDGET
+        :type  budget:  int
+        """
+        self.threads = threads
+        self.budget = budget or DEFAULT_BUDGET
+        self._lanes = [_Lane() for i in range(threads)]
+        _LANES.update(self._lanes)
+        self._next_lane = 0
+        self._queued = 0
+        self._stall_time = 0.0
+        self._room = threading.Condition(threading.Lock())
+
+    @property
+    def queued(self):
+        """
+        :return: bytes of chunks waiting to be written
+        :rtype:  int
+        """
+        with self._room:
+            return self._queued
+
+    @property
+    def stall_time(self):
+        """
+        :return: seconds readers waited for room in the budget, or for their
+                 chunks to be written, in total
+        :rtype:  float
+        """
+        with self._room:
+            return self._stall_time
+
+    def writer(self, file_handle):
+        """
+        :param file_handle: file-like object a download is written to
+        :return: file-like object whose writes are written to the file handle
+                 by an I/O thread
+        :rtype:  BehindWriter
+        """
+        with self._room:
+            lane = self._lanes[self._next_lane]
+            self._next_lane = (self._next_lane + 1) % len(self._lanes)
+        return BehindWriter(self, lane, file_handle)
+
+    def _reserve(self, size):
+        # a chunk larger than the budget is let through once nothing else waits
+        started = None
+        with self._room:
+            while self._queued and self._queued + size > self.budget:
+                if started is None:
+                    started = time.time()
+                self._room.wait(WAIT_POLL_INTERVAL)
+            self._queued += size
+        if started is None:
+            return 0.0
+        return self._stalled(started)
+
+    def _stalled(self, started):
+        stalled = time.time() - started
+        with self._room:
+            self._stall_time += stalled
+        return stalled
+
+    def _release(self, size):
+        with self._room:
+            self._queued -= size
+            self._room.notify_all()
+
+
+class BehindWriter(object):
+    """
+    Write-only file-like object that hands the data written to it over to an
+    I/O thread. An error writing it is raised by the next call.
+
+    :ivar file_handle: file-like object the data is written to
+    :ivar stall_time:  seconds writes waited for room in the budget, and drains
+                       for the data to be written
+    """
+
+    def __init__(self, write_behind, lane, file_handle):
+        self.file_handle = file_handle
+        self.stall_time = 0.0
+        self._write_behind = write_behind
+        self._lane = lane
+        self._pending = 0
+        self._discarding = False
+        self._exc_info = None
+        self._done = threading.Condition(threading.Lock())
+
+    def write(self, data):
+        self._raise()
+        if not data:
+            return
+        self.stall_time += self._write_behind._reserve(len(data))
+        with self._done:
+            self._pending += 1
+        self._lane.put(self, data)
+
+    def flush(self):
+        """
+        Wait for the data written so far to be written, and flush the file handle.
+        """
+        self.drain()
+        self.file_handle.flush()
+
+    def drain(self):
+        """
+        Wait for the data written so far to be written.
+
+        :raises Exception: what writing it raised
+        """
+        started = time.time()
+        if self._wait():
+            self.stall_time += self._write_behind._stalled(started)
+        self._raise()
+
+    def discard(self):
+        """
+        Drop the data that was not written yet, and wait for the write in
+        progress, if any.
+        """
+        with self._done:
+            self._discarding = True
+        self._wait()
+
+    def _wait(self):
+        # returns True if there was data to wait for
+        with self._done:
+            waited = bool(self._pending)
+            while self._pending:
+                self._done.wait(WAIT_POLL_INTERVAL)
+        return waited
+
+    def _raise(self):
+        exc_info = self._exc_info
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _write_queued(self, data):
+        # called by the I/O thread
+        try:
+            if self._exc_info is None and not self._discarding:
+                self.file_handle.write(data)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._write_behind._release(len(data))
+            with self._done:
+                self._pending -= 1
+                self._done.notify_all()
+
+
+class _Lane(object):
+    """
+    Queue of the chunks an I/O thread writes, and the thread, started when a
+    chunk is queued and none is running.
+    """
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, writer, data):
+        with self._lock:
+            self._queue.put((writer, data))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def stop(self):
+        """
+        Make the thread exit once the chunks queued are written, and wait for it
+        for at most EXIT_TIMEOUT seconds.
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join(EXIT_TIMEOUT)
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=IDLE_TIMEOUT)
+            except Queue.Empty:
+                item = None
+            if item is None:
+                with self._lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            writer, data = item
+            writer._write_queued(data)
+
+
+# lanes whose threads are stopped when the interpreter exits, before the
+# modules they use are torn down
+_LANES = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_lanes():
+    for lane in list(_LANES):
+        lane.stop()
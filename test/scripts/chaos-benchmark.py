@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+"""
+Measure the throughput and tail latency of the threaded downloader against a
+local server that injects faults into its responses.
+
+For each fault profile, a batch of downloads of the unit test data files is run
+and the following are reported:
+
+ * completed MB/s: bytes of successfully downloaded files per wall-clock second
+ * the number of succeeded and failed downloads
+ * p50, p95, p99 and max latency of the individual downloads in the batch
+
+Run from the root of the repository:
+
+ python2 test/scripts/chaos-benchmark.py [--copies N] [--concurrency N] [--seed N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, _ROOT_DIR)
+sys.path.insert(0, os.path.join(_ROOT_DIR, 'test/utils'))
+
+import http_chaos_test_server  # noqa
+from nectar.config import DownloaderConfig  # noqa
+from nectar.downloaders.threaded import HTTPThreadedDownloader  # noqa
+from nectar.listener import AggregatingEventListener  # noqa
+from nectar.request import DownloadRequest  # noqa
+
+
+DATA_FILES = ['100K_file', '500K_file', '1M_file']
+
+PROFILES = [
+    ('clean', {}),
+    ('resets 5%', {'reset': 0.05}),
+    ('truncated 5%', {'truncate': 0.05}),
+    ('slow-drip 5%', {'slow': 0.05}),
+    ('stalls 2%', {'stall': 0.02}),
+    ('429s 10%', {'429': 0.10}),
+    ('503s 10%', {'503': 0.10}),
+    ('mixed', {'reset': 0.02, 'truncate': 0.02, 'slow': 0.02, 'stall': 0.01, '429': 0.03,
+               '503': 0.03}),
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run_profile(server, faults, copies, concurrency, read_timeout):
+    server.faults = faults
+    server.reset_counts()
+    download_dir = tempfile.mkdtemp(prefix='nectar-chaos-benchmark-')
+
+    try:
+        requests = []
+        for i in range(copies):
+            for name in DATA_FILES:
+                url = 'http://localhost:%d/test/unit/data/%s' % (server.server.server_port, name)
+                requests.append(DownloadRequest(url, os.path.join(download_dir,
+                                                                  '%s-%d' % (name, i))))
+
+        config = DownloaderConfig(max_concurrent=concurrency, read_timeout=read_timeout)
+        listener = AggregatingEventListener()
+        downloader = HTTPThreadedDownloader(config, listener)
+
+        start = time.time()
+        downloader.download(requests)
+        elapsed = time.time() - start
+
+        latencies = [(r.finish_time - r.start_time).total_seconds()
+                     for r in listener.all_reports if r.finish_time and r.start_time]
+        completed_bytes = sum(r.bytes_downloaded for r in listener.succeeded_reports)
+
+        return {'mb_per_second': completed_bytes / elapsed / 1048576,
+                'succeeded': len(listener.succeeded_reports),
+                'failed': len(listener.failed_reports),
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies or [0.0]),
+                'elapsed': elapsed}
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--copies', type=int, default=20,
+                        help='number of times each data file is downloaded per profile')
+    parser.add_argument('--concurrency', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--read-timeout', type=float, default=2)
+    args = parser.parse_args()
+
+    os.chdir(_ROOT_DIR)
+    server = http_chaos_test_server.HTTPChaosTestServer(port=args.port, seed=args.seed,
+                                                        stall_time=args.read_timeout * 2)
+    server.start()
+
+    try:
+        print '%-14s %9s %5s %5s %7s %7s %7s %7s' % ('profile', 'MB/s', 'ok', 'fail', 'p50',
+                                                     'p95', 'p99', 'max')
+        for name, faults in PROFILES:
+            result = run_profile(server, faults, args.copies, args.concurrency,
+                                 args.read_timeout)
+            print '%-14s %9.2f %5d %5d %7.3f %7.3f %7.3f %7.3f' % (
+                name, result['mb_per_second'], result['succeeded'], result['failed'],
+                result['p50'], result['p95'], result['p99'], result['max'])
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
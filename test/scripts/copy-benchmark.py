@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+"""
+Measure the throughput of each of the copy methods the local file downloader
+uses, for a range of file sizes.
+
+For each size, a file of random data is copied several times with each method
+and the best MB/s is reported. Methods that aren't supported by the platform or
+file system of the working directory are reported as such.
+
+Run from the root of the repository:
+
+ python2 test/scripts/copy-benchmark.py [--dir PATH] [--runs N] [--buffer-size N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, _ROOT_DIR)
+
+from nectar import fastcopy  # noqa
+from nectar.downloaders.local import DEFAULT_BUFFER_SIZE  # noqa
+
+
+SIZES = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+
+
+def make_file(path, size):
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def copy(src_path, dst_path, method, buffer_size):
+    src_fd = os.open(src_path, os.O_RDONLY)
+    dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        start = time.time()
+        copier = fastcopy.FileCopier(src_fd, dst_fd, buffer_size, [method])
+        for chunk in copier:
+            pass
+        os.fsync(dst_fd)
+        elapsed = time.time() - start
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+    if copier.bytes_copied != os.path.getsize(src_path):
+        return copier.method, None
+    return copier.method, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dir', default=None,
+                        help='directory to copy in; defaults to a temporary directory')
+    parser.add_argument('--runs', type=int, default=3, help='copies per size and method')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='nectar-copy-benchmark-', dir=args.dir)
+    src_path = os.path.join(work_dir, 'src')
+    dst_path = os.path.join(work_dir, 'dst')
+
+    print '%-10s' % 'size' + ''.join('%18s' % method for method in fastcopy.METHODS)
+    try:
+        for size in SIZES:
+            make_file(src_path, size)
+            row = '%-10s' % ('%dK' % (size / 1024))
+            for method in fastcopy.METHODS:
+                best = None
+                for i in range(args.runs):
+                    used, elapsed = copy(src_path, dst_path, method, args.buffer_size)
+                    if used != method or elapsed is None:
+                        break
+                    best = elapsed if best is None else min(best, elapsed)
+                    os.unlink(dst_path)
+                if best is None:
+                    row += '%18s' % 'unsupported'
+                else:
+                    row += '%13.1f MB/s' % (size / 1048576.0 / max(best, 1e-6))
+            print row
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
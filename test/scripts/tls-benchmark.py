@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+"""
+Measure the time it takes to open a new HTTPS connection and download a small
+file over it, with and without the shared SSL context the threaded downloader
+uses.
+
+A local HTTPS server serves the test certificate, which is trusted through a CA
+bundle of the size of the system's. Every download is made over a new
+connection, so each one pays for a TLS handshake.
+
+Run from the root of the repository:
+
+ python2 test/scripts/tls-benchmark.py [--connections N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, _ROOT_DIR)
+sys.path.insert(0, os.path.join(_ROOT_DIR, 'test/utils'))
+
+from SimpleHTTPServer import SimpleHTTPRequestHandler  # noqa
+
+import requests  # noqa
+from requests.utils import DEFAULT_CA_BUNDLE_PATH  # noqa
+
+import http_static_test_server  # noqa
+from nectar import tls  # noqa
+from nectar.config import DownloaderConfig  # noqa
+
+
+PKI_DIR = os.path.join(_ROOT_DIR, 'test/unit/data/pki/localhost')
+PORT = 8443
+URL = 'https://localhost:%d/test/unit/data/pki/localhost/cert.pem' % PORT
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def make_session(adapter):
+    session = requests.Session()
+    session.mount('https://', adapter)
+    # a new connection, and so a new handshake, for every request
+    session.headers['Connection'] = 'close'
+    return session
+
+
+def run(session, ca_path, connections):
+    times = []
+    for i in range(connections):
+        start = time.time()
+        response = session.get(URL, verify=ca_path)
+        response.content
+        times.append(time.time() - start)
+    return sum(times) / len(times) * 1000, min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=200)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='nectar-tls-benchmark-')
+    ca_path = os.path.join(work_dir, 'ca-bundle.pem')
+    with open(ca_path, 'wb') as bundle:
+        for path in (DEFAULT_CA_BUNDLE_PATH, os.path.join(PKI_DIR, 'cert.pem')):
+            with open(path, 'rb') as f:
+                bundle.write(f.read())
+
+    os.chdir(_ROOT_DIR)
+    server = http_static_test_server.HTTPStaticTestServer(
+        port=PORT, certfile=os.path.join(PKI_DIR, 'cert.pem'),
+        keyfile=os.path.join(PKI_DIR, 'key.pem'))
+    server.server.RequestHandlerClass = QuietHandler
+    server.start()
+    try:
+        config = DownloaderConfig(ssl_ca_cert_path=ca_path)
+        sessions = [
+            ('per-connection context', make_session(requests.adapters.HTTPAdapter())),
+            ('shared context', make_session(tls.SSLContextAdapter(tls.get_ssl_context(config)))),
+        ]
+        # warm up
+        for name, session in sessions:
+            run(session, ca_path, 5)
+
+        bundle_size = os.path.getsize(ca_path) / 1024
+        print 'CA bundle: %d KB, %d connections each' % (bundle_size, args.connections)
+        results = []
+        for name, session in sessions:
+            mean, best = run(session, ca_path, args.connections)
+            results.append(mean)
+            print '%-24s mean %7.2f ms  min %7.2f ms' % (name, mean, best)
+        print 'saved per connection: %.2f ms' % (results[0] - results[1])
+        if not tls.SESSIONS_SUPPORTED:
+            print '(TLS session resumption needs Python 3.6 or later; not measured)'
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
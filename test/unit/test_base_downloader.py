@@ -1,4 +1,6 @@
 from cStringIO import StringIO
+import os
+import threading
 import unittest
 
 from nectar.config import DownloaderConfig
@@ -50,6 +52,72 @@ class LyingDownloader(Downloader):
         return report
 
 
+class BatchDownloader(LyingDownloader):
+    """
+    Downloads the requests one after the other, recording how many it had
+    finished by the time each one was consumed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BatchDownloader, self).__init__(*args, **kwargs)
+        self.finished = 0
+
+    def download(self, request_list):
+        for request in request_list:
+            if self.is_canceled:
+                break
+            self._download_one(request)
+            self.finished += 1
+
+
+class FailingDownloader(Downloader):
+    def download(self, request_list):
+        raise ValueError('broken')
+
+
+class TestIterDownload(unittest.TestCase):
+
+    def _requests(self, count):
+        return [DownloadRequest('http://stuff/%d' % i, os.devnull, data=i) for i in range(count)]
+
+    def test_yields_reports(self):
+        listener = AggregatingEventListener()
+        downloader = BatchDownloader(DownloaderConfig(), listener)
+
+        reports = list(downloader.iter_download(self._requests(5)))
+
+        self.assertEqual([r.data for r in reports], range(5))
+        # the listener still gets the events, and is put back
+        self.assertEqual(len(listener.succeeded_reports), 5)
+        self.assertTrue(downloader.event_listener is listener)
+
+    def test_backpressure(self):
+        downloader = BatchDownloader(DownloaderConfig())
+        reports = downloader.iter_download(self._requests(10), buffer_size=2)
+
+        next(reports)
+        threading.Event().wait(0.3)
+
+        # one consumed, two in the buffer and one waiting for room
+        self.assertEqual(downloader.finished, 3)
+        self.assertEqual(len(list(reports)), 9)
+
+    def test_stopped_early(self):
+        downloader = BatchDownloader(DownloaderConfig())
+        reports = downloader.iter_download(self._requests(10), buffer_size=1)
+
+        next(reports)
+        reports.close()
+
+        self.assertTrue(downloader.is_canceled)
+        self.assertTrue(downloader.finished < 10)
+
+    def test_error_raised(self):
+        downloader = FailingDownloader(DownloaderConfig())
+
+        self.assertRaises(ValueError, list, downloader.iter_download(self._requests(1)))
+
+
 class TestDownloadReport(unittest.TestCase):
 
     def setUp(self):
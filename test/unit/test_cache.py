@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+from SocketServer import ThreadingMixIn
+
+import mock
+
+import base
+from nectar import cache
+from nectar.config import DownloaderConfig
+from nectar.downloaders.threaded import HTTPThreadedDownloader
+from nectar.report import DOWNLOAD_SUCCEEDED
+from nectar.request import DownloadRequest
+
+
+PORT = 8091
+BODY = 'cached body ' * 1024
+ETAG = '"v1"'
+
+
+class CachingHandler(BaseHTTPRequestHandler):
+    """
+    Serves BODY, with the Cache-Control header of the server, and answers
+    requests conditional on its ETag with a 304.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('if-none-match'))
+        if self.headers.get('if-none-match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.send_header('Cache-Control', self.server.cache_control)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Cache-Control', self.server.cache_control)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class CachingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CacheTestCase(base.NectarTests):
+
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='nectar-cache-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = cache.HTTPCache(self.directory)
+
+    def _store(self, url='http://host/file', body='body', headers=None, request_headers=None,
+               scope=''):
+        headers = headers if headers is not None else {'Cache-Control': 'max-age=60'}
+        writer = self.cache.writer(url, request_headers or {}, 200, headers, scope)
+        self.assertTrue(writer is not None)
+        writer.write(body)
+        writer.commit()
+        return writer
+
+
+class ParseCacheControlTests(base.NectarTests):
+
+    def test_directives(self):
+        directives = cache.parse_cache_control('public, Max-Age="60",no-cache')
+
+        self.assertEqual(directives, {'public': None, 'max-age': '60', 'no-cache': None})
+
+    def test_none(self):
+        self.assertEqual(cache.parse_cache_control(None), {})
+
+
+class CredentialsScopeTests(base.NectarTests):
+
+    def test_no_credentials(self):
+        self.assertEqual(cache.credentials_scope(DownloaderConfig()), '')
+
+    def test_credentials_hashed(self):
+        scope = cache.credentials_scope(DownloaderConfig(basic_auth_username='user',
+                                                         basic_auth_password='secret'))
+
+        self.assertNotEqual(scope, '')
+        self.assertTrue('secret' not in scope)
+        self.assertNotEqual(scope, cache.credentials_scope(
+            DownloaderConfig(basic_auth_username='user', basic_auth_password='other')))
+
+
+class FreshnessTests(CacheTestCase):
+
+    def _entry(self, headers, stored_at=None):
+        meta = {'url': 'http://host/file', 'headers': headers, 'vary': {}, 'size': 0,
+                'stored_at': stored_at or time.time(), 'body': 'body'}
+        return cache.CacheEntry(self.cache, 'key', meta)
+
+    def test_max_age(self):
+        self.assertTrue(self._entry({'Cache-Control': 'max-age=60'}).is_fresh())
+        self.assertFalse(self._entry({'Cache-Control': 'max-age=60'},
+                                     stored_at=time.time() - 61).is_fresh())
+
+    def test_age_header(self):
+        entry = self._entry({'Cache-Control': 'max-age=60', 'Age': '61'})
+
+        self.assertFalse(entry.is_fresh())
+
+    def test_expires(self):
+        now = time.time()
+        entry = self._entry({'Date': formatdate(now, usegmt=True),
+                             'Expires': formatdate(now + 60, usegmt=True)})
+
+        self.assertTrue(59 <= entry.freshness_lifetime <= 60)
+        self.assertTrue(entry.is_fresh())
+
+    def test_invalid_expires(self):
+        self.assertEqual(self._entry({'Expires': '0'}).freshness_lifetime, 0)
+
+    def test_last_modified_heuristic(self):
+        now = time.time()
+        entry = self._entry({'Date': formatdate(now, usegmt=True),
+                             'Last-Modified': formatdate(now - 1000, usegmt=True)})
+
+        self.assertEqual(entry.freshness_lifetime, 100)
+
+    def test_no_cache(self):
+        self.assertFalse(self._entry({'Cache-Control': 'max-age=60, no-cache'}).is_fresh())
+
+    def test_request_no_cache(self):
+        entry = self._entry({'Cache-Control': 'max-age=60'})
+
+        self.assertFalse(entry.is_fresh({'Cache-Control': 'no-cache'}))
+        self.assertFalse(entry.is_fresh({'Pragma': 'no-cache'}))
+
+    def test_request_max_age(self):
+        entry = self._entry({'Cache-Control': 'max-age=60'}, stored_at=time.time() - 30)
+
+        self.assertTrue(entry.is_fresh({'Cache-Control': 'max-age=40'}))
+        self.assertFalse(entry.is_fresh({'Cache-Control': 'max-age=20'}))
+
+    def test_validators(self):
+        entry = self._entry({'ETag': ETAG, 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'})
+
+        self.assertEqual(entry.validators(), {'If-None-Match': ETAG,
+                                              'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'})
+
+
+class HTTPCacheTests(CacheTestCase):
+
+    def test_store_and_lookup(self):
+        self._store(body='some bytes')
+
+        entry = self.cache.lookup('http://host/file', {})
+
+        self.assertEqual(entry.size, 10)
+        self.assertEqual(entry.headers['cache-control'], 'max-age=60')
+        with entry.open() as body:
+            self.assertEqual(body.read(), 'some bytes')
+
+    def test_miss(self):
+        self.assertEqual(self.cache.lookup('http://host/file', {}), None)
+
+    def test_scope(self):
+        self._store(scope='credentials')
+
+        self.assertEqual(self.cache.lookup('http://host/file', {}), None)
+        self.assertTrue(self.cache.lookup('http://host/file', {}, 'credentials') is not None)
+
+    def test_replaced(self):
+        self._store(body='old')
+        self._store(body='new')
+
+        with self.cache.lookup('http://host/file', {}).open() as body:
+            self.assertEqual(body.read(), 'new')
+        bodies = [n for n in os.listdir(self.directory) if n.endswith(cache.BODY_SUFFIX)]
+        self.assertEqual(len(bodies), 1)
+
+    def test_vary(self):
+        self._store(headers={'Vary': 'Accept'}, request_headers={'accept': 'text/plain'})
+
+        self.assertTrue(self.cache.lookup('http://host/file', {'Accept': 'text/plain'}))
+        self.assertEqual(self.cache.lookup('http://host/file', {'Accept': 'text/html'}), None)
+        self.assertEqual(self.cache.lookup('http://host/file', {}), None)
+
+    def test_not_cacheable(self):
+        for args in ((200, {'Cache-Control': 'no-store'}, {}),
+                     (200, {'Vary': '*'}, {}),
+                     (200, {}, {'Range': 'bytes=0-10'}),
+                     (206, {}, {}),
+                     (404, {}, {})):
+            status_code, headers, request_headers = args
+            self.assertEqual(self.cache.writer('http://host/file', request_headers, status_code,
+                                               headers), None)
+
+    def test_request_no_store(self):
+        self._store()
+
+        self.assertEqual(self.cache.lookup('http://host/file', {'Cache-Control': 'no-store'}),
+                         None)
+
+    def test_abort(self):
+        writer = self.cache.writer('http://host/file', {}, 200, {})
+        writer.write('partial')
+
+        writer.abort()
+
+        self.assertEqual(self.cache.lookup('http://host/file', {}), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_too_big(self):
+        self.cache.max_size = 4
+        writer = self.cache.writer('http://host/file', {}, 200, {})
+        writer.write('too big')
+        writer.commit()
+
+        self.assertEqual(self.cache.lookup('http://host/file', {}), None)
+        self.assertEqual(self.cache.writer('http://host/file', {}, 200,
+                                           {'Content-Length': '5'}), None)
+
+    def test_revalidated(self):
+        self._store(headers={'Cache-Control': 'max-age=0', 'ETag': ETAG})
+        entry = self.cache.lookup('http://host/file', {})
+
+        entry = self.cache.revalidated(entry, {'Cache-Control': 'max-age=60',
+                                               'Content-Length': '0'})
+
+        self.assertTrue(entry.is_fresh())
+        entry = self.cache.lookup('http://host/file', {})
+        self.assertEqual(entry.headers['etag'], ETAG)
+        self.assertEqual(entry.headers['cache-control'], 'max-age=60')
+        self.assertEqual(entry.size, 4)
+
+    def test_evicted_entry_not_opened(self):
+        self._store()
+        entry = self.cache.lookup('http://host/file', {})
+        self._store(body='replaced')
+
+        self.assertEqual(entry.open(), None)
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_size = 25
+        for name in ('a', 'b', 'c'):
+            self._store(url='http://host/' + name, body='x' * 10)
+            # bring the entry's last use into the past, oldest first
+            key = self.cache._key('http://host/' + name, '')
+            meta = self.cache._path(key + cache.META_SUFFIX)
+            used = time.time() - 100 + ord(name)
+            os.utime(meta, (used, used))
+
+        self.assertEqual(self.cache.lookup('http://host/a', {}), None)
+        self.assertTrue(self.cache.lookup('http://host/b', {}) is not None)
+        self.assertTrue(self.cache.lookup('http://host/c', {}) is not None)
+
+    def test_evict_removes_orphans(self):
+        self._store()
+        orphan = os.path.join(self.directory, 'orphan-1' + cache.BODY_SUFFIX)
+        temp = os.path.join(self.directory, cache.TEMP_PREFIX + 'left')
+        recent = os.path.join(self.directory, cache.TEMP_PREFIX + 'recent')
+        for path in (orphan, temp, recent):
+            open(path, 'w').close()
+        old = time.time() - cache.ORPHAN_GRACE_TIME - 1
+        os.utime(orphan, (old, old))
+        os.utime(temp, (old, old))
+
+        self.cache.evict()
+
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(temp))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(self.cache.lookup('http://host/file', {}) is not None)
+
+    def test_shared_directory(self):
+        self._store(body='shared')
+
+        other = cache.HTTPCache(self.directory)
+
+        with other.lookup('http://host/file', {}).open() as body:
+            self.assertEqual(body.read(), 'shared')
+
+
+class CachedDownloadTests(CacheTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CachingServer(('127.0.0.1', PORT), CachingHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever,
+                                             kwargs={'poll_interval': 0.1})
+        cls.server_thread.setDaemon(True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super(CachedDownloadTests, self).setUp()
+        self.server.requests = []
+        self.server.cache_control = 'max-age=60'
+        self.destinations = tempfile.mkdtemp(prefix='nectar-destinations-')
+        self.addCleanup(shutil.rmtree, self.destinations)
+
+    def _download(self, name='file', **kwargs):
+        config = DownloaderConfig(cache_dir=self.directory, **kwargs)
+        downloader = HTTPThreadedDownloader(config, tries=1)
+        destination = os.path.join(self.destinations, name)
+        report = downloader.download_one(DownloadRequest('http://127.0.0.1:%d/file' % PORT,
+                                                         destination))
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        with open(destination) as f:
+            self.assertEqual(f.read(), BODY)
+        return report
+
+    def test_hit(self):
+        first = self._download('first')
+        second = self._download('second')
+
+        self.assertEqual(first.cache_status, cache.CACHE_MISS)
+        self.assertEqual(second.cache_status, cache.CACHE_HIT)
+        self.assertEqual(second.bytes_downloaded, len(BODY))
+        self.assertEqual(second.headers['etag'], ETAG)
+        self.assertEqual(self.server.requests, [None])
+
+    def test_revalidated(self):
+        self.server.cache_control = 'max-age=0'
+
+        self._download('first')
+        report = self._download('second')
+
+        self.assertEqual(report.cache_status, cache.CACHE_REVALIDATED)
+        self.assertEqual(self.server.requests, [None, ETAG])
+
+    def test_evicted_before_revalidation(self):
+        self.server.cache_control = 'max-age=0'
+        self._download('first')
+
+        with mock.patch.object(cache.CacheEntry, 'open', side_effect=[None, None]):
+            report = self._download('second')
+
+        self.assertEqual(report.cache_status, cache.CACHE_MISS)
+        self.assertEqual(self.server.requests, [None, None])
+
+    def test_no_store(self):
+        self.server.cache_control = 'no-store'
+
+        self._download('first')
+        report = self._download('second')
+
+        self.assertEqual(report.cache_status, cache.CACHE_MISS)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_scoped_by_credentials(self):
+        self._download('first')
+        report = self._download('second', basic_auth_username='user',
+                                basic_auth_password='secret')
+
+        self.assertEqual(report.cache_status, cache.CACHE_MISS)
+
+    def test_no_cache_configured(self):
+        config = DownloaderConfig()
+        downloader = HTTPThreadedDownloader(config, tries=1)
+        report = downloader.download_one(
+            DownloadRequest('http://127.0.0.1:%d/file' % PORT,
+                            os.path.join(self.destinations, 'file')))
+
+        self.assertEqual(report.cache_status, None)
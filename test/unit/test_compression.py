@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+import bz2
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from cStringIO import StringIO
+
+import base
+import mock
+from nectar import compression
+from nectar.request import DownloadRequest
+
+
+DATA = 'nectar ' * 10000
+
+
+def gzipped(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+class CompressionFromNameTests(unittest.TestCase):
+
+    def test_extensions(self):
+        self.assertEqual(compression.compression_from_name('primary.xml.gz'), compression.GZIP)
+        self.assertEqual(compression.compression_from_name('a/b.sqlite.bz2'), compression.BZIP2)
+        self.assertEqual(compression.compression_from_name('http://x/o.xml.xz'), compression.XZ)
+        self.assertEqual(compression.compression_from_name('f.zst?sig=1'), compression.ZSTD)
+
+    def test_no_extension(self):
+        self.assertTrue(compression.compression_from_name('repomd.xml') is None)
+
+    def test_unsupported(self):
+        self.assertRaises(compression.UnsupportedCompression, compression.decompressor, 'rar')
+
+
+class DecompressingWriterTests(unittest.TestCase):
+
+    def _write_in_chunks(self, writer, data, chunk_size=1000):
+        for offset in xrange(0, len(data), chunk_size):
+            writer.write(data[offset:offset + chunk_size])
+
+    def test_gzip(self):
+        output = StringIO()
+        writer = compression.DecompressingWriter(compression.GZIP, output)
+        compressed = gzipped(DATA)
+
+        self._write_in_chunks(writer, compressed)
+
+        self.assertEqual(output.getvalue(), DATA)
+        self.assertEqual(writer.bytes_written, len(compressed))
+        self.assertEqual(writer.bytes_decompressed, len(DATA))
+
+    def test_gzip_multiple_members(self):
+        output = StringIO()
+        writer = compression.DecompressingWriter(compression.GZIP, output)
+
+        self._write_in_chunks(writer, gzipped(DATA) + gzipped('more'))
+
+        self.assertEqual(output.getvalue(), DATA + 'more')
+
+    def test_bz2(self):
+        output = StringIO()
+        writer = compression.DecompressingWriter(compression.BZIP2, output)
+
+        self._write_in_chunks(writer, bz2.compress(DATA))
+
+        self.assertEqual(output.getvalue(), DATA)
+
+    def test_tee(self):
+        output = StringIO()
+        compressed_output = StringIO()
+        writer = compression.DecompressingWriter(compression.GZIP, output, compressed_output)
+        compressed = gzipped(DATA)
+
+        self._write_in_chunks(writer, compressed)
+
+        self.assertEqual(output.getvalue(), DATA)
+        self.assertEqual(compressed_output.getvalue(), compressed)
+
+    def test_corrupt_data(self):
+        writer = compression.DecompressingWriter(compression.GZIP, StringIO())
+
+        self.assertRaises(Exception, writer.write, 'not gzip data')
+
+    def _assert_truncated(self, compression_type, compressed):
+        writer = compression.DecompressingWriter(compression_type, StringIO())
+        self._write_in_chunks(writer, compressed)
+        writer.finish()
+
+        writer = compression.DecompressingWriter(compression_type, StringIO())
+        self._write_in_chunks(writer, compressed[:-10])
+        self.assertRaises(compression.TruncatedCompression, writer.finish)
+
+    def test_truncated_gzip(self):
+        self._assert_truncated(compression.GZIP, gzipped(DATA))
+
+    def test_truncated_gzip_member(self):
+        self._assert_truncated(compression.GZIP, gzipped(DATA) + gzipped('more'))
+
+    def test_truncated_bz2(self):
+        self._assert_truncated(compression.BZIP2, bz2.compress(DATA))
+
+    def test_truncated_xz(self):
+        if compression.lzma is None:
+            raise unittest.SkipTest('lzma is not available')
+        self._assert_truncated(compression.XZ, compression.lzma.compress(DATA))
+
+    def test_truncated_zstd(self):
+        if compression.zstandard is None:
+            raise unittest.SkipTest('zstandard is not available')
+        compressor = compression.zstandard.ZstdCompressor(write_content_size=True)
+        self._assert_truncated(compression.ZSTD, compressor.compress(DATA))
+
+    def test_empty(self):
+        writer = compression.DecompressingWriter(compression.GZIP, StringIO())
+
+        self.assertRaises(compression.TruncatedCompression, writer.finish)
+
+
+class ContentDecoderTests(unittest.TestCase):
+
+    def _decode(self, decoder, data, chunk_size=1000):
+        return list(decoder.decoded(data[offset:offset + chunk_size]
+                                    for offset in xrange(0, len(data), chunk_size)))
+
+    def test_accept_encoding(self):
+        self.assertEqual(compression.accept_encoding(['gzip', 'deflate']), 'gzip, deflate')
+        self.assertEqual(compression.accept_encoding(['rar', 'gzip']), 'gzip')
+        self.assertEqual(compression.accept_encoding([]), 'identity')
+
+    def test_accept_encoding_unavailable(self):
+        with mock.patch.object(compression, 'brotli', None):
+            self.assertEqual(compression.accept_encoding(['br']), 'identity')
+            self.assertFalse('br' in compression.supported_content_codings())
+        # a brotli that cannot bound its output
+        with mock.patch.object(compression, 'brotli') as mock_brotli:
+            mock_brotli.Decompressor = mock.Mock(spec=['process', 'is_finished'])
+            self.assertEqual(compression.accept_encoding(['br']), 'identity')
+            self.assertRaises(compression.UnsupportedCompression,
+                              compression.ContentDecoder, 'br')
+
+    def test_identity(self):
+        decoder = compression.ContentDecoder(None)
+
+        self.assertEqual(''.join(self._decode(decoder, DATA)), DATA)
+
+    def test_gzip(self):
+        decoder = compression.ContentDecoder('gzip')
+
+        self.assertEqual(''.join(self._decode(decoder, gzipped(DATA))), DATA)
+
+    def test_gzip_multiple_members(self):
+        decoder = compression.ContentDecoder('x-gzip')
+
+        self.assertEqual(''.join(self._decode(decoder, gzipped(DATA) + gzipped('more'))),
+                         DATA + 'more')
+
+    def test_deflate(self):
+        decoder = compression.ContentDecoder('deflate')
+
+        self.assertEqual(''.join(self._decode(decoder, zlib.compress(DATA))), DATA)
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(DATA) + compressor.flush()
+        decoder = compression.ContentDecoder('deflate')
+
+        self.assertEqual(''.join(self._decode(decoder, raw, chunk_size=1)), DATA)
+
+    def test_chained(self):
+        # deflated, then gzipped
+        decoder = compression.ContentDecoder('deflate, gzip')
+
+        self.assertEqual(''.join(self._decode(decoder, gzipped(zlib.compress(DATA)))), DATA)
+
+    def test_limit(self):
+        decoder = compression.ContentDecoder('gzip', limit=100)
+
+        pieces = self._decode(decoder, gzipped(DATA), chunk_size=len(DATA))
+
+        self.assertEqual(''.join(pieces), DATA)
+        self.assertTrue(max(len(p) for p in pieces) <= 100)
+
+    def test_limit_zstd(self):
+        if compression.zstandard is None:
+            raise unittest.SkipTest('zstandard is not available')
+        decoder = compression.ContentDecoder('zstd', limit=100)
+        encoded = compression.zstandard.ZstdCompressor().compress(DATA)
+
+        pieces = self._decode(decoder, encoded, chunk_size=len(encoded))
+
+        self.assertEqual(''.join(pieces), DATA)
+        self.assertTrue(max(len(p) for p in pieces) <= 100)
+
+    def test_limit_br(self):
+        if not compression._bounded_brotli():
+            raise unittest.SkipTest('brotli is not available, or cannot bound its output')
+        decoder = compression.ContentDecoder('br', limit=65536)
+        data = DATA * 20
+        encoded = compression.brotli.compress(data)
+
+        pieces = self._decode(decoder, encoded, chunk_size=len(encoded))
+
+        self.assertEqual(''.join(pieces), data)
+        # brotli grows its output buffer in steps, up to past the limit
+        self.assertTrue(len(pieces) > 1)
+        self.assertTrue(max(len(p) for p in pieces) < 3 * 65536)
+
+    def test_zstd_frame_end(self):
+        # single segment frame with a checksum, a raw block and a last RLE block
+        frame = struct.pack('<IBB', compression.ZSTD_MAGIC, 0x24, 9)
+        frame += struct.pack('<I', 5 << 3)[:3] + 'hello'
+        frame += struct.pack('<I', 4 << 3 | 1 << 1 | 1)[:3] + '!' + 'sums'
+
+        for chunk_size in (1, 4, len(frame)):
+            chunks = [frame[i:i + chunk_size] for i in xrange(0, len(frame), chunk_size)]
+            source = compression._ZstdFrameSource(chunks)
+            while source.read():
+                pass
+            self.assertTrue(source.frame_ended)
+
+            source = compression._ZstdFrameSource(chunks[:-1])
+            while source.read():
+                pass
+            self.assertFalse(source.frame_ended)
+
+    def test_unsupported(self):
+        self.assertRaises(compression.UnsupportedCompression,
+                          compression.ContentDecoder, 'compress')
+
+    def test_corrupt_data(self):
+        decoder = compression.ContentDecoder('gzip')
+
+        self.assertRaises(zlib.error, list, decoder.decoded(['not gzip data']))
+
+    def _assert_truncated(self, content_encoding, encoded):
+        decoder = compression.ContentDecoder(content_encoding)
+        self.assertEqual(''.join(self._decode(decoder, encoded)), DATA)
+
+        decoder = compression.ContentDecoder(content_encoding)
+        self.assertRaises(compression.TruncatedCompression,
+                          self._decode, decoder, encoded[:-10])
+
+    def test_truncated_gzip(self):
+        self._assert_truncated('gzip', gzipped(DATA))
+
+    def test_truncated_deflate(self):
+        self._assert_truncated('deflate', zlib.compress(DATA))
+
+    def test_truncated_raw_deflate(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._assert_truncated('deflate', compressor.compress(DATA) + compressor.flush())
+
+    def test_truncated_zstd(self):
+        if compression.zstandard is None:
+            raise unittest.SkipTest('zstandard is not available')
+        compressor = compression.zstandard.ZstdCompressor(write_content_size=True)
+        self._assert_truncated('zstd', compressor.compress(DATA))
+
+    def test_truncated_br(self):
+        if compression.brotli is None:
+            raise unittest.SkipTest('brotli is not available')
+        self._assert_truncated('br', compression.brotli.compress(DATA))
+
+    def test_truncated_br_unfinished(self):
+        # without brotli installed, its decompressor's end of stream is mocked
+        with mock.patch.object(compression, 'brotli') as mock_brotli:
+            mock_brotli.Decompressor.return_value.process.side_effect = ['decoded', '']
+            mock_brotli.Decompressor.return_value.is_finished.return_value = False
+            decoder = compression.ContentDecoder('br')
+
+            self.assertRaises(compression.TruncatedCompression,
+                              self._decode, decoder, 'encoded')
+
+    def test_empty_body(self):
+        decoder = compression.ContentDecoder('gzip')
+
+        self.assertEqual(self._decode(decoder, ''), [])
+
+
+class DecompressingRequestTests(base.NectarTests):
+
+    def setUp(self):
+        super(DecompressingRequestTests, self).setUp()
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-compression-testing-')
+
+    def tearDown(self):
+        super(DecompressingRequestTests, self).tearDown()
+        shutil.rmtree(self.dest_dir)
+
+    def test_guess_compression(self):
+        request = DownloadRequest('http://fake/primary.xml.gz', StringIO(), decompress=True)
+
+        self.assertEqual(request.compression, compression.GZIP)
+
+    def test_decompress_to_destination(self):
+        destination = os.path.join(self.dest_dir, 'primary.xml')
+        request = DownloadRequest('http://fake/primary.xml.gz', destination, decompress=True)
+
+        file_handle = request.initialize_file_handle()
+        file_handle.write(gzipped(DATA))
+        request.finalize_file_handle()
+
+        with open(destination) as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual(request.bytes_decompressed, len(DATA))
+
+    def test_decompress_to_both_destinations(self):
+        destination = os.path.join(self.dest_dir, 'primary.xml.gz')
+        decompressed_destination = os.path.join(self.dest_dir, 'primary.xml')
+        request = DownloadRequest('http://fake/primary.xml.gz', destination,
+                                  decompress=compression.GZIP,
+                                  decompressed_destination=decompressed_destination)
+        compressed = gzipped(DATA)
+
+        file_handle = request.initialize_file_handle()
+        file_handle.write(compressed)
+        request.finalize_file_handle()
+
+        with open(destination) as f:
+            self.assertEqual(f.read(), compressed)
+        with open(decompressed_destination) as f:
+            self.assertEqual(f.read(), DATA)
+
+    def test_truncated(self):
+        destination = os.path.join(self.dest_dir, 'primary.xml')
+        request = DownloadRequest('http://fake/primary.xml.gz', destination, decompress=True,
+                                  sinks=[])
+
+        file_handle = request.initialize_file_handle(staged=True)
+        file_handle.write(gzipped(DATA)[:-10])
+
+        self.assertRaises(compression.TruncatedCompression, request.finalize_file_handle)
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_no_decompression(self):
+        request = DownloadRequest('http://fake/primary.xml.gz', StringIO())
+
+        request.initialize_file_handle()
+
+        self.assertTrue(request.bytes_decompressed is None)
@@ -46,6 +46,13 @@ class InstantiationTests(base.NectarTests):
         self.assertEqual(config.use_sym_links, False)
         self.assertEqual(config.connect_timeout, 6.05)
         self.assertEqual(config.read_timeout, 27)
+        self.assertEqual(config.staged_writes, False)
+        self.assertEqual(config.durability, None)
+        self.assertEqual(config.link_strategies, None)
+        self.assertEqual(config.skip_identical, False)
+        self.assertEqual(config.shared_connections, False)
+        self.assertEqual(config.cache_dir, None)
+        self.assertEqual(config.cache_max_size, None)
 
     def test_dict_semantic_default_value(self):
         config = DownloaderConfig(basic_auth_username='username')
@@ -71,6 +78,16 @@ class InstantiationTests(base.NectarTests):
     def test_invalid_max_concurrent(self):
         self.assertRaises(ValueError, DownloaderConfig, max_concurrent=-1)
 
+    def test_invalid_transfer_limits(self):
+        self.assertRaises(ValueError, DownloaderConfig, deadline=0)
+        self.assertRaises(ValueError, DownloaderConfig, min_speed=-1)
+        self.assertRaises(ValueError, DownloaderConfig, min_speed_window=0)
+
+    def test_invalid_hedging(self):
+        self.assertRaises(ValueError, DownloaderConfig, hedge_percentile=100)
+        self.assertRaises(ValueError, DownloaderConfig, hedge_budget=0)
+        self.assertRaises(ValueError, DownloaderConfig, hedge_budget=1.5)
+
     def test_ssl_data_config_value(self):
         ca_cert_value = u'\xe9test cert'
         config = DownloaderConfig(ssl_ca_cert=ca_cert_value)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import base
+from nectar import delta, sink
+from nectar.request import DownloadRequest
+
+
+class DeltaTests(base.NectarTests):
+
+    def setUp(self):
+        super(DeltaTests, self).setUp()
+        self.dir = tempfile.mkdtemp(prefix='nectar-delta-testing-')
+        self.addCleanup(shutil.rmtree, self.dir)
+        # four blocks, the last one shorter
+        self.content = 'aaaabbbbccccdd'
+        self.index = delta.BlockIndex.from_file(StringIO(self.content), block_size=4)
+
+    def _seed(self, content):
+        path = os.path.join(self.dir, 'seed')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+
+class BlockIndexTests(DeltaTests):
+
+    def test_from_file(self):
+        self.assertEqual(self.index.size, 14)
+        self.assertEqual(self.index.digest, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(self.index.blocks, [hashlib.sha1(b).hexdigest()
+                                             for b in ('aaaa', 'bbbb', 'cccc', 'dd')])
+        self.assertEqual([self.index.block_length(b) for b in range(4)], [4, 4, 4, 2])
+
+    def test_save_and_load(self):
+        path = os.path.join(self.dir, 'file')
+        with open(path, 'wb') as f:
+            f.write(self.content)
+
+        index_path = delta.write_index(path, block_size=4)
+        loaded = delta.BlockIndex.load(index_path)
+
+        self.assertEqual(index_path, path + '.blocks')
+        self.assertEqual((loaded.size, loaded.block_size, loaded.digest, loaded.blocks),
+                         (self.index.size, 4, self.index.digest, self.index.blocks))
+
+    def test_load_invalid(self):
+        saved = StringIO()
+        self.index.save(saved)
+        lines = saved.getvalue().splitlines(True)
+        for document in ('', 'not an index\n', ''.join(lines[:-1]),
+                         ''.join(lines).replace('block-size 4', 'block-size 0'),
+                         ''.join(lines).replace('size 14', 'size many')):
+            self.assertRaises(delta.DeltaError, delta.BlockIndex.load, StringIO(document))
+
+    def test_plan(self):
+        # the second block changed, the third moved to the start
+        plan = self.index.plan(self._seed('ccccaaaaXXXXdd'))
+
+        self.assertEqual(plan.local, {0: 4, 2: 0, 3: 12})
+        self.assertEqual(plan.spans, [(4, 8)])
+        self.assertEqual((plan.fetched_bytes, plan.reused_bytes), (4, 10))
+
+    def test_plan_spans(self):
+        plan = self.index.plan(self._seed('aaaa'))
+
+        self.assertEqual(plan.spans, [(4, 14)])
+        self.assertEqual(plan.batches(), [[(4, 14)]])
+        self.assertEqual(delta.range_header([(0, 4), (8, 14)]), 'bytes=0-3,8-13')
+
+    def test_batches(self):
+        plan = self.index.plan(self._seed('XXXXbbbbYYYYdd'))
+
+        self.assertEqual(plan.batches(1), [[(0, 4)], [(8, 12)]])
+
+
+class RangesTests(base.NectarTests):
+
+    def test_single(self):
+        pieces = list(delta.iter_ranges('application/octet-stream', 'bytes 4-7/14',
+                                        iter(['bb', 'bb'])))
+
+        self.assertEqual(pieces, [(4, 'bb'), (6, 'bb')])
+
+    def test_multipart(self):
+        body = ('preamble\r\n--XYZ\r\nContent-Type: text/plain\r\n'
+                'Content-Range: bytes 0-3/14\r\n\r\naaaa\r\n--XYZ\r\n'
+                'Content-range: bytes 8-13/14\r\n\r\nc\r\n--d\r\n--XYZ--\r\n')
+        chunks = [body[i:i + 5] for i in range(0, len(body), 5)]
+
+        pieces = delta.iter_ranges('multipart/byteranges; boundary="XYZ"', None, iter(chunks))
+
+        self.assertEqual(''.join(d for o, d in pieces if o < 8), 'aaaa')
+        pieces = list(delta.iter_ranges('multipart/byteranges; boundary=XYZ', None,
+                                        iter(chunks)))
+        self.assertEqual(''.join(d for o, d in pieces if o >= 8), 'c\r\n--d')
+        self.assertEqual(pieces[0][0], 0)
+
+    def test_truncated(self):
+        pieces = delta.iter_ranges(None, 'bytes 0-9/14', iter(['abc']))
+
+        self.assertRaises(delta.DeltaError, list, pieces)
+
+    def test_invalid(self):
+        self.assertRaises(delta.DeltaError, delta.iter_ranges, None, 'bytes */14', iter([]))
+        self.assertRaises(delta.DeltaError, delta.iter_ranges, 'multipart/byteranges', None,
+                          iter([]))
+
+
+class AssemblerTests(DeltaTests):
+
+    def _assemble(self, seed, remote):
+        plan = self.index.plan(self._seed(seed))
+        destination = StringIO()
+        assembler = delta.Assembler(plan, destination)
+        self.addCleanup(assembler.close)
+        for offset, data in remote:
+            assembler.remote(offset, data)
+        assembler.finish()
+        return destination.getvalue()
+
+    def test_assemble(self):
+        self.assertEqual(self._assemble('ccccaaaaXXXXdd', [(4, 'bb'), (6, 'bb')]), self.content)
+
+    def test_corrupt(self):
+        self.assertRaises(sink.VerificationFailed, self._assemble, 'aaaaXXXXccccdd',
+                          [(4, 'bbbX')])
+
+    def test_unexpected_range(self):
+        self.assertRaises(delta.DeltaError, self._assemble, 'aaaaXXXXccccdd', [(0, 'aaaa')])
+
+    def test_missing_range(self):
+        self.assertRaises(delta.DeltaError, self._assemble, 'aaaaXXXXccccdd', [])
+
+
+class SeedTests(DeltaTests):
+
+    def test_seed_for(self):
+        seed = self._seed('aaaa')
+
+        self.assertEqual(delta.seed_for(DownloadRequest('http://host/f', seed,
+                                                        delta=self.index)), seed)
+        self.assertEqual(delta.seed_for(DownloadRequest('http://host/f', seed)), None)
+        self.assertEqual(delta.seed_for(DownloadRequest('http://host/f', seed + '.missing',
+                                                        delta=self.index)), None)
+        self.assertEqual(delta.seed_for(DownloadRequest('http://host/f', StringIO(),
+                                                        delta=self.index)), None)
+        self.assertEqual(delta.seed_for(DownloadRequest('http://host/f.gz', seed,
+                                                        decompress=True, delta=self.index)),
+                         None)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import shutil
+import tempfile
+
+import mock
+
+import base
+from nectar import fastcopy
+
+
+class FileCopierTests(base.NectarTests):
+
+    def setUp(self):
+        super(FileCopierTests, self).setUp()
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-fastcopy-testing-')
+        self.src_path = os.path.join(self.dest_dir, 'src')
+        self.dst_path = os.path.join(self.dest_dir, 'dst')
+        self.contents = os.urandom(100000)
+        with open(self.src_path, 'wb') as f:
+            f.write(self.contents)
+
+        self.src_fd = os.open(self.src_path, os.O_RDONLY)
+        self.dst_fd = os.open(self.dst_path, os.O_WRONLY | os.O_CREAT)
+
+    def tearDown(self):
+        super(FileCopierTests, self).tearDown()
+        os.close(self.src_fd)
+        os.close(self.dst_fd)
+        shutil.rmtree(self.dest_dir)
+
+    def _copy(self, methods):
+        copier = fastcopy.FileCopier(self.src_fd, self.dst_fd, 16384, methods)
+        chunks = list(copier)
+
+        self.assertEqual(sum(chunks), len(self.contents))
+        self.assertEqual(copier.bytes_copied, len(self.contents))
+        self.assertEqual(os.lseek(self.dst_fd, 0, os.SEEK_CUR), len(self.contents))
+        with open(self.dst_path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        return copier, chunks
+
+    def test_copy(self):
+        self._copy(fastcopy.METHODS)
+
+    def test_buffered(self):
+        copier, chunks = self._copy([fastcopy.METHOD_BUFFERED])
+
+        self.assertEqual(copier.method, fastcopy.METHOD_BUFFERED)
+        self.assertEqual(max(chunks), 16384)
+
+    def test_kernel_copy_chunked(self):
+        methods = [fastcopy.METHOD_COPY_FILE_RANGE, fastcopy.METHOD_SENDFILE,
+                   fastcopy.METHOD_BUFFERED]
+
+        copier, chunks = self._copy(methods)
+
+        self.assertEqual(max(chunks), 16384)
+
+    @mock.patch('nectar.fastcopy.fcntl')
+    def test_reflink_single_chunk(self, mock_fcntl):
+        def clone(dst_fd, request, src_fd):
+            # what the kernel does, without the sharing
+            with open(self.dst_path, 'wb') as f:
+                f.write(self.contents)
+        mock_fcntl.ioctl.side_effect = clone
+
+        copier, chunks = self._copy(fastcopy.METHODS)
+
+        mock_fcntl.ioctl.assert_called_once_with(self.dst_fd, fastcopy.FICLONE, self.src_fd)
+        self.assertEqual(copier.method, fastcopy.METHOD_REFLINK)
+        self.assertEqual(chunks, [len(self.contents)])
+
+    @mock.patch('nectar.fastcopy.sendfile')
+    @mock.patch('nectar.fastcopy.copy_file_range')
+    def test_unsupported_falls_back(self, mock_copy_file_range, mock_sendfile):
+        mock_copy_file_range.side_effect = fastcopy.UnsupportedCopy()
+        mock_sendfile.side_effect = fastcopy.UnsupportedCopy()
+
+        with mock.patch.dict(fastcopy._COPY_FUNCTIONS,
+                             {fastcopy.METHOD_COPY_FILE_RANGE: mock_copy_file_range,
+                              fastcopy.METHOD_SENDFILE: mock_sendfile}):
+            copier, chunks = self._copy(fastcopy.METHODS[1:])
+
+        self.assertEqual(mock_copy_file_range.call_count, 1)
+        self.assertEqual(mock_sendfile.call_count, 1)
+        self.assertEqual(copier.method, fastcopy.METHOD_BUFFERED)
+
+    def test_fallback_continues_from_offset(self):
+        calls = []
+
+        def copy_once(src_fd, dst_fd, count):
+            if calls:
+                raise fastcopy.UnsupportedCopy()
+            calls.append(count)
+            return fastcopy.buffered(src_fd, dst_fd, count)
+
+        with mock.patch.dict(fastcopy._COPY_FUNCTIONS,
+                             {fastcopy.METHOD_COPY_FILE_RANGE: copy_once}):
+            copier, chunks = self._copy([fastcopy.METHOD_COPY_FILE_RANGE,
+                                         fastcopy.METHOD_BUFFERED])
+
+        self.assertEqual(copier.method, fastcopy.METHOD_BUFFERED)
+
+    def test_empty_kernel_copy_not_trusted(self):
+        # files such as those in /proc look empty to the kernel copy functions
+        with mock.patch.dict(fastcopy._COPY_FUNCTIONS,
+                             {fastcopy.METHOD_COPY_FILE_RANGE: lambda *args: 0}):
+            copier, chunks = self._copy([fastcopy.METHOD_COPY_FILE_RANGE,
+                                         fastcopy.METHOD_BUFFERED])
+
+        self.assertEqual(copier.method, fastcopy.METHOD_BUFFERED)
+
+    def test_error_raised(self):
+        with mock.patch.object(fastcopy, '_copy_file_range', return_value=-1):
+            with mock.patch('ctypes.get_errno', return_value=errno.ENOSPC):
+                copier = fastcopy.FileCopier(self.src_fd, self.dst_fd, 16384,
+                                             [fastcopy.METHOD_COPY_FILE_RANGE])
+                self.assertRaises(OSError, list, copier)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from cStringIO import StringIO
+
+import mock
+
+import base
+from nectar import future
+from nectar.report import DownloadReport
+from nectar.request import DownloadRequest
+
+
+class DownloadFutureTests(base.NectarTests):
+
+    def setUp(self):
+        super(DownloadFutureTests, self).setUp()
+        self.request = DownloadRequest('http://fake/repomd.xml', StringIO())
+        self.future = future.DownloadFuture(self.request)
+        self.report = DownloadReport.from_download_request(self.request)
+
+    def test_result(self):
+        threading.Timer(0.1, self.future.set_result, [self.report]).start()
+
+        self.assertTrue(self.future.result() is self.report)
+        self.assertTrue(self.future.done())
+
+    @mock.patch.object(future, 'WAIT_POLL_INTERVAL', 0.01)
+    def test_timeout(self):
+        self.assertRaises(future.TimeoutError, self.future.result, 0.05)
+        self.assertFalse(self.future.done())
+
+    def test_set_once(self):
+        self.future.set_result(self.report)
+        self.future.set_canceled()
+
+        self.assertTrue(self.future.result() is self.report)
+
+    def test_set_canceled(self):
+        self.future.set_canceled()
+
+        self.assertEqual(self.future.result().state, DownloadReport.DOWNLOAD_CANCELED)
+        self.assertEqual(self.future.result().url, self.request.url)
+
+    def test_callbacks(self):
+        callback = mock.Mock()
+        failing = mock.Mock(side_effect=ValueError)
+        self.future.add_done_callback(failing)
+        self.future.add_done_callback(callback)
+        self.assertEqual(callback.call_count, 0)
+
+        self.future.set_result(self.report)
+
+        callback.assert_called_once_with(self.future)
+        # right away once done
+        late = mock.Mock()
+        self.future.add_done_callback(late)
+        late.assert_called_once_with(self.future)
+
+    def test_cancel(self):
+        self.assertTrue(self.future.cancel())
+        self.assertTrue(self.request.canceled)
+
+        self.future.set_result(self.report)
+
+        self.assertFalse(self.future.cancel())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import base
+from nectar import hedge
+
+
+class LatencyStatsTests(base.NectarTests):
+
+    def test_percentile(self):
+        stats = hedge.LatencyStats()
+        for i in range(1, 101):
+            stats.record(i / 100.0, i if i % 2 else None)
+
+        self.assertEqual(len(stats), 100)
+        first_byte, per_byte = stats.percentile(95)
+        self.assertEqual(first_byte, 0.95)
+        self.assertEqual(per_byte, 95)
+
+    def test_empty(self):
+        self.assertEqual(hedge.LatencyStats().percentile(95), (None, None))
+
+    def test_latest(self):
+        stats = hedge.LatencyStats(max_samples=2)
+        for first_byte in (10, 1, 2):
+            stats.record(first_byte)
+
+        self.assertEqual(stats.percentile(100), (2, None))
+
+
+class HedgingPolicyTests(base.NectarTests):
+
+    def test_delays(self):
+        policy = hedge.HedgingPolicy(percentile=50, min_samples=2)
+        policy.record(0.5, 100, 1.5)
+        self.assertEqual(policy.delays(), None)
+
+        policy.record(0.5, 0, 0.5)
+
+        self.assertEqual(policy.delays(), (0.5, 0.01))
+
+    def test_budget(self):
+        policy = hedge.HedgingPolicy(budget=0.1)
+        for i in range(19):
+            policy.request_started()
+        self.assertTrue(policy.spend())
+        self.assertFalse(policy.spend())
+
+        policy.request_started()
+
+        self.assertTrue(policy.spend())
+        self.assertEqual(policy.hedged, 2)
+
+
+class RaceTests(base.NectarTests):
+
+    def test_first_claim_wins(self):
+        race = hedge.Race()
+
+        self.assertTrue(race.claim(hedge.HEDGE))
+        self.assertFalse(race.claim(hedge.PRIMARY))
+        self.assertTrue(race.claim(hedge.HEDGE))
+        self.assertEqual(race.winner, hedge.HEDGE)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+
+import mock
+
+import base
+from nectar import inflight
+from nectar.downloaders.threaded import WorkerQueue
+
+
+class ConnectionTrackerTests(base.NectarTests):
+
+    def setUp(self):
+        super(ConnectionTrackerTests, self).setUp()
+        self.tracker = inflight.ConnectionTracker()
+        # socketpair gives the raw sockets, wrap them as connections do
+        self.sockets = [socket.socket(_sock=raw) for raw in socket.socketpair()]
+        for sock in self.sockets:
+            self.addCleanup(sock.close)
+
+    def test_abort_wakes_reader(self):
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.sockets[0].recv(10)))
+        reader.start()
+        self.tracker.add(self.sockets[0])
+
+        self.assertEqual(self.tracker.abort(), 1)
+
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(received, [''])
+
+    def test_discarded_not_aborted(self):
+        self.tracker.add(self.sockets[0])
+        self.tracker.discard(self.sockets[0])
+
+        self.assertEqual(self.tracker.abort(), 0)
+        self.sockets[1].sendall('still open')
+        self.assertEqual(self.sockets[0].recv(10), 'still open')
+
+    def test_closed_socket_object(self):
+        # the socket underneath is still shut down
+        self.tracker.add(self.sockets[0])
+        raw = self.sockets[0]._sock
+        self.sockets[0].close()
+
+        self.assertEqual(self.tracker.abort(), 1)
+        self.assertEqual(raw.recv(10), '')
+
+    def test_add_after_abort(self):
+        self.tracker.abort()
+
+        self.assertRaises(inflight.ConnectionAborted, self.tracker.add, self.sockets[0])
+
+    def test_forgotten_when_done(self):
+        with self.tracker.track():
+            self.assertTrue(inflight._local.tracker is self.tracker)
+            self.tracker.add(self.sockets[0])
+
+        self.assertEqual(inflight._local.tracker, None)
+        self.assertEqual(self.tracker.abort(), 0)
+
+    def test_refuses_connections_after_abort(self):
+        pool = inflight.HTTPConnectionPool('localhost', 1)
+        self.tracker.abort()
+
+        with self.tracker.track():
+            self.assertRaises(inflight.ConnectionAborted, pool._get_conn)
+
+    def test_abort_expired(self):
+        expired = inflight.TransferMonitor(deadline=time.time())
+        self.tracker.add(self.sockets[0])
+        self.tracker.watch(expired)
+        other = threading.Thread(target=self.tracker.add, args=[self.sockets[1]])
+        other.start()
+        other.join()
+
+        self.assertEqual(self.tracker.abort_expired(), 1)
+        self.assertEqual(expired.expired, inflight.EXPIRED_DEADLINE)
+        self.assertEqual(self.sockets[0].recv(10), '')
+        # not watched any more
+        self.assertEqual(self.tracker.abort_expired(), 0)
+
+    def test_stop_watching(self):
+        self.tracker.add(self.sockets[0])
+        self.tracker.watch(inflight.TransferMonitor(deadline=time.time()))
+        self.tracker.watch(None)
+
+        self.assertEqual(self.tracker.abort_expired(), 0)
+
+    def test_expire(self):
+        monitor = inflight.TransferMonitor()
+        self.tracker.add(self.sockets[0])
+        self.tracker.watch(monitor)
+        ident = threading.current_thread().ident
+
+        self.assertEqual(self.tracker.expire(ident, inflight.EXPIRED_HEDGED), 1)
+        self.assertEqual(monitor.expired, inflight.EXPIRED_HEDGED)
+        self.assertEqual(self.sockets[0].recv(10), '')
+        self.assertEqual(self.tracker.expire(ident, inflight.EXPIRED_HEDGED), 0)
+        # until the thread moves on to another transfer
+        self.assertRaises(inflight.ConnectionAborted, self.tracker.add, self.sockets[1])
+        self.tracker.watch(None)
+        self.tracker.add(self.sockets[1])
+
+    @mock.patch.object(inflight, 'WATCH_INTERVAL', 0.01)
+    def test_watchdog(self):
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.sockets[0].recv(10)))
+        reader.start()
+        self.tracker.add(self.sockets[0])
+
+        self.tracker.watch(inflight.TransferMonitor(deadline=time.time() + 0.05))
+
+        reader.join(5)
+        self.assertEqual(received, [''])
+
+
+class TransferMonitorTests(base.NectarTests):
+
+    def test_no_limits(self):
+        monitor = inflight.TransferMonitor()
+
+        self.assertEqual(monitor.check(monitor.started + 3600), None)
+
+    def test_deadline(self):
+        monitor = inflight.TransferMonitor(deadline=time.time() + 10)
+
+        self.assertEqual(monitor.check(monitor.started + 1), None)
+        self.assertEqual(monitor.check(monitor.started + 10), inflight.EXPIRED_DEADLINE)
+        self.assertEqual(monitor.expired, inflight.EXPIRED_DEADLINE)
+
+    @mock.patch('time.time')
+    def test_speed(self, mock_time):
+        mock_time.return_value = 1000
+        monitor = inflight.TransferMonitor(min_speed=100, window=10)
+        speeds = []
+        for second in range(1, 21):
+            mock_time.return_value = 1000 + second
+            # 200 bytes a second, then 50
+            monitor.update(200 if second <= 10 else 50)
+            speeds.append(monitor.speed())
+            if second == 15:
+                self.assertEqual(monitor.check(), None)
+
+        self.assertEqual(speeds[:9], [None] * 9)
+        self.assertEqual(speeds[9:], [200, 185, 170, 155, 140, 125, 110, 95, 80, 65, 50])
+        self.assertEqual(monitor.check(), inflight.EXPIRED_STALLED)
+
+    def test_slow(self):
+        on_slow = mock.Mock()
+        monitor = inflight.TransferMonitor(slow=(1, 0.01), on_slow=on_slow)
+
+        self.assertFalse(monitor.is_slow(monitor.started + 0.5))
+        self.assertTrue(monitor.is_slow(monitor.started + 1))
+        monitor.responded(size=100)
+        self.assertFalse(monitor.is_slow(monitor.started + 1.5))
+        self.assertTrue(monitor.is_slow(monitor.started + 2))
+
+        monitor.check(monitor.started + 2)
+        monitor.check(monitor.started + 3)
+        self.assertEqual(on_slow.call_count, 1)
+
+    def test_slow_unknown_size(self):
+        monitor = inflight.TransferMonitor(slow=(1, 0.01))
+        monitor.responded()
+
+        self.assertFalse(monitor.is_slow(monitor.started + 3600))
+
+    def test_stalled_without_bytes(self):
+        monitor = inflight.TransferMonitor(min_speed=1, window=10)
+
+        self.assertEqual(monitor.check(monitor.started + 10), inflight.EXPIRED_STALLED)
+
+
+class WorkerQueueDrainTests(base.NectarTests):
+
+    def test_drain(self):
+        queue = WorkerQueue(iter(range(5)))
+        self.assertEqual(queue.get(), 0)
+        queue.defer(1, 0)
+        queue.defer(0, 0)
+
+        self.assertEqual(list(queue.drain()), [1, 0, 1, 2, 3, 4])
+        self.assertTrue(queue.finished)
+        self.assertEqual(queue.get(), None)
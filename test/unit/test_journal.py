@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+import base
+from nectar import journal
+from nectar.config import DownloaderConfig
+from nectar.downloaders.local import LocalFileDownloader
+from nectar.listener import AggregatingEventListener
+from nectar.request import DownloadRequest
+
+
+class JournalTests(base.NectarTests):
+
+    def setUp(self):
+        super(JournalTests, self).setUp()
+        self.dir = tempfile.mkdtemp(prefix='nectar-journal-testing-')
+        self.path = os.path.join(self.dir, 'journal')
+        self.destination = os.path.join(self.dir, 'file')
+
+    def tearDown(self):
+        super(JournalTests, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def _lines(self):
+        with open(self.path, 'rb') as f:
+            return f.readlines()
+
+
+class DownloadJournalTests(JournalTests):
+
+    def test_new(self):
+        download_journal = journal.DownloadJournal(self.path)
+
+        self.assertEqual(len(download_journal), 0)
+        self.assertEqual(self._lines(), [journal.HEADER])
+
+    def test_record_and_reload(self):
+        download_journal = journal.DownloadJournal(self.path)
+        download_journal.record('http://fake/file', self.destination, 3, 'abc')
+        download_journal.record(u'http://fake/f\xefle\ttab', self.destination, 4)
+        download_journal.close()
+
+        reloaded = journal.DownloadJournal(self.path)
+
+        self.assertEqual(len(reloaded), 2)
+        self.assertEqual(reloaded.lookup('http://fake/file', self.destination), (3, 'abc'))
+        self.assertEqual(reloaded.lookup(u'http://fake/f\xefle\ttab', self.destination),
+                         (4, None))
+        self.assertEqual(reloaded.lookup('http://fake/other', self.destination), None)
+
+    def test_batched(self):
+        download_journal = journal.DownloadJournal(self.path, batch_size=2, flush_interval=60)
+
+        download_journal.record('http://fake/1', self.destination, 1)
+        self.assertEqual(len(self._lines()), 1)
+        download_journal.record('http://fake/2', self.destination, 2)
+        self.assertEqual(len(self._lines()), 3)
+        download_journal.record('http://fake/3', self.destination, 3)
+        download_journal.flush()
+        self.assertEqual(len(self._lines()), 4)
+
+    @mock.patch('time.time')
+    def test_flush_interval(self, mock_time):
+        mock_time.return_value = 1000
+        download_journal = journal.DownloadJournal(self.path, flush_interval=1)
+
+        download_journal.record('http://fake/1', self.destination, 1)
+        self.assertEqual(len(self._lines()), 1)
+        mock_time.return_value = 1001
+        download_journal.record('http://fake/2', self.destination, 2)
+        self.assertEqual(len(self._lines()), 3)
+
+    def test_torn_line(self):
+        download_journal = journal.DownloadJournal(self.path)
+        download_journal.record('http://fake/1', self.destination, 1)
+        download_journal.record('http://fake/2', self.destination, 2)
+        download_journal.close()
+        content = ''.join(self._lines())
+        with open(self.path, 'wb') as f:
+            f.write(content[:-5])
+
+        reloaded = journal.DownloadJournal(self.path)
+
+        self.assertEqual(len(reloaded), 1)
+        self.assertEqual(reloaded.lookup('http://fake/2', self.destination), None)
+        # rewritten without it, so records are not appended to it
+        self.assertEqual(''.join(self._lines()), content[:content.rindex('\n', 0, -1) + 1])
+
+    def test_corrupt_line(self):
+        download_journal = journal.DownloadJournal(self.path)
+        download_journal.record('http://fake/1', self.destination, 1)
+        download_journal.close()
+        content = ''.join(self._lines())
+        with open(self.path, 'wb') as f:
+            f.write(content.replace('\t1\t', '\t2\t'))
+
+        self.assertEqual(len(journal.DownloadJournal(self.path)), 0)
+
+    def test_compacted_on_load(self):
+        download_journal = journal.DownloadJournal(self.path)
+        for size in range(4):
+            download_journal.record('http://fake/file', self.destination, size)
+        download_journal.close()
+        self.assertEqual(len(self._lines()), 5)
+
+        reloaded = journal.DownloadJournal(self.path)
+
+        self.assertEqual(len(self._lines()), 2)
+        self.assertEqual(reloaded.lookup('http://fake/file', self.destination), (3, None))
+        self.assertEqual(os.listdir(self.dir), ['journal'])
+
+    def test_compact(self):
+        download_journal = journal.DownloadJournal(self.path)
+        download_journal.record('http://fake/file', self.destination, 1)
+        download_journal.record('http://fake/file', self.destination, 2)
+        download_journal.compact()
+        download_journal.record('http://fake/other', self.destination, 3)
+        download_journal.close()
+
+        self.assertEqual(len(self._lines()), 3)
+        reloaded = journal.DownloadJournal(self.path)
+        self.assertEqual(reloaded.lookup('http://fake/file', self.destination), (2, None))
+        self.assertEqual(reloaded.lookup('http://fake/other', self.destination), (3, None))
+
+    def test_is_done(self):
+        download_journal = journal.DownloadJournal(self.path)
+        request = DownloadRequest('http://fake/file', self.destination)
+        download_journal.record(request.url, request.destination, 3)
+
+        # missing
+        self.assertFalse(download_journal.is_done(request))
+        with open(self.destination, 'wb') as f:
+            f.write('abcd')
+        # truncated or overwritten
+        self.assertFalse(download_journal.is_done(request))
+        with open(self.destination, 'wb') as f:
+            f.write('abc')
+        self.assertTrue(download_journal.is_done(request))
+        self.assertFalse(download_journal.is_done(DownloadRequest(request.url, open(os.devnull))))
+
+
+class DownloaderJournalTests(JournalTests):
+
+    def setUp(self):
+        super(DownloaderJournalTests, self).setUp()
+        self.source = os.path.join(self.dir, 'source')
+        with open(self.source, 'wb') as f:
+            f.write('abc')
+        self.url = 'file://' + self.source
+
+    def test_skips_done(self):
+        config = DownloaderConfig(journal_path=self.path)
+        listener = AggregatingEventListener()
+        downloader = LocalFileDownloader(config, listener)
+        downloader.download([DownloadRequest(self.url, self.destination)])
+        self.assertEqual(len(listener.succeeded_reports), 1)
+        self.assertEqual(len(self._lines()), 2)
+
+        # as after a restart
+        listener = AggregatingEventListener()
+        downloader = LocalFileDownloader(config, listener)
+        with mock.patch.object(downloader, '_copy') as mock_copy:
+            downloader.download([DownloadRequest(self.url, self.destination)])
+
+        self.assertEqual(mock_copy.call_count, 0)
+        self.assertEqual(len(listener.succeeded_reports), 1)
+        report = listener.succeeded_reports[0]
+        self.assertEqual(report.strategy, 'skipped')
+        self.assertEqual(report.total_bytes, 3)
+        # not recorded again
+        self.assertEqual(len(self._lines()), 2)
+
+    def test_downloads_missing(self):
+        config = DownloaderConfig(journal_path=self.path)
+        LocalFileDownloader(config).download([DownloadRequest(self.url, self.destination)])
+        os.unlink(self.destination)
+
+        listener = AggregatingEventListener()
+        LocalFileDownloader(config, listener).download(
+            [DownloadRequest(self.url, self.destination)])
+
+        self.assertEqual(listener.succeeded_reports[0].strategy, None)
+        self.assertTrue(os.path.exists(self.destination))
+
+    def test_failed_not_recorded(self):
+        config = DownloaderConfig(journal_path=self.path)
+        listener = AggregatingEventListener()
+
+        LocalFileDownloader(config, listener).download(
+            [DownloadRequest('file://' + self.source + '.missing', self.destination)])
+
+        self.assertEqual(len(listener.failed_reports), 1)
+        self.assertEqual(self._lines(), [journal.HEADER])
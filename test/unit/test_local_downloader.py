@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import errno
+import gzip
 import os
 import shutil
 import tempfile
@@ -9,9 +11,10 @@ import unittest
 
 import mock
 
+from nectar import fastcopy
 from nectar.config import DownloaderConfig
 from nectar.downloaders import local
-from nectar.listener import AggregatingEventListener
+from nectar.listener import AggregatingEventListener, DownloadEventListener
 from nectar.report import DownloadReport
 from nectar.request import DownloadRequest
 
@@ -195,6 +198,99 @@ class GoodDownloadTests(DownloadTests):
         # make sure the no writing was attempted
         self.assertEqual(mock_open.return_value.write.call_count, 0)
 
+    def test_copy_decompress(self):
+        config = DownloaderConfig()
+        downloader = local.LocalFileDownloader(config)
+        src_path = os.path.join(self.dest_dir, 'data.gz')
+        gzip_file = gzip.open(src_path, 'wb')
+        gzip_file.write('abc' * 1000)
+        gzip_file.close()
+        request = DownloadRequest('file://' + os.path.abspath(src_path),
+                                  os.path.join(self.dest_dir, 'data'), decompress=True)
+
+        report = downloader._copy(request)
+
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(report.bytes_downloaded, os.path.getsize(src_path))
+        self.assertEqual(report.bytes_decompressed, 3000)
+        with open(request.destination) as f:
+            self.assertEqual(f.read(), 'abc' * 1000)
+
+    def test_link_decompress_copies(self):
+        config = DownloaderConfig(use_hard_links=True)
+        downloader = local.LocalFileDownloader(config)
+        request = DownloadRequest('file://' + __file__, StringIO(), decompress=True)
+
+        with mock.patch.object(downloader, '_copy') as mock_copy:
+            downloader.download_method(request)
+
+        mock_copy.assert_called_once_with(request, None)
+
+    def test_copy_staged(self):
+        config = DownloaderConfig(staged_writes=True)
+        downloader = local.LocalFileDownloader(config)
+        request_list = self._make_requests(DATA_FILES[:1])
+
+        report = downloader._copy(request_list[0])
+
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(os.listdir(self.dest_dir), DATA_FILES[:1])
+        self.assertEqual(os.path.getsize(request_list[0].destination),
+                         os.path.getsize(os.path.join(DATA_DIR, DATA_FILES[0])))
+
+    def test_copy_staged_canceled(self):
+        config = DownloaderConfig(staged_writes=True)
+        downloader = local.LocalFileDownloader(config)
+        request_list = self._make_requests(DATA_FILES[:1])
+        request_list[0].canceled = True
+
+        report = downloader._copy(request_list[0])
+
+        self.assertEqual(report.state, report.DOWNLOAD_CANCELED)
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_copy_kernel_progress(self):
+        config = DownloaderConfig(buffer_size=65536, progress_interval=0)
+        listener = mock.MagicMock()
+        downloader = local.LocalFileDownloader(config, listener)
+        request = self._make_requests(DATA_FILES[:1])[0]
+
+        with mock.patch.object(downloader, '_buffered_chunks') as mock_buffered_chunks:
+            report = downloader._copy(request)
+
+        self.assertEqual(mock_buffered_chunks.call_count, 0)
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(report.bytes_downloaded, os.path.getsize(request.destination))
+        self.assertTrue(listener.download_progress.call_count > 0)
+
+    def test_copy_kernel_canceled(self):
+        config = DownloaderConfig(buffer_size=65536, progress_interval=0)
+        listener = AggregatingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+        request = self._make_requests(DATA_FILES[:1])[0]
+        listener.download_progress = lambda report: downloader.cancel()
+
+        # a reflink would copy the whole file at once
+        with mock.patch('nectar.fastcopy.reflink', side_effect=fastcopy.UnsupportedCopy):
+            report = downloader._copy(request)
+
+        self.assertEqual(report.state, report.DOWNLOAD_CANCELED)
+        self.assertEqual(report.bytes_downloaded, 65536)
+
+    def test_copy_file_like_destination_buffered(self):
+        downloader = local.LocalFileDownloader(DownloaderConfig())
+        request = self._make_requests(DATA_FILES[:1])[0]
+        request.destination = StringIO()
+
+        with mock.patch.object(downloader, '_buffered_chunks',
+                               wraps=downloader._buffered_chunks) as mock_buffered_chunks:
+            report = downloader._copy(request)
+
+        self.assertEqual(mock_buffered_chunks.call_count, 1)
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(len(request.destination.getvalue()),
+                         os.path.getsize(os.path.join(DATA_DIR, DATA_FILES[0])))
+
     def test_copy_download(self):
         config = DownloaderConfig()
         listener = AggregatingEventListener()
@@ -225,6 +321,251 @@ class PerformanceDownloadTests(DownloadTests):
         self.assertEqual(len(listener.failed_reports), 0)
 
 
+class RecordingEventListener(DownloadEventListener):
+
+    def __init__(self):
+        self.events = []
+
+    def download_started(self, report):
+        self.events.append(('started', report.url))
+
+    def download_progress(self, report):
+        self.events.append(('progress', report.url))
+
+    def download_succeeded(self, report):
+        self.events.append(('succeeded', report.url))
+
+    def download_failed(self, report):
+        self.events.append(('failed', report.url))
+
+
+class ConcurrentDownloadTests(DownloadTests):
+
+    def _download(self, **kwargs):
+        config = DownloaderConfig(max_concurrent=3, **kwargs)
+        listener = AggregatingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+        request_list = self._make_requests()
+
+        downloader.download(iter(request_list))
+
+        self.assertEqual(len(listener.succeeded_reports), len(request_list))
+        self.assertEqual(len(listener.failed_reports), 0)
+        return request_list
+
+    def test_copy(self):
+        for request in self._download():
+            src_path = os.path.join(DATA_DIR, os.path.basename(request.destination))
+            self.assertEqual(os.path.getsize(request.destination), os.path.getsize(src_path))
+
+    def test_hard_link(self):
+        for request in self._download(use_hard_links=True):
+            src_path = os.path.join(DATA_DIR, os.path.basename(request.destination))
+            self.assertEqual(os.stat(request.destination).st_ino, os.stat(src_path).st_ino)
+
+    def test_symbolic_link(self):
+        for request in self._download(use_sym_links=True):
+            self.assertTrue(os.path.islink(request.destination))
+
+    def test_event_order(self):
+        config = DownloaderConfig(max_concurrent=3, progress_interval=0, buffer_size=16384)
+        listener = RecordingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+        request_list = self._make_requests()
+
+        downloader.download(request_list)
+
+        for request in request_list:
+            events = [e for e, url in listener.events if url == request.url]
+            self.assertEqual(events[0], 'started')
+            self.assertEqual(events[-1], 'succeeded')
+            self.assertEqual(set(events[1:-1]), set(['progress']))
+
+    def test_canceled(self):
+        config = DownloaderConfig(max_concurrent=2)
+        listener = AggregatingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+        request_list = self._make_requests() * 100
+
+        def cancel(report):
+            downloader.cancel()
+
+        listener.download_started = cancel
+        downloader.download(iter(request_list))
+
+        # the requests that were still queued are reported too
+        self.assertEqual(len(listener.failed_reports), len(request_list))
+        self.assertEqual(len(listener.succeeded_reports), 0)
+        for report in listener.failed_reports:
+            self.assertEqual(report.state, report.DOWNLOAD_CANCELED)
+
+    def test_canceled_mid_batch(self):
+        config = DownloaderConfig(max_concurrent=2)
+        listener = AggregatingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+        request_list = self._make_requests() * 10
+        succeeded = listener.download_succeeded
+
+        def cancel(report):
+            succeeded(report)
+            if len(listener.succeeded_reports) == 3:
+                downloader.cancel()
+
+        listener.download_succeeded = cancel
+        downloader.download(iter(request_list))
+
+        self.assertEqual(len(listener.succeeded_reports) + len(listener.failed_reports),
+                         len(request_list))
+        self.assertTrue(len(listener.succeeded_reports) >= 3)
+        self.assertTrue(len(listener.failed_reports) >= len(request_list) - 4)
+        for report in listener.failed_reports:
+            self.assertEqual(report.state, report.DOWNLOAD_CANCELED)
+
+    def test_unhandled_exception_cancels(self):
+        config = DownloaderConfig(max_concurrent=2)
+        downloader = local.LocalFileDownloader(config)
+
+        with mock.patch.object(downloader, '_copy', side_effect=RuntimeError):
+            downloader.download(self._make_requests())
+
+        self.assertTrue(downloader.is_canceled)
+
+
+class LinkChainTests(DownloadTests):
+
+    def _download(self, request, **kwargs):
+        config = DownloaderConfig(**kwargs)
+        listener = AggregatingEventListener()
+        downloader = local.LocalFileDownloader(config, listener)
+
+        downloader.download([request])
+
+        self.assertEqual(len(listener.succeeded_reports), 1)
+        return listener.succeeded_reports[0]
+
+    def test_download_method(self):
+        downloader = local.LocalFileDownloader(DownloaderConfig(use_hard_links=True,
+                                                                link_strategies=['hardlink']))
+
+        self.assertEqual(downloader.download_method, downloader._link_chain)
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, DownloaderConfig, link_strategies=['teleport'])
+
+    def test_hard_link(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+
+        report = self._download(request, link_strategies=['hardlink', 'copy'])
+
+        self.assertEqual(report.strategy, 'hardlink')
+        self.assertEqual(os.stat(request.destination).st_ino,
+                         os.stat(os.path.join(DATA_DIR, DATA_FILES[0])).st_ino)
+
+    def test_hard_link_cross_device_falls_through(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            report = self._download(request, link_strategies=['hardlink', 'buffered'])
+
+        self.assertEqual(report.strategy, 'buffered')
+        self.assertEqual(report.bytes_downloaded, os.path.getsize(request.destination))
+        self.assertFalse(os.path.islink(request.destination))
+
+    def test_reflink_unsupported_falls_through(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+
+        with mock.patch('nectar.fastcopy.reflink', side_effect=fastcopy.UnsupportedCopy):
+            report = self._download(request, link_strategies=['reflink', 'copy'],
+                                    staged_writes=True)
+
+        self.assertEqual(report.strategy, 'copy')
+        self.assertEqual(os.listdir(self.dest_dir), DATA_FILES[:1])
+
+    def test_hard_link_replaces_destination(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+        with open(request.destination, 'w') as f:
+            f.write('old contents')
+
+        report = self._download(request, link_strategies=['hardlink'])
+
+        self.assertEqual(report.strategy, 'hardlink')
+        self.assertEqual(os.path.getsize(request.destination),
+                         os.path.getsize(os.path.join(DATA_DIR, DATA_FILES[0])))
+        self.assertEqual(os.listdir(self.dest_dir), DATA_FILES[:1])
+
+    def test_failed_copy_keeps_linked_destination(self):
+        # the destination is a hard link to the source; a copy strategy that
+        # fails must not truncate it, or the next strategy links an empty file
+        src_path = os.path.join(self.dest_dir, 'source')
+        shutil.copyfile(os.path.join(DATA_DIR, DATA_FILES[0]), src_path)
+        request = DownloadRequest('file:/' + os.path.abspath(src_path),
+                                  os.path.join(self.dest_dir, DATA_FILES[0]))
+        os.link(src_path, request.destination)
+
+        with mock.patch('nectar.fastcopy.reflink', side_effect=fastcopy.UnsupportedCopy):
+            report = self._download(request, link_strategies=['reflink', 'hardlink'])
+
+        self.assertEqual(report.strategy, 'hardlink')
+        self.assertEqual(os.path.getsize(src_path),
+                         os.path.getsize(os.path.join(DATA_DIR, DATA_FILES[0])))
+        self.assertEqual(os.path.getsize(request.destination), os.path.getsize(src_path))
+        self.assertEqual(sorted(os.listdir(self.dest_dir)), [DATA_FILES[0], 'source'])
+
+    def test_link_file_like_destination_falls_through(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+        request.destination = StringIO()
+
+        report = self._download(request, link_strategies=['reflink', 'symlink', 'buffered'])
+
+        self.assertEqual(report.strategy, 'buffered')
+
+    def test_all_strategies_fail(self):
+        config = DownloaderConfig(link_strategies=['hardlink', 'symlink'])
+        downloader = local.LocalFileDownloader(config)
+        request = self._make_requests(DATA_FILES[:1])[0]
+        request.destination = StringIO()
+
+        report = downloader._link_chain(request)
+
+        self.assertEqual(report.state, report.DOWNLOAD_FAILED)
+        self.assertEqual(report.strategy, None)
+
+    def test_skip_same_inode(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+        os.link(os.path.join(DATA_DIR, DATA_FILES[0]), request.destination)
+
+        report = self._download(request, link_strategies=['hardlink'], skip_identical=True)
+
+        self.assertEqual(report.strategy, local.SKIPPED)
+
+    def test_skip_same_size_and_mtime(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+        self._download(request, link_strategies=['buffered'], skip_identical=True)
+
+        report = self._download(request, link_strategies=['buffered'], skip_identical=True)
+
+        self.assertEqual(report.strategy, local.SKIPPED)
+
+    def test_modified_destination_not_skipped(self):
+        request = self._make_requests(DATA_FILES[:1])[0]
+        with open(request.destination, 'w') as f:
+            f.write('old contents')
+
+        report = self._download(request, link_strategies=['buffered'], skip_identical=True)
+
+        self.assertEqual(report.strategy, 'buffered')
+
+    def test_canceled(self):
+        downloader = local.LocalFileDownloader(DownloaderConfig(link_strategies=['hardlink']))
+        downloader.cancel()
+        request = self._make_requests(DATA_FILES[:1])[0]
+
+        report = downloader._link_chain(request)
+
+        self.assertEqual(report.state, report.DOWNLOAD_CANCELED)
+        self.assertFalse(os.path.exists(request.destination))
+
+
 class BadDownloadTests(DownloadTests):
 
     def test_unsupported_url_scheme(self):
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import base
+from nectar import memory
+from nectar.config import DownloaderConfig
+from nectar.downloaders import local
+from nectar.report import DOWNLOAD_FAILED, DOWNLOAD_SUCCEEDED, DownloadReport
+from nectar.request import DownloadRequest
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class BufferPoolTests(base.NectarTests):
+
+    def test_buffer_size(self):
+        self.assertEqual(memory.BufferPool.buffer_size(1), memory.MIN_BUFFER_SIZE)
+        self.assertEqual(memory.BufferPool.buffer_size(memory.MIN_BUFFER_SIZE + 1),
+                         memory.MIN_BUFFER_SIZE * 2)
+
+    def test_reused(self):
+        pool = memory.BufferPool()
+        buffer = pool.acquire(100)
+
+        pool.release(buffer)
+
+        self.assertEqual(pool.pooled, len(buffer))
+        self.assertTrue(pool.acquire(200) is buffer)
+        self.assertEqual(pool.pooled, 0)
+
+    def test_other_size_not_reused(self):
+        pool = memory.BufferPool()
+        buffer = pool.acquire(100)
+        pool.release(buffer)
+
+        self.assertFalse(pool.acquire(memory.MIN_BUFFER_SIZE + 1) is buffer)
+
+    def test_max_pooled(self):
+        pool = memory.BufferPool(max_pooled=memory.MIN_BUFFER_SIZE)
+        pool.release(pool.acquire(1))
+        pool.release(pool.acquire(1))
+
+        self.assertEqual(pool.pooled, memory.MIN_BUFFER_SIZE)
+
+        pool.clear()
+        self.assertEqual(pool.pooled, 0)
+
+
+class MemoryDestinationTests(base.NectarTests):
+
+    def setUp(self):
+        super(MemoryDestinationTests, self).setUp()
+        self.pool = memory.BufferPool()
+
+    def test_write(self):
+        destination = memory.MemoryDestination(pool=self.pool)
+
+        destination.write('abc')
+        destination.write('x' * memory.MIN_BUFFER_SIZE)
+
+        self.assertFalse(destination.spilled)
+        self.assertEqual(destination.size, memory.MIN_BUFFER_SIZE + 3)
+        self.assertTrue(isinstance(destination.content, memoryview))
+        self.assertEqual(destination.getvalue(), 'abc' + 'x' * memory.MIN_BUFFER_SIZE)
+        # the smaller buffer was given back when it grew
+        self.assertEqual(self.pool.pooled, memory.MIN_BUFFER_SIZE)
+
+    def test_content_not_copied(self):
+        destination = memory.MemoryDestination(pool=self.pool)
+        destination.write('abc')
+
+        content = destination.content
+        destination._buffer[0:1] = 'z'
+
+        self.assertEqual(content.tobytes(), 'zbc')
+
+    def test_empty(self):
+        destination = memory.MemoryDestination(pool=self.pool)
+
+        self.assertEqual(destination.getvalue(), '')
+
+    def test_spill(self):
+        destination = memory.MemoryDestination(spill_threshold=10, pool=self.pool)
+        destination.write('0123456789')
+        self.assertFalse(destination.spilled)
+
+        destination.write('abc')
+
+        self.assertTrue(destination.spilled)
+        self.assertEqual(destination.getvalue(), '0123456789abc')
+        self.assertEqual(destination.content[10:].tobytes(), 'abc')
+        self.assertEqual(self.pool.pooled, memory.MIN_BUFFER_SIZE)
+
+    def test_max_size(self):
+        destination = memory.MemoryDestination(max_size=5, pool=self.pool)
+        destination.write('abc')
+
+        self.assertRaises(IOError, destination.write, 'def')
+        self.assertEqual(destination.getvalue(), 'abc')
+
+    def test_reset(self):
+        destination = memory.MemoryDestination(spill_threshold=10, pool=self.pool)
+        destination.write('abc')
+
+        destination.reset(5)
+        self.assertEqual(destination.getvalue(), '')
+        self.assertFalse(destination.spilled)
+
+        destination.reset(11)
+        self.assertTrue(destination.spilled)
+        destination.write('def')
+        self.assertEqual(destination.getvalue(), 'def')
+
+    def test_release(self):
+        with memory.MemoryDestination(pool=self.pool) as destination:
+            destination.write('abc')
+
+        self.assertEqual(destination.size, 0)
+        self.assertEqual(self.pool.pooled, memory.MIN_BUFFER_SIZE)
+
+    def test_request_resets(self):
+        destination = memory.MemoryDestination(pool=self.pool)
+        destination.write('partial')
+        request = DownloadRequest('http://host/file', destination)
+
+        file_handle = request.initialize_file_handle(size=3)
+        file_handle.write('new')
+        request.finalize_file_handle()
+
+        self.assertEqual(destination.getvalue(), 'new')
+
+    def test_report_content(self):
+        destination = memory.MemoryDestination(pool=self.pool)
+        destination.write('abc')
+
+        report = DownloadReport('http://host/file', destination)
+
+        self.assertEqual(report.content.tobytes(), 'abc')
+        self.assertEqual(DownloadReport('http://host/file', '/tmp/file').content, None)
+
+
+class MemoryDownloadTests(base.NectarTests):
+
+    def setUp(self):
+        super(MemoryDownloadTests, self).setUp()
+        self.downloader = local.LocalFileDownloader(DownloaderConfig())
+
+    def test_download(self):
+        source = os.path.join(DATA_DIR, '100K_file')
+        destination = memory.MemoryDestination()
+
+        report = self.downloader.download_one(DownloadRequest('file://' + source, destination))
+
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        with open(source, 'rb') as f:
+            self.assertEqual(report.content.tobytes(), f.read())
+        destination.release()
+
+    def test_download_spills(self):
+        source = os.path.join(DATA_DIR, '100K_file')
+        destination = memory.MemoryDestination(spill_threshold=1024)
+
+        report = self.downloader.download_one(DownloadRequest('file://' + source, destination))
+
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        self.assertTrue(destination.spilled)
+        self.assertEqual(len(report.content), os.path.getsize(source))
+        destination.release()
+
+    def test_download_too_big(self):
+        destination = memory.MemoryDestination(max_size=1024)
+        request = DownloadRequest('file://' + os.path.join(DATA_DIR, '100K_file'), destination)
+
+        report = self.downloader.download_one(request)
+
+        self.assertEqual(report.state, DOWNLOAD_FAILED)
+
+    def test_download_decompressed(self):
+        directory = tempfile.mkdtemp(prefix='nectar-memory-')
+        self.addCleanup(shutil.rmtree, directory)
+        source = os.path.join(directory, 'file.gz')
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write('decompressed')
+        with open(source, 'wb') as f:
+            f.write(compressed.getvalue())
+        destination = memory.MemoryDestination()
+
+        report = self.downloader.download_one(DownloadRequest('file://' + source, destination,
+                                                              decompress=True))
+
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        self.assertEqual(report.content.tobytes(), 'decompressed')
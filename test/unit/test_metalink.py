@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import base
+from nectar import metalink, sink
+from nectar.config import DownloaderConfig
+from nectar.downloaders.local import LocalFileDownloader
+from nectar.listener import AggregatingEventListener
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+METALINK_4 = '''<?xml version="1.0" encoding="UTF-8"?>
+<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+  <file name="example.ext">
+    <size>14471447</size>
+    <hash type="sha-1">A9993E364706816ABA3E25717850C26C9CD0D89D</hash>
+    <hash type="sha-256">%(sha256)s</hash>
+    <hash type="unknown">abc</hash>
+    <pieces length="262144" type="sha-1">
+      <hash>%(piece0)s</hash>
+      <hash>%(piece1)s</hash>
+    </pieces>
+    <url location="de" priority="2">http://de.example.com/example.ext</url>
+    <url priority="1">http://example.com/example.ext</url>
+    <url location="fr">ftp://fr.example.com/example.ext</url>
+    <url priority="3">rsync://example.com/example.ext</url>
+    <metaurl mediatype="torrent" priority="1">http://example.com/example.ext.torrent</metaurl>
+  </file>
+  <file name="sub/other.ext">
+    <url>http://example.com/sub/other.ext</url>
+  </file>
+</metalink>
+''' % {'sha256': 'ab' * 32, 'piece0': '01' * 20, 'piece1': '02' * 20}
+
+METALINK_3 = '''<?xml version="1.0" encoding="utf-8"?>
+<metalink version="3.0" xmlns="http://www.metalinker.org/">
+  <files>
+    <file name="repomd.xml">
+      <size>4096</size>
+      <verification>
+        <hash type="md5">%(md5)s</hash>
+        <hash type="sha256">%(sha256)s</hash>
+        <pieces length="1024" type="sha1">
+          <hash piece="1">%(piece1)s</hash>
+          <hash piece="0">%(piece0)s</hash>
+        </pieces>
+      </verification>
+      <resources maxconnections="1">
+        <url type="http" location="US" preference="90">http://us.example.com/repomd.xml</url>
+        <url type="https" location="DE" preference="100">https://de.example.com/repomd.xml</url>
+        <url type="bittorrent" preference="100">http://example.com/repomd.xml.torrent</url>
+      </resources>
+    </file>
+  </files>
+</metalink>
+''' % {'md5': 'cd' * 16, 'sha256': 'ef' * 32, 'piece0': '01' * 20, 'piece1': '02' * 20}
+
+
+def _metalink_4(name, body, url):
+    return StringIO('''<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+  <file name="%s">
+    <size>%d</size>
+    <hash type="sha-256">%s</hash>
+    <url>%s</url>
+  </file>
+</metalink>''' % (name, len(body), hashlib.sha256(body).hexdigest(), url))
+
+
+class ParseTests(base.NectarTests):
+
+    def test_metalink_4(self):
+        files = metalink.parse(StringIO(METALINK_4))
+
+        self.assertEqual([f.name for f in files], ['example.ext', 'sub/other.ext'])
+        example = files[0]
+        self.assertEqual(example.size, 14471447)
+        self.assertEqual(example.hashes, {'sha1': 'a9993e364706816aba3e25717850c26c9cd0d89d',
+                                          'sha256': 'ab' * 32})
+        self.assertEqual(example.digest(), ('sha256', 'ab' * 32))
+        self.assertEqual(example.piece_algorithm, 'sha1')
+        self.assertEqual(example.piece_length, 262144)
+        self.assertEqual(example.piece_digests, ['01' * 20, '02' * 20])
+        self.assertEqual(example.ordered_urls(), ['http://example.com/example.ext',
+                                                  'http://de.example.com/example.ext'])
+        self.assertEqual(example.ordered_urls('DE'), ['http://de.example.com/example.ext',
+                                                      'http://example.com/example.ext'])
+        other = files[1]
+        self.assertEqual(other.size, None)
+        self.assertEqual(other.digest(), None)
+        self.assertEqual(other.verifying_sink(), None)
+
+    def test_metalink_3(self):
+        files = metalink.parse(StringIO(METALINK_3))
+
+        self.assertEqual(len(files), 1)
+        repomd = files[0]
+        self.assertEqual(repomd.size, 4096)
+        self.assertEqual(repomd.digest(), ('sha256', 'ef' * 32))
+        self.assertEqual(repomd.piece_digests, ['01' * 20, '02' * 20])
+        self.assertEqual(repomd.ordered_urls(), ['https://de.example.com/repomd.xml',
+                                                 'http://us.example.com/repomd.xml'])
+        self.assertEqual(repomd.ordered_urls('us')[0], 'http://us.example.com/repomd.xml')
+
+    def test_schemes(self):
+        files = metalink.parse(StringIO(METALINK_4), schemes=('ftp',))
+
+        self.assertEqual(files[0].ordered_urls(), ['ftp://fr.example.com/example.ext'])
+        self.assertEqual(files[1].urls, [])
+
+    def test_unsafe_names(self):
+        for name in ('/etc/passwd', '../escape', 'sub/../../escape', 'sub\\..\\..\\escape', ''):
+            document = StringIO('<metalink xmlns="%s"><file name="%s"/></metalink>' % (
+                metalink.NS_METALINK_4, name))
+
+            self.assertRaises(metalink.MetalinkError, metalink.parse, document)
+
+    def test_invalid(self):
+        for document in ('<metalink', '<rss/>',
+                         '<metalink xmlns="%s"><file name="f"><size>big</size></file></metalink>'
+                         % metalink.NS_METALINK_4):
+            self.assertRaises(metalink.MetalinkError, metalink.parse, StringIO(document))
+
+
+class RequestTests(base.NectarTests):
+
+    def setUp(self):
+        super(RequestTests, self).setUp()
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-metalink-testing-')
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+
+    def test_requests(self):
+        requests = metalink.requests_from_metalink(StringIO(METALINK_4), self.dest_dir,
+                                                   location='fr')
+
+        self.assertEqual(len(requests), 2)
+        request = requests[0]
+        # the ftp url in that location is left out, the threaded downloader can't fetch it
+        self.assertEqual(request.url, 'http://example.com/example.ext')
+        self.assertEqual(request.mirrors, ['http://de.example.com/example.ext'])
+        self.assertEqual(request.destination, os.path.join(self.dest_dir, 'example.ext'))
+        self.assertEqual(request.size, 14471447)
+        self.assertEqual(request.data.name, 'example.ext')
+        verifying_sink = request.sinks[0]
+        self.assertTrue(isinstance(verifying_sink, sink.VerifyingSink))
+        self.assertEqual((verifying_sink.algorithm, verifying_sink.digest), ('sha256', 'ab' * 32))
+        self.assertEqual(verifying_sink.piece_digests, ['01' * 20, '02' * 20])
+        self.assertEqual(requests[1].sinks, [])
+
+    def test_no_urls(self):
+        metalink_file = metalink.MetalinkFile('file')
+
+        self.assertRaises(metalink.MetalinkError, metalink_file.request, self.dest_dir)
+        self.assertEqual(metalink.requests_from_metalink(
+            StringIO(METALINK_4), self.dest_dir, schemes=('ftp',))[0].url,
+            'ftp://fr.example.com/example.ext')
+
+    def test_download(self):
+        source = os.path.join(DATA_DIR, '100K_file')
+        with open(source, 'rb') as f:
+            body = f.read()
+        listener = AggregatingEventListener()
+        downloader = LocalFileDownloader(DownloaderConfig(staged_writes=True), listener)
+
+        good = metalink.requests_from_metalink(_metalink_4('good', body, 'file://' + source),
+                                               self.dest_dir, schemes=('file',))
+        bad = metalink.requests_from_metalink(_metalink_4('bad', body + 'x', 'file://' + source),
+                                              self.dest_dir, schemes=('file',))
+        downloader.download(good + bad)
+
+        self.assertEqual([r.data.name for r in listener.succeeded_reports], ['good'])
+        self.assertEqual([r.data.name for r in listener.failed_reports], ['bad'])
+        self.assertEqual(os.listdir(self.dest_dir), ['good'])
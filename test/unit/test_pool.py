@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import threading
+import time
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import mock
+
+import base
+from nectar import pool
+from nectar.config import DownloaderConfig
+from nectar.downloaders.threaded import HTTPThreadedDownloader
+from nectar.report import DOWNLOAD_SUCCEEDED
+from nectar.request import DownloadRequest
+
+
+PORT = 8090
+PATH = '/' + os.path.relpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                                          '100K_file'))
+
+
+class KeepAliveHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.sock = object()
+
+    def close(self):
+        self.sock = None
+
+
+class FingerprintTests(base.NectarTests):
+
+    def test_same_settings(self):
+        config = DownloaderConfig(proxy_url='http://proxy', proxy_port=3128,
+                                  basic_auth_username='user', basic_auth_password='secret')
+        other_config = DownloaderConfig(proxy_url='http://proxy', proxy_port=3128,
+                                        basic_auth_username='user', basic_auth_password='secret',
+                                        max_concurrent=2)
+
+        self.assertEqual(pool.connection_fingerprint(config),
+                         pool.connection_fingerprint(other_config))
+
+    def test_differs(self):
+        fingerprint = pool.connection_fingerprint(DownloaderConfig())
+
+        for kwargs in ({'proxy_url': 'http://proxy', 'proxy_port': 3128},
+                       {'basic_auth_username': 'user', 'basic_auth_password': 'secret'},
+                       {'ssl_validation': False}):
+            self.assertNotEqual(pool.connection_fingerprint(DownloaderConfig(**kwargs)),
+                                fingerprint)
+
+    def test_credentials_hashed(self):
+        config = DownloaderConfig(basic_auth_username='user', basic_auth_password='secret')
+
+        self.assertTrue('secret' not in pool.connection_fingerprint(config))
+
+
+class SocketSlotsTests(base.NectarTests):
+
+    def test_acquire_release(self):
+        slots = pool.SocketSlots(2, mock.Mock(return_value=False))
+        conn = Connection()
+
+        slots.acquire(conn)
+        slots.acquire(conn)
+        self.assertEqual(len(slots), 1)
+
+        slots.release(conn)
+        self.assertEqual(len(slots), 0)
+
+    def test_makes_room(self):
+        held = Connection()
+        slots = pool.SocketSlots(1, lambda: slots.release(held) or True)
+        slots.acquire(held)
+        conn = Connection()
+
+        slots.acquire(conn)
+
+        self.assertEqual(len(slots), 1)
+
+    def test_waits_for_release(self):
+        held = Connection()
+        slots = pool.SocketSlots(1, mock.Mock(return_value=False))
+        slots.acquire(held)
+        timer = threading.Timer(0.1, slots.release, [held])
+        timer.start()
+        conn = Connection()
+
+        slots.acquire(conn)
+
+        timer.join()
+        self.assertEqual(len(slots), 1)
+
+    def test_released_when_collected(self):
+        slots = pool.SocketSlots(1, mock.Mock(return_value=False))
+        slots.acquire(Connection())
+        gc.collect()
+
+        self.assertEqual(len(slots), 0)
+
+
+class PoolRegistryTests(base.NectarTests):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = KeepAliveServer(('127.0.0.1', PORT), KeepAliveHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever,
+                                             kwargs={'poll_interval': 0.1})
+        cls.server_thread.setDaemon(True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super(PoolRegistryTests, self).setUp()
+        self.registry = pool.PoolRegistry()
+        patcher = mock.patch.object(pool, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.registry.clear)
+
+        self.connects = []
+        connect = pool.HTTPConnection.connect
+
+        def counting_connect(conn):
+            self.connects.append(conn.host)
+            connect(conn)
+
+        patcher = mock.patch.object(pool.HTTPConnection, 'connect', counting_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _download(self, host='127.0.0.1', **kwargs):
+        config = DownloaderConfig(shared_connections=True, **kwargs)
+        downloader = HTTPThreadedDownloader(config, tries=1)
+        url = 'http://%s:%d%s' % (host, PORT, PATH)
+        report = downloader.download_one(DownloadRequest(url, os.devnull))
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        return report
+
+    def test_shared_between_downloaders(self):
+        self._download()
+        self._download()
+
+        self.assertEqual(self.connects, ['127.0.0.1'])
+        self.assertEqual(self.registry.open_sockets, 1)
+
+    def test_not_shared_between_configurations(self):
+        self._download()
+        self._download(basic_auth_username='user', basic_auth_password='secret')
+
+        self.assertEqual(len(self.connects), 2)
+
+    def test_idle_timeout(self):
+        self.registry.idle_timeout = 0
+
+        self._download()
+        self._download()
+
+        self.assertEqual(len(self.connects), 2)
+        self.assertEqual(self.registry.open_sockets, 1)
+
+    def test_evict_idle(self):
+        self._download()
+
+        self.assertEqual(self.registry.evict_idle(60), 0)
+        self.assertEqual(self.registry.evict_idle(0), 1)
+        self.assertEqual(self.registry.open_sockets, 0)
+
+    def test_reaper(self):
+        self.registry.idle_timeout = 0
+
+        self._download()
+
+        # the reaper closes the idle connection without another download
+        for i in range(50):
+            if not self.registry.open_sockets:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.registry.open_sockets, 0)
+
+    def test_clear_forgets_pools(self):
+        self._download()
+        self.assertTrue(self.registry._reaper.is_alive())
+
+        self.registry.clear()
+
+        self.assertEqual(len(self.registry._pools), 0)
+        self.assertEqual(self.registry.open_sockets, 0)
+        # the reaper exits once the registry has no pools left
+        self.assertFalse(self.registry._reap())
+        self.assertTrue(self.registry._reaper is None)
+
+    def test_max_sockets(self):
+        self.registry.slots.limit = 1
+
+        self._download()
+        self._download(host='localhost')
+
+        self.assertEqual(self.connects, ['127.0.0.1', 'localhost'])
+        self.assertEqual(self.registry.open_sockets, 1)
+
+    def test_adapter_close_keeps_pools(self):
+        self._download()
+        adapter = self.registry.adapter(DownloaderConfig())
+
+        adapter.close()
+        self._download()
+
+        self.assertEqual(len(self.connects), 1)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from cStringIO import StringIO
+
+import mock
+
+import base
+from nectar.config import DownloaderConfig
+from nectar.downloaders import process
+from nectar.downloaders.local import LocalFileDownloader
+from nectar.downloaders.threaded import HTTPThreadedDownloader
+from nectar.listener import AggregatingEventListener, DownloadEventListener
+from nectar.report import DownloadReport
+from nectar.request import DownloadRequest
+from nectar.sink import HashSink
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATA_FILES = ['100K_file', '500K_file', '1M_file']
+
+
+class RecordingEventListener(DownloadEventListener):
+
+    def __init__(self):
+        self.events = []
+
+    def download_started(self, report):
+        self.events.append(('started', report.data))
+
+    def download_succeeded(self, report):
+        self.events.append(('succeeded', report.data))
+
+    def download_failed(self, report):
+        self.events.append(('failed', report.data))
+
+
+class ProcessPoolDownloaderTests(base.NectarTests):
+
+    def setUp(self):
+        super(ProcessPoolDownloaderTests, self).setUp()
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-process-testing-')
+
+    def tearDown(self):
+        super(ProcessPoolDownloaderTests, self).tearDown()
+        shutil.rmtree(self.dest_dir)
+
+    def _make_requests(self, copies=1):
+        requests = []
+        for i in range(copies):
+            for name in DATA_FILES:
+                requests.append(DownloadRequest('file://' + os.path.join(DATA_DIR, name),
+                                                os.path.join(self.dest_dir, '%s-%d' % (name, i)),
+                                                data={'name': name, 'copy': i}))
+        return requests
+
+    def test_download(self):
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=2,
+                                                   backend=LocalFileDownloader)
+        requests = self._make_requests(copies=3)
+
+        downloader.download(iter(requests))
+
+        self.assertEqual(len(listener.succeeded_reports), len(requests))
+        self.assertEqual(len(listener.failed_reports), 0)
+        for report in listener.succeeded_reports:
+            self.assertEqual(report.data['name'], os.path.basename(report.url))
+            self.assertEqual(os.path.getsize(report.destination),
+                             os.path.getsize(os.path.join(DATA_DIR, report.data['name'])))
+
+    def test_journal(self):
+        config = DownloaderConfig(journal_path=os.path.join(self.dest_dir, 'journal'))
+        downloader = process.ProcessPoolDownloader(config, processes=2,
+                                                   backend=LocalFileDownloader)
+        downloader.download(iter(self._make_requests()))
+
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(config, listener, processes=2,
+                                                   backend=LocalFileDownloader)
+        downloader.download(iter(self._make_requests()))
+
+        self.assertEqual(len(listener.succeeded_reports), len(DATA_FILES))
+        self.assertEqual(set(r.strategy for r in listener.succeeded_reports), set(['skipped']))
+
+    def test_event_order(self):
+        listener = RecordingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=2,
+                                                   backend=LocalFileDownloader)
+        requests = self._make_requests()
+        for i, request in enumerate(requests):
+            request.data = i
+
+        downloader.download(requests)
+
+        for i in range(len(requests)):
+            events = [e for e, data in listener.events if data == i]
+            self.assertEqual(events, ['started', 'succeeded'])
+
+    def test_file_like_destination_fails(self):
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=1,
+                                                   backend=LocalFileDownloader)
+        request = DownloadRequest('file://' + os.path.join(DATA_DIR, DATA_FILES[0]), StringIO())
+
+        downloader.download([request])
+
+        self.assertEqual(len(listener.failed_reports), 1)
+
+    def test_sinks_fail(self):
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=1,
+                                                   backend=LocalFileDownloader)
+        request = DownloadRequest('file://' + os.path.join(DATA_DIR, DATA_FILES[0]), os.devnull,
+                                  sinks=[HashSink()])
+
+        downloader.download([request])
+
+        self.assertEqual(len(listener.failed_reports), 1)
+
+    def test_canceled(self):
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=2,
+                                                   backend=LocalFileDownloader)
+        downloader.cancel()
+
+        downloader.download(self._make_requests())
+
+        self.assertEqual(len(listener.succeeded_reports), 0)
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_max_speed_shared(self):
+        config = DownloaderConfig(max_speed=1000)
+        downloader = process.ProcessPoolDownloader(config, processes=3)
+
+        self.assertEqual(downloader._worker_config().max_speed, 334)
+        self.assertEqual(config.max_speed, 1000)
+
+    def test_max_speed_shrinks_buffers(self):
+        # twice the buffer size is the slowest a threaded downloader goes
+        config = DownloaderConfig(max_speed=8 * 1024 * 1024, buffer_size=1024 * 1024)
+        downloader = process.ProcessPoolDownloader(config, processes=4)
+        worker_config = downloader._worker_config()
+
+        self.assertEqual(worker_config.max_speed, 2 * 1024 * 1024)
+        self.assertEqual(worker_config.buffer_size, 512 * 1024)
+        worker = HTTPThreadedDownloader(worker_config)
+        self.assertEqual(worker._calculate_max_speed() * 4, config.max_speed / 2)
+        self.assertEqual(config.buffer_size, 1024 * 1024)
+
+    def test_max_speed_keeps_small_buffers(self):
+        config = DownloaderConfig(max_speed=8 * 1024 * 1024, buffer_size=8192)
+        downloader = process.ProcessPoolDownloader(config, processes=4)
+
+        self.assertEqual(downloader._worker_config().buffer_size, 8192)
+
+    def test_late_events(self):
+        # events still queued when the worker processes have exited are dispatched
+        queues = []
+        queue_class = multiprocessing.Queue
+
+        def make_queue(*args):
+            queue = queue_class(*args)
+            if queues:
+                # the events queue never yields while the worker processes run
+                original_get = queue.get
+
+                def get(block=True, timeout=None):
+                    if block:
+                        time.sleep(timeout)
+                        raise Queue.Empty()
+                    return original_get(block)
+                queue.get = get
+            queues.append(queue)
+            return queue
+
+        listener = AggregatingEventListener()
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), listener, processes=2,
+                                                   backend=LocalFileDownloader)
+
+        with mock.patch.object(process.multiprocessing, 'Queue', side_effect=make_queue):
+            downloader.download(self._make_requests())
+
+        self.assertEqual(len(listener.succeeded_reports), len(DATA_FILES))
+        self.assertEqual(len(listener.failed_reports), 0)
+
+    def test_download_one(self):
+        downloader = process.ProcessPoolDownloader(DownloaderConfig(), processes=2,
+                                                   backend=LocalFileDownloader)
+        request = self._make_requests()[0]
+
+        with mock.patch.object(LocalFileDownloader, '_download_one') as mock_download_one:
+            mock_download_one.return_value = DownloadReport.from_download_request(request)
+            report = downloader.download_one(request)
+
+        self.assertTrue(report is mock_download_one.return_value)
+
+
+class EventForwarderTests(base.NectarTests):
+
+    def test_wire_bytes(self):
+        events = Queue.Queue()
+        report = DownloadReport('http://fake/file.gz', os.devnull)
+        report.wire_bytes = 1024
+
+        process._EventForwarder(events).download_succeeded(report)
+
+        event, data, fields = events.get_nowait()
+        self.assertEqual(event, 'download_succeeded')
+        self.assertEqual(fields['wire_bytes'], 1024)
+
+    def test_write_stall_time(self):
+        events = Queue.Queue()
+        report = DownloadReport('http://fake/file', os.devnull)
+        report.write_stall_time = 0.5
+
+        process._EventForwarder(events).download_succeeded(report)
+
+        event, data, fields = events.get_nowait()
+        self.assertEqual(fields['write_stall_time'], 0.5)
+
+
+class ConfigPicklingTests(base.NectarTests):
+
+    def test_copy_does_not_own_temp_files(self):
+        config = DownloaderConfig(ssl_ca_cert='not really a cert',
+                                  working_dir=tempfile.gettempdir())
+        path = config.ssl_ca_cert_path
+
+        copied = pickle.loads(pickle.dumps(config))
+        copied.finalize()
+
+        self.assertEqual(copied.ssl_ca_cert_path, path)
+        self.assertTrue(os.path.exists(path))
+        config.finalize()
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
+import mock
+
+import base
+from nectar import compression, sink
+from nectar.config import DownloaderConfig
+from nectar.downloaders import local
+from nectar.report import DOWNLOAD_FAILED, DOWNLOAD_SUCCEEDED
+from nectar.request import DownloadRequest
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class RecordingSink(sink.Sink):
+
+    def __init__(self):
+        self.events = []
+
+    def start(self):
+        self.events.append('start')
+
+    def write(self, data):
+        self.events.append(data)
+
+    def finish(self):
+        self.events.append('finish')
+
+    def abort(self):
+        self.events.append('abort')
+
+
+class UpperStage(sink.Stage):
+
+    def transform(self, data):
+        return data.upper()
+
+    def end(self):
+        return '!'
+
+
+def _gzip(data):
+    compressed = StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+        f.write(data)
+    return compressed.getvalue()
+
+
+class StageTests(base.NectarTests):
+
+    def test_pipeline(self):
+        recording = RecordingSink()
+        stage = UpperStage(recording)
+
+        stage.start()
+        stage.write('ab')
+        stage.write('c')
+        stage.finish()
+
+        self.assertEqual(recording.events, ['start', 'AB', 'C', '!', 'finish'])
+
+    def test_tee(self):
+        first = RecordingSink()
+        second = RecordingSink()
+        tee = sink.Tee(first, second)
+
+        tee.start()
+        tee.write('abc')
+        tee.abort()
+
+        self.assertEqual(first.events, ['start', 'abc', 'abort'])
+        self.assertEqual(second.events, first.events)
+
+    def test_decompress(self):
+        recording = RecordingSink()
+        stage = sink.DecompressStage('gzip', recording)
+        compressed = _gzip('decompressed')
+
+        stage.start()
+        stage.write(compressed[:10])
+        stage.write(compressed[10:])
+        stage.finish()
+
+        self.assertEqual(''.join(recording.events[1:-1]), 'decompressed')
+
+    def test_decompress_truncated(self):
+        stage = sink.DecompressStage('gzip', RecordingSink())
+
+        stage.start()
+        stage.write(_gzip('decompressed')[:-4])
+
+        self.assertRaises(compression.TruncatedCompression, stage.verify)
+
+    def test_hash(self):
+        hash_sink = sink.HashSink('md5')
+        hash_sink.write('partial')
+        hash_sink.start()
+
+        hash_sink.write('abc')
+
+        self.assertEqual(hash_sink.hexdigest(), hashlib.md5('abc').hexdigest())
+
+    def test_verify_held_back(self):
+        verifying = sink.VerifyingSink('md5', hashlib.md5('AB!').hexdigest())
+        stage = UpperStage(verifying)
+
+        stage.start()
+        stage.write('ab')
+        stage.verify()
+        stage.finish()
+
+
+class VerifyingSinkTests(base.NectarTests):
+
+    def setUp(self):
+        super(VerifyingSinkTests, self).setUp()
+        self.content = 'abcdefghij'
+        self.pieces = [hashlib.sha1(self.content[i:i + 4]).hexdigest()
+                       for i in range(0, len(self.content), 4)]
+
+    def _sink(self, **kwargs):
+        return sink.VerifyingSink(piece_algorithm='sha1', piece_length=4,
+                                  piece_digests=self.pieces, **kwargs)
+
+    def test_verified(self):
+        verifying = self._sink(algorithm='sha256', size=10,
+                               digest=hashlib.sha256(self.content).hexdigest().upper())
+        # discarded by the next attempt
+        verifying.write('xyz')
+        verifying.start()
+
+        for data in ('abc', 'defghi', 'j'):
+            verifying.write(data)
+        verifying.verify()
+
+    def test_bad_piece(self):
+        verifying = self._sink()
+        verifying.write('abc')
+
+        # rejected as soon as the piece is complete
+        self.assertRaises(sink.VerificationFailed, verifying.write, 'Xefgh')
+
+    def test_bad_last_piece(self):
+        verifying = self._sink()
+        verifying.write('abcdefghiX')
+
+        self.assertRaises(sink.VerificationFailed, verifying.verify)
+
+    def test_missing_piece(self):
+        verifying = self._sink()
+        verifying.write('abcdefgh')
+
+        self.assertRaises(sink.VerificationFailed, verifying.verify)
+
+    def test_extra_piece(self):
+        verifying = self._sink()
+
+        self.assertRaises(sink.VerificationFailed, verifying.write, self.content + 'klmn')
+
+    def test_size(self):
+        verifying = sink.VerifyingSink(size=3)
+        verifying.write('ab')
+        self.assertRaises(sink.VerificationFailed, verifying.verify)
+        self.assertRaises(sink.VerificationFailed, verifying.write, 'cd')
+
+    def test_bad_digest(self):
+        verifying = sink.VerifyingSink('md5', hashlib.md5('abc').hexdigest())
+        verifying.write('abd')
+
+        self.assertRaises(sink.VerificationFailed, verifying.verify)
+
+
+class QueueSinkTests(base.NectarTests):
+
+    def test_consumed(self):
+        queue_sink = sink.QueueSink(maxsize=1)
+        consumed = []
+        consumer = threading.Thread(target=lambda: consumed.extend(queue_sink))
+        consumer.start()
+
+        for data in ('a', 'b', 'c'):
+            queue_sink.write(data)
+        queue_sink.finish()
+
+        consumer.join()
+        self.assertEqual(consumed, ['a', 'b', 'c'])
+
+    def test_aborted(self):
+        queue_sink = sink.QueueSink()
+        queue_sink.write('a')
+        queue_sink.abort()
+        queue_sink.write('b')
+        queue_sink.finish()
+
+        chunks = iter(queue_sink)
+        self.assertEqual(next(chunks), 'a')
+        self.assertRaises(sink.StreamAborted, next, chunks)
+        self.assertEqual(list(queue_sink), ['b'])
+
+    @mock.patch.object(sink, 'QUEUE_POLL_INTERVAL', 0.01)
+    def test_closed_does_not_block(self):
+        queue_sink = sink.QueueSink(maxsize=1)
+        queue_sink.write('a')
+        threading.Timer(0.05, queue_sink.close).start()
+
+        queue_sink.write('b')
+
+        self.assertTrue(queue_sink.closed)
+
+
+class RequestSinkTests(base.NectarTests):
+
+    def test_attempts(self):
+        recording = RecordingSink()
+        request = DownloadRequest('http://host/file', StringIO(), sinks=[recording])
+
+        request.initialize_file_handle().write('partial')
+        request.initialize_file_handle().write('abc')
+        request.finalize_file_handle(commit=True)
+        request.finalize_file_handle(commit=False)
+
+        self.assertEqual(recording.events,
+                         ['start', 'partial', 'abort', 'start', 'abc', 'finish'])
+
+    def test_failed(self):
+        recording = RecordingSink()
+        request = DownloadRequest('http://host/file', StringIO(), sinks=[recording])
+
+        request.initialize_file_handle().write('abc')
+        request.finalize_file_handle(commit=False)
+
+        self.assertEqual(recording.events, ['start', 'abc', 'abort'])
+
+    def test_verification_failed(self):
+        directory = tempfile.mkdtemp(prefix='nectar-sink-')
+        self.addCleanup(shutil.rmtree, directory)
+        recording = RecordingSink()
+        request = DownloadRequest('http://host/file', os.path.join(directory, 'file'),
+                                  sinks=[sink.VerifyingSink(size=4), recording])
+
+        request.initialize_file_handle(staged=True).write('abc')
+
+        self.assertRaises(sink.VerificationFailed, request.finalize_file_handle)
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(recording.events, ['start', 'abc', 'abort'])
+
+    def test_compressed_bytes(self):
+        recording = RecordingSink()
+        destination = StringIO()
+        compressed = _gzip('decompressed')
+        request = DownloadRequest('http://host/file.gz', destination, decompress=True,
+                                  sinks=[recording])
+
+        request.initialize_file_handle().write(compressed)
+        request.finalize_file_handle()
+
+        self.assertEqual(destination.getvalue(), 'decompressed')
+        self.assertEqual(recording.events, ['start', compressed, 'finish'])
+
+
+class LocalSinkTests(base.NectarTests):
+
+    def setUp(self):
+        super(LocalSinkTests, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='nectar-sink-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = os.path.join(DATA_DIR, '100K_file')
+        with open(self.source, 'rb') as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+
+    def _download(self, config):
+        hash_sink = sink.HashSink()
+        destination = os.path.join(self.directory, 'file')
+        downloader = local.LocalFileDownloader(config)
+        report = downloader.download_one(DownloadRequest('file://' + self.source, destination,
+                                                         sinks=[hash_sink]))
+        return report, hash_sink
+
+    def test_copy(self):
+        report, hash_sink = self._download(DownloaderConfig())
+
+        self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+        self.assertEqual(hash_sink.hexdigest(), self.digest)
+
+    def test_links_copy(self):
+        for config in (DownloaderConfig(use_hard_links=True),
+                       DownloaderConfig(link_strategies=['hardlink', 'copy'])):
+            report, hash_sink = self._download(config)
+
+            self.assertEqual(report.state, DOWNLOAD_SUCCEEDED)
+            self.assertEqual(hash_sink.hexdigest(), self.digest)
+            self.assertEqual(os.stat(os.path.join(self.directory, 'file')).st_nlink, 1)
+
+    def test_failing_sink(self):
+        failing = RecordingSink()
+        failing.write = mock.Mock(side_effect=ValueError('not xml'))
+        downloader = local.LocalFileDownloader(DownloaderConfig())
+
+        report = downloader.download_one(DownloadRequest(
+            'file://' + self.source, os.path.join(self.directory, 'file'), sinks=[failing]))
+
+        self.assertEqual(report.state, DOWNLOAD_FAILED)
+        self.assertEqual(failing.events, ['start', 'abort'])
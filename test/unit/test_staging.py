@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+import mock
+
+import base
+from nectar import staging
+from nectar.config import DownloaderConfig
+from nectar.downloaders.base import Downloader
+from nectar.request import DownloadRequest
+
+
+class StagingTests(base.NectarTests):
+
+    def setUp(self):
+        super(StagingTests, self).setUp()
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-staging-testing-')
+        self.destination = os.path.join(self.dest_dir, 'file')
+
+    def tearDown(self):
+        super(StagingTests, self).tearDown()
+        shutil.rmtree(self.dest_dir)
+
+
+class StagedFileTests(StagingTests):
+
+    def test_commit(self):
+        staged = staging.StagedFile(self.destination)
+        staged.write('abc')
+
+        self.assertFalse(os.path.exists(self.destination))
+        self.assertEqual(os.path.dirname(staged.path), self.dest_dir)
+
+        staged.commit()
+
+        with open(self.destination) as f:
+            self.assertEqual(f.read(), 'abc')
+        self.assertEqual(os.listdir(self.dest_dir), ['file'])
+
+    def test_commit_replaces_destination(self):
+        with open(self.destination, 'w') as f:
+            f.write('old contents')
+        staged = staging.StagedFile(self.destination)
+        staged.write('new')
+
+        staged.commit()
+
+        with open(self.destination) as f:
+            self.assertEqual(f.read(), 'new')
+
+    def test_discard(self):
+        with open(self.destination, 'w') as f:
+            f.write('old contents')
+        staged = staging.StagedFile(self.destination)
+        staged.write('new')
+
+        staged.discard()
+
+        with open(self.destination) as f:
+            self.assertEqual(f.read(), 'old contents')
+        self.assertEqual(os.listdir(self.dest_dir), ['file'])
+
+    def test_preallocated_file_truncated_to_written_size(self):
+        staged = staging.StagedFile(self.destination, size=1048576)
+        staged.write('abc')
+
+        staged.commit()
+
+        self.assertEqual(os.path.getsize(self.destination), 3)
+
+    @mock.patch('nectar.staging.fsync_directory')
+    @mock.patch('os.fsync')
+    def test_file_durability(self, mock_fsync, mock_fsync_directory):
+        staged = staging.StagedFile(self.destination, durability=staging.DURABILITY_FILE)
+
+        staged.commit()
+
+        self.assertEqual(mock_fsync.call_count, 1)
+        mock_fsync_directory.assert_called_once_with(self.dest_dir)
+
+    @mock.patch('nectar.staging.fsync_directory')
+    @mock.patch('nectar.staging._fdatasync')
+    def test_batch_durability(self, mock_fdatasync, mock_fsync_directory):
+        staged = staging.StagedFile(self.destination, durability=staging.DURABILITY_BATCH)
+
+        staged.commit()
+
+        self.assertEqual(mock_fdatasync.call_count, 1)
+        self.assertEqual(mock_fsync_directory.call_count, 0)
+
+    def test_posix_fallocate_unsupported(self):
+        with mock.patch('nectar.staging._posix_fallocate', return_value=95):  # EOPNOTSUPP
+            staging.posix_fallocate(0, 0, 100)
+
+    def test_posix_fallocate_no_space(self):
+        with mock.patch('nectar.staging._posix_fallocate', return_value=28):  # ENOSPC
+            self.assertRaises(OSError, staging.posix_fallocate, 0, 0, 100)
+
+
+class StagedRequestTests(StagingTests):
+
+    def test_commit(self):
+        request = DownloadRequest('http://fake/file', self.destination)
+
+        file_handle = request.initialize_file_handle(staged=True, size=10)
+        file_handle.write('abc')
+        committed = request.finalize_file_handle(commit=True)
+
+        self.assertEqual(committed, [self.destination])
+        self.assertEqual(os.path.getsize(self.destination), 3)
+
+    def test_discard(self):
+        request = DownloadRequest('http://fake/file', self.destination)
+
+        file_handle = request.initialize_file_handle(staged=True)
+        file_handle.write('abc')
+        committed = request.finalize_file_handle(commit=False)
+
+        self.assertEqual(committed, [])
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_file_like_destination_not_staged(self):
+        destination = StringIO()
+        request = DownloadRequest('http://fake/file', destination)
+
+        self.assertTrue(request.initialize_file_handle(staged=True) is destination)
+        self.assertEqual(request.finalize_file_handle(commit=True), [])
+
+
+class DownloaderDurabilityTests(StagingTests):
+
+    @mock.patch('nectar.staging.fsync_directory')
+    def test_batch_directories_synced_once(self, mock_fsync_directory):
+        config = DownloaderConfig(staged_writes=True, durability=staging.DURABILITY_BATCH)
+        downloader = Downloader(config)
+
+        for name in ('a', 'b'):
+            request = DownloadRequest('http://fake/' + name, os.path.join(self.dest_dir, name))
+            downloader.initialize_file_handle(request)
+            downloader.finalize_file_handle(request, commit=True)
+        downloader.sync_directories()
+
+        mock_fsync_directory.assert_called_once_with(self.dest_dir)
+
+    def test_invalid_durability(self):
+        self.assertRaises(ValueError, DownloaderConfig, durability='always')
@@ -1,11 +1,15 @@
 from cStringIO import StringIO
 import datetime
+import gzip
+import hashlib
 import httplib
 import os
 import random
 import shutil
 import string
 import tempfile
+import threading
+import time
 import unittest
 import urllib
 
@@ -13,14 +17,35 @@ import mock
 from requests import Response, ConnectionError, Timeout
 
 import base
+import http_chaos_test_server
+import http_encoding_test_server
+import http_range_test_server
 import http_static_test_server
-from nectar import config, listener, request
+from nectar import config, delta, hedge, journal, listener, request, sink
 from nectar.config import DownloaderConfig
 from nectar.downloaders import threaded
 from nectar.report import DownloadReport
 from nectar.request import DownloadRequest
 
 
+class RecordingEventListener(listener.DownloadEventListener):
+
+    def __init__(self):
+        self.events = []
+
+    def download_started(self, report):
+        self.events.append(('started', report))
+
+    def download_headers(self, report):
+        self.events.append(('headers', report))
+
+    def download_succeeded(self, report):
+        self.events.append(('succeeded', report))
+
+    def download_failed(self, report):
+        self.events.append(('failed', report))
+
+
 class InstantiationTests(base.NectarTests):
     def test_instantiation(self):
         cfg = config.DownloaderConfig()
@@ -227,6 +252,54 @@ class LiveDownloadingTests(base.NectarTests):
         self.assertEqual(len(lst.succeeded_reports), 1)
         self.assertEqual(len(lst.failed_reports), 0)
 
+    def test_download_to_sinks(self):
+        cfg = config.DownloaderConfig()
+        downloader = threaded.HTTPThreadedDownloader(cfg)
+        file_path = os.path.join(self.data_directory, self.data_file_names[0])
+        dest_path = os.path.join(self.download_dir, self.data_file_names[0])
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        hash_sink = sink.HashSink()
+        queue_sink = sink.QueueSink()
+        consumed = []
+        consumer = threading.Thread(target=lambda: consumed.extend(queue_sink))
+        consumer.start()
+
+        report = downloader.download_one(request.DownloadRequest(url, dest_path,
+                                                                 sinks=[hash_sink, queue_sink]))
+
+        consumer.join()
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        with open(dest_path, 'rb') as f:
+            content = f.read()
+        self.assertEqual(hash_sink.hexdigest(), hashlib.sha256(content).hexdigest())
+        self.assertEqual(''.join(consumed), content)
+
+    def test_journal(self):
+        journal_path = os.path.join(self.download_dir, 'journal')
+        cfg = config.DownloaderConfig(journal_path=journal_path)
+        file_path = os.path.join(self.data_directory, self.data_file_names[0])
+        dest_path = os.path.join(self.download_dir, self.data_file_names[0])
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        req = request.DownloadRequest(url, dest_path)
+
+        threaded.HTTPThreadedDownloader(cfg).download([req])
+
+        # the digest sink is only attached for the download
+        self.assertEqual(req.sinks, [])
+        with open(dest_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(journal.DownloadJournal(journal_path).lookup(url, dest_path),
+                         (self.data_file_sizes[0], digest))
+
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        with mock.patch.object(downloader, '_fetch') as mock_fetch:
+            downloader.download([request.DownloadRequest(url, dest_path)])
+
+        self.assertEqual(mock_fetch.call_count, 0)
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].strategy, 'skipped')
+
     def test_single_download_failure(self):
         cfg = config.DownloaderConfig()
         lst = listener.AggregatingEventListener()
@@ -245,6 +318,200 @@ class LiveDownloadingTests(base.NectarTests):
         self.assertEqual(len(lst.failed_reports), 1)
         self.assertTrue(lst.failed_reports[0].error_msg is not None)
 
+    def test_iter_download(self):
+        cfg = config.DownloaderConfig(max_concurrent=2)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        requests = []
+        for i, file_name in enumerate(self.data_file_names):
+            url = 'http://localhost:%d/%s' % (self.server_port,
+                                              os.path.join(self.data_directory, file_name))
+            requests.append(request.DownloadRequest(url, os.path.join(self.download_dir,
+                                                                      file_name), data=i))
+
+        reports = list(downloader.iter_download(requests, buffer_size=1))
+
+        self.assertEqual(sorted(r.data for r in reports), [0, 1, 2])
+        self.assertTrue(all(r.state == DownloadReport.DOWNLOAD_SUCCEEDED for r in reports))
+        self.assertEqual(len(lst.succeeded_reports), 3)
+
+    def _requests(self):
+        return [request.DownloadRequest(
+            'http://localhost:%d/%s' % (self.server_port,
+                                        os.path.join(self.data_directory, file_name)),
+            os.path.join(self.download_dir, file_name), data=i)
+            for i, file_name in enumerate(self.data_file_names)]
+
+    def test_engine(self):
+        cfg = config.DownloaderConfig(max_concurrent=2)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        make_session = mock.Mock(side_effect=downloader._make_session)
+        downloader._make_session = make_session
+
+        with downloader:
+            threads = list(downloader._engine_threads)
+            futures = [downloader.submit(r) for r in self._requests()]
+            reports = [f.result() for f in futures]
+            # a second batch, on the same workers
+            downloader.download(self._requests())
+            self.assertEqual(downloader._engine_threads, threads)
+
+        self.assertEqual([r.data for r in reports], [0, 1, 2])
+        self.assertTrue(all(r.state == DownloadReport.DOWNLOAD_SUCCEEDED for r in reports))
+        self.assertEqual(len(lst.succeeded_reports), 6)
+        self.assertTrue(make_session.call_count <= 2)
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self.assertTrue(downloader._engine_queue is None)
+
+    def test_engine_same_url_and_destination(self):
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(max_concurrent=3))
+        url = self._requests()[0].url
+        requests = [request.DownloadRequest(url, os.devnull, data=i) for i in range(6)]
+
+        with downloader:
+            futures = [downloader.submit(r) for r in requests]
+            reports = [f.result() for f in futures]
+
+        # each future gets the report of its own request
+        self.assertEqual([r.data for r in reports], range(6))
+
+    def test_engine_download_one(self):
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(max_concurrent=1))
+        make_session = mock.Mock(side_effect=downloader._make_session)
+        downloader._make_session = make_session
+
+        with downloader:
+            for req in self._requests():
+                report = downloader.download_one(req)
+                self.assertEqual(report.state, DownloadReport.DOWNLOAD_SUCCEEDED)
+
+        # for the calls to download_one; the worker makes its own once it
+        # gets a request
+        self.assertEqual(make_session.call_count, 1)
+        self.assertEqual(downloader._idle_sessions, [])
+
+    def test_engine_journal(self):
+        cfg = config.DownloaderConfig(journal_path=os.path.join(self.download_dir, 'journal'))
+        req = self._requests()[0]
+        threaded.HTTPThreadedDownloader(cfg).download([req])
+        downloader = threaded.HTTPThreadedDownloader(cfg)
+
+        with downloader:
+            report = downloader.submit(self._requests()[0]).result()
+
+        self.assertEqual(report.strategy, 'skipped')
+
+    def test_engine_batch_keeps_journal_sinks(self):
+        journal_path = os.path.join(self.download_dir, 'journal')
+        downloader = threaded.HTTPThreadedDownloader(
+            config.DownloaderConfig(journal_path=journal_path, max_concurrent=2))
+        first, second, third = self._requests()
+        missing = request.DownloadRequest(second.url + '-missing', second.destination + '-missing')
+        fetch = downloader._fetch
+        release = threading.Event()
+
+        def blocking_fetch(request, *args, **kwargs):
+            if request is first:
+                release.wait(5)
+            return fetch(request, *args, **kwargs)
+
+        downloader._fetch = blocking_fetch
+        with downloader:
+            future = downloader.submit(first)
+            downloader.download([second, missing])
+            # the batch is done with its own requests only
+            self.assertEqual(len(first.sinks), 1)
+            self.assertEqual(second.sinks, [])
+            self.assertEqual(missing.sinks, [])
+            release.set()
+            report = future.result()
+
+        self.assertEqual(report.state, DownloadReport.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(first.sinks, [])
+        with open(first.destination, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(journal.DownloadJournal(journal_path).lookup(first.url, first.destination),
+                         (self.data_file_sizes[0], digest))
+
+    def test_engine_cancel(self):
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(max_concurrent=1))
+        fetched = threading.Event()
+        release = threading.Event()
+
+        def blocking_fetch(request, *args, **kwargs):
+            fetched.set()
+            release.wait(5)
+            report = DownloadReport.from_download_request(request)
+            report.download_started()
+            report.download_canceled()
+            downloader.fire_download_failed(report)
+            return report
+
+        downloader._fetch = blocking_fetch
+        futures = [downloader.submit(r) for r in self._requests()]
+        fetched.wait(5)
+
+        downloader.cancel()
+        release.set()
+        downloader.shutdown()
+
+        reports = [f.result(timeout=5) for f in futures]
+        self.assertTrue(all(r.state == DownloadReport.DOWNLOAD_CANCELED for r in reports))
+        # submitted once canceled
+        report = downloader.submit(self._requests()[0]).result(timeout=5)
+        self.assertEqual(report.state, DownloadReport.DOWNLOAD_CANCELED)
+        downloader.shutdown()
+
+    def test_write_behind(self):
+        cfg = config.DownloaderConfig(write_behind_threads=2, write_behind_budget=64 * 1024)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+
+        downloader.download(self._requests())
+
+        self.assertEqual(len(lst.succeeded_reports), 3)
+        for report in lst.succeeded_reports:
+            self.assertEqual(os.path.getsize(report.destination),
+                             self.data_file_sizes[report.data])
+            self.assertTrue(report.write_stall_time >= 0)
+        self.assertEqual(downloader.write_behind.queued, 0)
+        self.assertEqual(downloader._behind_writers, {})
+
+    def test_write_behind_sinks(self):
+        cfg = config.DownloaderConfig(write_behind_threads=1)
+        downloader = threaded.HTTPThreadedDownloader(cfg)
+        on_io_thread = []
+
+        class ThreadSink(sink.Sink):
+            def write(self, data):
+                io_threads = [lane._thread for lane in downloader.write_behind._lanes]
+                on_io_thread.append(threading.current_thread() in io_threads)
+
+        req = self._requests()[0]
+        req.sinks = [ThreadSink()]
+
+        report = downloader.download_one(req)
+
+        self.assertEqual(report.state, DownloadReport.DOWNLOAD_SUCCEEDED)
+        # the sinks are written to by the worker, not by the I/O thread
+        self.assertTrue(on_io_thread)
+        self.assertFalse(any(on_io_thread))
+
+    def test_write_behind_error(self):
+        cfg = config.DownloaderConfig(write_behind_threads=1)
+        downloader = threaded.HTTPThreadedDownloader(cfg)
+        destination = mock.Mock()
+        destination.write.side_effect = IOError('disk full')
+        req = self._requests()[2]
+        req.destination = destination
+
+        report = downloader.download_one(req)
+
+        self.assertEqual(report.state, DownloadReport.DOWNLOAD_FAILED)
+        self.assertEqual(report.error_msg, 'disk full')
+        self.assertEqual(downloader.write_behind.queued, 0)
+
     def test_download_unhandled_exception(self):
         with mock.patch('nectar.downloaders.threaded._logger') as mock_logger:
             cfg = config.DownloaderConfig()
@@ -306,6 +573,646 @@ class LiveDownloadingTests(base.NectarTests):
         self.assertTrue(finish - start >= two_seconds)
         self.assertTrue(finish - start < three_seconds)
 
+    def _slow_fetches(self, downloader):
+        # give the workers the time to take the duplicates off the queue while
+        # the first request is in flight
+        fetch = downloader._fetch
+        fetches = []
+
+        def slow_fetch(request, *args, **kwargs):
+            fetches.append(request)
+            time.sleep(0.3)
+            return fetch(request, *args, **kwargs)
+
+        downloader._fetch = slow_fetch
+        return fetches
+
+    def test_duplicates_fetched_once(self):
+        cfg = config.DownloaderConfig(max_concurrent=3)
+        lst = RecordingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        fetches = self._slow_fetches(downloader)
+
+        file_path = os.path.join(self.data_directory, self.data_file_names[1])
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_list = [os.path.join(self.download_dir, str(i)) for i in range(3)]
+        stream = StringIO()
+        request_list = [request.DownloadRequest(url, d, data=d) for d in dest_list]
+        request_list.append(request.DownloadRequest(url, stream, data='stream'))
+
+        downloader.download(request_list)
+
+        self.assertEqual(len(fetches), 1)
+        for dest in dest_list:
+            self.assertEqual(os.path.getsize(dest), self.data_file_sizes[1])
+        self.assertEqual(len(stream.getvalue()), self.data_file_sizes[1])
+        for data in dest_list + ['stream']:
+            events = [e for e, report in lst.events if report.data == data]
+            self.assertEqual(events[0], 'started')
+            self.assertEqual(events[-1], 'succeeded')
+            self.assertTrue('headers' in events)
+        self.assertEqual(len(set(id(r) for e, r in lst.events)), 4)
+
+    def test_duplicates_same_destination(self):
+        cfg = config.DownloaderConfig(max_concurrent=2)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        self._slow_fetches(downloader)
+
+        file_path = os.path.join(self.data_directory, self.data_file_names[0])
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_names[0])
+
+        downloader.download([request.DownloadRequest(url, dest_path) for i in range(2)])
+
+        self.assertEqual(len(lst.succeeded_reports), 2)
+        self.assertEqual(os.path.getsize(dest_path), self.data_file_sizes[0])
+
+    def test_duplicates_share_refusal(self):
+        cfg = config.DownloaderConfig(max_concurrent=2)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst)
+        fetches = self._slow_fetches(downloader)
+
+        url = 'http://localhost:%d/%s' % (self.server_port, 'idontexist')
+        dest_list = [os.path.join(self.download_dir, str(i)) for i in range(2)]
+
+        downloader.download([request.DownloadRequest(url, d) for d in dest_list])
+
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(len(lst.failed_reports), 2)
+        for report in lst.failed_reports:
+            self.assertEqual(report.error_report['response_code'], 404)
+            self.assertFalse(os.path.exists(report.destination))
+
+
+class ChaosDownloadingTests(base.NectarTests):
+    """
+    Live tests of the error paths, against a server that injects faults into
+    every response.
+    """
+    data_directory = None
+    data_file_name = '100K_file'
+    data_file_size = 102400
+
+    server = None
+    server_port = 8089
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = _find_data_directory()
+        cls.server = http_chaos_test_server.HTTPChaosTestServer(
+            port=cls.server_port, retry_after=0, drip_size=10240, stall_time=2)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server = None
+        cls.data_directory = None
+
+    def setUp(self):
+        super(ChaosDownloadingTests, self).setUp()
+        self.download_dir = tempfile.mkdtemp(prefix='nectar_chaos_unit_testing-')
+        self.server.reset_counts()
+
+    def tearDown(self):
+        super(ChaosDownloadingTests, self).tearDown()
+        shutil.rmtree(self.download_dir)
+        self.download_dir = None
+
+    def _download(self, fault, **config_kwargs):
+        self.server.faults = {fault: 1.0}
+        cfg = config.DownloaderConfig(**config_kwargs)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst, tries=1)
+
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        downloader.download([request.DownloadRequest(url, dest_path)])
+
+        return downloader, lst
+
+    def test_connection_reset_mid_body(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_RESET)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertTrue(lst.failed_reports[0].bytes_downloaded < self.data_file_size)
+
+    def test_connection_reset_then_truncated(self):
+        # the bytes of the reset attempt must not count towards the retry's body
+        faults = [http_chaos_test_server.FAULT_RESET, http_chaos_test_server.FAULT_TRUNCATE]
+
+        with mock.patch.object(self.server, 'draw_fault',
+                               side_effect=lambda path: faults.pop(0) if faults else None):
+            downloader, lst = self._download(None, staged_writes=True)
+
+        self.assertEqual(faults, [])
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertTrue('Incomplete body' in lst.failed_reports[0].error_msg)
+        # only the truncated half of the retry counts
+        self.assertEqual(lst.failed_reports[0].bytes_downloaded, self.data_file_size / 2)
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_truncated_body(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_TRUNCATE)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertTrue('Incomplete body' in lst.failed_reports[0].error_msg)
+
+    def test_truncated_body_staged(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_TRUNCATE,
+                                         staged_writes=True)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_slow_drip_staged(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_SLOW, staged_writes=True)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(os.listdir(self.download_dir), [self.data_file_name])
+        self.assertEqual(os.path.getsize(os.path.join(self.download_dir, self.data_file_name)),
+                         self.data_file_size)
+
+    def test_slow_drip(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_SLOW)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+
+    def test_service_unavailable(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_UNAVAILABLE)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(lst.failed_reports[0].error_report['response_code'], 503)
+        self.assertEqual(self.server.requests, 2)  # retried once the host's pause is over
+
+    def test_too_many_requests(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_TOO_MANY_REQUESTS)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_stall_times_out(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_STALL, read_timeout=0.5)
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(lst.failed_reports[0].error_msg, 'A connection error occurred')
+        self.assertEqual(downloader.failed_netlocs, set())
+
+    def _time_to_cancel(self, fault):
+        """
+        Start downloading more requests than there are workers, all of them
+        held up by the fault, cancel, and measure how long download takes to
+        return.
+        """
+        self.server.faults = {fault: 1.0}
+        self.server.stall_time = 10
+        self.addCleanup(setattr, self.server, 'stall_time', 2)
+        cfg = config.DownloaderConfig(max_concurrent=2)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst, tries=1)
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        # distinct urls, or they'd be fetched once
+        requests = [request.DownloadRequest('%s?%d' % (url, i),
+                                            os.path.join(self.download_dir, str(i)))
+                    for i in range(5)]
+        download = threading.Thread(target=downloader.download, args=[requests])
+        download.start()
+        while self.server.requests < 2:
+            time.sleep(0.05)
+        time.sleep(0.2)
+
+        canceled = time.time()
+        downloader.cancel()
+        download.join(5)
+        time_to_cancel = time.time() - canceled
+
+        self.assertFalse(download.is_alive())
+        self.assertEqual(len(lst.failed_reports), 5)
+        self.assertEqual(len(lst.succeeded_reports), 0)
+        for report in lst.failed_reports:
+            self.assertEqual(report.state, DownloadReport.DOWNLOAD_CANCELED)
+        return time_to_cancel
+
+    def test_cancel_aborts_stalled_body(self):
+        self.assertTrue(self._time_to_cancel(http_chaos_test_server.FAULT_STALL) < 1)
+
+    def test_cancel_aborts_waiting_for_response(self):
+        self.assertTrue(self._time_to_cancel(http_chaos_test_server.FAULT_HANG) < 1)
+
+    def _drip(self, drip_size, drip_interval):
+        self.addCleanup(setattr, self.server, 'drip_size', self.server.drip_size)
+        self.addCleanup(setattr, self.server, 'drip_interval', self.server.drip_interval)
+        self.server.drip_size = drip_size
+        self.server.drip_interval = drip_interval
+
+    @mock.patch('nectar.inflight.WATCH_INTERVAL', 0.05)
+    def test_deadline(self):
+        started = time.time()
+        downloader, lst = self._download(http_chaos_test_server.FAULT_STALL, deadline=0.5)
+
+        self.assertTrue(time.time() - started < 1.5)
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(lst.failed_reports[0].error_report['expired'], 'deadline')
+        self.assertEqual(self.server.requests, 1)
+
+    @mock.patch('nectar.inflight.WATCH_INTERVAL', 0.05)
+    def test_min_speed(self):
+        # 10KB/s, which would take 10 seconds
+        self._drip(1024, 0.1)
+
+        started = time.time()
+        downloader, lst = self._download(http_chaos_test_server.FAULT_SLOW, min_speed=50000,
+                                         min_speed_window=0.5)
+
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertEqual(lst.failed_reports[0].error_report['expired'], 'stalled')
+        self.assertEqual(self.server.requests, threaded.DEFAULT_GENERIC_TRIES)
+
+    def test_min_speed_met(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_SLOW, min_speed=1024,
+                                         min_speed_window=0.05)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+
+    @mock.patch('nectar.inflight.WATCH_INTERVAL', 0.05)
+    def test_stall_retried_on_mirror(self):
+        self._drip(1024, 0.1)
+        self.server.faults = {http_chaos_test_server.FAULT_SLOW: 1.0}
+        mirror = http_static_test_server.HTTPStaticTestServer(port=8092)
+        mirror.start()
+        self.addCleanup(mirror.stop)
+        cfg = config.DownloaderConfig(min_speed=50000, min_speed_window=0.5)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst, tries=1)
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+
+        downloader.download([request.DownloadRequest(
+            url, dest_path, mirrors=['http://localhost:8092/%s' % file_path])])
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].url, url)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+        self.assertEqual(os.path.getsize(dest_path), self.data_file_size)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_corrupt_retried_on_mirror(self):
+        self.server.faults = {http_chaos_test_server.FAULT_CORRUPT: 1.0}
+        mirror = http_static_test_server.HTTPStaticTestServer(port=8092)
+        mirror.start()
+        self.addCleanup(mirror.stop)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(), lst, tries=1)
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        # the corrupt byte is in the piece in the middle
+        pieces = [hashlib.sha1(content[i:i + 4096]).hexdigest()
+                  for i in range(0, len(content), 4096)]
+        verifying_sink = sink.VerifyingSink(piece_algorithm='sha1', piece_length=4096,
+                                            piece_digests=pieces)
+        verifying_sink.write = mock.Mock(wraps=verifying_sink.write)
+
+        downloader.download([request.DownloadRequest(
+            url, dest_path, sinks=[verifying_sink],
+            mirrors=['http://localhost:8092/%s' % file_path])])
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(self.server.requests, 1)
+        with open(dest_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # rejected at the corrupt piece, before the rest was downloaded
+        written = sum(len(c[0][0]) for c in verifying_sink.write.call_args_list)
+        self.assertTrue(written < len(content) * 3 / 2 + 2 * threaded.DEFAULT_BUFFER_SIZE)
+
+    def test_corrupt_without_mirror(self):
+        self.server.faults = {http_chaos_test_server.FAULT_CORRUPT: 1.0}
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        cfg = config.DownloaderConfig(staged_writes=True)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst, tries=1)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+
+        downloader.download([request.DownloadRequest(
+            url, dest_path, sinks=[sink.VerifyingSink('sha256', digest)])])
+
+        self.assertEqual(len(lst.failed_reports), 1)
+        self.assertTrue('verification' in lst.failed_reports[0].error_report)
+        # the corrupt download never replaced the destination
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def _download_with_mirror(self, url):
+        mirror = http_static_test_server.HTTPStaticTestServer(port=8092)
+        mirror.start()
+        self.addCleanup(mirror.stop)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(), lst, tries=1)
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+
+        downloader.download([request.DownloadRequest(
+            url, dest_path, mirrors=['http://localhost:8092/%s' % file_path])])
+        return downloader, lst
+
+    def test_error_response_retried_on_mirror(self):
+        url = 'http://localhost:%d/%s/missing' % (self.server_port, self.data_directory)
+
+        downloader, lst = self._download_with_mirror(url)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].url, url)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_connection_error_retried_on_mirror(self):
+        # nothing listens on that port
+        url = 'http://localhost:8095/%s' % os.path.join(self.data_directory, self.data_file_name)
+
+        downloader, lst = self._download_with_mirror(url)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+        self.assertEqual(downloader.failed_netlocs, set())
+
+    def _hedging_downloader(self):
+        cfg = config.DownloaderConfig(hedge_percentile=95, hedge_budget=1)
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(cfg, lst, tries=1)
+        # the requests that succeeded so far took a hundredth of a second
+        for i in range(hedge.MIN_SAMPLES):
+            downloader._hedging.record(0.01, 102400, 0.01)
+        return downloader, lst
+
+    @mock.patch('nectar.inflight.WATCH_INTERVAL', 0.05)
+    def test_hedge_wins(self):
+        self.server.faults = {http_chaos_test_server.FAULT_HANG: 1.0}
+        mirror = http_static_test_server.HTTPStaticTestServer(port=8092)
+        mirror.start()
+        self.addCleanup(mirror.stop)
+        downloader, lst = self._hedging_downloader()
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+
+        started = time.time()
+        downloader.download([request.DownloadRequest(
+            url, dest_path, mirrors=['http://localhost:8092/%s' % file_path])])
+
+        self.assertTrue(time.time() - started < 1.5)
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(lst.succeeded_reports[0].bytes_downloaded, self.data_file_size)
+        with open(file_path, 'rb') as expected:
+            with open(dest_path, 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), expected.read())
+        self.assertEqual(os.listdir(self.download_dir), [self.data_file_name])
+        self.assertEqual(downloader._hedging.hedged, 1)
+
+    @mock.patch('nectar.inflight.WATCH_INTERVAL', 0.05)
+    def test_primary_wins(self):
+        # a second and a half, the hedge starting later
+        self._drip(10240, 0.15)
+        self.server.faults = {http_chaos_test_server.FAULT_SLOW: 1.0}
+        downloader, lst = self._hedging_downloader()
+        file_path = os.path.join(self.data_directory, self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+
+        downloader.download([request.DownloadRequest(url, dest_path)])
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(os.path.getsize(dest_path), self.data_file_size)
+        # the hedge was canceled, and its file removed
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(os.listdir(self.download_dir), [self.data_file_name])
+
+    def test_hedging_learns(self):
+        downloader, lst = self._download(http_chaos_test_server.FAULT_SLOW, hedge_percentile=95)
+
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        self.assertEqual(len(downloader._hedging.stats), 1)
+        self.assertEqual(downloader._hedging.hedged, 0)
+
+    def test_hedge_shares_downloader_state(self):
+        cfg = config.DownloaderConfig(hedge_percentile=95,
+                                      cache_dir=os.path.join(self.download_dir, 'cache'),
+                                      journal_path=os.path.join(self.download_dir, 'journal'),
+                                      write_behind_threads=1)
+        downloader = threaded.HTTPThreadedDownloader(cfg)
+        dest_path = os.path.join(self.download_dir, self.data_file_name)
+        hedged = threaded.HedgedRequest(downloader, request.DownloadRequest('http://x/', dest_path))
+
+        child = hedged._make_child()
+
+        self.assertTrue(child._cache is downloader._cache)
+        self.assertTrue(child.write_behind is downloader.write_behind)
+        self.assertTrue(child._hedging is None)
+        self.assertTrue(child.config.journal_path is None)
+        # the downloader's configuration is left as it was
+        self.assertEqual(downloader.config.hedge_percentile, 95)
+        self.assertEqual(downloader.config.write_behind_threads, 1)
+
+
+class DeltaDownloadingTests(base.NectarTests):
+    data_file_name = 'random_file'
+    block_size = 4096
+
+    server = None
+    server_port = 8093
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http_range_test_server.HTTPRangeTestServer(port=cls.server_port)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server = None
+
+    def setUp(self):
+        super(DeltaDownloadingTests, self).setUp()
+        self.download_dir = tempfile.mkdtemp(prefix='nectar_threaded_unit_testing-')
+        self.addCleanup(shutil.rmtree, self.download_dir)
+        # served from the working directory, as the data files are; those are
+        # all zeros, so all of their blocks match
+        self.served_dir = os.path.relpath(tempfile.mkdtemp(prefix='nectar-delta-',
+                                                           dir=os.getcwd()))
+        self.addCleanup(shutil.rmtree, self.served_dir)
+        self.file_path = os.path.join(self.served_dir, self.data_file_name)
+        generator = random.Random(0)
+        self.content = ''.join(chr(generator.randrange(256)) for i in xrange(256 * 1024 + 100))
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+        self.index = delta.BlockIndex.from_file(self.file_path, self.block_size)
+        self.dest_path = os.path.join(self.download_dir, self.data_file_name)
+        del self.server.ranges[:]
+
+    def _seed(self, changed_blocks):
+        # the previous download, with the given blocks since changed
+        seed = bytearray(self.content)
+        for block in changed_blocks:
+            seed[block * self.block_size] ^= 0xff
+        with open(self.dest_path, 'wb') as f:
+            f.write(seed)
+
+    def _download(self, index, port=None):
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(config.DownloaderConfig(), lst, tries=1)
+        url = 'http://localhost:%d/%s' % (port or self.server_port, self.file_path)
+        downloader.download([request.DownloadRequest(url, self.dest_path, delta=index)])
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        return lst.succeeded_reports[0]
+
+    def test_multiple_ranges(self):
+        self._seed([3, 4, 50])
+
+        report = self._download(self.index)
+
+        self.assertEqual(report.strategy, delta.STRATEGY_DELTA)
+        self.assertEqual(report.bytes_downloaded, 3 * self.block_size)
+        self.assertEqual(report.total_bytes, len(self.content))
+        self.assertEqual(self.server.ranges, [[(3 * self.block_size, 5 * self.block_size - 1),
+                                               (50 * self.block_size,
+                                                51 * self.block_size - 1)]])
+
+    def test_single_range(self):
+        # the last block, which is shorter
+        self._seed([len(self.index.blocks) - 1])
+
+        report = self._download(self.index)
+
+        self.assertEqual(report.strategy, delta.STRATEGY_DELTA)
+        self.assertEqual(report.bytes_downloaded, 100)
+        self.assertEqual(len(self.server.ranges), 1)
+
+    @mock.patch.object(delta, 'MAX_RANGES', 2)
+    def test_batches(self):
+        self._seed([1, 3, 5, 7, 9])
+
+        report = self._download(self.index)
+
+        self.assertEqual(report.strategy, delta.STRATEGY_DELTA)
+        self.assertEqual([len(spans) for spans in self.server.ranges], [2, 2, 1])
+
+    def test_sidecar(self):
+        # the sidecar is published next to the file
+        sidecar = delta.write_index(self.file_path, block_size=self.block_size)
+        self._seed([0])
+
+        report = self._download('http://localhost:%d/%s' % (self.server_port, sidecar))
+
+        self.assertEqual(report.strategy, delta.STRATEGY_DELTA)
+        self.assertEqual(report.bytes_downloaded, self.block_size)
+
+    def test_ranges_not_supported(self):
+        server = http_static_test_server.HTTPStaticTestServer(port=8092)
+        server.start()
+        self.addCleanup(server.stop)
+        self._seed([0])
+
+        report = self._download(self.index, port=8092)
+
+        self.assertEqual(report.strategy, None)
+        self.assertEqual(report.bytes_downloaded, len(self.content))
+
+    def test_corrupt_assembly(self):
+        self._seed([0])
+        self.index.digest = hashlib.sha256('other').hexdigest()
+
+        report = self._download(self.index)
+
+        self.assertEqual(report.strategy, None)
+        self.assertEqual(report.bytes_downloaded, len(self.content))
+
+    def test_no_seed(self):
+        report = self._download(self.index)
+
+        self.assertEqual(report.strategy, None)
+        self.assertEqual(self.server.ranges, [])
+
+
+class EncodingDownloadingTests(base.NectarTests):
+    data_file_name = '500K_file'
+    data_file_size = 512000
+
+    server = None
+    server_port = 8094
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http_encoding_test_server.HTTPEncodingTestServer(port=cls.server_port)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server = None
+
+    def setUp(self):
+        super(EncodingDownloadingTests, self).setUp()
+        self.download_dir = tempfile.mkdtemp(prefix='nectar_threaded_unit_testing-')
+        self.addCleanup(shutil.rmtree, self.download_dir)
+        self.dest_path = os.path.join(self.download_dir, self.data_file_name)
+        del self.server.accept_encodings[:]
+
+    def _download(self, accept_encoding, buffer_size=None, sinks=None):
+        lst = listener.AggregatingEventListener()
+        downloader = threaded.HTTPThreadedDownloader(
+            config.DownloaderConfig(buffer_size=buffer_size), lst, tries=1)
+        file_path = os.path.join(_find_data_directory(), self.data_file_name)
+        url = 'http://localhost:%d/%s' % (self.server_port, file_path)
+        downloader.download([request.DownloadRequest(url, self.dest_path, sinks=sinks,
+                                                     accept_encoding=accept_encoding)])
+        self.assertEqual(len(lst.succeeded_reports), 1)
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(f.read(), '\0' * self.data_file_size)
+        return lst.succeeded_reports[0]
+
+    def test_gzip(self):
+        report = self._download(['zstd', 'gzip'])
+
+        self.assertEqual(self.server.accept_encodings[0].split(', ')[-1], 'gzip')
+        self.assertEqual(report.bytes_downloaded, self.data_file_size)
+        self.assertTrue(0 < report.wire_bytes < report.bytes_downloaded)
+        self.assertEqual(report.wire_bytes, int(report.headers['content-length']))
+
+    def test_bounded_pieces(self):
+        # a few wire bytes inflate to many times the buffer size
+        pieces = mock.Mock(spec=sink.Sink)
+
+        report = self._download(['gzip'], buffer_size=1024, sinks=[pieces])
+
+        self.assertEqual(report.bytes_downloaded, self.data_file_size)
+        self.assertTrue(max(len(c[0][0]) for c in pieces.write.call_args_list) <= 1024)
+
+    def test_identity(self):
+        report = self._download([])
+
+        self.assertEqual(self.server.accept_encodings, ['identity'])
+        self.assertEqual(report.wire_bytes, self.data_file_size)
+
+    def test_default(self):
+        # decoded by requests, which does not count the bytes received
+        report = self._download(None)
+
+        self.assertEqual(report.bytes_downloaded, self.data_file_size)
+        self.assertEqual(report.wire_bytes, None)
+
 
 class TestFetch(unittest.TestCase):
     def setUp(self):
@@ -393,6 +1300,25 @@ class TestFetch(unittest.TestCase):
             URL, timeout=(self.config.connect_timeout, self.config.read_timeout),
             verify=True, stream=True, headers={'X-RHUI-ID': '1234'})
 
+    def test_decompress(self):
+        URL = 'http://fakeurl/primary.xml.gz'
+        data = 'abc' * 1000
+        compressed = _gzipped(data)
+        destination = StringIO()
+        req = DownloadRequest(URL, StringIO(), decompress=True,
+                              decompressed_destination=destination)
+        response = Response()
+        response.status_code = httplib.OK
+        response.raw = StringIO(compressed)
+        self.session.get.return_value = response
+
+        report = self.downloader._fetch(req, self.session)
+
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(destination.getvalue(), data)
+        self.assertEqual(report.bytes_downloaded, len(compressed))
+        self.assertEqual(report.bytes_decompressed, len(data))
+
     def test_fetch_with_connection_error(self):
         """
         Test that the report state is failed and that the baseurl is not tried again.
@@ -452,6 +1378,220 @@ class TestFetch(unittest.TestCase):
             self.assertIn(expected_log_message, log_calls)
 
 
+class TestRetryAfter(unittest.TestCase):
+    def setUp(self):
+        self.config = config.DownloaderConfig()
+        self.session = mock.Mock()
+        self.listener = listener.AggregatingEventListener()
+        self.downloader = threaded.HTTPThreadedDownloader(self.config, self.listener,
+                                                          session=self.session)
+
+    @staticmethod
+    def _response(status_code, body='', headers=None):
+        response = Response()
+        response.status_code = status_code
+        response.headers = headers or {}
+        response.raw = StringIO(body)
+        return response
+
+    def test_parse_retry_after_seconds(self):
+        self.assertEqual(threaded.parse_retry_after('120'), 120.0)
+
+    def test_parse_retry_after_date(self):
+        seconds = threaded.parse_retry_after('Fri, 31 Dec 1999 23:59:59 GMT')
+        self.assertEqual(seconds, 0.0)
+
+    def test_parse_retry_after_invalid(self):
+        self.assertTrue(threaded.parse_retry_after('soon') is None)
+        self.assertTrue(threaded.parse_retry_after(None) is None)
+
+    def test_retry_leaves_retry_after_to_downloader(self):
+        conf = threaded.HostPausingRetry(total=3, status_forcelist=[429])
+
+        self.assertFalse(conf.is_retry('GET', 429, has_retry_after=True))
+        self.assertFalse(conf.is_retry('GET', 503, has_retry_after=True))
+        self.assertTrue(conf.is_retry('GET', 429, has_retry_after=False))
+
+    def test_pause_netloc_keeps_longest_pause(self):
+        until = self.downloader.pause_netloc('fakeurl', 60)
+        self.downloader.pause_netloc('fakeurl', 1)
+
+        self.assertEqual(self.downloader.netloc_paused_until('fakeurl'), until)
+        self.assertTrue(self.downloader.netloc_paused_until('otherurl') is None)
+
+    def test_fetch_defers_request(self):
+        req = DownloadRequest('http://fakeurl/primary.xml', StringIO())
+        queue = mock.Mock()
+        self.session.get.return_value = self._response(429, headers={'retry-after': '30'})
+
+        ret = self.downloader._fetch(req, self.session, queue)
+
+        self.assertTrue(ret is None)
+        self.assertEqual(queue.defer.call_count, 1)
+        self.assertTrue(queue.defer.call_args[0][0] is req)
+        self.assertTrue(self.downloader.netloc_paused_until('fakeurl') is not None)
+        self.assertEqual(len(list(self.listener.all_reports)), 0)
+
+    def test_fetch_defers_other_requests_to_paused_host(self):
+        self.downloader.pause_netloc('fakeurl', 30)
+        req = DownloadRequest('http://fakeurl/other.xml', StringIO())
+        queue = mock.Mock()
+
+        self.downloader._fetch(req, self.session, queue)
+
+        self.assertEqual(self.session.get.call_count, 0)
+        self.assertEqual(queue.defer.call_count, 1)
+
+    def test_fetch_resumes_deferred_report(self):
+        req = DownloadRequest('http://fakeurl/primary.xml', StringIO())
+        self.session.get.side_effect = [self._response(503, headers={'retry-after': '0'}),
+                                        self._response(httplib.OK, 'abc')]
+        lst = mock.Mock()
+        self.downloader.event_listener = lst
+
+        self.downloader._fetch(req, self.session, mock.Mock())
+        report = self.downloader._fetch(req, self.session, mock.Mock())
+
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(lst.download_started.call_count, 1)
+
+    def test_fetch_waits_without_queue(self):
+        req = DownloadRequest('http://fakeurl/primary.xml', StringIO())
+        self.session.get.side_effect = [self._response(429, headers={'retry-after': '0'}),
+                                        self._response(httplib.OK, 'abc')]
+
+        report = self.downloader._fetch(req, self.session)
+
+        self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED)
+        self.assertEqual(self.session.get.call_count, 2)
+
+    def test_fetch_gives_up_after_tries(self):
+        self.downloader.tries = 1
+        req = DownloadRequest('http://fakeurl/primary.xml', StringIO())
+        self.session.get.side_effect = [self._response(429, headers={'retry-after': '0'}),
+                                        self._response(429, headers={'retry-after': '0'})]
+
+        report = self.downloader._fetch(req, self.session)
+
+        self.assertEqual(report.state, report.DOWNLOAD_FAILED)
+        self.assertEqual(report.error_report['response_code'], 429)
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.downloader = threaded.HTTPThreadedDownloader(DownloaderConfig())
+        self.leader = DownloadRequest('http://foo/bar', '/tmp/bar')
+        self.duplicate = DownloadRequest('http://foo/bar', StringIO())
+
+    def test_file_like_destination_does_not_lead(self):
+        self.assertFalse(self.downloader._join_in_flight(self.duplicate))
+        self.assertFalse(self.downloader._join_in_flight(self.leader))
+
+        self.assertTrue(self.downloader._join_in_flight(self.duplicate))
+
+    def test_different_headers_not_coalesced(self):
+        other = DownloadRequest('http://foo/bar', '/tmp/baz', headers={'range': 'bytes=0-1'})
+
+        self.assertFalse(self.downloader._join_in_flight(self.leader))
+        self.assertFalse(self.downloader._join_in_flight(other))
+
+    def test_deferred_leader_still_leads(self):
+        self.assertFalse(self.downloader._join_in_flight(self.leader))
+
+        self.assertFalse(self.downloader._join_in_flight(self.leader))
+
+    def test_duplicates_requeued_after_connection_error(self):
+        queue = threaded.WorkerQueue([])
+        self.downloader._join_in_flight(self.leader)
+        self.downloader._join_in_flight(self.duplicate)
+        report = DownloadReport.from_download_request(self.leader)
+        report.download_started()
+        report.download_connection_error()
+
+        self.downloader._land_duplicates(self.leader, report, queue)
+
+        self.assertTrue(queue.get() is self.duplicate)
+        # its report is carried over to when it is fetched
+        self.assertTrue(self.duplicate in self.downloader._deferred)
+        self.assertFalse(self.downloader._join_in_flight(self.duplicate))
+
+
+class TestWorkerQueue(unittest.TestCase):
+    def test_iterates(self):
+        queue = threaded.WorkerQueue(iter([1, 2]))
+
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [1, 2, None])
+        self.assertTrue(queue.finished)
+
+    def test_deferred_items_wait(self):
+        queue = threaded.WorkerQueue([1, 2, 3])
+        item = queue.get()
+        queue.defer(item, time.time() + 0.1)
+
+        self.assertEqual([queue.get(), queue.get(), queue.get(), queue.get()], [2, 3, 1, None])
+
+    def test_due_deferred_items_served_first(self):
+        queue = threaded.WorkerQueue([1, 2, 3])
+        item = queue.get()
+        queue.defer(item, 0)
+
+        self.assertEqual(queue.get(), 1)
+
+    def test_not_before(self):
+        queue = threaded.WorkerQueue([1, 2], not_before=lambda i: {1: 1e12}.get(i))
+        self.assertEqual(queue.get(), 2)
+        self.assertFalse(queue.finished)
+
+        queue.close()
+
+        self.assertTrue(queue.get() is None)
+        self.assertTrue(queue.finished)
+
+
+class TestSubmissionQueue(unittest.TestCase):
+    def test_waits_for_items(self):
+        queue = threaded.SubmissionQueue()
+        items = []
+        getter = threading.Thread(target=lambda: items.append(queue.get()))
+        getter.start()
+
+        time.sleep(0.1)
+        self.assertEqual(items, [])
+        self.assertTrue(queue.put(1))
+        getter.join(1)
+
+        self.assertEqual(items, [1])
+        self.assertFalse(queue.finished)
+
+    def test_finish(self):
+        queue = threaded.SubmissionQueue()
+        queue.put(1)
+        queue.finish()
+
+        self.assertFalse(queue.put(2))
+        self.assertFalse(queue.finished)
+        self.assertEqual([queue.get(), queue.get()], [1, None])
+        self.assertTrue(queue.finished)
+
+    def test_finish_waits_for_deferred_items(self):
+        queue = threaded.SubmissionQueue()
+        queue.put(1)
+        queue.defer(queue.get(), time.time() + 0.1)
+        queue.finish()
+
+        self.assertEqual([queue.get(), queue.get()], [1, None])
+
+    def test_drain(self):
+        queue = threaded.SubmissionQueue()
+        queue.put(1)
+        queue.put(2)
+        queue.defer(queue.get(), time.time() + 60)
+
+        self.assertEqual(list(queue.drain()), [1, 2])
+        self.assertTrue(queue.get() is None)
+        self.assertFalse(queue.put(3))
+
+
 class TestDownloadOne(unittest.TestCase):
     @mock.patch.object(threaded.HTTPThreadedDownloader, '_fetch', spec_set=True)
     def test_calls_fetch(self, mock_fetch):
@@ -480,6 +1620,14 @@ def _find_data_directory():
     raise RuntimeError('cannot find data directory')
 
 
+def _gzipped(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+
 def _generate_urls(num_urls, host_url='http://10.20.30.40/', path_prefix=''):
     file_names = [''.join(random.sample(string.letters, 7)) for i in range(num_urls)]
     return [urllib.basejoin(host_url, path_prefix + f) for f in file_names]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import mock
+
+import base
+from nectar import tls
+from nectar.config import DownloaderConfig
+from nectar.downloaders.threaded import HTTPThreadedDownloader
+from nectar.request import DownloadRequest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'utils'))
+import http_static_test_server  # noqa
+
+
+PKI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'pki', 'localhost')
+CERT_PATH = os.path.join(PKI_DIR, 'cert.pem')
+KEY_PATH = os.path.join(PKI_DIR, 'key.pem')
+
+
+class SSLContextTests(base.NectarTests):
+
+    def setUp(self):
+        super(SSLContextTests, self).setUp()
+        tls.clear_ssl_contexts()
+
+    def tearDown(self):
+        super(SSLContextTests, self).tearDown()
+        tls.clear_ssl_contexts()
+
+    def test_fingerprint_by_contents(self):
+        with open(CERT_PATH) as f:
+            pem = f.read()
+        # each config writes the certificate to its own temporary file
+        config = DownloaderConfig(ssl_ca_cert=pem)
+        other_config = DownloaderConfig(ssl_ca_cert=pem)
+
+        self.assertNotEqual(config.ssl_ca_cert_path, other_config.ssl_ca_cert_path)
+        self.assertEqual(tls.ssl_fingerprint(config), tls.ssl_fingerprint(other_config))
+
+    def test_fingerprint_differs(self):
+        fingerprints = set([
+            tls.ssl_fingerprint(DownloaderConfig()),
+            tls.ssl_fingerprint(DownloaderConfig(ssl_validation=False)),
+            tls.ssl_fingerprint(DownloaderConfig(ssl_ca_cert_path=CERT_PATH)),
+            tls.ssl_fingerprint(DownloaderConfig(ssl_client_cert_path=CERT_PATH,
+                                                 ssl_client_key_path=KEY_PATH)),
+        ])
+
+        self.assertEqual(len(fingerprints), 4)
+
+    def test_context_shared(self):
+        config = DownloaderConfig(ssl_ca_cert_path=CERT_PATH)
+
+        with mock.patch.object(tls, '_build_ssl_context',
+                               wraps=tls._build_ssl_context) as mock_build:
+            context = tls.get_ssl_context(config)
+            other_context = tls.get_ssl_context(DownloaderConfig(ssl_ca_cert_path=CERT_PATH))
+
+        self.assertTrue(context is other_context)
+        self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(context.ca_path, CERT_PATH)
+
+    def test_context_without_validation(self):
+        context = tls.get_ssl_context(DownloaderConfig(ssl_validation=False))
+
+        self.assertEqual(context.ca_path, None)
+        self.assertEqual(context.verify_mode, tls.ssl.CERT_NONE)
+
+    def test_cert_verify_uses_context(self):
+        config = DownloaderConfig(ssl_ca_cert_path=CERT_PATH, ssl_client_cert_path=CERT_PATH,
+                                  ssl_client_key_path=KEY_PATH)
+        adapter = tls.SSLContextAdapter(tls.get_ssl_context(config))
+        conn = mock.MagicMock()
+
+        adapter.cert_verify(conn, 'https://localhost/', CERT_PATH, (CERT_PATH, KEY_PATH))
+
+        self.assertEqual(conn.cert_reqs, 'CERT_REQUIRED')
+        self.assertEqual(conn.ca_certs, None)
+        self.assertEqual(conn.cert_file, None)
+
+    def test_cert_verify_mismatch(self):
+        adapter = tls.SSLContextAdapter(tls.get_ssl_context(DownloaderConfig(ssl_validation=False)))
+
+        self.assertRaises(tls.SSLContextMismatch, adapter.cert_verify, mock.MagicMock(),
+                          'https://localhost/', True, None)
+
+
+class HTTPSDownloadTests(base.NectarTests):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http_static_test_server.HTTPStaticTestServer(port=8443, certfile=CERT_PATH,
+                                                                  keyfile=KEY_PATH)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super(HTTPSDownloadTests, self).setUp()
+        tls.clear_ssl_contexts()
+
+    def _download(self, config):
+        downloader = HTTPThreadedDownloader(config, tries=1)
+        url = 'https://localhost:8443/' + os.path.relpath(CERT_PATH)
+
+        return downloader.download_one(DownloadRequest(url, os.devnull))
+
+    def test_download(self):
+        config = DownloaderConfig(ssl_ca_cert_path=CERT_PATH)
+
+        calls = []
+
+        def load_verify_locations(context, *args, **kwargs):
+            calls.append(args)
+            return tls.ssl.SSLContext.load_verify_locations(context, *args, **kwargs)
+
+        with mock.patch.object(tls.SharedSSLContext, 'load_verify_locations',
+                               load_verify_locations):
+            for i in range(3):
+                report = self._download(config)
+                self.assertEqual(report.state, report.DOWNLOAD_SUCCEEDED, report.error_msg)
+
+        # the CA bundle is loaded once, not for each connection
+        self.assertEqual(len(calls), 1)
+
+    def test_untrusted(self):
+        report = self._download(DownloaderConfig())
+
+        self.assertEqual(report.state, report.DOWNLOAD_FAILED)
+
+    def test_invalid_client_cert(self):
+        bogus_dir = os.path.join(os.path.dirname(PKI_DIR), 'bogus')
+        config = DownloaderConfig(ssl_ca_cert_path=CERT_PATH,
+                                  ssl_client_cert_path=os.path.join(bogus_dir, 'cert.pem'),
+                                  ssl_client_key_path=os.path.join(bogus_dir, 'key.pem'))
+
+        report = self._download(config)
+
+        self.assertEqual(report.state, report.DOWNLOAD_FAILED)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+import base
+from nectar import walk
+from nectar.config import DownloaderConfig
+from nectar.downloaders.local import LocalFileDownloader
+from nectar.listener import AggregatingEventListener
+
+
+class IterFileRequestsTests(base.NectarTests):
+
+    def setUp(self):
+        super(IterFileRequestsTests, self).setUp()
+        self.src_dir = tempfile.mkdtemp(prefix='nectar-walk-testing-')
+        self.dest_dir = tempfile.mkdtemp(prefix='nectar-walk-testing-')
+        self.files = {
+            'a.rpm': 10,
+            'b.txt': 20,
+            'repodata/repomd.xml': 30,
+            'repodata/primary.xml.gz': 40,
+            'sub/dir/c.rpm': 50,
+        }
+        for relative_path, size in self.files.items():
+            path = os.path.join(self.src_dir, relative_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write('x' * size)
+        os.makedirs(os.path.join(self.src_dir, 'empty'))
+
+    def tearDown(self):
+        super(IterFileRequestsTests, self).tearDown()
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.dest_dir)
+
+    def _relative_paths(self, requests):
+        return [os.path.relpath(r.destination, self.dest_dir) for r in requests]
+
+    def test_all_files(self):
+        requests = list(walk.iter_file_requests('file://' + self.src_dir, self.dest_dir))
+
+        self.assertEqual(self._relative_paths(requests),
+                         ['a.rpm', 'b.txt', 'repodata/primary.xml.gz', 'repodata/repomd.xml',
+                          'sub/dir/c.rpm'])
+        for request in requests:
+            relative_path = os.path.relpath(request.destination, self.dest_dir)
+            self.assertEqual(request.url, 'file://' + os.path.join(self.src_dir, relative_path))
+            self.assertEqual(request.size, self.files[relative_path])
+
+    def test_lazy(self):
+        requests = walk.iter_file_requests(self.src_dir, self.dest_dir)
+
+        self.assertEqual(os.listdir(self.dest_dir), [])
+        next(requests)
+        # the directories of the later requests haven't been made yet
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+    def test_destination_directories_made(self):
+        for request in walk.iter_file_requests(self.src_dir, self.dest_dir):
+            self.assertTrue(os.path.isdir(os.path.dirname(request.destination)))
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, 'empty')))
+
+    def test_patterns(self):
+        requests = walk.iter_file_requests(self.src_dir, self.dest_dir,
+                                           patterns=['*.rpm', 'repodata/*.xml'])
+
+        self.assertEqual(self._relative_paths(requests),
+                         ['a.rpm', 'repodata/repomd.xml', 'sub/dir/c.rpm'])
+
+    def test_size(self):
+        requests = walk.iter_file_requests(self.src_dir, self.dest_dir, min_size=20, max_size=40)
+
+        self.assertEqual(self._relative_paths(requests),
+                         ['b.txt', 'repodata/primary.xml.gz', 'repodata/repomd.xml'])
+
+    def test_mtime(self):
+        now = time.time()
+        os.utime(os.path.join(self.src_dir, 'b.txt'), (now - 3600, now - 3600))
+
+        newer = walk.iter_file_requests(self.src_dir, self.dest_dir, newer_than=now - 60)
+        older = walk.iter_file_requests(self.src_dir, self.dest_dir, older_than=now - 60)
+
+        self.assertFalse('b.txt' in self._relative_paths(newer))
+        self.assertEqual(self._relative_paths(older), ['b.txt'])
+
+    def test_symlinked_directories_not_followed(self):
+        os.symlink(self.src_dir, os.path.join(self.src_dir, 'loop'))
+        os.symlink(os.path.join(self.src_dir, 'a.rpm'), os.path.join(self.src_dir, 'link.rpm'))
+
+        paths = self._relative_paths(walk.iter_file_requests(self.src_dir, self.dest_dir))
+
+        self.assertTrue('link.rpm' in paths)
+        self.assertFalse(any(p.startswith('loop') for p in paths))
+
+    def test_without_scandir(self):
+        os.symlink(os.path.join(self.src_dir, 'a.rpm'), os.path.join(self.src_dir, 'link.rpm'))
+        os.symlink(self.src_dir, os.path.join(self.src_dir, 'loop'))
+
+        with mock.patch.object(walk, 'scandir', None):
+            requests = list(walk.iter_file_requests(self.src_dir, self.dest_dir))
+
+        self.assertEqual(self._relative_paths(requests),
+                         ['a.rpm', 'b.txt', 'link.rpm', 'repodata/primary.xml.gz',
+                          'repodata/repomd.xml', 'sub/dir/c.rpm'])
+        self.assertEqual(requests[2].size, 10)
+
+    def test_unsupported_scheme(self):
+        requests = walk.iter_file_requests('http://example.com/', self.dest_dir)
+
+        self.assertRaises(ValueError, list, requests)
+
+    def test_download(self):
+        listener = AggregatingEventListener()
+        downloader = LocalFileDownloader(DownloaderConfig(), listener)
+
+        downloader.download(walk.iter_file_requests(self.src_dir, self.dest_dir))
+
+        self.assertEqual(len(listener.succeeded_reports), len(self.files))
+        for report in listener.succeeded_reports:
+            relative_path = os.path.relpath(report.destination, self.dest_dir)
+            self.assertEqual(report.total_bytes, self.files[relative_path])
+            self.assertEqual(os.path.getsize(report.destination), self.files[relative_path])
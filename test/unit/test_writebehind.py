@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from cStringIO import StringIO
+
+import mock
+
+import base
+from nectar import writebehind
+
+
+class SlowFile(object):
+    """
+    File-like object that takes its time writing, and can be held up.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.chunks = []
+        self.threads = set()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, data):
+        self.gate.wait(5)
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread().ident)
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+
+class WriteBehindTests(base.NectarTests):
+
+    def test_written_in_order(self):
+        write_behind = writebehind.WriteBehind(2)
+        destinations = [SlowFile(), SlowFile(), SlowFile()]
+        writers = [write_behind.writer(d) for d in destinations]
+
+        for i in range(100):
+            for writer in writers:
+                writer.write(str(i))
+        for writer in writers:
+            writer.drain()
+
+        for destination in destinations:
+            self.assertEqual(destination.chunks, [str(i) for i in range(100)])
+            # a file's chunks are written by a single thread
+            self.assertEqual(len(destination.threads), 1)
+        self.assertEqual(write_behind.queued, 0)
+
+    def test_not_written_by_the_caller(self):
+        write_behind = writebehind.WriteBehind(1)
+        destination = SlowFile()
+        destination.gate.clear()
+        writer = write_behind.writer(destination)
+
+        writer.write('data')
+
+        self.assertEqual(destination.chunks, [])
+        self.assertEqual(write_behind.queued, 4)
+        destination.gate.set()
+        writer.flush()
+        self.assertEqual(destination.chunks, ['data'])
+        self.assertFalse(threading.current_thread().ident in destination.threads)
+
+    def test_budget(self):
+        write_behind = writebehind.WriteBehind(1, budget=10)
+        destination = SlowFile(delay=0.05)
+        writer = write_behind.writer(destination)
+
+        for i in range(5):
+            writer.write('x' * 6)
+            self.assertTrue(write_behind.queued <= 10)
+        writer.drain()
+
+        self.assertEqual(''.join(destination.chunks), 'x' * 30)
+        self.assertTrue(writer.stall_time > 0)
+        self.assertTrue(write_behind.stall_time >= writer.stall_time)
+
+    def test_chunk_larger_than_budget(self):
+        write_behind = writebehind.WriteBehind(1, budget=10)
+        destination = StringIO()
+        writer = write_behind.writer(destination)
+
+        writer.write('x' * 100)
+        writer.drain()
+
+        self.assertEqual(destination.getvalue(), 'x' * 100)
+
+    def test_error_raised_by_next_call(self):
+        write_behind = writebehind.WriteBehind(1)
+        destination = mock.Mock()
+        destination.write.side_effect = IOError('disk full')
+        writer = write_behind.writer(destination)
+
+        writer.write('data')
+
+        self.assertRaises(IOError, writer.drain)
+        self.assertRaises(IOError, writer.write, 'more')
+        self.assertEqual(destination.write.call_count, 1)
+        self.assertEqual(write_behind.queued, 0)
+
+    def test_discard(self):
+        write_behind = writebehind.WriteBehind(1)
+        destination = SlowFile()
+        destination.gate.clear()
+        writer = write_behind.writer(destination)
+        writer.write('first')
+        writer.write('second')
+
+        threading.Timer(0.1, destination.gate.set).start()
+        writer.discard()
+
+        # the write in progress, at most
+        self.assertTrue(destination.chunks in ([], ['first']))
+        self.assertEqual(write_behind.queued, 0)
+
+    @mock.patch.object(writebehind, 'IDLE_TIMEOUT', 0.05)
+    def test_idle_threads_exit(self):
+        write_behind = writebehind.WriteBehind(1)
+        destination = StringIO()
+        writer = write_behind.writer(destination)
+        writer.write('a')
+        writer.drain()
+        time.sleep(0.2)
+        self.assertTrue(write_behind._lanes[0]._thread is None)
+
+        # started again
+        writer.write('b')
+        writer.drain()
+
+        self.assertEqual(destination.getvalue(), 'ab')
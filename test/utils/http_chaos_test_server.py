@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP test server that injects faults into the responses it serves, for
+exercising the error and retry paths of the downloaders.
+"""
+
+import atexit
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+FAULT_RESET = 'reset'  # connection reset part way through the body
+FAULT_SLOW = 'slow'  # body dripped out in small pieces
+FAULT_TOO_MANY_REQUESTS = '429'  # 429 response with a Retry-After header
+FAULT_UNAVAILABLE = '503'  # 503 response with a Retry-After header
+FAULT_TRUNCATE = 'truncate'  # connection closed cleanly part way through the body
+FAULT_STALL = 'stall'  # headers sent, then nothing for stall_time seconds
+FAULT_HANG = 'hang'  # nothing sent for stall_time seconds, then the response
+FAULT_CORRUPT = 'corrupt'  # a byte of the body flipped
+
+FAULTS = (FAULT_RESET, FAULT_SLOW, FAULT_TOO_MANY_REQUESTS, FAULT_UNAVAILABLE, FAULT_TRUNCATE,
+          FAULT_STALL, FAULT_HANG, FAULT_CORRUPT)
+
+
+class ThreadingHTTPServerIPV6(ThreadingMixIn, HTTPServer):
+    address_family = socket.AF_INET6
+    daemon_threads = True
+
+
+class ChaosRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file request handler that, for each GET, draws a fault from the
+    owning server's fault profile and injects it into the response.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        chaos = self.server.chaos
+        fault = chaos.draw_fault(self.path)
+
+        if fault == FAULT_HANG:
+            time.sleep(chaos.stall_time)
+            fault = None
+
+        if fault in (FAULT_TOO_MANY_REQUESTS, FAULT_UNAVAILABLE):
+            self.send_response(int(fault))
+            self.send_header('Retry-After', str(chaos.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        path = self.translate_path(self.path)
+        if fault is None or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        with open(path, 'rb') as file_handle:
+            body = file_handle.read()
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if fault == FAULT_STALL:
+            self.wfile.flush()
+            time.sleep(chaos.stall_time)
+            self.wfile.write(body)
+
+        elif fault == FAULT_SLOW:
+            for offset in xrange(0, len(body), chaos.drip_size):
+                self.wfile.write(body[offset:offset + chaos.drip_size])
+                self.wfile.flush()
+                time.sleep(chaos.drip_interval)
+
+        elif fault == FAULT_TRUNCATE:
+            self.wfile.write(body[:len(body) / 2])
+            self.wfile.flush()
+            self.close_connection = 1
+
+        elif fault == FAULT_RESET:
+            self.wfile.write(body[:len(body) / 2])
+            self.wfile.flush()
+            # give the client the time to read what was sent, which a reset
+            # would otherwise throw away
+            time.sleep(0.1)
+            # a zero linger time makes close() send an RST instead of a FIN;
+            # the socket is closed here, before the server shuts it down with
+            # a FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.connection.close()
+            self.close_connection = 1
+
+        elif fault == FAULT_CORRUPT:
+            middle = len(body) / 2
+            self.wfile.write(body[:middle] + chr(ord(body[middle]) ^ 0xff) + body[middle + 1:])
+
+
+class HTTPChaosTestServer(object):
+    """
+    Test server that serves files from the local directory and sub-directories,
+    just like the static test server, but injects faults into a configurable
+    fraction of the responses.
+
+    The fault profile is a dictionary mapping fault names (see FAULTS) to the
+    rate, between 0 and 1, at which that fault is injected. A single fault is
+    drawn for each request; the rates should therefore sum to at most 1. The
+    profile can be changed between tests by assigning to the ``faults``
+    attribute.
+
+    Requests are handled in their own threads so that a slow or stalled response
+    does not hold up the others.
+
+    :ivar counts: dictionary of fault name to the number of times it was injected
+    :ivar requests: total number of GET requests handled
+    """
+
+    def __init__(self, port=8089, faults=None, seed=None, retry_after=1, drip_size=1024,
+                 drip_interval=0.01, stall_time=5):
+        """
+        :param port:          port to listen on
+        :type  port:          int
+        :param faults:        fault profile, fault name -> rate
+        :type  faults:        dict
+        :param seed:          seed for the random fault draws, for reproducible runs
+        :type  seed:          int
+        :param retry_after:   value of the Retry-After header sent with 429 and 503 responses
+        :type  retry_after:   int
+        :param drip_size:     number of bytes sent at a time by slow responses
+        :type  drip_size:     int
+        :param drip_interval: number of seconds between the pieces of slow responses
+        :type  drip_interval: float
+        :param stall_time:    number of seconds stalled responses wait before sending the body
+        :type  stall_time:    float
+        """
+        self.faults = faults or {}
+        self.retry_after = retry_after
+        self.drip_size = drip_size
+        self.drip_interval = drip_interval
+        self.stall_time = stall_time
+
+        self.counts = dict((f, 0) for f in FAULTS)
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.server = ThreadingHTTPServerIPV6(('', port), ChaosRequestHandler)
+        self.server.timeout = 0.1  # timeout after a tenth of a second
+        self.server.chaos = self
+        self._is_running = False
+        self._server_thread = None
+        _SERVERS.append(self)
+
+    def draw_fault(self, path):
+        """
+        Pick the fault, if any, to inject into the response for the given path.
+
+        :param path: path of the request
+        :type  path: str
+        :return: name of the fault to inject or None
+        :rtype:  str or None
+        """
+        with self._lock:
+            self.requests += 1
+            draw = self._random.random()
+            for fault in FAULTS:
+                rate = self.faults.get(fault, 0)
+                if draw < rate:
+                    self.counts[fault] += 1
+                    return fault
+                draw -= rate
+            return None
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = dict((f, 0) for f in FAULTS)
+            self.requests = 0
+
+    def _serve(self):
+        while self._is_running:
+            self.server.handle_request()
+
+    def start(self):
+        self._is_running = True
+        self._server_thread = threading.Thread(target=self._serve)
+        self._server_thread.setDaemon(True)
+        self._server_thread.start()
+
+    def stop(self):
+        self._is_running = False
+        # the server may have been created and never started, or already stopped
+        if self._server_thread is not None:
+            self._server_thread.join()
+            self._server_thread = None
+        if self in _SERVERS:
+            self.server.server_close()
+            _SERVERS.remove(self)
+
+
+_SERVERS = []
+
+
+def _cleanup_servers():
+    """
+    Cleanup all of the running server in case we were ctrl+c'd
+    """
+    for server in _SERVERS[:]:
+        server.stop()
+
+
+atexit.register(_cleanup_servers)
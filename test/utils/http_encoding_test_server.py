@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP test server that sends the files it serves gzip content-encoded to the
+clients that accept it, for exercising transfer compression.
+"""
+
+import gzip
+import os
+from cStringIO import StringIO
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from http_static_test_server import HTTPStaticTestServer
+
+
+class EncodingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file request handler that gzips the body of the responses to the
+    requests that accept the gzip content coding.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        accept_encoding = self.headers.get('Accept-Encoding')
+        self.server.accept_encodings.append(accept_encoding)
+        path = self.translate_path(self.path)
+        codings = [c.strip() for c in (accept_encoding or '').split(',')]
+        if 'gzip' not in codings or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        with open(path, 'rb') as file_handle:
+            gzip_file.write(file_handle.read())
+        gzip_file.close()
+        body = buf.getvalue()
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPEncodingTestServer(HTTPStaticTestServer):
+    """
+    Static test server that gzips the responses to the requests that accept it.
+
+    :ivar accept_encodings: the Accept-Encoding header of each request, or None
+    """
+
+    def __init__(self, port=8094):
+        super(HTTPEncodingTestServer, self).__init__(port)
+        self.server.RequestHandlerClass = EncodingRequestHandler
+        self.server.accept_encodings = self.accept_encodings = []
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP test server that honors Range requests, single and multiple, for
+exercising delta updates.
+"""
+
+import os
+import re
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from http_static_test_server import HTTPStaticTestServer
+
+
+BOUNDARY = 'NECTAR_BYTERANGES'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file request handler that answers Range requests with a 206
+    response, multipart/byteranges if several ranges are asked for.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        ranges = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if ranges is None or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        with open(path, 'rb') as file_handle:
+            body = file_handle.read()
+        spans = [(int(start), int(end)) for start, end in re.findall(r'(\d+)-(\d+)', ranges)]
+        self.server.ranges.append(spans)
+
+        self.send_response(206)
+        if len(spans) == 1:
+            start, end = spans[0]
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(body[start:end + 1])
+            return
+
+        parts = []
+        for start, end in spans:
+            parts.append('\r\n--%s\r\nContent-Type: application/octet-stream\r\n'
+                         'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                         % (BOUNDARY, start, end, len(body)))
+            parts.append(body[start:end + 1])
+        parts.append('\r\n--%s--\r\n' % BOUNDARY)
+        multipart = ''.join(parts)
+        self.send_header('Content-Type', 'multipart/byteranges; boundary=%s' % BOUNDARY)
+        self.send_header('Content-Length', str(len(multipart)))
+        self.end_headers()
+        self.wfile.write(multipart)
+
+
+class HTTPRangeTestServer(HTTPStaticTestServer):
+    """
+    Static test server that honors Range requests.
+
+    :ivar ranges: the ranges of each Range request, as lists of (first, last)
+                  byte offsets
+    """
+
+    def __init__(self, port=8093):
+        super(HTTPRangeTestServer, self).__init__(port)
+        self.server.RequestHandlerClass = RangeRequestHandler
+        self.server.ranges = self.ranges = []
@@ -5,6 +5,7 @@ HTTP test server for writing tests against an "external" server.
 
 import atexit
 import socket
+import ssl
 import threading
 from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
@@ -30,8 +31,19 @@ class HTTPStaticTestServer(object):
     run.
     """
 
-    def __init__(self, port=8088):
+    def __init__(self, port=8088, certfile=None, keyfile=None):
+        """
+        :param port:     port to listen on
+        :type  port:     int
+        :param certfile: path of a certificate to serve HTTPS with, instead of HTTP
+        :type  certfile: str
+        :param keyfile:  path of the certificate's private key
+        :type  keyfile:  str
+        """
         self.server = HTTPServerIPV6(('', port), SimpleHTTPRequestHandler)
+        if certfile is not None:
+            self.server.socket = ssl.wrap_socket(self.server.socket, keyfile, certfile,
+                                                 server_side=True)
         self.server.timeout = 0.1  # timeout after a tenth of a second
         self._is_running = False
         self._server_thread = None